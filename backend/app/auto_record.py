@@ -0,0 +1,348 @@
+"""
+自動録音ルール
+
+キーワード・出演者・放送局・曜日・時間帯の条件を保存しておき、番組表の更新で
+追加・変更された番組だけを照合して、一致した番組をダウンロードキューに登録する。
+
+- programs テーブルのトリガーが program_changes に変更を記録し、スキャナーは
+  前回以降の変更だけを読む(7日分の番組表を毎回全件なめない)。
+- ルールのキーワードと出演者は先頭2文字の索引にまとめておき、番組1件あたりの照合は
+  ルールの数ではなく番組の文字数に比例する。
+- 同じ番組はアカウントごとに1回だけ登録する(auto_record_matches)。複数の
+  アカウントのルールに一致した番組は1つのジョブを共有し、どのアカウントにも
+  ジョブのイベントが届く。
+"""
+
+import sqlite3
+import threading
+import unicodedata
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .database import get_db_connection
+from .job_queue import submit_job
+from .metrics import sqlite_lock_wait
+from .program_index import TIME_FORMAT, TIMEFREE_DAYS
+from .radiko import JST
+
+SCAN_INTERVAL = 300  # レコーダーが番組表の変更を照合する間隔(秒)
+SCAN_BATCH_SIZE = 2000  # 1トランザクションで照合する変更の件数
+# タイムフリーで聴けるようになるまでの放送終了後の待ち時間(秒)
+TIMEFREE_DELAY = 10 * 60
+ALL_WEEKDAYS = 0b1111111  # ビット0が月曜
+
+
+def normalize(text: Optional[str]) -> str:
+    """全角・半角や大文字・小文字の違いを無視して照合するための正規化"""
+    return unicodedata.normalize("NFKC", text or "").casefold()
+
+
+def _minutes(hhmm: Optional[str]) -> Optional[int]:
+    if not hhmm:
+        return None
+    hours, minutes = hhmm.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+@dataclass(frozen=True)
+class Rule:
+    id: int
+    account: str
+    keyword: str  # 正規化済み。空なら条件なし
+    performer: str
+    station_id: Optional[str]
+    weekdays: int
+    start_after: Optional[int]  # 0時からの分
+    start_before: Optional[int]
+
+    @classmethod
+    def from_row(cls, row) -> "Rule":
+        return cls(
+            id=row["id"],
+            account=row["account"],
+            keyword=normalize(row["keyword"]),
+            performer=normalize(row["performer"]),
+            station_id=row["station_id"] or None,
+            weekdays=row["weekdays"],
+            start_after=_minutes(row["start_after"]),
+            start_before=_minutes(row["start_before"]),
+        )
+
+    def accepts_time(self, station_id: str, start: datetime) -> bool:
+        if self.station_id and self.station_id != station_id:
+            return False
+        # 曜日はRadikoの放送日(5時始まり)で数える。深夜番組は前日の曜日になる
+        if not self.weekdays & (1 << (start - timedelta(hours=5)).weekday()):
+            return False
+        minute = start.hour * 60 + start.minute
+        after, before = self.start_after, self.start_before
+        if after is not None and before is not None and after > before:
+            # 23:00〜02:00 のように日付をまたぐ時間帯
+            return minute >= after or minute < before
+        if after is not None and minute < after:
+            return False
+        if before is not None and minute >= before:
+            return False
+        return True
+
+
+class TermIndex:
+    """語の先頭2文字(1文字の語は1文字)から語を引く索引"""
+
+    def __init__(self, terms: Iterable[str]):
+        self._by_prefix: Dict[str, List[str]] = {}
+        for term in set(terms):
+            self._by_prefix.setdefault(term[:2], []).append(term)
+        self._prefix_lengths = sorted({len(prefix) for prefix in self._by_prefix})
+
+    def find(self, text: str) -> Set[str]:
+        """text に含まれる語をすべて返す"""
+        found: Set[str] = set()
+        if not self._by_prefix:
+            return found
+        by_prefix = self._by_prefix
+        for i in range(len(text)):
+            for length in self._prefix_lengths:
+                candidates = by_prefix.get(text[i : i + length])
+                if candidates:
+                    for term in candidates:
+                        if text.startswith(term, i):
+                            found.add(term)
+        return found
+
+
+class RuleMatcher:
+    """有効なルールをまとめて照合できる形にしたもの"""
+
+    def __init__(self, rules: Iterable[Rule]):
+        self.rules = list(rules)
+        self._by_keyword: Dict[str, List[Rule]] = {}
+        self._by_performer: Dict[str, List[Rule]] = {}
+        self._unindexed: List[Rule] = []
+        for rule in self.rules:
+            # キーワードと出演者の両方がある場合はキーワードで引いて出演者を確かめる
+            if rule.keyword:
+                self._by_keyword.setdefault(rule.keyword, []).append(rule)
+            elif rule.performer:
+                self._by_performer.setdefault(rule.performer, []).append(rule)
+            else:
+                self._unindexed.append(rule)
+        self._keywords = TermIndex(self._by_keyword)
+        self._performers = TermIndex(self._by_performer)
+
+    def match(self, program) -> List[Rule]:
+        """番組(programsの行)に一致するルールを返す"""
+        start = datetime.strptime(program["start_time"], TIME_FORMAT)
+        text = normalize(f"{program['title']}\n{program['description'] or ''}")
+        performers = normalize(program["pfm"])
+        candidates = list(self._unindexed)
+        for keyword in self._keywords.find(text):
+            candidates.extend(
+                rule
+                for rule in self._by_keyword[keyword]
+                if not rule.performer or rule.performer in performers
+            )
+        for performer in self._performers.find(performers):
+            candidates.extend(self._by_performer[performer])
+        return [
+            rule
+            for rule in candidates
+            if rule.accepts_time(program["station_id"], start)
+        ]
+
+
+_matcher_lock = threading.Lock()
+_matcher_cache: Tuple[tuple, Optional[RuleMatcher]] = ((), None)
+
+
+def load_matcher(conn: sqlite3.Connection) -> RuleMatcher:
+    """有効なルールの照合器を返す。ルールが変わっていなければ作り直さない"""
+    global _matcher_cache
+    rows = conn.execute(
+        "SELECT id, account, keyword, performer, station_id, weekdays, "
+        "start_after, start_before FROM auto_record_rules "
+        "WHERE enabled = 1 ORDER BY id"
+    ).fetchall()
+    key = tuple(tuple(row) for row in rows)
+    with _matcher_lock:
+        cached_key, matcher = _matcher_cache
+        if matcher is None or cached_key != key:
+            matcher = RuleMatcher(Rule.from_row(row) for row in rows)
+            _matcher_cache = (key, matcher)
+        return matcher
+
+
+def enqueue_matches(
+    conn: sqlite3.Connection,
+    matcher: RuleMatcher,
+    programs: Iterable[sqlite3.Row],
+    now: Optional[datetime] = None,
+) -> List[str]:
+    """一致した番組をキューに登録し、ジョブIDを返す(コミットは呼び出し側)"""
+    now = now or datetime.now(JST)
+    oldest = (now - timedelta(days=TIMEFREE_DAYS)).strftime(TIME_FORMAT)
+    job_ids = []
+    for program in programs:
+        # タイムフリーで聴けなくなった番組は対象外
+        if program["start_time"] < oldest:
+            continue
+        # アカウントごとに最初に一致したルールで登録する
+        rules_by_account: Dict[str, Rule] = {}
+        for rule in matcher.match(program):
+            rules_by_account.setdefault(rule.account, rule)
+        for account, rule in rules_by_account.items():
+            matched = conn.execute(
+                "SELECT 1 FROM auto_record_matches "
+                "WHERE account = ? AND station_id = ? AND start_time = ?",
+                (account, program["station_id"], program["start_time"]),
+            ).fetchone()
+            if matched:
+                continue  # このアカウントで登録済みの番組
+            end = JST.localize(datetime.strptime(program["end_time"], TIME_FORMAT))
+            # 予約済みの番組(他のアカウントの予約を含む)なら、そのジョブが返る
+            submission = submit_job(
+                conn,
+                program["station_id"],
+                program["station_name"] or program["station_id"],
+                program["title"],
+                program["start_time"],
+                program["end_time"],
+                radiko_token=None,
+                account=account,
+                not_before=end.timestamp() + TIMEFREE_DELAY,
+            )
+            conn.execute(
+                "INSERT INTO auto_record_matches "
+                "(account, station_id, start_time, rule_id, job_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    account,
+                    program["station_id"],
+                    program["start_time"],
+                    rule.id,
+                    submission.job_id,
+                ),
+            )
+            if submission.created:
+                job_ids.append(submission.job_id)
+    return job_ids
+
+
+def scan_program_changes(
+    batch_size: int = SCAN_BATCH_SIZE, now: Optional[datetime] = None
+) -> List[str]:
+    """前回以降に追加・変更された番組をルールと照合し、登録したジョブIDを返す"""
+    conn = get_db_connection()
+    job_ids: List[str] = []
+    try:
+        while True:
+            with sqlite_lock_wait("auto_record"):
+                conn.execute("BEGIN IMMEDIATE")
+            try:
+                changes = conn.execute(
+                    "SELECT MAX(seq) FROM ("
+                    "SELECT seq FROM program_changes ORDER BY seq LIMIT ?)",
+                    (batch_size,),
+                ).fetchone()[0]
+                if changes is None:
+                    conn.rollback()
+                    break
+                matcher = load_matcher(conn)
+                if matcher.rules:
+                    programs = conn.execute(
+                        """
+                        SELECT * FROM programs WHERE id IN (
+                            SELECT program_id FROM program_changes WHERE seq <= ?
+                        )
+                        """,
+                        (changes,),
+                    ).fetchall()
+                    job_ids += enqueue_matches(conn, matcher, programs, now)
+                # 照合済みの変更は消す(削除された番組の変更もここで消える)
+                conn.execute("DELETE FROM program_changes WHERE seq <= ?", (changes,))
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+    finally:
+        conn.close()
+    if job_ids:
+        print(f"自動録音ルールに一致した番組を{len(job_ids)}件登録しました")
+    return job_ids
+
+
+def backfill_rule(rule_id: int, now: Optional[datetime] = None) -> List[str]:
+    """
+    新しく作ったルールを、インデックス済みのタイムフリー期間の番組と照合する。
+    以後は scan_program_changes が変更分だけを照合する。
+    """
+    now = now or datetime.now(JST)
+    oldest = (now - timedelta(days=TIMEFREE_DAYS)).strftime(TIME_FORMAT)
+    conn = get_db_connection()
+    try:
+        row = conn.execute(
+            "SELECT * FROM auto_record_rules WHERE id = ? AND enabled = 1", (rule_id,)
+        ).fetchone()
+        if row is None:
+            return []
+        matcher = RuleMatcher([Rule.from_row(row)])
+        with sqlite_lock_wait("auto_record"):
+            conn.execute("BEGIN IMMEDIATE")
+        try:
+            programs = conn.execute(
+                "SELECT * FROM programs WHERE start_time >= ?", (oldest,)
+            )
+            job_ids = enqueue_matches(conn, matcher, programs, now)
+            conn.commit()
+            return job_ids
+        except BaseException:
+            conn.rollback()
+            raise
+    finally:
+        conn.close()
+
+
+def weekday_mask(weekdays: Optional[Iterable[int]]) -> int:
+    """曜日のリスト(0=月曜)をビットマスクにする。Noneなら毎日"""
+    if weekdays is None:
+        return ALL_WEEKDAYS
+    mask = 0
+    for day in weekdays:
+        mask |= 1 << day
+    return mask
+
+
+def weekday_list(mask: int) -> List[int]:
+    return [day for day in range(7) if mask & (1 << day)]
+
+
+def create_rule(
+    conn: sqlite3.Connection,
+    account: str,
+    name: str,
+    keyword: Optional[str] = None,
+    performer: Optional[str] = None,
+    station_id: Optional[str] = None,
+    weekdays: Optional[Iterable[int]] = None,
+    start_after: Optional[str] = None,
+    start_before: Optional[str] = None,
+) -> int:
+    cursor = conn.execute(
+        """
+        INSERT INTO auto_record_rules
+            (account, name, keyword, performer, station_id, weekdays, start_after, start_before)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            account,
+            name,
+            keyword or None,
+            performer or None,
+            station_id or None,
+            weekday_mask(weekdays),
+            start_after,
+            start_before,
+        ),
+    )
+    return cursor.lastrowid
@@ -0,0 +1,64 @@
+"""
+ダウンロードのチェックポイント
+
+download_hls がセグメントを書くたびに、書き込み済みのセグメント数とバイト数を
+download_checkpoints テーブルに記録する。再起動や再試行で同じジョブを実行すると、
+記録した位置から続きだけを取得する。記録はまとめ書きなので、クラッシュ時は
+少し前の位置に戻ることがあるが、その分のセグメントを取り直すだけで済む。
+"""
+
+import os
+import time
+from typing import Optional
+
+from .database import get_db_connection, status_writer
+from .downloader import Checkpoint
+
+
+class JobCheckpoint:
+    """ジョブごとのチェックポイントの保存先(downloader.CheckpointStore)"""
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+
+    def load(self) -> Optional[Checkpoint]:
+        # 同じプロセス内の再試行では直前の記録まで反映させてから読む
+        status_writer.flush()
+        conn = get_db_connection()
+        try:
+            row = conn.execute(
+                "SELECT segments_done, total_segments, bytes_written, media_seconds "
+                "FROM download_checkpoints WHERE job_id = ?",
+                (self.job_id,),
+            ).fetchone()
+        finally:
+            conn.close()
+        return Checkpoint(*row) if row else None
+
+    def save(self, checkpoint: Checkpoint):
+        status_writer.submit(
+            """
+            INSERT INTO download_checkpoints
+                (job_id, segments_done, total_segments, bytes_written, media_seconds, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (job_id) DO UPDATE SET
+                segments_done = excluded.segments_done,
+                total_segments = excluded.total_segments,
+                bytes_written = excluded.bytes_written,
+                media_seconds = excluded.media_seconds,
+                updated_at = excluded.updated_at
+            """,
+            (self.job_id, *checkpoint, time.time()),
+        )
+
+    def clear(self):
+        status_writer.submit(
+            "DELETE FROM download_checkpoints WHERE job_id = ?", (self.job_id,)
+        )
+
+    def discard(self, output_path: str):
+        """再開しないことが決まったジョブの記録と書きかけのファイルを消す"""
+        self.clear()
+        part_path = output_path + ".part"
+        if os.path.exists(part_path):
+            os.remove(part_path)
@@ -1,35 +1,200 @@
+import atexit
 import os
+import queue
 import sqlite3
+import threading
+import time
+
+from .metrics import sqlite_lock_wait
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # 環境変数でデータベースパスを制御（テスト用）
 DATABASE = os.getenv("DATABASE_PATH", os.path.join(BASE_DIR, "r_downloader.db"))
 
+BUSY_TIMEOUT = 5.0  # ロック待ちの上限(秒)
+CACHED_STATEMENTS = 256  # 接続ごとにキャッシュするプリペアドステートメント数
+MAX_IDLE_CONNECTIONS = 4  # スレッドごとに保持しておく空き接続数
+WRITE_BATCH_INTERVAL = 0.2  # まとめ書きの待ち時間(秒)
+WRITE_BATCH_SIZE = 500  # まとめ書き1回あたりの最大件数
+WRITE_RETRIES = 5  # ロック待ちでまとめ書きに失敗したときの再試行回数
+WRITE_RETRY_DELAY = 0.1  # 最初の再試行までの待ち時間(秒)。再試行ごとに倍にする
 
-def get_db_connection():
-    """データベースへの接続を取得する"""
-    conn = sqlite3.connect(DATABASE)
+_local = threading.local()
+
+
+class PooledConnection(sqlite3.Connection):
+    """close() で閉じずに、同じスレッドの次の get_db_connection() で再利用される接続"""
+
+    def close(self):
+        if self.in_transaction:
+            # コミットされなかった変更は次の利用者に持ち越さない
+            self.rollback()
+        idle = _idle_connections(self.path)
+        if self.pid == os.getpid() and len(idle) < MAX_IDLE_CONNECTIONS:
+            idle.append(self)
+        else:
+            super().close()
+
+
+def _idle_connections(path: str) -> list:
+    pools = getattr(_local, "pools", None)
+    if pools is None:
+        pools = _local.pools = {}
+    return pools.setdefault(path, [])
+
+
+def _connect(path: str) -> PooledConnection:
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT,
+        cached_statements=CACHED_STATEMENTS,
+        factory=PooledConnection,
+    )
     conn.row_factory = sqlite3.Row
+    conn.path = path
+    conn.pid = os.getpid()
+    # WALなら読み取りと書き込みが互いを待たない。WALでは NORMAL でも壊れない
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {int(BUSY_TIMEOUT * 1000)}")
     return conn
 
 
+def _checkout(path: str) -> PooledConnection:
+    idle = _idle_connections(path)
+    while idle:
+        conn = idle.pop()
+        # fork前の接続は子プロセスで使わない
+        if conn.pid == os.getpid():
+            return conn
+    return _connect(path)
+
+
+def get_db_connection():
+    """データベースへの接続を取得する。close() すると同じスレッドで再利用される"""
+    return _checkout(DATABASE)
+
+
+class WriteBatcher:
+    """
+    頻度の高い小さな更新(ジョブの状態など)を専用スレッドでまとめて書き込む。
+    呼び出し側はロック待ちで止まらず、書き込みは1トランザクションにまとまる。
+    同じバッチャーに投入した更新は投入順に反映される。
+    """
+
+    def __init__(
+        self,
+        interval: float = WRITE_BATCH_INTERVAL,
+        max_batch: int = WRITE_BATCH_SIZE,
+    ):
+        self.interval = interval
+        self.max_batch = max_batch
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, sql: str, params=()):
+        self._queue.put((DATABASE, sql, params))
+        self._ensure_thread()
+
+    def flush(self):
+        """投入済みの更新がすべて書き込まれるまで待つ"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="db-write-batcher", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch):
+        # テストなどでデータベースが切り替わっても、投入時点のパスに書く
+        for path in dict.fromkeys(item[0] for item in batch):
+            items = [
+                (sql, params) for item_path, sql, params in batch if item_path == path
+            ]
+            try:
+                _execute_with_retry(path, items)
+            except sqlite3.Error as e:
+                if _is_locked(e):
+                    print(f"ロック待ちでまとめ書きに失敗しました ({len(items)}件): {e}")
+                    continue
+                # 1件の不正な更新のためにバッチ全体を捨てず、1件ずつ書き直す
+                print(f"まとめ書きに失敗したので1件ずつ書き込みます: {e}")
+                for sql, params in items:
+                    try:
+                        _execute_with_retry(path, [(sql, params)])
+                    except sqlite3.Error as e:
+                        print(f"まとめ書きの更新を書き込めませんでした: {e} ({sql})")
+
+
+def _is_locked(error: sqlite3.Error) -> bool:
+    message = str(error)
+    return isinstance(error, sqlite3.OperationalError) and (
+        "locked" in message or "busy" in message
+    )
+
+
+def _execute_with_retry(path: str, items):
+    """itemsを1トランザクションで書き込む。ロック待ちで失敗したら間隔をあけて再試行する"""
+    delay = WRITE_RETRY_DELAY
+    for attempt in range(WRITE_RETRIES + 1):
+        conn = _checkout(path)
+        try:
+            with sqlite_lock_wait("write_batch"):
+                conn.execute("BEGIN IMMEDIATE")
+            with conn:
+                for sql, params in items:
+                    conn.execute(sql, params)
+            return
+        except sqlite3.OperationalError as e:
+            if not _is_locked(e) or attempt == WRITE_RETRIES:
+                raise
+        finally:
+            conn.close()
+        time.sleep(delay)
+        delay *= 2
+
+
+status_writer = WriteBatcher()
+atexit.register(status_writer.flush)
+
+
 def init_db():
     """データベースのテーブルを初期化（作成）する"""
     conn = get_db_connection()
     # ログイン履歴テーブル
-    conn.execute(
-        """
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS login_history (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             login_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             email TEXT NOT NULL,
             status TEXT NOT NULL
         )
-        """
-    )
+        """)
     # ダウンロードログテーブル
-    conn.execute(
-        """
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS download_log (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             job_id TEXT UNIQUE NOT NULL,
@@ -39,7 +204,329 @@ def init_db():
             status TEXT NOT NULL,
             filename TEXT
         )
-        """
+        """)
+    # ダウンロードキュー（download_logと1対1。実行に必要なパラメータと状態を保持）
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS download_queue (
+            job_id TEXT PRIMARY KEY REFERENCES download_log(job_id),
+            station_id TEXT NOT NULL,
+            station_name TEXT NOT NULL,
+            program_title TEXT NOT NULL,
+            start_time TEXT NOT NULL,
+            end_time TEXT NOT NULL,
+            radiko_token TEXT,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            enqueued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            heartbeat_at TIMESTAMP
+        )
+        """)
+    # 実行時にトークンを取り直すためのアカウント(以前のデータベースには列を追加する)
+    add_column(conn, "download_queue", "account", "TEXT")
+    # この時刻(UNIX時刻)までは取り出さない（放送前に登録した自動録音など）
+    add_column(conn, "download_queue", "not_before", "REAL")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_download_queue_state "
+        "ON download_queue (state, station_id)"
+    )
+    # 番組(放送局・開始・終了時刻)ごとに1つだけのジョブ（重複した予約をまとめる）
+    has_job_programs = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'job_programs'"
+    ).fetchone()
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS job_programs (
+            station_id TEXT NOT NULL,
+            start_time TEXT NOT NULL,
+            end_time TEXT NOT NULL,
+            job_id TEXT NOT NULL REFERENCES download_log(job_id),
+            PRIMARY KEY (station_id, start_time, end_time)
+        )
+        """)
+    if not has_job_programs:
+        # 既存のジョブは番組ごとに最新のものを対象にする
+        conn.execute("""
+            INSERT OR IGNORE INTO job_programs (station_id, start_time, end_time, job_id)
+            SELECT station_id, start_time, end_time, job_id FROM download_queue
+            ORDER BY enqueued_at DESC, rowid DESC
+            """)
+    # ジョブを予約したアカウント（同じ番組の予約は1つのジョブを共有する）
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS job_accounts (
+            job_id TEXT NOT NULL REFERENCES download_log(job_id),
+            account TEXT NOT NULL,
+            PRIMARY KEY (job_id, account)
+        )
+        """)
+    # 予約リクエストの冪等キー（同じキーの再送は同じジョブを返す）
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            account TEXT NOT NULL,
+            key TEXT NOT NULL,
+            job_id TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (account, key)
+        )
+        """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at "
+        "ON idempotency_keys (created_at)"
     )
+    # 中断したダウンロードの再開位置（書き込み済みのセグメント数とバイト数）
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS download_checkpoints (
+            job_id TEXT PRIMARY KEY REFERENCES download_log(job_id),
+            segments_done INTEGER NOT NULL,
+            total_segments INTEGER NOT NULL,
+            bytes_written INTEGER NOT NULL,
+            media_seconds REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """)
+    # ジョブ一覧のキーセットページング用（新しい順、放送局での絞り込み）
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_download_log_start_time "
+        "ON download_log (start_time DESC, id DESC)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_download_log_station "
+        "ON download_log (station_id, start_time DESC, id DESC)"
+    )
+    # 録音ライブラリ（pathは録音ディレクトリからの相対パス、時刻はdownload_logと同じ形式）
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS recordings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            path TEXT UNIQUE NOT NULL,
+            station_id TEXT,
+            station_name TEXT NOT NULL,
+            program_title TEXT NOT NULL,
+            start_time TIMESTAMP NOT NULL,
+            end_time TIMESTAMP,
+            duration REAL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            checksum TEXT NOT NULL,
+            pfm TEXT,
+            description TEXT,
+            job_id TEXT,
+            indexed_at REAL NOT NULL
+        )
+        """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_recordings_start_time "
+        "ON recordings (start_time DESC, id DESC)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_recordings_station "
+        "ON recordings (station_name, start_time DESC, id DESC)"
+    )
+    # 走査済みの放送局ディレクトリとそのmtime（変わっていなければ読み直さない）
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS library_dirs (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL
+        )
+        """)
+    # ダウンロード後の後処理（対象ファイルと番組情報、ステップごとの状態）
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS postprocess_jobs (
+            job_id TEXT PRIMARY KEY REFERENCES download_log(job_id),
+            path TEXT NOT NULL,
+            meta TEXT NOT NULL
+        )
+        """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS postprocess_steps (
+            job_id TEXT NOT NULL REFERENCES download_log(job_id),
+            position INTEGER NOT NULL,
+            step TEXT NOT NULL,
+            status TEXT NOT NULL,
+            output TEXT,
+            message TEXT,
+            started_at REAL,
+            finished_at REAL,
+            PRIMARY KEY (job_id, position)
+        )
+        """)
+    # Radikoアカウントごとの認証トークン（パスワードはSECRET_KEYで暗号化して保存）
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS radiko_accounts (
+            email TEXT PRIMARY KEY,
+            password TEXT NOT NULL,
+            area_id TEXT,
+            auth_token TEXT,
+            expires_at REAL NOT NULL DEFAULT 0
+        )
+        """)
+    # 放送局マップ（放送局→エリアの逆引きを兼ねる）
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS station_areas (
+            station_id TEXT NOT NULL,
+            area_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            PRIMARY KEY (station_id, area_id)
+        )
+        """)
+    # キャッシュの最終更新日時
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cache_meta (
+            key TEXT PRIMARY KEY,
+            updated_at TIMESTAMP NOT NULL
+        )
+        """)
+    # Radikoへのリクエストのトークンバケット（全プロセスで共有する）
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+            name TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """)
+    # 画面からのリクエストが待っている間(この時刻まで)はbackgroundに渡さない
+    add_column(
+        conn, "rate_limit_buckets", "interactive_until", "REAL NOT NULL DEFAULT 0"
+    )
+    # ジョブの状態変化と進捗（全APIワーカーがここを読んでSSEで配信する）
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS job_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id TEXT NOT NULL,
+            event TEXT NOT NULL,
+            data TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+        """)
+    # 番組表キャッシュ（放送局・日付ごと。過去日は更新されないので再検証しない）
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS guide_cache (
+            cache_key TEXT NOT NULL,
+            date_str TEXT NOT NULL,
+            body TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            fetched_at REAL NOT NULL,
+            immutable INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (cache_key, date_str)
+        )
+        """)
+    # 番組検索用のインデックス（番組表の取得時に更新する）
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS programs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            station_id TEXT NOT NULL,
+            start_time TEXT NOT NULL,
+            end_time TEXT NOT NULL,
+            title TEXT NOT NULL,
+            pfm TEXT,
+            description TEXT,
+            station_name TEXT,
+            image_url TEXT,
+            content_hash TEXT NOT NULL,
+            UNIQUE (station_id, start_time)
+        )
+        """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_programs_start_time ON programs (start_time)"
+    )
+    # 追加・変更された番組の記録（自動録音ルールの差分照合用。照合後に消す）
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS program_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            program_id INTEGER NOT NULL
+        )
+        """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS programs_changed_ai AFTER INSERT ON programs BEGIN
+            INSERT INTO program_changes (program_id) VALUES (new.id);
+        END
+        """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS programs_changed_au AFTER UPDATE ON programs BEGIN
+            INSERT INTO program_changes (program_id) VALUES (new.id);
+        END
+        """)
+    # 自動録音ルール（weekdaysはビット0が月曜。時刻は HH:MM）
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS auto_record_rules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            account TEXT NOT NULL,
+            name TEXT NOT NULL,
+            keyword TEXT,
+            performer TEXT,
+            station_id TEXT,
+            weekdays INTEGER NOT NULL DEFAULT 127,
+            start_after TEXT,
+            start_before TEXT,
+            enabled INTEGER NOT NULL DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+    # 自動録音で登録済みの番組（同じ番組を二重に登録しない）
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(auto_record_matches)")}
+    if columns and "account" not in columns:
+        # 以前は番組ごとに1件だった。アカウントごとに作り直し、ルールのアカウントを引き継ぐ
+        conn.execute(
+            "ALTER TABLE auto_record_matches RENAME TO auto_record_matches_old"
+        )
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS auto_record_matches (
+            account TEXT NOT NULL,
+            station_id TEXT NOT NULL,
+            start_time TEXT NOT NULL,
+            rule_id INTEGER NOT NULL,
+            job_id TEXT NOT NULL,
+            PRIMARY KEY (account, station_id, start_time)
+        )
+        """)
+    if columns and "account" not in columns:
+        conn.execute("""
+            INSERT OR IGNORE INTO auto_record_matches
+                (account, station_id, start_time, rule_id, job_id)
+            SELECT r.account, m.station_id, m.start_time, m.rule_id, m.job_id
+            FROM auto_record_matches_old AS m
+            JOIN auto_record_rules AS r ON r.id = m.rule_id
+            """)
+        conn.execute("DROP TABLE auto_record_matches_old")
+    try:
+        init_program_fts(conn)
+    except sqlite3.OperationalError as e:
+        # FTS5が使えないSQLiteではローカル検索を無効にする
+        print(f"全文検索インデックスを作成できません: {e}")
     conn.commit()
     conn.close()
+
+
+def add_column(conn, table: str, column: str, definition: str):
+    """列がなければ追加する"""
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def init_program_fts(conn):
+    """番組のFTS5(trigram)インデックスと同期用トリガーを作成する"""
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS program_fts USING fts5(
+            title, pfm, description, station_name,
+            content='programs', content_rowid='id', tokenize='trigram'
+        )
+        """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS programs_ai AFTER INSERT ON programs BEGIN
+            INSERT INTO program_fts (rowid, title, pfm, description, station_name)
+            VALUES (new.id, new.title, new.pfm, new.description, new.station_name);
+        END
+        """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS programs_ad AFTER DELETE ON programs BEGIN
+            INSERT INTO program_fts (program_fts, rowid, title, pfm, description, station_name)
+            VALUES ('delete', old.id, old.title, old.pfm, old.description, old.station_name);
+        END
+        """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS programs_au AFTER UPDATE ON programs BEGIN
+            INSERT INTO program_fts (program_fts, rowid, title, pfm, description, station_name)
+            VALUES ('delete', old.id, old.title, old.pfm, old.description, old.station_name);
+            INSERT INTO program_fts (rowid, title, pfm, description, station_name)
+            VALUES (new.id, new.title, new.pfm, new.description, new.station_name);
+        END
+        """)
@@ -0,0 +1,120 @@
+"""
+録音ファイルの配信
+
+本番ではNGINXに転送を任せる。APIは権限を確認したら X-Accel-Redirect で内部
+ロケーションのパスを返すだけなので、ワーカーは大きなファイルの送信で塞がらず、
+NGINXが sendfile と Range(シーク)に対応して返す。
+RECORDINGS_ACCEL_PREFIX を設定しない開発環境では、Python で Range に対応して返す。
+"""
+
+import os
+import re
+from typing import Iterator, Optional, Tuple
+from urllib.parse import quote
+
+from fastapi import HTTPException
+from fastapi.responses import Response, StreamingResponse
+
+from .library import RECORDINGS_DIR
+
+# NGINXの internal ロケーション(例: /internal/recordings/)。空ならPythonで配信する
+RECORDINGS_ACCEL_PREFIX = os.getenv("RECORDINGS_ACCEL_PREFIX", "")
+CHUNK_SIZE = 256 * 1024
+RECORDING_MEDIA_TYPE = "audio/aac"
+_RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def resolve_recording_path(relpath: str, root: Optional[str] = None) -> str:
+    """ライブラリの相対パスを実際のパスにする。録音ディレクトリの外は指させない"""
+    root = os.path.realpath(root or RECORDINGS_DIR)
+    path = os.path.realpath(os.path.join(root, relpath))
+    if os.path.commonpath([root, path]) != root:
+        raise HTTPException(status_code=404, detail="録音ファイルが見つかりません")
+    return path
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Rangeヘッダーから (開始, 終了) を返す(終了を含む)。指定がないか、複数範囲など
+    対応しない形式ならNone(全体を返す)。満たせない範囲は416にする。
+    """
+    if not header:
+        return None
+    match = _RANGE_PATTERN.match(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # bytes=-N は末尾のNバイト
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="範囲が不正です",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, end
+
+
+def _read_range(path: str, start: int, length: int) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def content_disposition(filename: str, attachment: bool = False) -> str:
+    kind = "attachment" if attachment else "inline"
+    return f"{kind}; filename*=UTF-8''{quote(filename)}"
+
+
+def recording_response(
+    relpath: str,
+    range_header: Optional[str] = None,
+    attachment: bool = False,
+    root: Optional[str] = None,
+    accel_prefix: Optional[str] = None,
+) -> Response:
+    """録音ファイルを返すレスポンスを作る"""
+    if accel_prefix is None:
+        accel_prefix = RECORDINGS_ACCEL_PREFIX
+    headers = {
+        "Content-Disposition": content_disposition(
+            os.path.basename(relpath), attachment
+        ),
+        "Accept-Ranges": "bytes",
+    }
+    path = resolve_recording_path(relpath, root)
+    if accel_prefix:
+        # 存在確認とRangeの処理はNGINXが行う
+        headers["X-Accel-Redirect"] = accel_prefix + quote(relpath)
+        return Response(headers=headers, media_type=RECORDING_MEDIA_TYPE)
+
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        raise HTTPException(status_code=404, detail="録音ファイルが見つかりません")
+    byte_range = parse_range(range_header, size)
+    if byte_range is None:
+        start, end, status_code = 0, size - 1, 200
+    else:
+        (start, end), status_code = byte_range, 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    length = end - start + 1
+    headers["Content-Length"] = str(length)
+    # 同期のイテレーターはスレッドプールで読まれるので、イベントループは止まらない
+    return StreamingResponse(
+        _read_range(path, start, length),
+        status_code=status_code,
+        headers=headers,
+        media_type=RECORDING_MEDIA_TYPE,
+    )
@@ -0,0 +1,382 @@
+"""
+タイムフリー番組(HLS)のダウンロードエンジン
+
+playlist.m3u8 → chunklist.m3u8 → AACセグメント の順に解決し、
+セグメントをコネクションプール付きのセッションで並列取得して、
+放送順に出力ファイルへ書き込む。ffmpegによる取得もフォールバックとして残す。
+"""
+
+import os
+import subprocess
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, NamedTuple, Optional, Protocol
+from urllib.parse import urljoin
+
+import requests
+
+from .metrics import instrument_session
+from .rate_limit import BACKGROUND, RateLimitedAdapter, RateLimitedRetry
+
+# "native"(並列セグメント取得) または "ffmpeg"
+DOWNLOAD_ENGINE = os.getenv("DOWNLOAD_ENGINE", "native")
+# 1ジョブあたりのセグメント同時取得数
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "8"))
+REQUEST_TIMEOUT = (5, 30)  # (接続, 読み込み) 秒
+SEGMENT_RETRIES = 3
+MAX_PLAYLIST_DEPTH = 3
+
+
+class PlaylistError(Exception):
+    """プレイリストを解析できない場合の例外"""
+
+
+class Segment(NamedTuple):
+    url: str
+    duration: float
+
+
+class Playlist(NamedTuple):
+    variants: List[str]
+    segments: List[Segment]
+
+
+class DownloadProgress(NamedTuple):
+    """ダウンロードの途中経過"""
+
+    bytes_written: int
+    media_seconds: float  # 書き込み済みの再生時間
+    total_media_seconds: float  # 番組全体の再生時間(不明なら0)
+    elapsed: float
+    resumed_bytes: int = 0  # 前回までに書き込み済みで、今回は取得していないバイト数
+
+
+ProgressCallback = Callable[[DownloadProgress], None]
+
+
+class DownloadResult(NamedTuple):
+    bytes_written: int
+    segments: int
+    media_seconds: float
+    elapsed: float
+    resumed_segments: int = 0
+
+
+class Checkpoint(NamedTuple):
+    """途中まで書き込んだ .part ファイルの状態"""
+
+    segments_done: int
+    total_segments: int
+    bytes_written: int
+    media_seconds: float
+
+
+class CheckpointStore(Protocol):
+    """チェックポイントの保存先。download_hls はセグメントを書くたびに save する"""
+
+    def load(self) -> Optional[Checkpoint]: ...
+
+    def save(self, checkpoint: Checkpoint): ...
+
+    def clear(self): ...
+
+
+def create_session(
+    pool_size: int = DOWNLOAD_CONCURRENCY, priority: str = BACKGROUND
+) -> requests.Session:
+    """Keep-Aliveで接続を使い回すセッションを生成する。リクエストはレート制限を通す"""
+    session = requests.Session()
+    retry = RateLimitedRetry(
+        total=SEGMENT_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(["GET"]),
+        priority=priority,
+    )
+    adapter = RateLimitedAdapter(
+        pool_connections=2,
+        pool_maxsize=pool_size,
+        max_retries=retry,
+        priority=priority,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return instrument_session(session)
+
+
+def parse_playlist(text: str, base_url: str) -> Playlist:
+    """m3u8を解析し、ネストしたプレイリストとメディアセグメントを返す"""
+    lines = [line.strip() for line in text.splitlines()]
+    if not lines or lines[0] != "#EXTM3U":
+        raise PlaylistError("m3u8形式ではありません")
+
+    variants: List[str] = []
+    segments: List[Segment] = []
+    pending_duration: Optional[float] = None
+    pending_variant = False
+    for line in lines[1:]:
+        if not line:
+            continue
+        if line.startswith("#EXT-X-STREAM-INF"):
+            pending_variant = True
+        elif line.startswith("#EXTINF:"):
+            pending_duration = float(line[8:].split(",", 1)[0] or 0)
+        elif line.startswith("#"):
+            continue
+        elif pending_variant:
+            variants.append(urljoin(base_url, line))
+            pending_variant = False
+        elif pending_duration is not None:
+            segments.append(Segment(urljoin(base_url, line), pending_duration))
+            pending_duration = None
+        elif line.endswith(".m3u8") or ".m3u8?" in line:
+            variants.append(urljoin(base_url, line))
+    return Playlist(variants=variants, segments=segments)
+
+
+def resolve_segments(
+    session: requests.Session, playlist_url: str, headers: Dict[str, str]
+) -> List[Segment]:
+    """マスタープレイリストからchunklistを辿り、セグメント一覧を取得する"""
+    url = playlist_url
+    for _ in range(MAX_PLAYLIST_DEPTH):
+        res = session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        res.raise_for_status()
+        playlist = parse_playlist(res.text, res.url or url)
+        if playlist.segments:
+            return playlist.segments
+        if not playlist.variants:
+            break
+        url = playlist.variants[0]
+    raise PlaylistError(f"セグメントが見つかりません: {playlist_url}")
+
+
+def id3_tag_length(data, pos: int = 0) -> int:
+    """pos から始まるID3v2タグのバイト数。タグがなければ0"""
+    if len(data) < pos + 10 or data[pos : pos + 3] != b"ID3":
+        return 0
+    size = (
+        (data[pos + 6] << 21)
+        | (data[pos + 7] << 14)
+        | (data[pos + 8] << 7)
+        | data[pos + 9]
+    )
+    footer = 10 if data[pos + 5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def strip_id3(data: bytes) -> bytes:
+    """セグメント先頭のID3v2タグ(タイムスタンプ情報)を取り除きADTSだけにする"""
+    while True:
+        length = id3_tag_length(data)
+        if not length:
+            return data
+        data = data[length:]
+
+
+def _fetch_segment(
+    session: requests.Session, segment: Segment, headers: Dict[str, str]
+) -> bytes:
+    res = session.get(segment.url, headers=headers, timeout=REQUEST_TIMEOUT)
+    res.raise_for_status()
+    return strip_id3(res.content)
+
+
+def download_hls(
+    playlist_url: str,
+    output_path: str,
+    headers: Dict[str, str],
+    concurrency: int = DOWNLOAD_CONCURRENCY,
+    session: Optional[requests.Session] = None,
+    progress: Optional[ProgressCallback] = None,
+    checkpoint: Optional[CheckpointStore] = None,
+) -> DownloadResult:
+    """
+    セグメントを並列取得し、放送順に連結して書き込む。
+    checkpointを渡すと失敗時も .part ファイルを残し、次回は続きのセグメントだけを
+    取得して追記する(AACのセグメントは連結するだけで無劣化でつながる)。
+    """
+    started = time.monotonic()
+    own_session = session is None
+    session = session or create_session(concurrency)
+    part_path = output_path + ".part"
+    bytes_written = 0
+    media_written = 0.0
+    done = 0
+    try:
+        segments = resolve_segments(session, playlist_url, headers)
+        total_media = sum(segment.duration for segment in segments)
+        resumed = _resume_point(checkpoint, part_path, len(segments))
+        if resumed is not None:
+            done = resumed.segments_done
+            bytes_written = resumed.bytes_written
+            media_written = resumed.media_seconds
+        resumed_bytes = bytes_written
+        # 先読みは同時取得数の2倍までに抑え、メモリ使用量を一定に保つ
+        window = max(1, concurrency) * 2
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            in_flight = deque()
+            try:
+                with open(part_path, "r+b" if resumed else "wb") as out:
+                    # チェックポイントより後ろの書きかけのデータは捨てる
+                    out.truncate(bytes_written)
+                    out.seek(bytes_written)
+
+                    def write_next():
+                        nonlocal bytes_written, media_written, done
+                        future, segment = in_flight.popleft()
+                        data = future.result()
+                        out.write(data)
+                        bytes_written += len(data)
+                        media_written += segment.duration
+                        done += 1
+                        if checkpoint is not None:
+                            # 記録した位置までは必ずファイルに書かれているようにする
+                            out.flush()
+                            checkpoint.save(
+                                Checkpoint(
+                                    done, len(segments), bytes_written, media_written
+                                )
+                            )
+                        if progress is not None:
+                            progress(
+                                DownloadProgress(
+                                    bytes_written,
+                                    media_written,
+                                    total_media,
+                                    time.monotonic() - started,
+                                    resumed_bytes,
+                                )
+                            )
+
+                    for segment in segments[done:]:
+                        in_flight.append(
+                            (
+                                pool.submit(_fetch_segment, session, segment, headers),
+                                segment,
+                            )
+                        )
+                        if len(in_flight) >= window:
+                            write_next()
+                    while in_flight:
+                        write_next()
+            except BaseException:
+                for future, _ in in_flight:
+                    future.cancel()
+                raise
+        os.replace(part_path, output_path)
+        if checkpoint is not None:
+            checkpoint.clear()
+    except BaseException:
+        # 再開できる場合は書き込み済みの部分を残す
+        if checkpoint is None and os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    finally:
+        if own_session:
+            session.close()
+
+    return DownloadResult(
+        bytes_written=bytes_written,
+        segments=len(segments),
+        media_seconds=total_media,
+        elapsed=time.monotonic() - started,
+        resumed_segments=resumed.segments_done if resumed else 0,
+    )
+
+
+def _resume_point(
+    checkpoint: Optional[CheckpointStore], part_path: str, total_segments: int
+) -> Optional[Checkpoint]:
+    """前回の続きから書けるなら、そのチェックポイントを返す"""
+    if checkpoint is None:
+        return None
+    saved = checkpoint.load()
+    if saved is None or not os.path.exists(part_path):
+        return None
+    # セグメント構成が変わった場合や、記録した分がファイルに残っていない場合は最初から
+    if (
+        saved.total_segments != total_segments
+        or saved.segments_done > total_segments
+        or os.path.getsize(part_path) < saved.bytes_written
+    ):
+        return None
+    return saved
+
+
+def download_with_ffmpeg(
+    stream_url: str,
+    output_path: str,
+    auth_token: str,
+    duration: Optional[float] = None,
+    progress: Optional[ProgressCallback] = None,
+) -> None:
+    """
+    ffmpegでストリームをコピー保存する(フォールバック用)。
+    .part ファイルに書き、成功したら output_path に置き換える。失敗したら消す
+    """
+    part_path = output_path + ".part"
+    command = [
+        "ffmpeg",
+        "-y",  # 前回失敗したときの .part が残っていても上書きする
+        "-nostdin",
+        "-loglevel",
+        "error",
+        "-nostats",
+        "-progress",
+        "pipe:1",
+        "-headers",
+        f"X-Radiko-AuthToken: {auth_token}",
+        "-i",
+        stream_url,
+        "-acodec",
+        "copy",
+        "-f",
+        "adts",  # 拡張子が .part なので形式を指定する
+        part_path,
+    ]
+    started = time.monotonic()
+    try:
+        # stderrもパイプにすると、stdoutを読んでいる間にstderrのバッファが埋まって
+        # ffmpegが止まることがあるので一時ファイルに書かせて最後に読む
+        with tempfile.TemporaryFile(mode="w+") as stderr_file:
+            process = subprocess.Popen(
+                command, stdout=subprocess.PIPE, stderr=stderr_file, text=True
+            )
+            _read_ffmpeg_progress(process, started, duration, progress)
+            returncode = process.wait()
+            stderr_file.seek(0)
+            stderr = stderr_file.read()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command, stderr=stderr)
+        os.replace(part_path, output_path)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+
+def _read_ffmpeg_progress(
+    process: subprocess.Popen,
+    started: float,
+    duration: Optional[float],
+    progress: Optional[ProgressCallback],
+):
+    # -progress は key=value の行を出力し、progress=continue/end で1回分が区切られる
+    values: Dict[str, str] = {}
+    for line in process.stdout:
+        key, _, value = line.strip().partition("=")
+        values[key] = value
+        if key == "progress" and progress is not None:
+            try:
+                media = int(values.get("out_time_us", "0")) / 1_000_000
+                size = int(values.get("total_size", "0"))
+            except ValueError:
+                continue
+            progress(
+                DownloadProgress(
+                    size, media, duration or 0.0, time.monotonic() - started
+                )
+            )
@@ -0,0 +1,386 @@
+"""
+番組表キャッシュ
+
+プロセス内のLRUとSQLite(全ワーカー共有)の2段構成。
+放送日が終わった番組表は変わらないので期限なしで使い、
+今日以降の番組表は短い有効期限の後にETag/Last-Modifiedで再検証する。
+"""
+
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, List, Optional, Tuple, Type
+
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel
+
+from .database import get_db_connection
+from .http_cache import CACHE_IMMUTABLE, RenderedBody, max_age
+from .metrics import GUIDE_CACHE_LOOKUPS
+from .program_index import index_area_guide, index_guide
+from .radiko import (
+    JST,
+    AreaGuideResponse,
+    GuideResponse,
+    fetch_area_guide,
+    fetch_program_guide,
+)
+from .radiko_client import radiko_client
+
+GUIDE_CACHE_TTL = int(os.getenv("GUIDE_CACHE_TTL", "600"))  # 今日以降の有効期限(秒)
+GUIDE_CACHE_SIZE = int(os.getenv("GUIDE_CACHE_SIZE", "256"))  # LRUの最大件数
+GUIDE_CACHE_RETENTION_DAYS = 14  # これより古い放送日のキャッシュは削除する
+# 同じ番組表の同時取得を防ぐロックの数。キーのハッシュで割り当てるので増え続けない
+KEY_LOCK_STRIPES = 64
+
+# loader(etag, last_modified) -> (値 or 更新なしならNone, etag, last_modified)
+Loader = Callable[
+    [Optional[str], Optional[str]],
+    Tuple[Optional[BaseModel], Optional[str], Optional[str]],
+]
+AsyncLoader = Callable[
+    [Optional[str], Optional[str]],
+    Awaitable[Tuple[Optional[BaseModel], Optional[str], Optional[str]]],
+]
+
+
+def radiko_today(now: Optional[datetime] = None) -> str:
+    """Radikoの放送日(5時始まり)で今日の日付をYYYYMMDDで返す"""
+    now = now or datetime.now(JST)
+    return (now - timedelta(hours=5)).strftime("%Y%m%d")
+
+
+@dataclass
+class CacheEntry:
+    value: BaseModel
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched_at: float
+    immutable: bool
+    # JSONにした本文(SQLiteへの保存とAPIのレスポンスで共有する)
+    rendered: Optional[RenderedBody] = field(default=None, repr=False, compare=False)
+
+    def render(self) -> RenderedBody:
+        if self.rendered is None:
+            self.rendered = RenderedBody(self.value.model_dump_json().encode())
+        return self.rendered
+
+
+class GuideCache:
+    def __init__(self, ttl: int = GUIDE_CACHE_TTL, size: int = GUIDE_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._memory: "OrderedDict[Tuple[str, str], CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = [threading.Lock() for _ in range(KEY_LOCK_STRIPES)]
+        self._async_key_locks: List[asyncio.Lock] = []
+        self._async_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def get(
+        self,
+        cache_key: str,
+        date_str: str,
+        model: Type[BaseModel],
+        loader: Loader,
+    ) -> BaseModel:
+        key = (cache_key, date_str)
+        entry = self._get_memory(key)
+        if entry is not None and self._is_fresh(entry):
+            GUIDE_CACHE_LOOKUPS.labels("memory").inc()
+            return entry.value
+
+        # 同じ番組表を複数のリクエストが同時に取りに行かないようにする
+        with self._key_lock(key):
+            entry = self._get_memory(key)
+            source = "memory"
+            if entry is None:
+                entry = self._load(key, model)
+                source = "sqlite"
+            if entry is not None and self._is_fresh(entry):
+                GUIDE_CACHE_LOOKUPS.labels(source).inc()
+                self._put_memory(key, entry)
+                return entry.value
+
+            # 取得時点で放送日が終わっていれば、以後は変わらない
+            immutable = date_str < radiko_today()
+            try:
+                fetched = loader(
+                    entry.etag if entry else None,
+                    entry.last_modified if entry else None,
+                )
+            except HTTPException:
+                if entry is None:
+                    raise
+                GUIDE_CACHE_LOOKUPS.labels("stale").inc()
+                # 再検証に失敗した場合は古いキャッシュを返す
+                return entry.value
+            return self._store(key, entry, fetched, immutable).value
+
+    async def aget(
+        self,
+        cache_key: str,
+        date_str: str,
+        model: Type[BaseModel],
+        loader: AsyncLoader,
+    ) -> BaseModel:
+        """get() の非同期版。SQLiteの読み書きはスレッドプールで行う"""
+        return (await self.aget_entry(cache_key, date_str, model, loader)).value
+
+    async def aget_entry(
+        self,
+        cache_key: str,
+        date_str: str,
+        model: Type[BaseModel],
+        loader: AsyncLoader,
+    ) -> CacheEntry:
+        """aget() と同じだが、ETagなどに使えるようキャッシュのエントリーを返す"""
+        key = (cache_key, date_str)
+        entry = self._get_memory(key)
+        if entry is not None and self._is_fresh(entry):
+            GUIDE_CACHE_LOOKUPS.labels("memory").inc()
+            return entry
+
+        async with self._async_key_lock(key):
+            entry = self._get_memory(key)
+            source = "memory"
+            if entry is None:
+                entry = await run_in_threadpool(self._load, key, model)
+                source = "sqlite"
+            if entry is not None and self._is_fresh(entry):
+                GUIDE_CACHE_LOOKUPS.labels(source).inc()
+                self._put_memory(key, entry)
+                return entry
+
+            immutable = date_str < radiko_today()
+            try:
+                fetched = await loader(
+                    entry.etag if entry else None,
+                    entry.last_modified if entry else None,
+                )
+            except HTTPException:
+                if entry is None:
+                    raise
+                GUIDE_CACHE_LOOKUPS.labels("stale").inc()
+                return entry
+            return await run_in_threadpool(self._store, key, entry, fetched, immutable)
+
+    def _store(
+        self, key, entry: Optional[CacheEntry], fetched, immutable: bool
+    ) -> CacheEntry:
+        value, etag, last_modified = fetched
+        if value is None and entry is not None:
+            # 304 Not Modified
+            GUIDE_CACHE_LOOKUPS.labels("not_modified").inc()
+            entry.fetched_at = time.time()
+            entry.immutable = immutable
+            self._touch(key, entry)
+        else:
+            GUIDE_CACHE_LOOKUPS.labels("fetched").inc()
+            entry = CacheEntry(value, etag, last_modified, time.time(), immutable)
+            self._save(key, entry)
+        self._put_memory(key, entry)
+        return entry
+
+    def get_station_guide(
+        self, station_id: str, date_str: str, auth_token: Optional[str]
+    ) -> GuideResponse:
+        def load(etag, last_modified):
+            fetched = fetch_program_guide(
+                station_id, date_str, auth_token, etag, last_modified
+            )
+            if fetched.guide is not None:
+                index_guide(station_id, date_str, fetched.guide)
+            return fetched
+
+        return self.get(f"station:{station_id}", date_str, GuideResponse, load)
+
+    def get_area_guide(
+        self, area_id: str, date_str: str, auth_token: Optional[str]
+    ) -> AreaGuideResponse:
+        def load(etag, last_modified):
+            fetched = fetch_area_guide(
+                area_id, date_str, auth_token, etag, last_modified
+            )
+            if fetched.guide is not None:
+                self._seed_station_guides(fetched.guide)
+                index_area_guide(fetched.guide)
+            return fetched
+
+        return self.get(f"area:{area_id}", date_str, AreaGuideResponse, load)
+
+    async def aget_station_guide(
+        self, station_id: str, date_str: str, auth_token: Optional[str]
+    ) -> GuideResponse:
+        entry = await self.aget_station_guide_entry(station_id, date_str, auth_token)
+        return entry.value
+
+    async def aget_station_guide_entry(
+        self, station_id: str, date_str: str, auth_token: Optional[str]
+    ) -> CacheEntry:
+        async def load(etag, last_modified):
+            fetched = await radiko_client.fetch_program_guide(
+                station_id, date_str, auth_token, etag, last_modified
+            )
+            if fetched.guide is not None:
+                await run_in_threadpool(
+                    index_guide, station_id, date_str, fetched.guide
+                )
+            return fetched
+
+        return await self.aget_entry(
+            f"station:{station_id}", date_str, GuideResponse, load
+        )
+
+    async def aget_area_guide(
+        self, area_id: str, date_str: str, auth_token: Optional[str]
+    ) -> AreaGuideResponse:
+        entry = await self.aget_area_guide_entry(area_id, date_str, auth_token)
+        return entry.value
+
+    async def aget_area_guide_entry(
+        self, area_id: str, date_str: str, auth_token: Optional[str]
+    ) -> CacheEntry:
+        async def load(etag, last_modified):
+            fetched = await radiko_client.fetch_area_guide(
+                area_id, date_str, auth_token, etag, last_modified
+            )
+            if fetched.guide is not None:
+                await run_in_threadpool(self._seed_station_guides, fetched.guide)
+                await run_in_threadpool(index_area_guide, fetched.guide)
+            return fetched
+
+        return await self.aget_entry(
+            f"area:{area_id}", date_str, AreaGuideResponse, load
+        )
+
+    def _seed_station_guides(self, area_guide: AreaGuideResponse):
+        """エリア番組表に含まれる各局の番組表も放送局単位のキャッシュに入れる"""
+        fetched_at = time.time()
+        immutable = area_guide.date < radiko_today()
+        items = [
+            (
+                (f"station:{station.station_id}", area_guide.date),
+                CacheEntry(
+                    GuideResponse(
+                        station_name=station.station_name, programs=station.programs
+                    ),
+                    None,
+                    None,
+                    fetched_at,
+                    immutable,
+                ),
+            )
+            for station in area_guide.stations
+        ]
+        self._save_many(items)
+        for key, entry in items:
+            self._put_memory(key, entry)
+
+    def clear(self):
+        """プロセス内のキャッシュを破棄する(SQLiteは残る)"""
+        with self._lock:
+            self._memory.clear()
+
+    def cache_control(self, entry: CacheEntry) -> str:
+        """ブラウザに返す Cache-Control。今日以降はこのキャッシュの残りの有効期間"""
+        if entry.immutable:
+            return CACHE_IMMUTABLE
+        return max_age(self.ttl - (time.time() - entry.fetched_at), public=False)
+
+    def _is_fresh(self, entry: CacheEntry) -> bool:
+        return entry.immutable or time.time() - entry.fetched_at < self.ttl
+
+    def _key_lock(self, key) -> threading.Lock:
+        return self._key_locks[hash(key) % KEY_LOCK_STRIPES]
+
+    def _async_key_lock(self, key) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            # asyncio.Lock は作ったイベントループでしか使えないので、ループごとに作る
+            if self._async_loop is not loop:
+                self._async_loop = loop
+                self._async_key_locks = [
+                    asyncio.Lock() for _ in range(KEY_LOCK_STRIPES)
+                ]
+            return self._async_key_locks[hash(key) % KEY_LOCK_STRIPES]
+
+    def _get_memory(self, key) -> Optional[CacheEntry]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+            return entry
+
+    def _put_memory(self, key, entry: CacheEntry):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.size:
+                self._memory.popitem(last=False)
+
+    def _load(self, key, model: Type[BaseModel]) -> Optional[CacheEntry]:
+        conn = get_db_connection()
+        row = conn.execute(
+            "SELECT body, etag, last_modified, fetched_at, immutable FROM guide_cache WHERE cache_key = ? AND date_str = ?",
+            key,
+        ).fetchone()
+        conn.close()
+        if row is None:
+            return None
+        return CacheEntry(
+            model.model_validate_json(row["body"]),
+            row["etag"],
+            row["last_modified"],
+            row["fetched_at"],
+            bool(row["immutable"]),
+            RenderedBody(row["body"].encode()),
+        )
+
+    def _save(self, key, entry: CacheEntry):
+        self._save_many([(key, entry)])
+
+    def _save_many(self, items):
+        conn = get_db_connection()
+        conn.executemany(
+            "INSERT OR REPLACE INTO guide_cache (cache_key, date_str, body, etag, last_modified, fetched_at, immutable) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    *key,
+                    entry.render().body.decode(),
+                    entry.etag,
+                    entry.last_modified,
+                    entry.fetched_at,
+                    int(entry.immutable),
+                )
+                for key, entry in items
+            ],
+        )
+        conn.commit()
+        conn.close()
+
+    def _touch(self, key, entry: CacheEntry):
+        conn = get_db_connection()
+        conn.execute(
+            "UPDATE guide_cache SET fetched_at = ?, immutable = ? WHERE cache_key = ? AND date_str = ?",
+            (entry.fetched_at, int(entry.immutable), *key),
+        )
+        conn.commit()
+        conn.close()
+
+
+def prune_guide_cache(retention_days: int = GUIDE_CACHE_RETENTION_DAYS) -> int:
+    """タイムフリーの範囲を過ぎた古い番組表を削除する"""
+    oldest = (datetime.now(JST) - timedelta(days=retention_days)).strftime("%Y%m%d")
+    conn = get_db_connection()
+    cursor = conn.execute("DELETE FROM guide_cache WHERE date_str < ?", (oldest,))
+    conn.commit()
+    conn.close()
+    return cursor.rowcount
+
+
+guide_cache = GuideCache()
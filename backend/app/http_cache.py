@@ -0,0 +1,149 @@
+"""
+APIレスポンスのHTTPキャッシュと圧縮
+
+JSONにしたレスポンスの本文からETagを作り、If-None-Match が一致すれば304を返す。
+番組表のように同じ内容を何度も返すものは、本文・ETag・圧縮結果を RenderedBody に
+保持して使い回すので、304を返すときも本文を返すときも作り直さない。
+Accept-Encoding に応じて brotli(brotliがインストールされていれば)か gzip で圧縮する。
+"""
+
+import gzip
+import hashlib
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import Response
+
+try:
+    import brotli
+
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+COMPRESS_MIN_SIZE = 1024  # これより小さい本文は圧縮しない(バイト)
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# 放送日が終わった番組表は変わらない。認証が必要なので共有キャッシュには置かせない
+CACHE_IMMUTABLE = "private, max-age=604800, immutable"
+# ユーザーごとの内容。ブラウザには保存させるが、毎回ETagで確認させる
+CACHE_PRIVATE = "private, no-cache"
+
+
+class RenderedBody:
+    """JSONの本文と、そのETag・圧縮結果"""
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        self._encoded: Dict[str, bytes] = {}
+
+    def encoded(self, encoding: Optional[str]) -> bytes:
+        if encoding is None:
+            return self.body
+        data = self._encoded.get(encoding)
+        if data is None:
+            if encoding == "br":
+                data = brotli.compress(self.body, quality=BROTLI_QUALITY)
+            else:
+                data = gzip.compress(self.body, compresslevel=GZIP_LEVEL, mtime=0)
+            self._encoded[encoding] = data
+        return data
+
+
+def choose_encoding(accept_encoding: Optional[str], size: int) -> Optional[str]:
+    """Accept-Encoding から使う圧縮方式を選ぶ(brotli優先)。圧縮しないならNone"""
+    if not accept_encoding or size < COMPRESS_MIN_SIZE:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in ("br", "gzip") if BROTLI_AVAILABLE else ("gzip",):
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def _etag(rendered: RenderedBody, encoding: Optional[str]) -> str:
+    # 圧縮した表現は別のバイト列なので、強いETagも分ける
+    return f'"{rendered.etag}-{encoding}"' if encoding else f'"{rendered.etag}"'
+
+
+def etag_matches(if_none_match: Optional[str], rendered: RenderedBody) -> bool:
+    """If-None-Match が同じ本文を指しているか(圧縮の違いは問わない弱い比較)"""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag.strip('"').split("-", 1)[0] == rendered.etag:
+            return True
+    return False
+
+
+def cached_response(
+    request: Request, rendered: RenderedBody, cache_control: str
+) -> Response:
+    """ETagが一致すれば304、そうでなければ(必要なら圧縮した)本文を返す"""
+    encoding = choose_encoding(
+        request.headers.get("accept-encoding"), len(rendered.body)
+    )
+    headers = {
+        "ETag": _etag(rendered, encoding),
+        "Cache-Control": cache_control,
+        "Vary": "Accept-Encoding",
+    }
+    if etag_matches(request.headers.get("if-none-match"), rendered):
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(
+        rendered.encoded(encoding), headers=headers, media_type="application/json"
+    )
+
+
+def max_age(seconds: float, public: bool = True) -> str:
+    scope = "public" if public else "private"
+    return f"{scope}, max-age={max(int(seconds), 0)}"
+
+
+class RenderedCache:
+    """キーごとの RenderedBody をプロセス内に ttl 秒保持する"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries: Dict[str, Tuple[float, RenderedBody]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[RenderedBody, float]]:
+        """(本文, 残りの有効期間) を返す。期限切れならNone"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        remaining = self.ttl - (time.monotonic() - entry[0])
+        if remaining <= 0:
+            return None
+        return entry[1], remaining
+
+    def put(self, key: str, rendered: RenderedBody):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), rendered)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,246 @@
+"""
+ジョブの状態変化と進捗の配信
+
+レコーダーが job_events テーブルにイベントを書き、各APIワーカーは1つのポーリング
+タスクで新しいイベントを読み出して、接続中のクライアントへSSEで配る。
+SQLiteを介すので、gunicornのワーカーがいくつあっても同じイベントが届く。
+イベントはジョブを予約したアカウントのクライアントにだけ配る。
+"""
+
+import asyncio
+import json
+import sqlite3
+import time
+from typing import AsyncIterator, Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+
+from .database import get_db_connection, status_writer
+from .downloader import DownloadProgress
+from .metrics import DOWNLOAD_BYTES
+
+EVENT_POLL_INTERVAL = 0.5  # APIワーカーが新しいイベントを読みに行く間隔(秒)
+PROGRESS_INTERVAL = 1.0  # 進捗イベントを書く最短間隔(秒)
+KEEPALIVE_INTERVAL = 15  # 接続維持のコメントを送る間隔(秒)
+EVENT_RETENTION = 60 * 60  # イベントを残しておく時間(秒)
+BACKLOG_LIMIT = 500  # 再接続時に送り直すイベントの上限
+MAX_POLL_BACKOFF = 10.0  # 読み込みに失敗したときの再試行間隔の上限(秒)
+
+INSERT_EVENT = (
+    "INSERT INTO job_events (job_id, event, data, created_at) VALUES (?, ?, ?, ?)"
+)
+
+
+def _event_params(job_id: str, event: str, data: dict):
+    payload = json.dumps({"job_id": job_id, **data}, ensure_ascii=False)
+    return (job_id, event, payload, time.time())
+
+
+def insert_event(conn, job_id: str, event: str, data: dict):
+    """呼び出し側のトランザクション内でイベントを書く"""
+    conn.execute(INSERT_EVENT, _event_params(job_id, event, data))
+
+
+def publish_event(job_id: str, event: str, data: dict):
+    """イベントをまとめ書きで書く(状態更新と同じ順序で反映される)"""
+    status_writer.submit(INSERT_EVENT, _event_params(job_id, event, data))
+
+
+class ProgressReporter:
+    """ダウンローダーの進捗コールバック。書き込みはPROGRESS_INTERVALごとに間引く"""
+
+    def __init__(self, job_id: str, interval: float = PROGRESS_INTERVAL):
+        self.job_id = job_id
+        self.interval = interval
+        self._last_sent = float("-inf")
+        self._last: Optional[DownloadProgress] = None
+        self._counted = 0
+
+    def __call__(self, progress: DownloadProgress):
+        # バイト数のメトリクスは間引かずに加算する(前回までに取得した分は除く)
+        self._counted = max(self._counted, progress.resumed_bytes)
+        if progress.bytes_written > self._counted:
+            DOWNLOAD_BYTES.inc(progress.bytes_written - self._counted)
+            self._counted = progress.bytes_written
+        now = time.monotonic()
+        done = (
+            progress.total_media_seconds
+            and progress.media_seconds >= progress.total_media_seconds
+        )
+        if now - self._last_sent < self.interval and not done:
+            return
+        # 速度は前回の通知からの増分で計算する
+        if self._last is not None and progress.elapsed > self._last.elapsed:
+            speed = (progress.bytes_written - self._last.bytes_written) / (
+                progress.elapsed - self._last.elapsed
+            )
+        else:
+            downloaded = progress.bytes_written - progress.resumed_bytes
+            speed = downloaded / progress.elapsed if progress.elapsed else 0
+        percent = (
+            min(100.0, progress.media_seconds / progress.total_media_seconds * 100)
+            if progress.total_media_seconds
+            else None
+        )
+        publish_event(
+            self.job_id,
+            "progress",
+            {
+                "bytes_written": progress.bytes_written,
+                "media_seconds": round(progress.media_seconds, 1),
+                "total_media_seconds": round(progress.total_media_seconds, 1),
+                "percent": round(percent, 1) if percent is not None else None,
+                "bytes_per_second": round(speed),
+            },
+        )
+        self._last_sent = now
+        self._last = progress
+
+
+def read_events(conn, after_id: int, limit: int = BACKLOG_LIMIT) -> List[dict]:
+    """
+    after_idより後のイベントを、ジョブを予約したアカウントとともに返す。
+    shared_accounts は同じジョブを後から予約したアカウント(改行区切り)
+    """
+    rows = conn.execute(
+        """
+        SELECT e.id, e.event, e.data, q.account, (
+            SELECT GROUP_CONCAT(a.account, char(10)) FROM job_accounts AS a
+            WHERE a.job_id = e.job_id
+        ) AS shared_accounts
+        FROM job_events AS e
+        LEFT JOIN download_queue AS q ON q.job_id = e.job_id
+        WHERE e.id > ? ORDER BY e.id LIMIT ?
+        """,
+        (after_id, limit),
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def visible_to(event: dict, account: Optional[str]) -> bool:
+    """購読者に配るイベントか。accountなしの購読者とアカウント不明のジョブは制限しない"""
+    if account is None or event["account"] in (None, account):
+        return True
+    shared = event.get("shared_accounts")
+    return bool(shared) and account in shared.split("\n")
+
+
+def _fetch_events(after_id: int, limit: int = BACKLOG_LIMIT) -> List[dict]:
+    conn = get_db_connection()
+    try:
+        return read_events(conn, after_id, limit)
+    finally:
+        conn.close()
+
+
+def _latest_event_id() -> int:
+    conn = get_db_connection()
+    try:
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM job_events").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def prune_job_events(retention: float = EVENT_RETENTION) -> int:
+    conn = get_db_connection()
+    cursor = conn.execute(
+        "DELETE FROM job_events WHERE created_at < ?", (time.time() - retention,)
+    )
+    conn.commit()
+    conn.close()
+    return cursor.rowcount
+
+
+def format_sse(event: dict) -> str:
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {event['data']}\n\n"
+
+
+class EventBroadcaster:
+    """
+    APIワーカー内で1つだけ動くポーリングタスクから、購読中のクライアントへ配る。
+    クライアント数が増えてもデータベースへの問い合わせ回数は変わらない。
+    """
+
+    def __init__(self, poll_interval: float = EVENT_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        # 購読者のキューとアカウント
+        self._subscribers: Dict[asyncio.Queue, Optional[str]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._ready: Optional[asyncio.Event] = None
+        self._last_id = 0
+
+    async def subscribe(
+        self, last_event_id: Optional[int] = None, account: Optional[str] = None
+    ) -> AsyncIterator:
+        """
+        イベントを順に返す。last_event_idを渡すとその続きから送り直す。
+        accountを渡すとそのアカウントのジョブのイベントだけを返す。
+        KEEPALIVE_INTERVALの間イベントがなければNoneを返す。
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers[queue] = account
+        try:
+            if self._task is None or self._task.done():
+                self._ready = asyncio.Event()
+                self._task = asyncio.create_task(self._poll())
+            await self._ready.wait()
+            # これより後のイベントはポーリングタスクからキューに届く
+            delivered_from = self._last_id
+            if last_event_id is not None and last_event_id < delivered_from:
+                backlog = await run_in_threadpool(_fetch_events, last_event_id)
+                for event in backlog:
+                    if event["id"] <= delivered_from and visible_to(event, account):
+                        yield event
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            self._subscribers.pop(queue, None)
+
+    async def _poll(self):
+        # 購読を始めた時点より前のイベントは、再接続時の送り直し以外では配らない
+        backoff = self.poll_interval
+        try:
+            while self._subscribers:
+                try:
+                    self._last_id = await run_in_threadpool(_latest_event_id)
+                    break
+                except sqlite3.Error as e:
+                    print(f"ジョブイベントの読み込みに失敗しました: {e}")
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, MAX_POLL_BACKOFF)
+        finally:
+            self._ready.set()
+        while self._subscribers:
+            try:
+                events = await run_in_threadpool(_fetch_events, self._last_id)
+            except sqlite3.Error as e:
+                # ロック待ちなどで失敗してもタスクは止めず、間隔をあけて読み直す
+                print(f"ジョブイベントの読み込みに失敗しました: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, MAX_POLL_BACKOFF)
+                continue
+            backoff = self.poll_interval
+            for event in events:
+                self._last_id = event["id"]
+                for queue, account in list(self._subscribers.items()):
+                    if visible_to(event, account):
+                        queue.put_nowait(event)
+            if len(events) < BACKLOG_LIMIT:
+                await asyncio.sleep(self.poll_interval)
+
+
+async def event_stream(
+    broadcaster: EventBroadcaster,
+    last_event_id: Optional[int] = None,
+    account: Optional[str] = None,
+) -> AsyncIterator[str]:
+    """SSEの本文。イベントがない間は接続維持のコメントを送る"""
+    yield "retry: 3000\n\n"
+    async for event in broadcaster.subscribe(last_event_id, account):
+        yield format_sse(event) if event is not None else ": keepalive\n\n"
+
+
+job_events = EventBroadcaster()
@@ -0,0 +1,445 @@
+"""
+SQLiteに永続化したダウンロードジョブキューとワーカープール
+
+ジョブは download_queue テーブルに保存され、固定数のワーカースレッドが
+全体および放送局ごとの同時実行数の上限を守りながら取り出して実行する。
+実行中のジョブはハートビートを更新し、途絶えたもの(再起動などで中断されたもの)は
+起動時に待機状態へ戻される。
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Callable, NamedTuple, Optional, Set, Tuple
+
+from .database import get_db_connection, status_writer
+from .job_events import insert_event
+from .metrics import sqlite_lock_wait
+
+# 全体の同時ダウンロード数(全プロセス合計)
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "3"))
+# 放送局ごとの同時ダウンロード数
+MAX_DOWNLOADS_PER_STATION = int(os.getenv("MAX_DOWNLOADS_PER_STATION", "2"))
+POLL_INTERVAL = 1.0  # 新規ジョブの確認間隔(秒)
+HEARTBEAT_INTERVAL = 10.0  # 実行中ジョブの生存通知間隔(秒)
+STALE_AFTER = 60  # この秒数ハートビートがなければ中断されたとみなす
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60  # 冪等キーを覚えておく秒数
+
+
+def enqueue_job(
+    conn: sqlite3.Connection,
+    job_id: str,
+    station_id: str,
+    station_name: str,
+    program_title: str,
+    start_time: str,
+    end_time: str,
+    radiko_token: Optional[str],
+    account: Optional[str] = None,
+    not_before: Optional[float] = None,
+):
+    """
+    キューにジョブを追加する（コミットは呼び出し側で行う）。
+    accountを指定すると、実行時にそのアカウントの有効なトークンを使う。
+    not_before(UNIX時刻)を指定すると、その時刻まで取り出されない。
+    """
+    conn.execute(
+        "INSERT INTO download_queue (job_id, station_id, station_name, program_title, start_time, end_time, radiko_token, account, not_before) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            job_id,
+            station_id,
+            station_name,
+            program_title,
+            start_time,
+            end_time,
+            radiko_token,
+            account,
+            not_before,
+        ),
+    )
+
+
+def validate_program_times(start_time: str, end_time: str) -> Optional[str]:
+    """予約する番組の開始・終了時刻(YYYYMMDDhhmmss)を確かめ、不正なら理由を返す"""
+    try:
+        start = datetime.strptime(start_time, "%Y%m%d%H%M%S")
+        end = datetime.strptime(end_time, "%Y%m%d%H%M%S")
+    except ValueError:
+        return "開始・終了時刻は YYYYMMDDhhmmss で指定してください"
+    if end <= start:
+        return "終了時刻は開始時刻より後にしてください"
+    return None
+
+
+class Submission(NamedTuple):
+    """予約の結果"""
+
+    job_id: str
+    status: str  # download_log の状態
+    created: bool  # 新しく登録した(失敗したジョブを再登録した)ならTrue
+
+
+class IdempotencyKeyConflict(ValueError):
+    """同じ冪等キーが別の番組の予約に使われている"""
+
+
+def submit_job(
+    conn: sqlite3.Connection,
+    station_id: str,
+    station_name: str,
+    program_title: str,
+    start_time: str,
+    end_time: str,
+    radiko_token: Optional[str],
+    account: Optional[str] = None,
+    not_before: Optional[float] = None,
+    job_id: Optional[str] = None,
+    idempotency_key: Optional[str] = None,
+) -> Submission:
+    """
+    ダウンロードログとキューにジョブを登録する（コミットは呼び出し側）。
+    同じ番組(放送局・開始・終了時刻)のジョブが待機中・実行中・完了済みならそれを返し、
+    失敗していれば同じジョブIDで再登録する。
+    idempotency_key を指定すると、同じキーの再送には最初の予約と同じジョブを返す。
+    """
+    program = (station_id, start_time, end_time)
+    if idempotency_key:
+        row = conn.execute(
+            """
+            SELECT p.station_id, p.start_time, p.end_time, p.job_id, l.status
+            FROM idempotency_keys AS k
+            JOIN job_programs AS p ON p.job_id = k.job_id
+            JOIN download_log AS l ON l.job_id = k.job_id
+            WHERE k.account = ? AND k.key = ?
+            """,
+            (account or "", idempotency_key),
+        ).fetchone()
+        if row is not None:
+            if tuple(row)[:3] != program:
+                raise IdempotencyKeyConflict(idempotency_key)
+            return Submission(row["job_id"], row["status"], False)
+
+    job_id = job_id or str(uuid.uuid4())
+    # 主キーで番組ごとに1件に絞る。同時に予約されても後から来た方は既存のジョブを使う
+    cursor = conn.execute(
+        "INSERT OR IGNORE INTO job_programs (station_id, start_time, end_time, job_id) VALUES (?, ?, ?, ?)",
+        (*program, job_id),
+    )
+    if cursor.rowcount:
+        conn.execute(
+            "INSERT INTO download_log (job_id, station_id, program_title, start_time, status) VALUES (?, ?, ?, ?, ?)",
+            (
+                job_id,
+                station_id,
+                program_title,
+                datetime.strptime(start_time, "%Y%m%d%H%M%S"),
+                "queued",
+            ),
+        )
+        insert_event(conn, job_id, "status", {"status": "queued", "filename": None})
+        enqueue_job(
+            conn,
+            job_id,
+            station_id,
+            station_name,
+            program_title,
+            start_time,
+            end_time,
+            radiko_token,
+            account,
+            not_before,
+        )
+        submission = Submission(job_id, "queued", True)
+    else:
+        submission = _attach_to_existing(
+            conn, program, radiko_token, account, not_before
+        )
+
+    if account:
+        # 同じ番組を予約した他のアカウントにもジョブのイベントを配る
+        conn.execute(
+            "INSERT OR IGNORE INTO job_accounts (job_id, account) VALUES (?, ?)",
+            (submission.job_id, account),
+        )
+    if idempotency_key:
+        now = time.time()
+        conn.execute(
+            "DELETE FROM idempotency_keys WHERE created_at < ?",
+            (now - IDEMPOTENCY_KEY_TTL,),
+        )
+        conn.execute(
+            "INSERT OR IGNORE INTO idempotency_keys (account, key, job_id, created_at) VALUES (?, ?, ?, ?)",
+            (account or "", idempotency_key, submission.job_id, now),
+        )
+    return submission
+
+
+def _attach_to_existing(
+    conn: sqlite3.Connection,
+    program: Tuple[str, str, str],
+    radiko_token: Optional[str],
+    account: Optional[str],
+    not_before: Optional[float],
+) -> Submission:
+    row = conn.execute(
+        """
+        SELECT p.job_id, l.status FROM job_programs AS p
+        JOIN download_log AS l ON l.job_id = p.job_id
+        WHERE p.station_id = ? AND p.start_time = ? AND p.end_time = ?
+        """,
+        program,
+    ).fetchone()
+    if not row["status"].startswith("failed"):
+        # 待機中・実行中・完了済みのジョブをそのまま返す
+        return Submission(row["job_id"], row["status"], False)
+
+    # 失敗したジョブは同じジョブIDで待機状態に戻す
+    job_id = row["job_id"]
+    conn.execute(
+        "UPDATE download_log SET status = 'queued', filename = NULL WHERE job_id = ?",
+        (job_id,),
+    )
+    conn.execute(
+        """
+        UPDATE download_queue SET
+            state = 'pending',
+            radiko_token = ?,
+            account = COALESCE(?, account),
+            not_before = ?,
+            enqueued_at = CURRENT_TIMESTAMP
+        WHERE job_id = ?
+        """,
+        (radiko_token, account, not_before, job_id),
+    )
+    insert_event(conn, job_id, "status", {"status": "queued", "filename": None})
+    return Submission(job_id, "queued", True)
+
+
+def claim_next_job(
+    conn: sqlite3.Connection,
+    max_running: int = MAX_CONCURRENT_DOWNLOADS,
+    max_per_station: int = MAX_DOWNLOADS_PER_STATION,
+) -> Optional[sqlite3.Row]:
+    """同時実行数の上限内で次のジョブを取り出し、実行中にする"""
+    # 複数プロセスから同時に取り出されないよう書き込みロックを先に取る
+    with sqlite_lock_wait("claim_job"):
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        running = conn.execute(
+            "SELECT COUNT(*) FROM download_queue WHERE state = 'running'"
+        ).fetchone()[0]
+        if running >= max_running:
+            conn.rollback()
+            return None
+        job = conn.execute(
+            """
+            SELECT * FROM download_queue AS q
+            WHERE q.state = 'pending'
+              AND (q.not_before IS NULL OR q.not_before <= ?)
+              AND (
+                SELECT COUNT(*) FROM download_queue AS r
+                WHERE r.state = 'running' AND r.station_id = q.station_id
+              ) < ?
+            ORDER BY q.enqueued_at, q.rowid
+            LIMIT 1
+            """,
+            (time.time(), max_per_station),
+        ).fetchone()
+        if job is None:
+            conn.rollback()
+            return None
+        conn.execute(
+            "UPDATE download_queue SET state = 'running', attempts = attempts + 1, heartbeat_at = CURRENT_TIMESTAMP WHERE job_id = ?",
+            (job["job_id"],),
+        )
+        conn.commit()
+        return job
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def finish_job(conn: sqlite3.Connection, job_id: str):
+    """ジョブをキューから完了扱いにする"""
+    conn.execute(
+        "UPDATE download_queue SET state = 'done', radiko_token = NULL WHERE job_id = ?",
+        (job_id,),
+    )
+    conn.commit()
+
+
+def touch_jobs(conn: sqlite3.Connection, job_ids):
+    """実行中ジョブのハートビートを更新する"""
+    conn.executemany(
+        "UPDATE download_queue SET heartbeat_at = CURRENT_TIMESTAMP WHERE job_id = ? AND state = 'running'",
+        [(job_id,) for job_id in job_ids],
+    )
+    conn.commit()
+
+
+# 成功・失敗が記録済みのジョブ(戻すと次回起動時にもう一度ダウンロードしてしまう)
+_FINISHED = "(status = 'success' OR status LIKE 'failed%')"
+
+
+def requeue_jobs(conn: sqlite3.Connection, job_ids):
+    """停止時に実行中だったジョブを待機状態へ戻す。結果が記録済みのジョブは完了にする"""
+    params = [(job_id,) for job_id in job_ids]
+    conn.executemany(
+        f"""
+        UPDATE download_queue SET state = CASE
+            WHEN job_id IN (SELECT job_id FROM download_log WHERE {_FINISHED})
+            THEN 'done' ELSE 'pending' END
+        WHERE job_id = ? AND state = 'running'
+        """,
+        params,
+    )
+    conn.executemany(
+        f"UPDATE download_log SET status = 'queued' WHERE job_id = ? AND NOT {_FINISHED}",
+        params,
+    )
+    conn.commit()
+
+
+def recover_interrupted_jobs(
+    conn: sqlite3.Connection, stale_after: int = STALE_AFTER
+) -> int:
+    """ハートビートが途絶えた実行中ジョブを待機状態に戻す"""
+    stale = f"-{int(stale_after)} seconds"
+    # 結果を記録したあと完了にする前に止まったジョブは、やり直さずに完了にする
+    conn.execute(
+        f"""
+        UPDATE download_queue SET state = 'done'
+        WHERE state = 'running' AND heartbeat_at < datetime('now', ?)
+          AND job_id IN (SELECT job_id FROM download_log WHERE {_FINISHED})
+        """,
+        (stale,),
+    )
+    conn.execute(
+        """
+        UPDATE download_log SET status = 'queued'
+        WHERE job_id IN (
+            SELECT job_id FROM download_queue
+            WHERE state = 'running' AND heartbeat_at < datetime('now', ?)
+        )
+        """,
+        (stale,),
+    )
+    cursor = conn.execute(
+        "UPDATE download_queue SET state = 'pending' WHERE state = 'running' AND heartbeat_at < datetime('now', ?)",
+        (stale,),
+    )
+    conn.commit()
+    return cursor.rowcount
+
+
+class DownloadWorkerPool:
+    """キューからジョブを取り出して実行する固定サイズのワーカープール"""
+
+    def __init__(
+        self,
+        handler: Callable[[sqlite3.Row], None],
+        workers: int = MAX_CONCURRENT_DOWNLOADS,
+        max_running: int = MAX_CONCURRENT_DOWNLOADS,
+        max_per_station: int = MAX_DOWNLOADS_PER_STATION,
+        poll_interval: float = POLL_INTERVAL,
+    ):
+        self.handler = handler
+        self.workers = workers
+        self.max_running = max_running
+        self.max_per_station = max_per_station
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._running: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def start(self):
+        conn = get_db_connection()
+        recovered = recover_interrupted_jobs(conn)
+        conn.close()
+        if recovered:
+            print(f"中断されていたジョブを{recovered}件再開します")
+
+        self._stopping.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._worker_loop, name=f"download-worker-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        heartbeat = threading.Thread(
+            target=self._heartbeat_loop, name="download-heartbeat", daemon=True
+        )
+        heartbeat.start()
+        self._threads.append(heartbeat)
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+        # 終わらなかったジョブは次回起動時にすぐ再開できるよう戻しておく。
+        # 停止中に終わったジョブの結果がまとめ書き待ちのこともあるので先に書き込む
+        with self._lock:
+            job_ids = list(self._running)
+        if job_ids:
+            status_writer.flush()
+            conn = get_db_connection()
+            requeue_jobs(conn, job_ids)
+            conn.close()
+
+    def notify(self):
+        """新しいジョブが追加されたことをワーカーに知らせる"""
+        self._wakeup.set()
+
+    def _worker_loop(self):
+        conn = get_db_connection()
+        try:
+            while not self._stopping.is_set():
+                try:
+                    job = claim_next_job(conn, self.max_running, self.max_per_station)
+                except sqlite3.OperationalError as e:
+                    print(f"ジョブの取得に失敗しました: {e}")
+                    job = None
+                if job is None:
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+                    continue
+
+                with self._lock:
+                    self._running.add(job["job_id"])
+                try:
+                    self.handler(job)
+                except Exception as e:
+                    print(f"ジョブ {job['job_id']} の実行中にエラー: {e}")
+                finally:
+                    with self._lock:
+                        self._running.discard(job["job_id"])
+                    finish_job(conn, job["job_id"])
+                    # 空いた枠で次のジョブを待っているワーカーを起こす
+                    self._wakeup.set()
+        finally:
+            conn.close()
+
+    def _heartbeat_loop(self):
+        conn = get_db_connection()
+        try:
+            while not self._stopping.wait(HEARTBEAT_INTERVAL):
+                with self._lock:
+                    job_ids = list(self._running)
+                try:
+                    if job_ids:
+                        touch_jobs(conn, job_ids)
+                    # 起動直後にはまだ新しかった中断ジョブもここで回収する
+                    if recover_interrupted_jobs(conn):
+                        self._wakeup.set()
+                except sqlite3.OperationalError as e:
+                    print(f"ハートビートの更新に失敗しました: {e}")
+        finally:
+            conn.close()
@@ -0,0 +1,322 @@
+"""
+録音ライブラリ
+
+録音ファイルのパス・サイズ・再生時間・チェックサムと番組情報を recordings テーブルに
+保存し、一覧はファイルシステムを見ずにここから返す。
+
+- ダウンロードが完了したファイルはその場で登録する(record_download)。
+- アプリの外で追加・削除されたファイルは scan_library で取り込む。前回の走査から
+  mtimeが変わったディレクトリだけを読み直し、その中でもサイズとmtimeが変わった
+  ファイルだけを読み込むので、数万ファイルあっても毎回すべてを読むことはない。
+"""
+
+import hashlib
+import mmap
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime
+from typing import NamedTuple, Optional, Tuple
+
+from .database import get_db_connection
+from .downloader import id3_tag_length
+
+RECORDINGS_DIR = os.getenv("RECORDINGS_DIR", "/recordings")
+LIBRARY_SCAN_INTERVAL = 600  # レコーダーが録音ディレクトリを走査する間隔(秒)
+RECORDING_EXTENSION = ".aac"
+# 保存時のファイル名: <YYYYMMDD-HHMM>_<番組名>.aac
+FILENAME_PATTERN = re.compile(r"^(\d{8})-(\d{4})_(.+)\.aac$")
+# mtimeの更新と同じ瞬間に追加されたファイルを取りこぼさないよう、
+# 走査の直前に変更されたディレクトリは次回も読み直す
+MTIME_GRACE_NS = 2 * 10**9
+
+# ADTSヘッダーのサンプリング周波数インデックス
+ADTS_SAMPLE_RATES = (
+    96000,
+    88200,
+    64000,
+    48000,
+    44100,
+    32000,
+    24000,
+    22050,
+    16000,
+    12000,
+    11025,
+    8000,
+    7350,
+)
+ADTS_FRAME_SAMPLES = 1024
+
+
+class FileInfo(NamedTuple):
+    size: int
+    mtime_ns: int
+    checksum: str  # SHA-256
+    duration: Optional[float]  # ADTSとして読めなければNone
+
+
+def adts_duration(data) -> Optional[float]:
+    """
+    ADTS(.aac)のフレーム数から再生時間(秒)を求める。中身はデコードしない。
+    後処理で先頭に付けたID3v2タグは読み飛ばす
+    """
+    size = len(data)
+    start = 0
+    while True:
+        length = id3_tag_length(data, start)
+        if not length:
+            break
+        start += length
+    if size < start + 7 or data[start] != 0xFF or data[start + 1] & 0xF6 != 0xF0:
+        return None
+    rate_index = (data[start + 2] >> 2) & 0x0F
+    if rate_index >= len(ADTS_SAMPLE_RATES):
+        return None
+    frames = 0
+    pos = start
+    while pos + 7 <= size:
+        if data[pos] != 0xFF or data[pos + 1] & 0xF6 != 0xF0:
+            break  # 末尾の書きかけのフレームなど
+        length = (
+            ((data[pos + 3] & 0x03) << 11) | (data[pos + 4] << 3) | (data[pos + 5] >> 5)
+        )
+        if length < 7:
+            break
+        frames += (data[pos + 6] & 0x03) + 1
+        pos += length
+    return frames * ADTS_FRAME_SAMPLES / ADTS_SAMPLE_RATES[rate_index]
+
+
+def inspect_file(path: str) -> FileInfo:
+    """ファイルを1回だけマップしてチェックサムと再生時間を求める"""
+    with open(path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        if stat.st_size == 0:
+            return FileInfo(0, stat.st_mtime_ns, hashlib.sha256().hexdigest(), None)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            checksum = hashlib.sha256(data).hexdigest()
+            duration = adts_duration(data)
+    return FileInfo(stat.st_size, stat.st_mtime_ns, checksum, duration)
+
+
+def parse_recording_path(relpath: str) -> Optional[Tuple[str, datetime, str]]:
+    """<放送局名>/<YYYYMMDD-HHMM>_<番組名>.aac から (放送局名, 開始時刻, 番組名) を返す"""
+    station_name, _, filename = relpath.rpartition("/")
+    match = FILENAME_PATTERN.match(filename)
+    if not station_name or match is None:
+        return None
+    try:
+        start = datetime.strptime(match.group(1) + match.group(2), "%Y%m%d%H%M")
+    except ValueError:
+        return None
+    return station_name, start, match.group(3).replace("_", " ")
+
+
+def _program_metadata(conn, station_name: str, start: datetime) -> dict:
+    """キューと番組表から番組の情報を探す(アプリの外で追加されたファイル用)"""
+    radiko_start = start.strftime("%Y%m%d%H%M%S")
+    meta = {}
+    job = conn.execute(
+        "SELECT job_id, station_id, program_title, end_time FROM download_queue "
+        "WHERE station_name = ? AND start_time = ? ORDER BY enqueued_at DESC LIMIT 1",
+        (station_name, radiko_start),
+    ).fetchone()
+    if job is not None:
+        meta.update(
+            job_id=job["job_id"],
+            station_id=job["station_id"],
+            program_title=job["program_title"],
+            end_time=job["end_time"],
+        )
+    program = conn.execute(
+        "SELECT station_id, title, end_time, pfm, description FROM programs "
+        "WHERE start_time = ? AND station_name = ?",
+        (radiko_start, station_name),
+    ).fetchone()
+    if program is not None:
+        meta.setdefault("station_id", program["station_id"])
+        meta.setdefault("program_title", program["title"])
+        meta.setdefault("end_time", program["end_time"])
+        meta.update(pfm=program["pfm"], description=program["description"])
+    return meta
+
+
+def _upsert(
+    conn: sqlite3.Connection,
+    relpath: str,
+    info: FileInfo,
+    station_name: str,
+    start: datetime,
+    program_title: str,
+    meta: dict,
+):
+    end_time = meta.get("end_time")
+    conn.execute(
+        """
+        INSERT INTO recordings (
+            path, station_id, station_name, program_title, start_time, end_time,
+            duration, size, mtime_ns, checksum, pfm, description, job_id, indexed_at
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (path) DO UPDATE SET
+            station_id = excluded.station_id,
+            station_name = excluded.station_name,
+            program_title = excluded.program_title,
+            start_time = excluded.start_time,
+            end_time = excluded.end_time,
+            duration = excluded.duration,
+            size = excluded.size,
+            mtime_ns = excluded.mtime_ns,
+            checksum = excluded.checksum,
+            pfm = excluded.pfm,
+            description = excluded.description,
+            job_id = excluded.job_id,
+            indexed_at = excluded.indexed_at
+        """,
+        (
+            relpath,
+            meta.get("station_id"),
+            station_name,
+            meta.get("program_title") or program_title,
+            str(start),
+            str(datetime.strptime(end_time, "%Y%m%d%H%M%S")) if end_time else None,
+            info.duration,
+            info.size,
+            info.mtime_ns,
+            info.checksum,
+            meta.get("pfm"),
+            meta.get("description"),
+            meta.get("job_id"),
+            time.time(),
+        ),
+    )
+
+
+def record_download(
+    output_path: str,
+    job_id: str,
+    station_id: str,
+    station_name: str,
+    program_title: str,
+    start_time: str,
+    end_time: str,
+    root: Optional[str] = None,
+) -> dict:
+    """ダウンロードが完了したファイルをライブラリに登録し、番組の情報を返す"""
+    root = root or RECORDINGS_DIR
+    info = inspect_file(output_path)
+    relpath = os.path.relpath(output_path, root).replace(os.sep, "/")
+    # 放送局名は走査時と揃えてディレクトリ名("/"を置き換えたもの)で保存する
+    station_dir = relpath.rpartition("/")[0]
+    start = datetime.strptime(start_time, "%Y%m%d%H%M%S")
+    conn = get_db_connection()
+    try:
+        meta = _program_metadata(conn, station_name, start)
+        meta.update(
+            job_id=job_id,
+            station_id=station_id,
+            program_title=program_title,
+            end_time=end_time,
+        )
+        _upsert(conn, relpath, info, station_dir, start, program_title, meta)
+        conn.commit()
+    finally:
+        conn.close()
+    return dict(meta, station_name=station_name, start_time=start_time)
+
+
+def _scan_directory(
+    conn: sqlite3.Connection, root: str, station_name: str
+) -> Tuple[int, int]:
+    """1つの放送局ディレクトリを読み直し、(登録・更新した数, 削除した数) を返す"""
+    known = {
+        row["path"]: (row["size"], row["mtime_ns"])
+        for row in conn.execute(
+            "SELECT path, size, mtime_ns FROM recordings WHERE station_name = ?",
+            (station_name,),
+        )
+    }
+    updated = 0
+    seen = set()
+    with os.scandir(os.path.join(root, station_name)) as entries:
+        for entry in entries:
+            if not entry.name.endswith(RECORDING_EXTENSION) or not entry.is_file():
+                continue
+            relpath = f"{station_name}/{entry.name}"
+            parsed = parse_recording_path(relpath)
+            if parsed is None:
+                continue
+            seen.add(relpath)
+            stat = entry.stat()
+            if known.get(relpath) == (stat.st_size, stat.st_mtime_ns):
+                continue
+            try:
+                info = inspect_file(entry.path)
+            except OSError as e:
+                print(f"録音ファイルを読めません ({relpath}): {e}")
+                continue
+            _, start, title = parsed
+            meta = _program_metadata(conn, station_name, start)
+            _upsert(conn, relpath, info, station_name, start, title, meta)
+            updated += 1
+    removed = [(path,) for path in known if path not in seen]
+    conn.executemany("DELETE FROM recordings WHERE path = ?", removed)
+    return updated, len(removed)
+
+
+def scan_library(root: str = RECORDINGS_DIR) -> Tuple[int, int]:
+    """
+    前回から変更されたディレクトリだけを走査してライブラリを更新する。
+    (登録・更新したファイル数, 削除したファイル数) を返す。
+    """
+    if not os.path.isdir(root):
+        return 0, 0
+    started_ns = time.time_ns()
+    conn = get_db_connection()
+    updated = removed = 0
+    try:
+        known_dirs = {
+            row["path"]: row["mtime_ns"]
+            for row in conn.execute("SELECT path, mtime_ns FROM library_dirs")
+        }
+        present = set()
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    continue
+                present.add(entry.name)
+                mtime_ns = entry.stat().st_mtime_ns
+                if known_dirs.get(entry.name) == mtime_ns:
+                    continue
+                counts = _scan_directory(conn, root, entry.name)
+                updated += counts[0]
+                removed += counts[1]
+                if started_ns - mtime_ns > MTIME_GRACE_NS:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO library_dirs (path, mtime_ns) VALUES (?, ?)",
+                        (entry.name, mtime_ns),
+                    )
+                else:
+                    conn.execute(
+                        "DELETE FROM library_dirs WHERE path = ?", (entry.name,)
+                    )
+                # 大きなディレクトリの走査中に書き込みロックを持ち続けない
+                conn.commit()
+        # 消えたディレクトリのファイルを削除する
+        indexed = {
+            row[0]
+            for row in conn.execute("SELECT DISTINCT station_name FROM recordings")
+        }
+        for name in (known_dirs.keys() | indexed) - present:
+            cursor = conn.execute(
+                "DELETE FROM recordings WHERE station_name = ?", (name,)
+            )
+            removed += cursor.rowcount
+            conn.execute("DELETE FROM library_dirs WHERE path = ?", (name,))
+        conn.commit()
+    finally:
+        conn.close()
+    if updated or removed:
+        print(f"録音ライブラリを更新しました (更新 {updated}件, 削除 {removed}件)")
+    return updated, removed
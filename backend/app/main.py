@@ -1,27 +1,73 @@
 import base64
 import math
-import os
-import shlex
-import subprocess
-import uuid
-import xml.etree.ElementTree as ET
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import List, Optional
 
-import pytz
-import requests
-from apscheduler.schedulers.background import BackgroundScheduler
-from fastapi import Depends, FastAPI, Form, Header, HTTPException, Query
+from fastapi import Depends, FastAPI, Form, Header, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, EmailStr
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, EmailStr, Field, TypeAdapter
+
+from .auto_record import backfill_rule, create_rule, weekday_list
+from .database import get_db_connection, init_db, status_writer
+from .delivery import recording_response
+from .guide_cache import guide_cache
+from .http_cache import (
+    CACHE_PRIVATE,
+    RenderedBody,
+    RenderedCache,
+    cached_response,
+    max_age,
+)
+from .job_events import event_stream, job_events
+from .job_queue import IdempotencyKeyConflict, submit_job, validate_program_times
+from .metrics import render_metrics, sqlite_lock_wait
+from .program_index import is_index_complete, search_local_programs
+from .radiko import (
+    JST,
+    AreaGuideResponse,
+    GuideResponse,
+    SearchResponse,
+    SearchResult,
+    Station,
+)
+from .radiko_client import radiko_client
+from .recorder import EMBEDDED_RECORDER, download_workers
+from .security import (
+    RECORDING_LINK_EXPIRE_MINUTES,
+    SECRET_KEY_IS_DEFAULT,
+    create_access_token,
+    create_recording_token,
+    get_current_user,
+    verify_recording_token,
+    warn_default_secret_key,
+)
+from .station_map import station_map
+from .token_manager import token_manager
 
-from .database import get_db_connection
-from .security import create_access_token, get_current_user
 
 # --------------------------------------------------------------------------
 # FastAPIの初期化とグローバル変数
 # --------------------------------------------------------------------------
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_db()
+    warn_default_secret_key()
+    # 放送局マップをSQLiteから読み込み、古ければバックグラウンドで取得しておく
+    station_map.ensure_loaded()
+    # 通常ダウンロードは別プロセスのレコーダー(app.recorder)が実行する
+    if EMBEDDED_RECORDER:
+        download_workers.start()
+    yield
+    if EMBEDDED_RECORDER:
+        download_workers.stop(timeout=5)
+        status_writer.flush()
+    await radiko_client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # CORSミドルウェアの設定
 origins = [
@@ -37,19 +83,14 @@ app.add_middleware(
     allow_headers=["*"],  # 全てのヘッダーを許可
 )
 
-scheduler = BackgroundScheduler(timezone="Asia/Tokyo")
-scheduler.start()
-
-JST = pytz.timezone("Asia/Tokyo")
-
-# 全国放送局IDと名前の対応表をキャッシュするためのグローバル変数
-station_id_to_name_cache: Dict[str, str] = {}
-ALL_AREA_IDS = [f"JP{i}" for i in range(1, 48)]
 SEARCH_RESULTS_PER_PAGE = 10  # 検索結果の1ページあたりの件数
+JOBS_PER_PAGE = 50  # ジョブ一覧の1ページあたりの件数
+LOGINS_PER_PAGE = 10  # ログイン履歴の1ページあたりの件数
+MAX_BATCH_SIZE = 200  # 一度にまとめて予約できる番組数
+STATION_LIST_TTL = 3600  # エリアの放送局リストをプロセス内に保持する時間(秒)
 
-radiko_session = None
-user_email = None
-user_password = None
+station_lists = RenderedCache(STATION_LIST_TTL)
+_station_list_adapter = TypeAdapter(List[Station])
 
 
 # --------------------------------------------------------------------------
@@ -68,62 +109,55 @@ class LoginResponse(BaseModel):
     radiko_token: str
 
 
-class Station(BaseModel):
-    id: str
-    name: str
+class DownloadRequest(BaseModel):
+    station_id: str
+    station_name: str
+    program_title: str
+    start_time: str
+    end_time: str
+    # 実行時にはログインしたアカウントのトークンを使う。取り直せない場合の予備
+    radiko_token: Optional[str] = None
 
 
-class Program(BaseModel):
-    title: str
-    start_time: datetime
-    end_time: datetime
-    duration: int
-    pfm: Optional[str] = None
-    image_url: Optional[str] = None  # 画像がない場合もあるのでOptional
+class JobStep(BaseModel):
+    """ダウンロード後の後処理の1ステップ"""
 
+    step: str
+    status: str  # pending / running / success / failed / skipped
+    output: Optional[str] = None  # 変換で作ったファイル
+    message: Optional[str] = None
 
-class GuideResponse(BaseModel):
-    station_name: str
-    programs: List[Program]
 
+class BatchDownloadRequest(BaseModel):
+    """複数の番組をまとめて予約する"""
 
-class SearchResult(BaseModel):
-    """検索結果の単一プログラムを表すモデル"""
+    items: List[DownloadRequest] = Field(..., min_length=1, max_length=MAX_BATCH_SIZE)
 
-    title: str
-    station_id: str
-    station_name: str  # APIからは取得できないため、station_idと同じ値を入れる
-    start_time: datetime
-    end_time: datetime
-    pfm: Optional[str] = None
-    image_url: Optional[str] = None
 
+class BatchDownloadResult(BaseModel):
+    """まとめて予約した番組ごとの結果。errorがあれば予約していない"""
 
-class SearchResponse(BaseModel):
-    """ページング情報を含む検索結果を返すためのモデル"""
+    index: int
+    job_id: Optional[str] = None
+    status: Optional[str] = None
+    created: bool = False  # Falseなら予約済みのジョブを返した
+    error: Optional[str] = None
 
-    programs: List[SearchResult]
-    total_results: int
-    current_page: int
-    total_pages: int
 
-
-class DownloadRequest(BaseModel):
-    station_id: str
-    station_name: str
-    program_title: str
-    start_time: str
-    end_time: str
-    radiko_token: str
+class BatchDownloadResponse(BaseModel):
+    results: List[BatchDownloadResult]
+    scheduled: int  # 新しく登録したジョブ数
 
 
 class DownloadJob(BaseModel):
     id: int
+    job_id: Optional[str] = None  # 進捗イベントとの対応付けに使う
     program_title: str
     station_id: str
     start_time: datetime
     status: str
     filename: Optional[str] = None
+    steps: List[JobStep] = []
 
 
 class LoginHistory(BaseModel):
@@ -138,169 +172,230 @@ class StatusResponse(BaseModel):
     logins: List[LoginHistory]
 
 
-# --------------------------------------------------------------------------
-# Radikoの認証ロジック
-# --------------------------------------------------------------------------
-def radiko_authenticate(mail: str, password: str):
-    global radiko_session
-    # (以前のコードとほぼ同じ。エラーハンドリングをFastAPI流に)
-    try:
-        radiko_session = requests.Session()
-        res_login = radiko_session.post(
-            "https://radiko.jp/v4/api/member/login",
-            data={"mail": mail, "pass": password},
-        )
-        res_login.raise_for_status()
-        premium_cookie = radiko_session.cookies
-        session_id = res_login.json()["radiko_session"]
-        print(session_id)
-
-        headers = {
-            "User-Agent": "curl/7.52.1",
-            "Accept": "*/*",
-            "X-Radiko-App": "pc_html5",
-            "X-Radiko-App-Version": "0.0.1",
-            "X-Radiko-Device": "pc",
-            "X-Radiko-User": "dummy_user",
-        }
-        res1 = radiko_session.get(
-            "https://radiko.jp/v2/api/auth1", headers=headers, cookies=premium_cookie
-        )
-        res1.raise_for_status()
+class JobPage(BaseModel):
+    """ジョブ一覧の1ページ分。next_cursorを渡すと続きを取得できる"""
 
-        auth_token = res1.headers["X-Radiko-AuthToken"]
-        key_length = int(res1.headers["X-Radiko-KeyLength"])
-        key_offset = int(res1.headers["X-Radiko-KeyOffset"])
+    jobs: List[DownloadJob]
+    next_cursor: Optional[str] = None
 
-        radiko_key = "bcd151073c03b352e1ef2fd66c32209da9ca0afa"
-        partial_key_bytes = radiko_key[key_offset : key_offset + key_length].encode(
-            "utf-8"
-        )
-        partial_key = base64.b64encode(partial_key_bytes).decode("utf-8")
 
-        headers.update(
-            {
-                "X-Radiko-AuthToken": auth_token,
-                "X-Radiko-PartialKey": partial_key,
-            }
-        )
-        res2 = radiko_session.get(
-            f"https://radiko.jp/v2/api/auth2?radiko_session={session_id}",
-            headers=headers,
-            cookies=premium_cookie,
-        )
-        res2.raise_for_status()
+class LoginPage(BaseModel):
+    logins: List[LoginHistory]
+    next_cursor: Optional[str] = None
 
-        area_id = res2.text.split(",")[0]
-        return TokenData(auth_token=auth_token, area_id=area_id)
-    except requests.exceptions.RequestException as e:
-        # FastAPIではHTTPExceptionをraiseするのが一般的
-        raise HTTPException(
-            status_code=401, detail=f"Radiko authentication failed: {e}"
-        )
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"An unexpected error occurred during authentication: {e}",
-        )
 
+class Recording(BaseModel):
+    id: int
+    path: str  # 録音ディレクトリからの相対パス
+    station_id: Optional[str] = None
+    station_name: str
+    program_title: str
+    start_time: datetime
+    end_time: Optional[datetime] = None
+    duration: Optional[float] = None  # 秒
+    size: int
+    checksum: str
+    pfm: Optional[str] = None
+    description: Optional[str] = None
+    job_id: Optional[str] = None
 
-def get_station_list(area_id: str, auth_token: str) -> List[Station]:
-    url = f"http://radiko.jp/v3/station/list/{area_id}.xml"
-    headers = {"X-Radiko-AuthToken": auth_token}
-    try:
-        res = requests.get(url, headers=headers)
-        res.raise_for_status()
-        stations = []
-        root = ET.fromstring(res.content)
-        for station in root.findall("station"):
-            stations.append(
-                Station(id=station.find("id").text, name=station.find("name").text)
-            )
-        return stations
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"放送局リストの取得に失敗: {e}")
 
+class RecordingPage(BaseModel):
+    recordings: List[Recording]
+    next_cursor: Optional[str] = None
 
-def build_station_map(auth_token: str):
-    global station_id_to_name_cache
-    if station_id_to_name_cache:
-        return
 
-    print("全国の放送局情報を取得・キャッシュします...")
-    for area_id in ALL_AREA_IDS:
-        stations_in_area = get_station_list(area_id, auth_token)
-        for station in stations_in_area:
-            station_id_to_name_cache[station.id] = station.name
-    print(f"放送局情報のキャッシュが完了しました ({len(station_id_to_name_cache)}局)")
+HHMM_PATTERN = r"^([01][0-9]|2[0-3]):[0-5][0-9]$"
 
 
-def get_program_guide(station_id: str, date_str: str, auth_token: str) -> GuideResponse:
-    url = f"http://radiko.jp/v3/program/station/date/{date_str}/{station_id}.xml"
-    headers = {"X-Radiko-AuthToken": auth_token}
-    try:
-        res = requests.get(url, headers=headers)
-        res.raise_for_status()
-        programs = []
-        root = ET.fromstring(res.content)
-        station_name = root.find(".//station/name").text
-        for prog in root.findall(".//prog"):
-            image_elem = prog.find("img")
-            programs.append(
-                Program(
-                    title=prog.find("title").text,
-                    start_time=JST.localize(
-                        datetime.strptime(prog.get("ft"), "%Y%m%d%H%M%S")
-                    ),
-                    end_time=JST.localize(
-                        datetime.strptime(prog.get("to"), "%Y%m%d%H%M%S")
-                    ),
-                    duration=int(prog.get("dur")),
-                    pfm=prog.find("pfm").text if prog.find("pfm") is not None else "",
-                    image_url=image_elem.text if image_elem is not None else None,
-                )
-            )
-        return GuideResponse(station_name=station_name, programs=programs)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"番組表の取得に失敗: {e}")
+class AutoRecordRuleRequest(BaseModel):
+    """自動録音ルール。指定した条件をすべて満たす番組を録音する"""
 
+    name: str
+    keyword: Optional[str] = None  # 番組名・番組説明に含まれる語
+    performer: Optional[str] = None  # 出演者に含まれる語
+    station_id: Optional[str] = None
+    weekdays: Optional[List[int]] = Field(None, min_length=1)  # 0=月曜(放送日基準)
+    start_after: Optional[str] = Field(None, pattern=HHMM_PATTERN)
+    start_before: Optional[str] = Field(None, pattern=HHMM_PATTERN)
 
-def search_radiko_programs(
-    keyword: str, auth_token: str, page: int = 1
-) -> SearchResponse:
-    build_station_map(auth_token)
 
-    url = "https://radiko.jp/v3/api/program/search"
-    params = {"key": keyword, "page_idx": page - 1}
-    headers = {"X-Radiko-AuthToken": auth_token}
+class AutoRecordRule(AutoRecordRuleRequest):
+    id: int
+    weekdays: List[int]
+    enabled: bool
+
 
+# --------------------------------------------------------------------------
+# ジョブ・ログイン履歴の一覧 (キーセットページング)
+# --------------------------------------------------------------------------
+def encode_cursor(*values) -> str:
+    raw = "\t".join(str(value) for value in values)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, *types: type) -> list:
+    """encode_cursor() の逆。各値を types の型に変換し、合わなければ400を返す"""
     try:
-        res = requests.get(url, headers=headers, params=params)
-        res.raise_for_status()
-        data = res.json()
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 401:
-            raise HTTPException(
-                status_code=401,
-                detail="Radiko API authentication failed. Token might be expired.",
-            )
-        else:
-            raise HTTPException(
-                status_code=502,
-                detail=f"Radiko API returned an error: {e.response.status_code}",
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        values = raw.split("\t")
+        if len(values) == len(types):
+            return [convert(value) for convert, value in zip(types, values)]
+    except ValueError:
+        pass
+    raise HTTPException(status_code=400, detail="カーソルが不正です")
+
+
+def query_jobs(
+    conn,
+    limit: int,
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    station_id: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+) -> JobPage:
+    """開始時刻の新しい順にジョブを返す。日付はYYYYMMDD(date_toの日を含む)"""
+    conditions, params = [], []
+    if cursor:
+        start_time, job_id = decode_cursor(cursor, str, int)
+        conditions.append("(start_time, id) < (?, ?)")
+        params += [start_time, job_id]
+    if status:
+        # "failed" は "failed: 理由" もまとめて対象にする
+        conditions.append("(status = ? OR status LIKE ?)")
+        params += [status, f"{status}:%"]
+    if station_id:
+        conditions.append("station_id = ?")
+        params.append(station_id)
+    try:
+        if date_from:
+            conditions.append("start_time >= ?")
+            params.append(str(datetime.strptime(date_from, "%Y%m%d")))
+        if date_to:
+            conditions.append("start_time < ?")
+            params.append(str(datetime.strptime(date_to, "%Y%m%d") + timedelta(days=1)))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="日付はYYYYMMDDで指定してください")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    # 1件多く取得して次のページがあるかを判定する
+    rows = conn.execute(
+        f"SELECT id, job_id, program_title, station_id, start_time, status, filename "
+        f"FROM download_log {where} ORDER BY start_time DESC, id DESC LIMIT ?",
+        [*params, limit + 1],
+    ).fetchall()
+    jobs = [DownloadJob.model_validate(dict(row)) for row in rows[:limit]]
+    attach_job_steps(conn, jobs)
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(last["start_time"], last["id"])
+    return JobPage(jobs=jobs, next_cursor=next_cursor)
+
+
+def attach_job_steps(conn, jobs: List[DownloadJob]):
+    """ページ内のジョブの後処理の状態をまとめて読み込む"""
+    by_id = {job.job_id: job for job in jobs if job.job_id}
+    if not by_id:
+        return
+    placeholders = ",".join("?" * len(by_id))
+    rows = conn.execute(
+        f"SELECT job_id, step, status, output, message FROM postprocess_steps "
+        f"WHERE job_id IN ({placeholders}) ORDER BY job_id, position",
+        list(by_id),
+    ).fetchall()
+    for row in rows:
+        by_id[row["job_id"]].steps.append(
+            JobStep(
+                step=row["step"],
+                status=row["status"],
+                output=row["output"],
+                message=row["message"],
             )
-    except Exception as e:
-        raise HTTPException(
-            status_code=500, detail=f"Failed to connect to Radiko API: {e}"
         )
 
+
+def query_recordings(
+    conn,
+    limit: int,
+    cursor: Optional[str] = None,
+    station_name: Optional[str] = None,
+    keyword: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+) -> RecordingPage:
+    """録音ライブラリを放送日時の新しい順に返す。日付はYYYYMMDD(date_toの日を含む)"""
+    conditions, params = [], []
+    if cursor:
+        start_time, recording_id = decode_cursor(cursor, str, int)
+        conditions.append("(start_time, id) < (?, ?)")
+        params += [start_time, recording_id]
+    if station_name:
+        conditions.append("station_name = ?")
+        params.append(station_name)
+    if keyword:
+        conditions.append("(program_title LIKE ? OR pfm LIKE ?)")
+        params += [f"%{keyword}%"] * 2
+    try:
+        if date_from:
+            conditions.append("start_time >= ?")
+            params.append(str(datetime.strptime(date_from, "%Y%m%d")))
+        if date_to:
+            conditions.append("start_time < ?")
+            params.append(str(datetime.strptime(date_to, "%Y%m%d") + timedelta(days=1)))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="日付はYYYYMMDDで指定してください")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    rows = conn.execute(
+        f"SELECT * FROM recordings {where} ORDER BY start_time DESC, id DESC LIMIT ?",
+        [*params, limit + 1],
+    ).fetchall()
+    recordings = [Recording.model_validate(dict(row)) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(last["start_time"], last["id"])
+    return RecordingPage(recordings=recordings, next_cursor=next_cursor)
+
+
+def query_logins(conn, limit: int, cursor: Optional[str] = None) -> LoginPage:
+    """新しい順にログイン履歴を返す"""
+    conditions, params = "", []
+    if cursor:
+        (login_id,) = decode_cursor(cursor, int)
+        conditions = "WHERE id < ?"
+        params.append(login_id)
+    rows = conn.execute(
+        f"SELECT * FROM login_history {conditions} ORDER BY id DESC LIMIT ?",
+        [*params, limit + 1],
+    ).fetchall()
+    logins = [LoginHistory.model_validate(dict(row)) for row in rows[:limit]]
+    next_cursor = encode_cursor(rows[limit - 1]["id"]) if len(rows) > limit else None
+    return LoginPage(logins=logins, next_cursor=next_cursor)
+
+
+# --------------------------------------------------------------------------
+# Radikoの認証ロジック
+# --------------------------------------------------------------------------
+async def radiko_authenticate(mail: str, password: str) -> TokenData:
+    auth_token, area_id = await radiko_client.authenticate(mail, password)
+    return TokenData(auth_token=auth_token, area_id=area_id)
+
+
+async def search_radiko_programs(
+    keyword: str, auth_token: str, page: int = 1
+) -> SearchResponse:
+    # SQLiteからの読み直しでイベントループを止めない
+    await run_in_threadpool(station_map.ensure_loaded, auth_token)
+    data = await radiko_client.search(keyword, auth_token, page)
+
     programs = []
     total_results = data.get("meta", {}).get("result_count", 0)
 
     for prog in data.get("data", []):
         try:
             station_id = prog.get("station_id")
-            station_name = station_id_to_name_cache.get(station_id, station_id)
+            station_name = station_map.name(station_id)
 
             # 日付文字列がNoneでないことを確認
             start_time_str = prog.get("start_time")
@@ -340,78 +435,6 @@ def search_radiko_programs(
     )
 
 
-def update_job_status(job_id, status, filename=None):
-    """ダウンロードジョブの状態をデータベースに保存する"""
-    conn = get_db_connection()
-    conn.execute(
-        "UPDATE download_log SET status = ?, filename = ? WHERE job_id = ?",
-        (status, filename, job_id),
-    )
-    conn.commit()
-    conn.close()
-
-
-def start_download_job(
-    job_id,
-    station_id,
-    station_name,
-    program_title,
-    start_time_str,
-    end_time_str,
-    radiko_token: str,
-):
-    """スケジューラから呼び出されるダウンロード実行関数"""
-    update_job_status(job_id, "downloading")
-
-    if not radiko_token:
-        update_job_status(job_id, "failed: Radikoトークンなし")
-        return
-
-    try:
-        stream_url = f"https://radiko.jp/v2/api/ts/playlist.m3u8?station_id={station_id}&l=15&ft={start_time_str}&to={end_time_str}"
-
-        save_dir = os.path.join("/recordings", station_name.replace("/", "／"))
-        os.makedirs(save_dir, exist_ok=True)
-
-        safe_title = (
-            program_title.replace("/", "／").replace(":", "：").replace(" ", "_")
-        )
-        output_filename = (
-            f"{start_time_str[:8]}-{start_time_str[8:12]}_{safe_title}.aac"
-        )
-        output_path = os.path.join(save_dir, output_filename)
-
-        headers_str = f"X-Radiko-AuthToken: {radiko_token}"
-        command = [
-            "ffmpeg",
-            "-loglevel",
-            "error",
-            "-headers",
-            headers_str,
-            "-i",
-            stream_url,
-            "-acodec",
-            "copy",
-            output_path,
-        ]
-
-        print(f"--- FFmpeg Command For Job {job_id} ---")
-        print(shlex.join(command))
-
-        subprocess.run(command, check=True, capture_output=True, text=True)
-        update_job_status(job_id, "success", output_filename)
-
-    except subprocess.CalledProcessError as e:
-        error_message = e.stderr.strip()
-        # トークン期限切れ(401 Unauthorized)を検知
-        if "401 Unauthorized" in error_message:
-            update_job_status(job_id, "failed: Radikoトークンの有効期限切れ")
-        else:
-            update_job_status(job_id, f"failed: {error_message.splitlines()[-1]}")
-    except Exception as e:
-        update_job_status(job_id, f"failed: {str(e)}")
-
-
 # --------------------------------------------------------------------------
 # APIエンドポイント
 # --------------------------------------------------------------------------
@@ -420,24 +443,41 @@ def health():
     return {"status": "ok"}
 
 
-@app.post("/api/login", response_model=LoginResponse, tags=["Auth"])
-def login(email: EmailStr = Form(...), password: str = Form(...)):
-    global user_email, user_password
-    user_email = email
-    user_password = password
-    token_data = radiko_authenticate(email, password)
+@app.get("/metrics")
+def metrics():
+    """Prometheus用。NGINXは /api 以外を転送しないので、コンテナ内部からのみ取得できる"""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
 
+def record_login(email: str, status: str):
     conn = get_db_connection()
-    status = "success" if token_data else "failed"
     conn.execute(
         "INSERT INTO login_history (email, status) VALUES (?, ?)", (email, status)
     )
     conn.commit()
     conn.close()
 
+
+@app.post("/api/login", response_model=LoginResponse, tags=["Auth"])
+async def login(email: EmailStr = Form(...), password: str = Form(...)):
+    token_data = await radiko_authenticate(email, password)
+
+    status = "success" if token_data else "failed"
+    await run_in_threadpool(record_login, email, status)
+
     if not token_data:
         raise HTTPException(status_code=401, detail="Login failed")
 
+    # 予約したジョブの実行時に再認証できるよう、サーバー側で保持する
+    await run_in_threadpool(
+        token_manager.save_account,
+        email,
+        password,
+        token_data.auth_token,
+        token_data.area_id,
+    )
+
     # ★★★ JWTアクセス・トークンを生成 ★★★
     access_token = create_access_token(
         data={
@@ -453,13 +493,33 @@ def login(email: EmailStr = Form(...), password: str = Form(...)):
 
 
 @app.get("/api/stations/{area_id}", response_model=List[Station], tags=["Stations"])
-def get_stations_in_area(
+async def get_stations_in_area(
     area_id: str,
+    request: Request,
     x_radiko_authtoken: str = Header(...),
     current_user: str = Depends(get_current_user),
 ):
     """指定されたエリアの放送局リストを取得する"""
-    return get_station_list(area_id, x_radiko_authtoken)
+    cached = station_lists.get(area_id)
+    if cached is None:
+        stations = await radiko_client.get_station_list(area_id, x_radiko_authtoken)
+        rendered = RenderedBody(
+            _station_list_adapter.dump_json(
+                _station_list_adapter.validate_python(stations)
+            )
+        )
+        station_lists.put(area_id, rendered)
+        cached = rendered, STATION_LIST_TTL
+    rendered, remaining = cached
+    # 放送局リストはエリアごとに共通だが、認証が必要なので共有キャッシュには置かせない
+    return cached_response(request, rendered, max_age(remaining, public=False))
+
+
+async def guide_response(request: Request, entry) -> Response:
+    """番組表キャッシュのエントリーを返す。JSON化と圧縮は初回だけスレッドプールで行う"""
+    return await run_in_threadpool(
+        cached_response, request, entry.render(), guide_cache.cache_control(entry)
+    )
 
 
 @app.get(
@@ -467,73 +527,400 @@ def get_stations_in_area(
     response_model=GuideResponse,
     tags=["Programs"],
 )
-def get_guide_for_station(
+async def get_guide_for_station(
     station_id: str,
     date_str: str,
+    request: Request,
     x_radiko_authtoken: str = Header(...),
     current_user: str = Depends(get_current_user),
 ):
     """指定された放送局・日付の番組表を取得する"""
-    return get_program_guide(station_id, date_str, x_radiko_authtoken)
+    entry = await guide_cache.aget_station_guide_entry(
+        station_id, date_str, x_radiko_authtoken
+    )
+    return await guide_response(request, entry)
+
+
+@app.get(
+    "/api/guide/area/{area_id}/{date_str}",
+    response_model=AreaGuideResponse,
+    tags=["Programs"],
+)
+async def get_guide_for_area(
+    area_id: str,
+    date_str: str,
+    request: Request,
+    x_radiko_authtoken: str = Header(...),
+    current_user: str = Depends(get_current_user),
+):
+    """指定されたエリア・日付の全放送局の番組表をまとめて取得する"""
+    entry = await guide_cache.aget_area_guide_entry(
+        area_id, date_str, x_radiko_authtoken
+    )
+    return await guide_response(request, entry)
 
 
 @app.get("/api/search/{keyword}", response_model=SearchResponse, tags=["Radiko API"])
-def search_programs(
+async def search_programs(
     keyword: str,
     page: int = Query(1, ge=1),
+    per_page: int = Query(SEARCH_RESULTS_PER_PAGE, ge=1, le=100),
+    station_id: Optional[str] = None,
+    source: str = Query("auto", pattern="^(auto|local|remote)$"),
     x_radiko_authtoken: str = Header(...),
     current_user: str = Depends(get_current_user),
 ):
-    return search_radiko_programs(keyword, x_radiko_authtoken, page)
+    """
+    番組を検索する。
+    source=auto ではローカルの検索インデックスが揃っていればそれを使い、
+    使えない検索語(2文字以下の語)やヒットなしの場合はRadikoの検索APIに問い合わせる。
+    per_page と station_id はローカル検索でのみ有効。
+    """
+    if source != "remote" and (
+        source == "local" or await run_in_threadpool(is_index_complete)
+    ):
+        result = await run_in_threadpool(
+            search_local_programs, keyword, page, per_page, station_id
+        )
+        if source == "local":
+            if result is None:
+                raise HTTPException(
+                    status_code=400,
+                    detail="ローカル検索では3文字以上の語を指定してください",
+                )
+            return result
+        if result is not None and result.total_results > 0:
+            return result
+    return await search_radiko_programs(keyword, x_radiko_authtoken, page)
 
 
 @app.post("/api/download", status_code=202, tags=["Jobs"])
 def schedule_download(
-    request: DownloadRequest, current_user: str = Depends(get_current_user)
+    request: DownloadRequest,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, max_length=200),
+    current_user: str = Depends(get_current_user),
 ):
-    """ダウンロードジョブをスケジュールする"""
-    job_id = str(uuid.uuid4())
-    start_time_dt = datetime.strptime(request.start_time, "%Y%m%d%H%M%S")
+    """
+    ダウンロードジョブをスケジュールする。
+    同じ番組のジョブが待機中・実行中・完了済みなら、新しく作らずにそのジョブを返す(200)。
+    """
+    error = validate_program_times(request.start_time, request.end_time)
+    if error:
+        raise HTTPException(status_code=422, detail=error)
 
     conn = get_db_connection()
-    conn.execute(
-        "INSERT INTO download_log (job_id, station_id, program_title, start_time, status) VALUES (?, ?, ?, ?, ?)",
-        (job_id, request.station_id, request.program_title, start_time_dt, "queued"),
-    )
-    conn.commit()
-    conn.close()
-
-    scheduler.add_job(
-        start_download_job,
-        "date",
-        run_date=datetime.now(JST) + timedelta(seconds=1),
-        args=[
-            job_id,
+    try:
+        # 同時に届いた同じ予約が両方とも未登録と判断しないよう、書き込みロックを先に取る
+        with sqlite_lock_wait("submit_job"):
+            conn.execute("BEGIN IMMEDIATE")
+        submission = submit_job(
+            conn,
             request.station_id,
             request.station_name,
             request.program_title,
             request.start_time,
             request.end_time,
             request.radiko_token,
-        ],  # radiko_tokenを渡す
+            current_user,
+            idempotency_key=idempotency_key,
+        )
+        conn.commit()
+    except IdempotencyKeyConflict:
+        raise HTTPException(
+            status_code=422,
+            detail="Idempotency-Key が別の番組の予約に使われています",
+        )
+    finally:
+        conn.close()
+
+    if not submission.created:
+        response.status_code = 200
+        return {
+            "message": "Download already scheduled",
+            "job_id": submission.job_id,
+            "status": submission.status,
+        }
+    # 同一プロセスでワーカーが動いている場合はすぐに起こす
+    download_workers.notify()
+    return {
+        "message": "Download scheduled",
+        "job_id": submission.job_id,
+        "status": submission.status,
+    }
+
+
+@app.post(
+    "/api/download/batch",
+    response_model=BatchDownloadResponse,
+    status_code=202,
+    tags=["Jobs"],
+)
+def schedule_downloads(
+    request: BatchDownloadRequest, current_user: str = Depends(get_current_user)
+):
+    """
+    複数の番組をまとめて予約する。正しい項目は1つのトランザクションで登録し、
+    項目ごとのジョブIDまたはエラーを返す(不正な項目があっても他は登録する)。
+    """
+    results = [
+        BatchDownloadResult(
+            index=i, error=validate_program_times(item.start_time, item.end_time)
+        )
+        for i, item in enumerate(request.items)
+    ]
+    conn = get_db_connection()
+    try:
+        with sqlite_lock_wait("submit_job"):
+            conn.execute("BEGIN IMMEDIATE")
+        for item, result in zip(request.items, results):
+            if result.error:
+                continue
+            # 同じ番組が複数含まれていても1つのジョブにまとまる
+            submission = submit_job(
+                conn,
+                item.station_id,
+                item.station_name,
+                item.program_title,
+                item.start_time,
+                item.end_time,
+                item.radiko_token,
+                current_user,
+            )
+            result.job_id = submission.job_id
+            result.status = submission.status
+            result.created = submission.created
+        conn.commit()
+    finally:
+        conn.close()
+
+    scheduled = sum(1 for result in results if result.created)
+    if scheduled:
+        download_workers.notify()
+    return BatchDownloadResponse(results=results, scheduled=scheduled)
+
+
+@app.get("/api/jobs", response_model=JobPage, tags=["Jobs"])
+def list_jobs(
+    limit: int = Query(JOBS_PER_PAGE, ge=1, le=200),
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    station_id: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    current_user: str = Depends(get_current_user),
+):
+    """ダウンロードジョブを開始時刻の新しい順に取得する"""
+    conn = get_db_connection()
+    try:
+        return query_jobs(conn, limit, cursor, status, station_id, date_from, date_to)
+    finally:
+        conn.close()
+
+
+@app.get("/api/jobs/events", tags=["Jobs"])
+async def stream_job_events(
+    last_event_id: Optional[int] = Header(None),
+    current_user: str = Depends(get_current_user),
+):
+    """
+    自分が予約したジョブの状態変化(event: status)と進捗(event: progress)を
+    Server-Sent Eventsで配信する。
+    Last-Event-IDヘッダーを付けて再接続すると、その続きから送り直す。
+    """
+    return StreamingResponse(
+        event_stream(job_events, last_event_id, current_user),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
-    return {"message": "Download scheduled", "job_id": job_id}
 
 
-@app.get("/api/status", response_model=StatusResponse, tags=["Jobs"])
-def get_status(current_user: str = Depends(get_current_user)):
-    """ダウンロードジョブとログイン履歴を取得する"""
+@app.get("/api/logins", response_model=LoginPage, tags=["Jobs"])
+def list_logins(
+    limit: int = Query(LOGINS_PER_PAGE, ge=1, le=200),
+    cursor: Optional[str] = None,
+    current_user: str = Depends(get_current_user),
+):
+    """ログイン履歴を新しい順に取得する"""
     conn = get_db_connection()
-    jobs_raw = conn.execute(
-        "SELECT * FROM download_log ORDER BY start_time DESC"
-    ).fetchall()
-    logins_raw = conn.execute(
-        "SELECT * FROM login_history ORDER BY login_time DESC LIMIT 10"
-    ).fetchall()
-    conn.close()
+    try:
+        return query_logins(conn, limit, cursor)
+    finally:
+        conn.close()
+
+
+@app.get("/api/recordings", response_model=RecordingPage, tags=["Recordings"])
+def list_recordings(
+    limit: int = Query(JOBS_PER_PAGE, ge=1, le=200),
+    cursor: Optional[str] = None,
+    station_name: Optional[str] = None,
+    keyword: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    current_user: str = Depends(get_current_user),
+):
+    """録音ライブラリを放送日時の新しい順に取得する(ファイルシステムは参照しない)"""
+    conn = get_db_connection()
+    try:
+        return query_recordings(
+            conn, limit, cursor, station_name, keyword, date_from, date_to
+        )
+    finally:
+        conn.close()
+
+
+def _get_recording(recording_id: int):
+    conn = get_db_connection()
+    try:
+        row = conn.execute(
+            "SELECT id, path FROM recordings WHERE id = ?", (recording_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        raise HTTPException(status_code=404, detail="録音が見つかりません")
+    return row
+
+
+@app.get("/api/recordings/{recording_id}/link", tags=["Recordings"])
+def get_recording_link(
+    recording_id: int, current_user: str = Depends(get_current_user)
+):
+    """
+    録音ファイルの署名付きURLを返す。<audio> の src やダウンロードリンクなど、
+    Authorizationヘッダーを付けられない要求にはこのURLを使う。
+    """
+    row = _get_recording(recording_id)
+    token = create_recording_token(current_user, row["id"])
+    return {
+        "url": f"/api/recordings/{row['id']}/file?token={token}",
+        "expires_in": RECORDING_LINK_EXPIRE_MINUTES * 60,
+    }
+
+
+@app.api_route(
+    "/api/recordings/{recording_id}/file", methods=["GET", "HEAD"], tags=["Recordings"]
+)
+def get_recording_file(
+    recording_id: int,
+    token: str,
+    download: bool = False,
+    range_header: Optional[str] = Header(None, alias="Range"),
+):
+    """
+    録音ファイルを返す。RECORDINGS_ACCEL_PREFIX が設定されていれば転送はNGINXに任せる
+    (X-Accel-Redirect)。Rangeヘッダーでのシークに対応する。
+    """
+    verify_recording_token(token, recording_id)
+    row = _get_recording(recording_id)
+    return recording_response(row["path"], range_header, attachment=download)
+
+
+def _rule_response(row) -> AutoRecordRule:
+    return AutoRecordRule(
+        id=row["id"],
+        name=row["name"],
+        keyword=row["keyword"],
+        performer=row["performer"],
+        station_id=row["station_id"],
+        weekdays=weekday_list(row["weekdays"]),
+        start_after=row["start_after"],
+        start_before=row["start_before"],
+        enabled=bool(row["enabled"]),
+    )
 
-    # データベースの行をPydanticモデルに変換
-    jobs = [DownloadJob.model_validate(dict(job)) for job in jobs_raw]
-    logins = [LoginHistory.model_validate(dict(login)) for login in logins_raw]
 
-    return StatusResponse(jobs=jobs, logins=logins)
+@app.get("/api/rules", response_model=List[AutoRecordRule], tags=["Rules"])
+def list_rules(current_user: str = Depends(get_current_user)):
+    """自動録音ルールの一覧を取得する"""
+    conn = get_db_connection()
+    try:
+        rows = conn.execute(
+            "SELECT * FROM auto_record_rules WHERE account = ? ORDER BY id",
+            (current_user,),
+        ).fetchall()
+    finally:
+        conn.close()
+    return [_rule_response(row) for row in rows]
+
+
+@app.post("/api/rules", response_model=AutoRecordRule, status_code=201, tags=["Rules"])
+def create_auto_record_rule(
+    request: AutoRecordRuleRequest, current_user: str = Depends(get_current_user)
+):
+    """自動録音ルールを追加し、タイムフリー期間の一致する番組をすぐに登録する"""
+    if SECRET_KEY_IS_DEFAULT:
+        # 自動録音のジョブは保存したアカウントで認証するので、保存できなければ必ず失敗する
+        raise HTTPException(
+            status_code=503,
+            detail="SECRET_KEY が設定されていないため自動録音は使えません",
+        )
+    if not (request.keyword or request.performer or request.station_id):
+        raise HTTPException(
+            status_code=422,
+            detail="キーワード・出演者・放送局のいずれかを指定してください",
+        )
+    if request.weekdays and not all(0 <= day <= 6 for day in request.weekdays):
+        raise HTTPException(
+            status_code=422, detail="曜日は0(月)〜6(日)で指定してください"
+        )
+
+    conn = get_db_connection()
+    try:
+        rule_id = create_rule(
+            conn,
+            current_user,
+            request.name,
+            request.keyword,
+            request.performer,
+            request.station_id,
+            request.weekdays,
+            request.start_after,
+            request.start_before,
+        )
+        conn.commit()
+        row = conn.execute(
+            "SELECT * FROM auto_record_rules WHERE id = ?", (rule_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+
+    if backfill_rule(rule_id):
+        download_workers.notify()
+    return _rule_response(row)
+
+
+@app.delete("/api/rules/{rule_id}", status_code=204, tags=["Rules"])
+def delete_auto_record_rule(
+    rule_id: int, current_user: str = Depends(get_current_user)
+):
+    """自動録音ルールを削除する(登録済みのジョブはそのまま)"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute(
+            "DELETE FROM auto_record_rules WHERE id = ? AND account = ?",
+            (rule_id, current_user),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    if not cursor.rowcount:
+        raise HTTPException(status_code=404, detail="ルールが見つかりません")
+    return Response(status_code=204)
+
+
+@app.get("/api/status", response_model=StatusResponse, tags=["Jobs"])
+def get_status(request: Request, current_user: str = Depends(get_current_user)):
+    """
+    ダウンロードジョブとログイン履歴の最新分を取得する(互換用)。
+    返すのは新しい順に JOBS_PER_PAGE 件まで。それより前は /api/jobs で取得する
+    """
+    conn = get_db_connection()
+    try:
+        jobs = query_jobs(conn, JOBS_PER_PAGE).jobs
+        logins = query_logins(conn, LOGINS_PER_PAGE).logins
+    finally:
+        conn.close()
+    # ポーリングで変化がなければ304で返す
+    body = StatusResponse(jobs=jobs, logins=logins).model_dump_json().encode()
+    return cached_response(request, RenderedBody(body), CACHE_PRIVATE)
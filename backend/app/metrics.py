@@ -0,0 +1,234 @@
+"""
+Prometheusのメトリクス
+
+gunicornのワーカーやレコーダーなど複数プロセスで集計するため、
+PROMETHEUS_MULTIPROC_DIR を指定するとprometheus_clientのマルチプロセスモードで動く。
+各プロセスは値をこのディレクトリのファイルに書き、/metrics は全ファイルを合算して返す。
+キューの長さは取得時にSQLiteから数えるので、どのプロセスで取得しても同じ値になる。
+"""
+
+import glob
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Optional, Tuple
+from urllib.parse import urlparse
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    values,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+# レコーダーなど別コンテナのプロセスは、PIDが重ならないよう名前を付けてファイルを分ける
+METRICS_PROCESS_NAME = os.getenv("METRICS_PROCESS_NAME")
+
+
+def _process_identifier() -> str:
+    return f"{METRICS_PROCESS_NAME}-{os.getpid()}"
+
+
+if MULTIPROC_DIR:
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+if MULTIPROC_DIR and METRICS_PROCESS_NAME:
+    values.ValueClass = values.MultiProcessValue(_process_identifier)
+    # 再起動前の同じプロセス名の実行中ゲージを引き継がない
+    multiprocess.mark_process_dead(_process_identifier(), MULTIPROC_DIR)
+
+# Radikoのエンドポイント(パスの先頭)とラベル名の対応
+UPSTREAM_ENDPOINTS = (
+    ("/v2/api/auth1", "auth1"),
+    ("/v2/api/auth2", "auth2"),
+    ("/v4/api/member/login", "login"),
+    ("/v3/station/list/", "station_list"),
+    ("/v3/program/station/date/", "station_guide"),
+    ("/v3/program/date/", "area_guide"),
+    ("/v3/api/program/search", "search"),
+    ("/v2/api/ts/playlist.m3u8", "hls_playlist"),
+    ("/v2/api/ts/chunklist/", "hls_chunklist"),
+)
+
+JOB_DURATION_BUCKETS = (10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+LOCK_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+UPSTREAM_LATENCY = Histogram(
+    "radiko_upstream_request_seconds",
+    "Radikoへのリクエストの応答時間",
+    ["endpoint", "status"],
+)
+DOWNLOAD_BYTES = Counter("recorder_download_bytes", "ダウンロードしたバイト数")
+ACTIVE_DOWNLOADS = Gauge(
+    "recorder_active_downloads",
+    "実行中のダウンロードジョブ数",
+    multiprocess_mode="livesum",
+)
+JOB_DURATION = Histogram(
+    "recorder_job_duration_seconds",
+    "ダウンロードジョブの所要時間",
+    ["outcome"],
+    buckets=JOB_DURATION_BUCKETS,
+)
+JOB_FAILURES = Counter(
+    "recorder_job_failures", "失敗したダウンロードジョブ数", ["reason"]
+)
+POSTPROCESS_DURATION = Histogram(
+    "recorder_postprocess_seconds",
+    "後処理のステップごとの所要時間",
+    ["step", "outcome"],
+    buckets=JOB_DURATION_BUCKETS,
+)
+GUIDE_CACHE_LOOKUPS = Counter(
+    "guide_cache_lookups",
+    "番組表キャッシュの参照結果(memory/sqlite: ヒット, not_modified: 304で再検証, "
+    "fetched: 取得, stale: 取得失敗で古い値)",
+    ["result"],
+)
+RATE_LIMIT_WAIT = Histogram(
+    "radiko_rate_limit_wait_seconds",
+    "Radikoへのリクエストがレート制限で待たされた時間",
+    ["limit", "priority"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+SQLITE_LOCK_WAIT = Histogram(
+    "sqlite_lock_wait_seconds",
+    "SQLiteの書き込みロックの取得にかかった時間",
+    ["operation"],
+    buckets=LOCK_WAIT_BUCKETS,
+)
+SQLITE_LOCK_TIMEOUTS = Counter(
+    "sqlite_lock_timeouts",
+    "busy_timeout内に書き込みロックを取れなかった回数",
+    ["operation"],
+)
+
+
+def endpoint_label(url: str) -> str:
+    """URLをメトリクスのラベルにまとめる(放送局IDや日付でラベルを増やさない)"""
+    path = urlparse(url).path
+    for prefix, label in UPSTREAM_ENDPOINTS:
+        if path.startswith(prefix):
+            return label
+    if path.endswith(".aac"):
+        return "hls_segment"
+    return "other"
+
+
+def observe_upstream(url: str, status: int, seconds: float):
+    UPSTREAM_LATENCY.labels(endpoint_label(url), str(status)).observe(seconds)
+
+
+def instrument_session(session):
+    """requests.Session の応答時間を記録する"""
+
+    def hook(res, *args, **kwargs):
+        observe_upstream(res.url, res.status_code, res.elapsed.total_seconds())
+
+    session.hooks["response"].append(hook)
+    return session
+
+
+async def _mark_request_start(request):
+    request.extensions["metrics_started"] = time.perf_counter()
+
+
+async def _observe_response(response):
+    started = response.request.extensions.get("metrics_started")
+    if started is not None:
+        observe_upstream(
+            str(response.request.url),
+            response.status_code,
+            time.perf_counter() - started,
+        )
+
+
+# httpx.AsyncClient(event_hooks=...) に渡す
+HTTPX_EVENT_HOOKS = {"request": [_mark_request_start], "response": [_observe_response]}
+
+
+@contextmanager
+def sqlite_lock_wait(operation: str):
+    """BEGIN IMMEDIATE など、書き込みロックを待つ処理の時間を記録する"""
+    started = time.perf_counter()
+    try:
+        yield
+    except sqlite3.OperationalError as e:
+        if "locked" in str(e):
+            SQLITE_LOCK_TIMEOUTS.labels(operation).inc()
+        raise
+    finally:
+        SQLITE_LOCK_WAIT.labels(operation).observe(time.perf_counter() - started)
+
+
+class QueueCollector:
+    """取得時点のキューの状態をSQLiteから数える"""
+
+    def _family(self) -> GaugeMetricFamily:
+        return GaugeMetricFamily(
+            "recorder_queue_jobs", "状態ごとのキュー内のジョブ数", labels=["state"]
+        )
+
+    def describe(self):
+        # 登録時にデータベースへ問い合わせない
+        yield self._family()
+
+    def collect(self):
+        from .database import get_db_connection
+
+        depth = self._family()
+        counts = {"pending": 0, "running": 0}
+        conn = get_db_connection()
+        try:
+            rows = conn.execute(
+                "SELECT state, COUNT(*) FROM download_queue "
+                "WHERE state IN ('pending', 'running') GROUP BY state"
+            ).fetchall()
+            counts.update((state, count) for state, count in rows)
+        except sqlite3.Error:
+            # テーブル作成前などは数えない
+            return
+        finally:
+            conn.close()
+        for state, count in counts.items():
+            depth.add_metric([state], count)
+        yield depth
+
+
+if not MULTIPROC_DIR:
+    REGISTRY.register(QueueCollector())
+
+
+def build_registry(multiproc_dir: Optional[str] = MULTIPROC_DIR) -> CollectorRegistry:
+    """マルチプロセスモードなら全プロセスのファイルを合算するレジストリを作る"""
+    if not multiproc_dir:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=multiproc_dir)
+    registry.register(QueueCollector())
+    return registry
+
+
+def render_metrics(multiproc_dir: Optional[str] = MULTIPROC_DIR) -> Tuple[bytes, str]:
+    return generate_latest(build_registry(multiproc_dir)), CONTENT_TYPE_LATEST
+
+
+def clear_multiproc_dir(path: Optional[str] = MULTIPROC_DIR, keep_named=True):
+    """
+    gunicorn起動時に前回のワーカーのファイルを消す。
+    名前付きのプロセス(レコーダー)のファイルは別コンテナで動いているので残す。
+    """
+    if not path:
+        return
+    for f in glob.glob(os.path.join(path, "*.db")):
+        pid = os.path.basename(f)[: -len(".db")].rsplit("_", 1)[-1]
+        if keep_named and not pid.isdigit():
+            continue
+        os.remove(f)
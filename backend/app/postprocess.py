@@ -0,0 +1,330 @@
+"""
+ダウンロード後の後処理(タグ付け・ラウドネス補正・変換)
+
+ダウンロードが成功したジョブの後処理を、ダウンロードとは別のプロセスプールで実行する。
+エンコードはCPUを使うので、ダウンロードのワーカー(回線待ちが中心)と同じ枠で
+動かすと録音が詰まる。ジョブはファイルを書き終えた時点で枠を空け、後処理は
+POSTPROCESS_WORKERS 個のプロセスで順番に進む。
+
+各ステップの状態は postprocess_steps テーブルに記録し、ジョブ一覧に含めて返す。
+レコーダーが途中で止まった場合は、起動時に終わっていないステップから再開する。
+"""
+
+import json
+import multiprocessing
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial
+from typing import Callable, Dict, List, Optional
+
+from .database import get_db_connection, status_writer
+from .job_events import publish_event
+from .metrics import POSTPROCESS_DURATION
+
+# 実行するステップ(カンマ区切り、書いた順に実行)。例: loudnorm,tag,opus
+POSTPROCESS_STEPS = [
+    step.strip()
+    for step in os.getenv("POSTPROCESS_STEPS", "").split(",")
+    if step.strip()
+]
+POSTPROCESS_WORKERS = int(os.getenv("POSTPROCESS_WORKERS", "1"))
+LOUDNESS_TARGET = os.getenv("LOUDNESS_TARGET", "I=-16:TP=-1.5:LRA=11")
+
+
+def _metadata_args(meta: dict) -> List[str]:
+    tags = {
+        "title": meta.get("program_title"),
+        "artist": meta.get("pfm"),
+        "album": meta.get("station_name"),
+        "date": (meta.get("start_time") or "")[:4],
+        "comment": meta.get("description"),
+    }
+    args = []
+    for key, value in tags.items():
+        if value:
+            args += ["-metadata", f"{key}={value}"]
+    return args
+
+
+def _ffmpeg(args: List[str]):
+    subprocess.run(
+        ["ffmpeg", "-y", "-loglevel", "error", "-nostdin", *args],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+
+
+def _replace_in_place(path: str, args: List[str]):
+    """ffmpegの出力を一時ファイルに書き、成功したら元のファイルと入れ替える"""
+    tmp_path = path + ".tmp"
+    try:
+        _ffmpeg(["-i", path, *args, "-f", "adts", tmp_path])
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def tag_step(path: str, meta: dict) -> Optional[str]:
+    """番組名・出演者・放送局などをID3v2タグとして埋め込む(再エンコードなし)"""
+    _replace_in_place(path, ["-c", "copy", *_metadata_args(meta), "-write_id3v2", "1"])
+    return None
+
+
+def loudnorm_step(path: str, meta: dict) -> Optional[str]:
+    """ラウドネスを揃える(AACで再エンコード)"""
+    _replace_in_place(
+        path,
+        [
+            "-af",
+            f"loudnorm={LOUDNESS_TARGET}",
+            "-c:a",
+            "aac",
+            "-b:a",
+            "128k",
+            *_metadata_args(meta),
+            "-write_id3v2",
+            "1",
+        ],
+    )
+    return None
+
+
+def _transcode(path: str, meta: dict, extension: str, codec_args: List[str]) -> str:
+    output = os.path.splitext(path)[0] + extension
+    tmp_path = output + ".tmp"
+    try:
+        _ffmpeg(
+            ["-i", path, "-vn", *codec_args, *_metadata_args(meta), "-f", extension[1:]]
+            + [tmp_path]
+        )
+        os.replace(tmp_path, output)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return output
+
+
+def opus_step(path: str, meta: dict) -> Optional[str]:
+    """モバイル向けにOpusへ変換したファイルを隣に作る"""
+    return _transcode(path, meta, ".opus", ["-c:a", "libopus", "-b:a", "48k"])
+
+
+def mp3_step(path: str, meta: dict) -> Optional[str]:
+    """MP3へ変換したファイルを隣に作る"""
+    return _transcode(
+        path, meta, ".mp3", ["-c:a", "libmp3lame", "-q:a", "5", "-id3v2_version", "3"]
+    )
+
+
+STEPS: Dict[str, Callable[[str, dict], Optional[str]]] = {
+    "tag": tag_step,
+    "loudnorm": loudnorm_step,
+    "opus": opus_step,
+    "mp3": mp3_step,
+}
+# 元のファイルを書き換えるステップ(終わったら録音ライブラリを更新する)
+IN_PLACE_STEPS = frozenset(["tag", "loudnorm"])
+
+
+def run_step(step: str, path: str, meta: dict) -> Optional[str]:
+    """プロセスプールの子プロセスで実行する。データベースには触らない"""
+    return STEPS[step](path, meta)
+
+
+def _step_error(error: BaseException) -> str:
+    if isinstance(error, subprocess.CalledProcessError) and error.stderr:
+        return error.stderr.strip().splitlines()[-1]
+    return str(error) or type(error).__name__
+
+
+class Postprocessor:
+    """後処理のステップをプロセスプールで順に実行する"""
+
+    def __init__(
+        self,
+        steps: Optional[List[str]] = None,
+        workers: int = POSTPROCESS_WORKERS,
+        runner: Callable[[str, str, dict], Optional[str]] = run_step,
+        executor_factory: Optional[Callable[[], Executor]] = None,
+        on_complete: Optional[Callable[[str, str, dict], None]] = None,
+    ):
+        steps = POSTPROCESS_STEPS if steps is None else steps
+        unknown = [step for step in steps if step not in STEPS]
+        if unknown:
+            raise ValueError(f"不明な後処理ステップ: {', '.join(unknown)}")
+        self.steps = list(steps)
+        self.workers = workers
+        self.runner = runner
+        self.executor_factory = executor_factory or self._process_pool
+        # 元のファイルを書き換えたジョブが終わったときに呼ぶ(録音ライブラリの更新)
+        self.on_complete = on_complete
+        self._executor: Optional[Executor] = None
+        self._lock = threading.Lock()
+
+    def _process_pool(self) -> Executor:
+        # ワーカースレッドの動いているプロセスをforkしないよう spawn で起動する
+        return ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def _get_executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = self.executor_factory()
+            return self._executor
+
+    def submit(self, job_id: str, path: str, meta: dict) -> bool:
+        """ダウンロードしたファイルの後処理を予約する。ステップがなければFalse"""
+        if not self.steps:
+            return False
+        conn = get_db_connection()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO postprocess_jobs (job_id, path, meta) VALUES (?, ?, ?)",
+                (job_id, path, json.dumps(meta, ensure_ascii=False)),
+            )
+            conn.execute("DELETE FROM postprocess_steps WHERE job_id = ?", (job_id,))
+            conn.executemany(
+                "INSERT INTO postprocess_steps (job_id, position, step, status) VALUES (?, ?, ?, 'pending')",
+                [(job_id, i, step) for i, step in enumerate(self.steps)],
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        self._run(job_id, path, meta, self.steps, 0, False)
+        return True
+
+    def recover(self) -> int:
+        """前回の停止で終わらなかった後処理を、未完了のステップから再開する"""
+        conn = get_db_connection()
+        try:
+            jobs = conn.execute("""
+                SELECT j.job_id, j.path, j.meta FROM postprocess_jobs AS j
+                WHERE EXISTS (
+                    SELECT 1 FROM postprocess_steps AS s
+                    WHERE s.job_id = j.job_id AND s.status IN ('pending', 'running')
+                )
+                """).fetchall()
+            resumed = []
+            for job in jobs:
+                rows = conn.execute(
+                    "SELECT position, step, status FROM postprocess_steps "
+                    "WHERE job_id = ? ORDER BY position",
+                    (job["job_id"],),
+                ).fetchall()
+                start = next(
+                    row["position"]
+                    for row in rows
+                    if row["status"] in ("pending", "running")
+                )
+                modified = any(
+                    row["status"] == "success" and row["step"] in IN_PLACE_STEPS
+                    for row in rows
+                )
+                resumed.append((job, [row["step"] for row in rows], start, modified))
+        finally:
+            conn.close()
+        for job, steps, start, modified in resumed:
+            self._run(
+                job["job_id"],
+                job["path"],
+                json.loads(job["meta"]),
+                steps,
+                start,
+                modified,
+            )
+        return len(resumed)
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _run(
+        self,
+        job_id: str,
+        path: str,
+        meta: dict,
+        steps: List[str],
+        position: int,
+        modified: bool,
+    ):
+        step = steps[position]
+        self._update(job_id, position, step, "running", started_at=time.time())
+        started = time.monotonic()
+        try:
+            future = self._get_executor().submit(self.runner, step, path, meta)
+        except RuntimeError as e:
+            # 停止中。ステップは running のまま残り、次回起動時に再開される
+            print(f"Job {job_id}: 後処理 {step} を開始できません: {e}")
+            return
+        future.add_done_callback(
+            partial(
+                self._step_done, job_id, path, meta, steps, position, modified, started
+            )
+        )
+
+    def _step_done(
+        self, job_id, path, meta, steps, position, modified, started, future
+    ):
+        step = steps[position]
+        if future.cancelled():
+            return  # 停止時に取り消されたものは次回起動時に再開する
+        error = future.exception()
+        elapsed = time.monotonic() - started
+        if error is not None:
+            POSTPROCESS_DURATION.labels(step, "failed").observe(elapsed)
+            message = _step_error(error)
+            print(f"Job {job_id}: 後処理 {step} に失敗しました: {message}")
+            self._update(job_id, position, step, "failed", message=message)
+            # 後続のステップは失敗したステップの結果を前提にするので実行しない
+            for i in range(position + 1, len(steps)):
+                self._update(job_id, i, steps[i], "skipped")
+        else:
+            POSTPROCESS_DURATION.labels(step, "success").observe(elapsed)
+            output = future.result()
+            self._update(job_id, position, step, "success", output=output)
+            modified = modified or step in IN_PLACE_STEPS
+            if position + 1 < len(steps):
+                self._run(job_id, path, meta, steps, position + 1, modified)
+                return
+        if modified and self.on_complete is not None:
+            try:
+                self.on_complete(job_id, path, meta)
+            except Exception as e:
+                print(f"Job {job_id}: 後処理後の更新に失敗しました: {e}")
+
+    def _update(
+        self,
+        job_id: str,
+        position: int,
+        step: str,
+        status: str,
+        started_at: Optional[float] = None,
+        output: Optional[str] = None,
+        message: Optional[str] = None,
+    ):
+        finished_at = time.time() if status in ("success", "failed") else None
+        status_writer.submit(
+            """
+            UPDATE postprocess_steps SET
+                status = ?,
+                started_at = COALESCE(?, started_at),
+                finished_at = ?,
+                output = ?,
+                message = ?
+            WHERE job_id = ? AND position = ?
+            """,
+            (status, started_at, finished_at, output, message, job_id, position),
+        )
+        publish_event(
+            job_id,
+            "postprocess",
+            {"step": step, "status": status, "output": output, "message": message},
+        )
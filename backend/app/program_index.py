@@ -0,0 +1,275 @@
+"""
+番組のローカル全文検索インデックス (SQLite FTS5 / trigram)
+
+番組表を取得するたびに、内容が変わった番組だけを programs テーブルへ反映する。
+タイトル・出演者・番組説明・放送局名を対象に、日本語でも部分一致で検索できる。
+"""
+
+import hashlib
+import math
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional
+
+from fastapi import HTTPException
+
+from .database import get_db_connection
+from .radiko import (
+    ALL_AREA_IDS,
+    JST,
+    AreaGuideResponse,
+    GuideResponse,
+    Program,
+    SearchResponse,
+    SearchResult,
+)
+
+# 定期的に番組表を取得してインデックスを埋めるエリア(カンマ区切り、例: "JP13,JP27")
+SEARCH_INDEX_AREAS = [
+    area for area in os.getenv("SEARCH_INDEX_AREAS", "").split(",") if area
+]
+TIMEFREE_DAYS = 7  # タイムフリーで聴ける日数
+INDEX_TTL = 6 * 60 * 60  # この秒数以内に全エリアを取得済みならローカル検索を優先する
+MIN_TERM_LENGTH = 3  # trigramで検索できる最短の語の長さ
+META_KEY = "program_index"
+TIME_FORMAT = "%Y%m%d%H%M%S"
+
+
+def _content_hash(program: Program, station_name: str) -> str:
+    content = "\0".join(
+        [
+            program.end_time.strftime(TIME_FORMAT),
+            program.title or "",
+            program.pfm or "",
+            program.description or "",
+            station_name or "",
+            program.image_url or "",
+        ]
+    )
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def index_programs(
+    conn: sqlite3.Connection,
+    station_id: str,
+    station_name: str,
+    date_str: str,
+    programs: Iterable[Program],
+) -> int:
+    """1局1日分の番組を反映する。追加・変更された番組数を返す"""
+    day_start = datetime.strptime(date_str, "%Y%m%d") + timedelta(hours=5)
+    window = (
+        day_start.strftime(TIME_FORMAT),
+        (day_start + timedelta(days=1)).strftime(TIME_FORMAT),
+    )
+    rows = [
+        (
+            station_id,
+            program.start_time.strftime(TIME_FORMAT),
+            program.end_time.strftime(TIME_FORMAT),
+            program.title,
+            program.pfm,
+            program.description,
+            station_name,
+            program.image_url,
+            _content_hash(program, station_name),
+        )
+        for program in programs
+    ]
+    # 内容が変わっていない番組は書き換えない(FTSの更新も発生しない)
+    cursor = conn.executemany(
+        """
+        INSERT INTO programs (station_id, start_time, end_time, title, pfm, description, station_name, image_url, content_hash)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (station_id, start_time) DO UPDATE SET
+            end_time = excluded.end_time,
+            title = excluded.title,
+            pfm = excluded.pfm,
+            description = excluded.description,
+            station_name = excluded.station_name,
+            image_url = excluded.image_url,
+            content_hash = excluded.content_hash
+        WHERE programs.content_hash != excluded.content_hash
+        """,
+        rows,
+    )
+    changed = cursor.rowcount
+    # 番組表から消えた番組を削除する
+    starts = {row[1] for row in rows}
+    stale = [
+        (row[0],)
+        for row in conn.execute(
+            "SELECT id, start_time FROM programs WHERE station_id = ? AND start_time >= ? AND start_time < ?",
+            (station_id, *window),
+        )
+        if row[1] not in starts
+    ]
+    conn.executemany("DELETE FROM programs WHERE id = ?", stale)
+    return changed
+
+
+def index_guide(station_id: str, date_str: str, guide: GuideResponse) -> int:
+    conn = get_db_connection()
+    try:
+        changed = index_programs(
+            conn, station_id, guide.station_name, date_str, guide.programs
+        )
+        conn.commit()
+        return changed
+    except sqlite3.OperationalError as e:
+        print(f"検索インデックスの更新に失敗しました: {e}")
+        return 0
+    finally:
+        conn.close()
+
+
+def index_area_guide(area_guide: AreaGuideResponse) -> int:
+    conn = get_db_connection()
+    try:
+        changed = sum(
+            index_programs(
+                conn,
+                station.station_id,
+                station.station_name,
+                area_guide.date,
+                station.programs,
+            )
+            for station in area_guide.stations
+        )
+        conn.commit()
+        return changed
+    except sqlite3.OperationalError as e:
+        print(f"検索インデックスの更新に失敗しました: {e}")
+        return 0
+    finally:
+        conn.close()
+
+
+def _match_query(keyword: str) -> Optional[str]:
+    """空白区切りの語をすべて含むFTS5クエリを作る。短すぎる語があればNone"""
+    terms = keyword.split()
+    if not terms or any(len(term) < MIN_TERM_LENGTH for term in terms):
+        return None
+    return " AND ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def search_local_programs(
+    keyword: str,
+    page: int = 1,
+    per_page: int = 10,
+    station_id: Optional[str] = None,
+    now: Optional[datetime] = None,
+) -> Optional[SearchResponse]:
+    """ローカルインデックスを検索する。インデックスで扱えない検索語ならNone"""
+    query = _match_query(keyword)
+    if query is None:
+        return None
+    now = now or datetime.now(JST)
+    oldest = (now - timedelta(days=TIMEFREE_DAYS)).strftime(TIME_FORMAT)
+    conditions = "program_fts MATCH ? AND p.end_time >= ?"
+    params = [query, oldest]
+    if station_id:
+        conditions += " AND p.station_id = ?"
+        params.append(station_id)
+
+    conn = get_db_connection()
+    try:
+        total = conn.execute(
+            f"SELECT COUNT(*) FROM program_fts JOIN programs AS p ON p.id = program_fts.rowid WHERE {conditions}",
+            params,
+        ).fetchone()[0]
+        # タイトル > 出演者 > 放送局名 > 説明 の重みで関連度順に並べる
+        rows = conn.execute(
+            f"""
+            SELECT p.* FROM program_fts JOIN programs AS p ON p.id = program_fts.rowid
+            WHERE {conditions}
+            ORDER BY bm25(program_fts, 10.0, 5.0, 1.0, 2.0), p.start_time DESC
+            LIMIT ? OFFSET ?
+            """,
+            [*params, per_page, (page - 1) * per_page],
+        ).fetchall()
+    except sqlite3.OperationalError as e:
+        print(f"ローカル検索に失敗しました: {e}")
+        return None
+    finally:
+        conn.close()
+
+    programs = [
+        SearchResult(
+            title=row["title"],
+            station_id=row["station_id"],
+            station_name=row["station_name"] or row["station_id"],
+            start_time=JST.localize(datetime.strptime(row["start_time"], TIME_FORMAT)),
+            end_time=JST.localize(datetime.strptime(row["end_time"], TIME_FORMAT)),
+            pfm=row["pfm"],
+            image_url=row["image_url"],
+        )
+        for row in rows
+    ]
+    return SearchResponse(
+        programs=programs,
+        total_results=total,
+        current_page=page,
+        total_pages=math.ceil(total / per_page),
+    )
+
+
+def is_index_complete() -> bool:
+    """設定された全エリアのタイムフリー期間を最近取得し終えているか"""
+    if not SEARCH_INDEX_AREAS:
+        return False
+    conn = get_db_connection()
+    row = conn.execute(
+        "SELECT CAST(strftime('%s', updated_at) AS INTEGER) FROM cache_meta WHERE key = ?",
+        (META_KEY,),
+    ).fetchone()
+    conn.close()
+    return row is not None and time.time() - row[0] < INDEX_TTL
+
+
+def crawl_timefree_window(areas: Optional[List[str]] = None):
+    """設定されたエリアのタイムフリー期間の番組表を取得してインデックスを埋める"""
+    # 番組表キャッシュ経由で取得するので、変わらない過去日は再取得されない
+    from .guide_cache import guide_cache, radiko_today
+
+    areas = SEARCH_INDEX_AREAS if areas is None else areas
+    areas = [area for area in areas if area in ALL_AREA_IDS]
+    if not areas:
+        return
+    today = datetime.strptime(radiko_today(), "%Y%m%d")
+    dates = [
+        (today - timedelta(days=offset)).strftime("%Y%m%d")
+        for offset in range(TIMEFREE_DAYS + 1)
+    ]
+    failed = 0
+    for area_id in areas:
+        for date_str in dates:
+            try:
+                guide_cache.get_area_guide(area_id, date_str, None)
+            except HTTPException as e:
+                failed += 1
+                print(f"番組表の取得に失敗しました ({area_id} {date_str}): {e.detail}")
+    if failed:
+        # 取りこぼしがある間はRadikoの検索APIを優先させる
+        return
+
+    conn = get_db_connection()
+    conn.execute(
+        "INSERT OR REPLACE INTO cache_meta (key, updated_at) VALUES (?, CURRENT_TIMESTAMP)",
+        (META_KEY,),
+    )
+    conn.commit()
+    conn.close()
+
+
+def prune_program_index(now: Optional[datetime] = None) -> int:
+    """タイムフリー期間を過ぎた番組を削除する"""
+    now = now or datetime.now(JST)
+    oldest = (now - timedelta(days=TIMEFREE_DAYS + 1)).strftime(TIME_FORMAT)
+    conn = get_db_connection()
+    cursor = conn.execute("DELETE FROM programs WHERE end_time < ?", (oldest,))
+    conn.commit()
+    conn.close()
+    return cursor.rowcount
@@ -0,0 +1,324 @@
+"""
+Radiko APIの呼び出しとレスポンスのモデル
+
+ここの関数は同期版で、レコーダーや放送局マップの更新などバックグラウンド処理で使う。
+APIのエンドポイントからは非同期版(radiko_client.py)を使う。
+"""
+
+import base64
+import io
+import os
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, List, Mapping, NamedTuple, Optional, Tuple, Union
+
+import pytz
+import requests
+from fastapi import HTTPException
+from pydantic import BaseModel
+
+from .downloader import create_session
+
+JST = pytz.timezone("Asia/Tokyo")
+# 日本は夏時間がないので、番組表の日時は固定オフセットで扱える
+JST_OFFSET = timezone(timedelta(hours=9))
+ALL_AREA_IDS = [f"JP{i}" for i in range(1, 48)]
+# ベンチマークなどでローカルの代替サーバーを使う場合に変更する
+RADIKO_BASE_URL = os.getenv("RADIKO_BASE_URL", "https://radiko.jp")
+
+# バックグラウンド処理で共有するKeep-Aliveセッション
+http_session = create_session(pool_size=16)
+
+RADIKO_KEY = "bcd151073c03b352e1ef2fd66c32209da9ca0afa"
+AUTH_HEADERS = {
+    "User-Agent": "curl/7.52.1",
+    "Accept": "*/*",
+    "X-Radiko-App": "pc_html5",
+    "X-Radiko-App-Version": "0.0.1",
+    "X-Radiko-Device": "pc",
+    "X-Radiko-User": "dummy_user",
+}
+
+_PROGRAM_FIELDS = frozenset(["title", "pfm", "img", "desc"])
+_TIME_CACHE: dict = {}
+_TIME_CACHE_SIZE = 4096
+
+
+class Station(BaseModel):
+    id: str
+    name: str
+
+
+class Program(BaseModel):
+    title: str
+    start_time: datetime
+    end_time: datetime
+    duration: int
+    pfm: Optional[str] = None
+    image_url: Optional[str] = None  # 画像がない場合もあるのでOptional
+    description: Optional[str] = None
+
+
+class GuideResponse(BaseModel):
+    station_name: str
+    programs: List[Program]
+
+
+class StationGuide(BaseModel):
+    station_id: str
+    station_name: str
+    programs: List[Program]
+
+
+class AreaGuideResponse(BaseModel):
+    """エリア内の全放送局の番組表"""
+
+    area_id: str
+    date: str
+    stations: List[StationGuide]
+
+
+class SearchResult(BaseModel):
+    """検索結果の単一プログラムを表すモデル"""
+
+    title: str
+    station_id: str
+    station_name: str  # APIからは取得できないため、station_idと同じ値を入れる
+    start_time: datetime
+    end_time: datetime
+    pfm: Optional[str] = None
+    image_url: Optional[str] = None
+
+
+class SearchResponse(BaseModel):
+    """ページング情報を含む検索結果を返すためのモデル"""
+
+    programs: List[SearchResult]
+    total_results: int
+    current_page: int
+    total_pages: int
+
+
+class GuideFetch(NamedTuple):
+    """条件付き取得の結果。更新がなければ(304) guide は None"""
+
+    guide: Optional[Union[GuideResponse, AreaGuideResponse]]
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+
+def partial_key(auth1_headers: Mapping[str, str]) -> str:
+    """auth1の応答ヘッダーからauth2に渡すパーシャルキーを作る"""
+    key_length = int(auth1_headers["X-Radiko-KeyLength"])
+    key_offset = int(auth1_headers["X-Radiko-KeyOffset"])
+    return base64.b64encode(
+        RADIKO_KEY[key_offset : key_offset + key_length].encode("utf-8")
+    ).decode("utf-8")
+
+
+def authenticate(
+    mail: str, password: str, base_url: Optional[str] = None
+) -> Tuple[str, str]:
+    """
+    プレミアム会員でログインし、(認証トークン, エリアID)を返す。
+    ログインのCookieを他の処理と混ぜないよう、認証ごとにセッションを作る。
+    """
+    base_url = base_url or RADIKO_BASE_URL
+    session = create_session(pool_size=1)
+    try:
+        res_login = session.post(
+            f"{base_url}/v4/api/member/login",
+            data={"mail": mail, "pass": password},
+            timeout=(5, 30),
+        )
+        res_login.raise_for_status()
+        session_id = res_login.json()["radiko_session"]
+
+        res1 = session.get(
+            f"{base_url}/v2/api/auth1", headers=AUTH_HEADERS, timeout=(5, 30)
+        )
+        res1.raise_for_status()
+        auth_token = res1.headers["X-Radiko-AuthToken"]
+
+        headers = dict(AUTH_HEADERS)
+        headers.update(
+            {
+                "X-Radiko-AuthToken": auth_token,
+                "X-Radiko-PartialKey": partial_key(res1.headers),
+            }
+        )
+        res2 = session.get(
+            f"{base_url}/v2/api/auth2",
+            params={"radiko_session": session_id},
+            headers=headers,
+            timeout=(5, 30),
+        )
+        res2.raise_for_status()
+        return auth_token, res2.text.split(",")[0]
+    finally:
+        session.close()
+
+
+def get_station_list(area_id: str, auth_token: Optional[str]) -> List[Station]:
+    url = f"{RADIKO_BASE_URL}/v3/station/list/{area_id}.xml"
+    # 放送局リストはトークンなしでも取得できる(バックグラウンド更新用)
+    headers = {"X-Radiko-AuthToken": auth_token} if auth_token else {}
+    try:
+        res = http_session.get(url, headers=headers, timeout=(5, 30))
+        res.raise_for_status()
+        return parse_station_list(res.content)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"放送局リストの取得に失敗: {e}")
+
+
+def timefree_playlist_url(station_id: str, start_time: str, end_time: str) -> str:
+    """タイムフリー番組のマスタープレイリストのURL"""
+    return (
+        f"{RADIKO_BASE_URL}/v2/api/ts/playlist.m3u8"
+        f"?station_id={station_id}&l=15&ft={start_time}&to={end_time}"
+    )
+
+
+def parse_radiko_time(value: str) -> datetime:
+    """YYYYMMDDhhmmss(JST)を解析する。strptimeより速い固定長の高速版"""
+    dt = _TIME_CACHE.get(value)
+    if dt is None:
+        if len(value) != 14 or not value.isdigit():
+            raise ValueError(f"日時の形式が不正です: {value}")
+        dt = datetime(
+            int(value[0:4]),
+            int(value[4:6]),
+            int(value[6:8]),
+            int(value[8:10]),
+            int(value[10:12]),
+            int(value[12:14]),
+            tzinfo=JST_OFFSET,
+        )
+        # 前の番組の終了時刻は次の番組の開始時刻なので、同じ文字列が何度も現れる
+        if len(_TIME_CACHE) >= _TIME_CACHE_SIZE:
+            _TIME_CACHE.clear()
+        _TIME_CACHE[value] = dt
+    return dt
+
+
+def parse_station_list(content: bytes) -> List[Station]:
+    stations = []
+    for _, elem in ET.iterparse(io.BytesIO(content)):
+        if elem.tag == "station":
+            stations.append(
+                Station.model_construct(
+                    id=elem.findtext("id"), name=elem.findtext("name")
+                )
+            )
+            elem.clear()
+    return stations
+
+
+def _new_program(prog) -> Program:
+    fields = {child.tag: child.text for child in prog if child.tag in _PROGRAM_FIELDS}
+    attrib = prog.attrib
+    # 値は解析済みで型も揃っているので、Pydanticの検証は省く
+    return Program.model_construct(
+        title=fields.get("title"),
+        start_time=parse_radiko_time(attrib["ft"]),
+        end_time=parse_radiko_time(attrib["to"]),
+        duration=int(attrib["dur"]),
+        pfm=fields.get("pfm", ""),
+        image_url=fields.get("img"),
+        description=fields.get("desc"),
+    )
+
+
+def iter_station_guides(content: bytes) -> Iterator[StationGuide]:
+    """番組表XMLを先頭から順に読み、放送局ごとの番組表を返す(木全体は作らない)"""
+    programs: List[Program] = []
+    for _, elem in ET.iterparse(io.BytesIO(content)):
+        tag = elem.tag
+        if tag == "prog":
+            programs.append(_new_program(elem))
+            elem.clear()
+        elif tag == "station":
+            yield StationGuide.model_construct(
+                station_id=elem.get("id"),
+                station_name=elem.findtext("name"),
+                programs=programs,
+            )
+            programs = []
+            elem.clear()
+
+
+def parse_program_guide(content: bytes) -> GuideResponse:
+    station = next(iter_station_guides(content))
+    return GuideResponse.model_construct(
+        station_name=station.station_name, programs=station.programs
+    )
+
+
+def parse_area_guide(content: bytes, area_id: str, date_str: str) -> AreaGuideResponse:
+    return AreaGuideResponse.model_construct(
+        area_id=area_id, date=date_str, stations=list(iter_station_guides(content))
+    )
+
+
+def _conditional_get(
+    url: str,
+    auth_token: Optional[str],
+    etag: Optional[str],
+    last_modified: Optional[str],
+) -> requests.Response:
+    headers = {"X-Radiko-AuthToken": auth_token} if auth_token else {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    res = http_session.get(url, headers=headers, timeout=(5, 30))
+    res.raise_for_status()
+    return res
+
+
+def fetch_program_guide(
+    station_id: str,
+    date_str: str,
+    auth_token: str,
+    etag: Optional[str] = None,
+    last_modified: Optional[str] = None,
+) -> GuideFetch:
+    """番組表を取得する。ETag/Last-Modifiedを渡すと条件付きリクエストになる"""
+    url = f"{RADIKO_BASE_URL}/v3/program/station/date/{date_str}/{station_id}.xml"
+    try:
+        res = _conditional_get(url, auth_token, etag, last_modified)
+        if res.status_code == 304:
+            return GuideFetch(None, etag, last_modified)
+        return GuideFetch(
+            parse_program_guide(res.content),
+            res.headers.get("ETag"),
+            res.headers.get("Last-Modified"),
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"番組表の取得に失敗: {e}")
+
+
+def fetch_area_guide(
+    area_id: str,
+    date_str: str,
+    auth_token: str,
+    etag: Optional[str] = None,
+    last_modified: Optional[str] = None,
+) -> GuideFetch:
+    """エリア内の全放送局の番組表を1回のリクエストで取得する"""
+    url = f"{RADIKO_BASE_URL}/v3/program/date/{date_str}/{area_id}.xml"
+    try:
+        res = _conditional_get(url, auth_token, etag, last_modified)
+        if res.status_code == 304:
+            return GuideFetch(None, etag, last_modified)
+        return GuideFetch(
+            parse_area_guide(res.content, area_id, date_str),
+            res.headers.get("ETag"),
+            res.headers.get("Last-Modified"),
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"エリア番組表の取得に失敗: {e}")
+
+
+def get_program_guide(station_id: str, date_str: str, auth_token: str) -> GuideResponse:
+    return fetch_program_guide(station_id, date_str, auth_token).guide
@@ -0,0 +1,274 @@
+"""
+Radiko APIの非同期クライアント
+
+APIワーカー内で1つのhttpx.AsyncClientを共有し、keep-aliveの接続プールを使い回す。
+h2がインストールされていればHTTP/2で接続する。
+レスポンスの解析は同期版(radiko.py)と共通。レコーダーなどのバックグラウンド処理は
+引き続き同期版を使う。
+"""
+
+import asyncio
+import os
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from typing import List, Optional, Set, Tuple
+
+import httpx
+from fastapi import HTTPException
+
+from .metrics import HTTPX_EVENT_HOOKS
+from .radiko import (
+    AUTH_HEADERS,
+    RADIKO_BASE_URL,
+    GuideFetch,
+    GuideResponse,
+    Station,
+    parse_area_guide,
+    parse_program_guide,
+    parse_station_list,
+    partial_key,
+)
+from .rate_limit import INTERACTIVE, RateLimiter, upstream_limiter
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+RADIKO_MAX_CONNECTIONS = int(os.getenv("RADIKO_MAX_CONNECTIONS", "100"))
+RADIKO_MAX_KEEPALIVE = int(os.getenv("RADIKO_MAX_KEEPALIVE", "20"))
+RADIKO_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+
+
+def _token_headers(auth_token: Optional[str]) -> dict:
+    return {"X-Radiko-AuthToken": auth_token} if auth_token else {}
+
+
+async def _close_quietly(client: httpx.AsyncClient):
+    # 終了したループの接続は閉じる途中で失敗することがある。残りはGCに任せる
+    try:
+        await client.aclose()
+    except Exception as e:
+        print(f"古いRadikoクライアントを閉じられませんでした: {e}")
+
+
+class RadikoClient:
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        priority: str = INTERACTIVE,
+        limiter: Optional[RateLimiter] = None,
+    ):
+        self.base_url = base_url or RADIKO_BASE_URL
+        self.transport = transport
+        # 画面からのリクエストは録音などのバックグラウンド処理より優先する
+        self.priority = priority
+        self.limiter = limiter or upstream_limiter
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._closing: Set[asyncio.Future] = set()
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # 接続はイベントループに紐づくので、ループが変わったら作り直す
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            if self._client is not None:
+                self._retire(self._client, self._loop, loop)
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                http2=HTTP2_AVAILABLE,
+                transport=self.transport,
+                timeout=RADIKO_TIMEOUT,
+                event_hooks={
+                    **HTTPX_EVENT_HOOKS,
+                    "request": [self._rate_limit, *HTTPX_EVENT_HOOKS["request"]],
+                },
+                limits=httpx.Limits(
+                    max_connections=RADIKO_MAX_CONNECTIONS,
+                    max_keepalive_connections=RADIKO_MAX_KEEPALIVE,
+                ),
+                # 共有クライアントにユーザーごとのCookieを溜めない
+                cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+            )
+            self._loop = loop
+        return self._client
+
+    def _retire(
+        self,
+        client: httpx.AsyncClient,
+        old_loop: asyncio.AbstractEventLoop,
+        loop: asyncio.AbstractEventLoop,
+    ):
+        """ループが変わる前のクライアントの接続プールを閉じる"""
+        if old_loop.is_running():
+            # 元のループが別スレッドでまだ動いていれば、そこで閉じる
+            future = asyncio.run_coroutine_threadsafe(client.aclose(), old_loop)
+        else:
+            future = loop.create_task(_close_quietly(client))
+        # 閉じ終わるまで参照を持っておく
+        self._closing.add(future)
+        future.add_done_callback(self._closing.discard)
+
+    async def _rate_limit(self, request: httpx.Request):
+        await self.limiter.aacquire(str(request.url), self.priority)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._loop = None
+
+    async def _conditional_get(
+        self,
+        path: str,
+        auth_token: Optional[str],
+        etag: Optional[str],
+        last_modified: Optional[str],
+    ) -> httpx.Response:
+        headers = _token_headers(auth_token)
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        res = await self.client.get(path, headers=headers)
+        if res.status_code != 304:
+            res.raise_for_status()
+        return res
+
+    async def get_station_list(
+        self, area_id: str, auth_token: Optional[str]
+    ) -> List[Station]:
+        try:
+            res = await self.client.get(
+                f"/v3/station/list/{area_id}.xml", headers=_token_headers(auth_token)
+            )
+            res.raise_for_status()
+            return parse_station_list(res.content)
+        except Exception as e:
+            raise HTTPException(
+                status_code=500, detail=f"放送局リストの取得に失敗: {e}"
+            )
+
+    async def fetch_program_guide(
+        self,
+        station_id: str,
+        date_str: str,
+        auth_token: Optional[str],
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> GuideFetch:
+        """番組表を取得する。ETag/Last-Modifiedを渡すと条件付きリクエストになる"""
+        path = f"/v3/program/station/date/{date_str}/{station_id}.xml"
+        try:
+            res = await self._conditional_get(path, auth_token, etag, last_modified)
+            if res.status_code == 304:
+                return GuideFetch(None, etag, last_modified)
+            return GuideFetch(
+                parse_program_guide(res.content),
+                res.headers.get("ETag"),
+                res.headers.get("Last-Modified"),
+            )
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"番組表の取得に失敗: {e}")
+
+    async def fetch_area_guide(
+        self,
+        area_id: str,
+        date_str: str,
+        auth_token: Optional[str],
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> GuideFetch:
+        """エリア内の全放送局の番組表を1回のリクエストで取得する"""
+        path = f"/v3/program/date/{date_str}/{area_id}.xml"
+        try:
+            res = await self._conditional_get(path, auth_token, etag, last_modified)
+            if res.status_code == 304:
+                return GuideFetch(None, etag, last_modified)
+            return GuideFetch(
+                parse_area_guide(res.content, area_id, date_str),
+                res.headers.get("ETag"),
+                res.headers.get("Last-Modified"),
+            )
+        except Exception as e:
+            raise HTTPException(
+                status_code=500, detail=f"エリア番組表の取得に失敗: {e}"
+            )
+
+    async def get_program_guide(
+        self, station_id: str, date_str: str, auth_token: str
+    ) -> GuideResponse:
+        return (await self.fetch_program_guide(station_id, date_str, auth_token)).guide
+
+    async def search(self, keyword: str, auth_token: str, page: int = 1) -> dict:
+        """番組検索APIのレスポンス(JSON)をそのまま返す"""
+        try:
+            res = await self.client.get(
+                "/v3/api/program/search",
+                params={"key": keyword, "page_idx": page - 1},
+                headers=_token_headers(auth_token),
+            )
+            res.raise_for_status()
+            return res.json()
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 401:
+                raise HTTPException(
+                    status_code=401,
+                    detail="Radiko API authentication failed. Token might be expired.",
+                )
+            raise HTTPException(
+                status_code=502,
+                detail=f"Radiko API returned an error: {e.response.status_code}",
+            )
+        except Exception as e:
+            raise HTTPException(
+                status_code=500, detail=f"Failed to connect to Radiko API: {e}"
+            )
+
+    async def authenticate(self, mail: str, password: str) -> Tuple[str, str]:
+        """プレミアム会員でログインし、(認証トークン, エリアID)を返す"""
+        try:
+            res_login = await self.client.post(
+                "/v4/api/member/login", data={"mail": mail, "pass": password}
+            )
+            res_login.raise_for_status()
+            session_id = res_login.json()["radiko_session"]
+            # ログインのCookieはこの認証の間だけ明示的に送る
+            cookie = "; ".join(
+                f"{name}={value}" for name, value in res_login.cookies.items()
+            )
+            headers = dict(AUTH_HEADERS)
+            if cookie:
+                headers["Cookie"] = cookie
+
+            res1 = await self.client.get("/v2/api/auth1", headers=headers)
+            res1.raise_for_status()
+            auth_token = res1.headers["X-Radiko-AuthToken"]
+            headers.update(
+                {
+                    "X-Radiko-AuthToken": auth_token,
+                    "X-Radiko-PartialKey": partial_key(res1.headers),
+                }
+            )
+            res2 = await self.client.get(
+                "/v2/api/auth2",
+                params={"radiko_session": session_id},
+                headers=headers,
+            )
+            res2.raise_for_status()
+            return auth_token, res2.text.split(",")[0]
+        except httpx.HTTPError as e:
+            raise HTTPException(
+                status_code=401, detail=f"Radiko authentication failed: {e}"
+            )
+        except Exception as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"An unexpected error occurred during authentication: {e}",
+            )
+
+
+radiko_client = RadikoClient()
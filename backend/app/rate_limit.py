@@ -0,0 +1,293 @@
+"""
+Radikoへのリクエストのレート制限
+
+番組表・検索・認証・ダウンロードのリクエストは、すべてここのトークンバケットを
+通してから送る。バケットはエンドポイントの種類ごとにあり、SQLiteに置くので
+APIワーカーとレコーダーの全プロセスで共有される。
+
+画面からのリクエスト(interactive)はバケットを空になるまで使えるが、
+番組表の先読みや録音など(background)はバーストの一部を残した状態で待つ。
+さらにinteractiveが待っている間は、backgroundにはトークンを渡さない。
+大量の録音中でも画面の操作が待たされないようにするため。
+
+HLSのセグメントのように回数の多いリクエストで毎回SQLiteに書かないよう、
+トークンは1回のトランザクションで数個まとめて借り、プロセス内で使う。
+SQLiteが使えないときは制限なしに通さず、少し待ってから確かめ直す。続けて失敗したら
+RateLimitUnavailable を送出し、リクエストを送らずに呼び出し元を失敗させる。
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .database import get_db_connection
+from .metrics import RATE_LIMIT_WAIT, endpoint_label, sqlite_lock_wait
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+# メトリクスのエンドポイント名 → レート制限の種類(その他はHLSの取得として扱う)
+LIMIT_CLASSES = {
+    "login": "auth",
+    "auth1": "auth",
+    "auth2": "auth",
+    "station_list": "station",
+    "station_guide": "guide",
+    "area_guide": "guide",
+    "search": "search",
+}
+STREAM_LIMIT = "stream"
+# 種類ごとの 1秒あたりの回数/バースト。RADIKO_RATE_LIMITS で種類ごとに上書きできる
+DEFAULT_RATE_LIMITS = "auth=1/5,station=10/20,guide=10/20,search=5/10,stream=40/80"
+# backgroundのリクエストが使わずに残すバーストの割合
+RATE_LIMIT_BACKGROUND_RESERVE = float(
+    os.getenv("RATE_LIMIT_BACKGROUND_RESERVE", "0.25")
+)
+# 1回のトランザクションで借りるトークン数(補充量の何秒分か。最低1個)
+RATE_LIMIT_LEASE_SECONDS = float(os.getenv("RATE_LIMIT_LEASE_SECONDS", "0.25"))
+LEASE_TTL = 1.0  # 借りたトークンを使わずに持っておける時間(秒)
+ERROR_WAIT = 0.5  # SQLiteが使えないときに確かめ直すまでの待ち時間(秒)
+ERROR_RETRIES = 10  # SQLiteが続けて使えないとき、あきらめるまでに確かめ直す回数
+
+
+class RateLimitUnavailable(RuntimeError):
+    """SQLiteのバケットが使えず、トークンを取れなかった"""
+
+
+class Bucket(NamedTuple):
+    rate: float  # 1秒あたりに補充するトークン数。0なら制限しない
+    burst: float  # 貯められるトークンの上限
+
+
+def parse_rate_limits(value: str) -> Dict[str, Bucket]:
+    """ "guide=10/20,search=5/10" の形式を解析する"""
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, _, spec = item.partition("=")
+        rate, _, burst = spec.partition("/")
+        rate = float(rate)
+        limits[name.strip()] = Bucket(rate, float(burst) if burst else max(rate, 1.0))
+    return limits
+
+
+RATE_LIMITS = {
+    **parse_rate_limits(DEFAULT_RATE_LIMITS),
+    **parse_rate_limits(os.getenv("RADIKO_RATE_LIMITS", "")),
+}
+
+
+def limit_class(url: str) -> str:
+    return LIMIT_CLASSES.get(endpoint_label(url), STREAM_LIMIT)
+
+
+class RateLimiter:
+    """SQLiteに置いたトークンバケットで、全プロセスのリクエスト数を制限する"""
+
+    def __init__(
+        self,
+        limits: Optional[Dict[str, Bucket]] = None,
+        reserve: float = RATE_LIMIT_BACKGROUND_RESERVE,
+        clock: Callable[[], float] = time.time,
+        lease_seconds: float = RATE_LIMIT_LEASE_SECONDS,
+    ):
+        self.limits = RATE_LIMITS if limits is None else limits
+        self.reserve = reserve
+        # プロセス間で比べるので壁時計を使う
+        self.clock = clock
+        self.lease_seconds = lease_seconds
+        # (種類, 優先度) → [借りて残っているトークン数, 期限]
+        self._leases: Dict[Tuple[str, str], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def try_acquire(self, name: str, priority: str = INTERACTIVE) -> float:
+        """
+        トークンを1つ取る。取れたら0、足りなければ取れるまでの秒数を返す(取らない)。
+        SQLiteが使えないときは sqlite3.Error を送出する。
+        """
+        bucket = self.limits.get(name)
+        if bucket is None or bucket.rate <= 0:
+            return 0.0
+        if self._take_leased(name, priority):
+            return 0.0
+        wait, leased = self._lease(name, bucket, priority)
+        if leased > 1:
+            with self._lock:
+                self._leases[(name, priority)] = [
+                    leased - 1,
+                    self.clock() + LEASE_TTL,
+                ]
+        return wait
+
+    def _take_leased(self, name: str, priority: str) -> bool:
+        with self._lock:
+            lease = self._leases.get((name, priority))
+            if lease is None or lease[0] < 1 or lease[1] < self.clock():
+                return False
+            lease[0] -= 1
+            return True
+
+    def _lease(self, name: str, bucket: Bucket, priority: str) -> Tuple[float, int]:
+        """SQLiteのバケットからトークンをまとめて借りる。(待ち秒数, 借りた数)を返す"""
+        floor = bucket.burst * self.reserve if priority == BACKGROUND else 0.0
+        size = max(1, int(bucket.rate * self.lease_seconds))
+        conn = get_db_connection()
+        try:
+            with sqlite_lock_wait("rate_limit"):
+                conn.execute("BEGIN IMMEDIATE")
+            now = self.clock()
+            row = conn.execute(
+                "SELECT tokens, updated_at, interactive_until "
+                "FROM rate_limit_buckets WHERE name = ?",
+                (name,),
+            ).fetchone()
+            if row is None:
+                tokens, interactive_until = bucket.burst, 0.0
+            else:
+                elapsed = max(now - row["updated_at"], 0.0)
+                tokens = min(bucket.burst, row["tokens"] + elapsed * bucket.rate)
+                interactive_until = row["interactive_until"]
+            wait, leased = 0.0, 0
+            if priority == BACKGROUND and interactive_until > now:
+                # 画面からのリクエストが待っている間は譲る
+                wait = interactive_until - now
+            elif tokens - 1 >= floor - 1e-9:  # 浮動小数点の誤差で待たないように
+                leased = min(size, int(tokens - floor + 1e-9))
+                tokens -= leased
+            else:
+                wait = (floor + 1 - tokens) / bucket.rate
+                if priority == INTERACTIVE:
+                    interactive_until = max(interactive_until, now + wait)
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limit_buckets "
+                "(name, tokens, updated_at, interactive_until) VALUES (?, ?, ?, ?)",
+                (name, tokens, now, interactive_until),
+            )
+            conn.commit()
+            return wait, leased
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _error_wait(self, name: str, errors: int, error: sqlite3.Error) -> float:
+        """SQLiteのエラーの errors 回目。待ち時間を返すか、あきらめて送出する"""
+        if errors > ERROR_RETRIES:
+            logger.error(
+                "レート制限を確認できないためリクエストを中止します(%s): %s",
+                name,
+                error,
+            )
+            raise RateLimitUnavailable(name) from error
+        logger.warning("レート制限を確認できません(%s): %s", name, error)
+        return ERROR_WAIT
+
+    def acquire(self, url: str, priority: str = BACKGROUND) -> float:
+        """
+        トークンが取れるまで待つ。待った秒数を返す。
+        SQLiteが続けて使えなければ RateLimitUnavailable を送出する
+        """
+        name = limit_class(url)
+        waited = 0.0
+        errors = 0
+        while True:
+            try:
+                wait = self.try_acquire(name, priority)
+                errors = 0
+            except sqlite3.Error as e:
+                errors += 1
+                wait = self._error_wait(name, errors, e)
+            if not wait:
+                break
+            time.sleep(wait)
+            waited += wait
+        if waited:
+            RATE_LIMIT_WAIT.labels(name, priority).observe(waited)
+        return waited
+
+    async def aacquire(self, url: str, priority: str = INTERACTIVE) -> float:
+        """acquire() の非同期版。SQLiteの読み書きはスレッドプールで行う"""
+        name = limit_class(url)
+        waited = 0.0
+        errors = 0
+        while True:
+            try:
+                wait = await run_in_threadpool(self.try_acquire, name, priority)
+                errors = 0
+            except sqlite3.Error as e:
+                errors += 1
+                wait = self._error_wait(name, errors, e)
+            if not wait:
+                break
+            await asyncio.sleep(wait)
+            waited += wait
+        if waited:
+            RATE_LIMIT_WAIT.labels(name, priority).observe(waited)
+        return waited
+
+
+upstream_limiter = RateLimiter()
+
+
+class RateLimitedRetry(Retry):
+    """urllib3の再試行。再試行はアダプターのsend()を通らないので、送り直す前にトークンを取る"""
+
+    def __init__(
+        self,
+        *args,
+        priority: str = BACKGROUND,
+        limiter: Optional[RateLimiter] = None,
+        url: Optional[str] = None,
+        **kwargs,
+    ):
+        self.priority = priority
+        self.limiter = limiter or upstream_limiter
+        self.url = url  # 次に送り直すリクエストのパス
+        super().__init__(*args, **kwargs)
+
+    def new(self, **kw):
+        kw.setdefault("priority", self.priority)
+        kw.setdefault("limiter", self.limiter)
+        kw.setdefault("url", self.url)
+        return super().new(**kw)
+
+    def increment(self, method=None, url=None, *args, **kwargs):
+        retry = super().increment(method, url, *args, **kwargs)
+        retry.url = url
+        return retry
+
+    def sleep(self, response=None):
+        super().sleep(response)
+        if self.url:
+            self.limiter.acquire(self.url, self.priority)
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """requests.Session に付けるアダプター。送信前にトークンを取る"""
+
+    def __init__(
+        self,
+        *args,
+        priority: str = BACKGROUND,
+        limiter: Optional[RateLimiter] = None,
+        **kwargs,
+    ):
+        self.priority = priority
+        self.limiter = limiter or upstream_limiter
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, *args, **kwargs):
+        self.limiter.acquire(request.url, self.priority)
+        return super().send(request, *args, **kwargs)
@@ -0,0 +1,384 @@
+"""
+録音デーモン
+
+ダウンロードの実行はすべてこのプロセスが受け持つ。APIはSQLiteのキューに
+ジョブを登録して状態を読むだけなので、APIワーカーを増やしても録音処理は重複しない。
+
+起動方法 (backend ディレクトリで実行):
+    python -m app.recorder
+"""
+
+import os
+import signal
+import sqlite3
+import subprocess
+import threading
+import time
+from datetime import datetime
+from typing import Optional, Tuple
+
+import requests
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from .auto_record import SCAN_INTERVAL, scan_program_changes
+from .checkpoints import JobCheckpoint
+from .database import get_db_connection, init_db, status_writer
+from .downloader import (
+    DOWNLOAD_ENGINE,
+    PlaylistError,
+    download_hls,
+    download_with_ffmpeg,
+)
+from .guide_cache import prune_guide_cache
+from .job_events import ProgressReporter, prune_job_events, publish_event
+from .job_queue import DownloadWorkerPool
+from .library import (
+    LIBRARY_SCAN_INTERVAL,
+    RECORDINGS_DIR,
+    record_download,
+    scan_library,
+)
+from .metrics import ACTIVE_DOWNLOADS, JOB_DURATION, JOB_FAILURES
+from .postprocess import Postprocessor
+from .program_index import INDEX_TTL, crawl_timefree_window, prune_program_index
+from .radiko import JST, timefree_playlist_url
+from .security import warn_default_secret_key
+from .station_map import STATION_MAP_TTL, station_map
+from .token_manager import TOKEN_REFRESH_INTERVAL, token_manager
+
+# 1を指定するとAPIプロセス内でもワーカープールを動かす(開発用の単一プロセス構成)
+EMBEDDED_RECORDER = os.getenv("EMBEDDED_RECORDER", "0") == "1"
+MAINTENANCE_INTERVAL = 600  # 定期処理(キャッシュ更新など)の実行間隔(秒)
+DOWNLOAD_RETRIES = 2  # 通信断などで中断したダウンロードを再開する回数
+RETRY_DELAY = 5  # 再開までの待ち時間(秒)
+# 失敗したジョブの書きかけファイルを再予約に備えて残しておく時間(秒)
+CHECKPOINT_RETENTION = 7 * 24 * 60 * 60
+
+
+def update_job_status(job_id, status, filename=None):
+    """ダウンロードジョブの状態をデータベースに保存し、変化を配信する(まとめ書き)"""
+    status_writer.submit(
+        "UPDATE download_log SET status = ?, filename = ? WHERE job_id = ?",
+        (status, filename, job_id),
+    )
+    publish_event(job_id, "status", {"status": status, "filename": filename})
+
+
+def fail_job(job_id, reason, message) -> str:
+    """失敗を記録する。reason はメトリクスで失敗理由を集計するための分類"""
+    JOB_FAILURES.labels(reason).inc()
+    update_job_status(job_id, f"failed: {message}")
+    return "failed"
+
+
+def is_unauthorized(error: Exception) -> bool:
+    """トークン期限切れ(401 Unauthorized)による失敗か"""
+    if isinstance(error, subprocess.CalledProcessError):
+        return "401 Unauthorized" in (error.stderr or "")
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code == 401
+    return False
+
+
+def is_transient(error: Exception) -> bool:
+    """時間をおけば成功しそうな失敗(通信断や5xx)か"""
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    return isinstance(
+        error,
+        (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ),
+    )
+
+
+def output_location(station_name, program_title, start_time_str) -> Tuple[str, str]:
+    """録音ファイルの保存先ディレクトリとファイル名"""
+    save_dir = os.path.join(RECORDINGS_DIR, station_name.replace("/", "／"))
+    safe_title = program_title.replace("/", "／").replace(":", "：").replace(" ", "_")
+    filename = f"{start_time_str[:8]}-{start_time_str[8:12]}_{safe_title}.aac"
+    return save_dir, filename
+
+
+def download_stream(
+    job_id, stream_url, output_path, radiko_token, duration, checkpoint=None
+):
+    """設定されたエンジンで番組をダウンロードする。再開できるのはnativeのみ"""
+    progress = ProgressReporter(job_id)
+    if DOWNLOAD_ENGINE == "ffmpeg":
+        print(f"--- FFmpeg Download For Job {job_id} ---")
+        print(stream_url)
+        download_with_ffmpeg(stream_url, output_path, radiko_token, duration, progress)
+        return
+    try:
+        result = download_hls(
+            stream_url,
+            output_path,
+            {"X-Radiko-AuthToken": radiko_token},
+            progress=progress,
+            checkpoint=checkpoint,
+        )
+    except PlaylistError as e:
+        # 想定外のプレイリスト形式の場合はffmpegに任せる
+        print(f"Job {job_id}: {e} (ffmpegにフォールバックします)")
+        download_with_ffmpeg(stream_url, output_path, radiko_token, duration, progress)
+    else:
+        resumed = (
+            f", {result.resumed_segments}セグメントは前回から再開"
+            if result.resumed_segments
+            else ""
+        )
+        print(
+            f"Job {job_id}: {result.segments}セグメント "
+            f"{result.bytes_written / 1024 / 1024:.1f}MB "
+            f"({result.elapsed:.1f}秒{resumed})"
+        )
+
+
+def start_download_job(
+    job_id,
+    station_id,
+    station_name,
+    program_title,
+    start_time_str,
+    end_time_str,
+    radiko_token: Optional[str],
+    account: Optional[str] = None,
+):
+    """
+    ワーカープールから呼び出されるダウンロード実行関数。結果("success"/"failed")を返す。
+    accountがあれば実行時点で有効なトークンを使い、401なら1回だけ取り直して再試行する。
+    通信断などの一時的な失敗は、書き込み済みの位置から DOWNLOAD_RETRIES 回まで再開する。
+    """
+    update_job_status(job_id, "downloading")
+
+    if account:
+        radiko_token = token_manager.get_token(account) or radiko_token
+    if not radiko_token:
+        return fail_job(job_id, "no_token", "Radikoトークンなし")
+
+    checkpoint = JobCheckpoint(job_id)
+    try:
+        stream_url = timefree_playlist_url(station_id, start_time_str, end_time_str)
+
+        save_dir, output_filename = output_location(
+            station_name, program_title, start_time_str
+        )
+        os.makedirs(save_dir, exist_ok=True)
+        output_path = os.path.join(save_dir, output_filename)
+        duration = (
+            datetime.strptime(end_time_str, "%Y%m%d%H%M%S")
+            - datetime.strptime(start_time_str, "%Y%m%d%H%M%S")
+        ).total_seconds()
+
+        retries = DOWNLOAD_RETRIES
+        token_refreshed = False
+        while True:
+            try:
+                download_stream(
+                    job_id, stream_url, output_path, radiko_token, duration, checkpoint
+                )
+                break
+            except (
+                subprocess.CalledProcessError,
+                requests.exceptions.RequestException,
+            ) as e:
+                if is_unauthorized(e) and account and not token_refreshed:
+                    token_refreshed = True
+                    fresh_token = token_manager.get_token(
+                        account, invalid_token=radiko_token
+                    )
+                    if fresh_token:
+                        print(f"Job {job_id}: トークンを取り直して再試行します")
+                        radiko_token = fresh_token
+                        continue
+                elif is_transient(e) and retries > 0:
+                    retries -= 1
+                    print(f"Job {job_id}: {e} (中断した位置から再開します)")
+                    time.sleep(RETRY_DELAY)
+                    continue
+                raise
+        update_job_status(job_id, "success", output_filename)
+        meta = {
+            "station_id": station_id,
+            "station_name": station_name,
+            "program_title": program_title,
+            "start_time": start_time_str,
+            "end_time": end_time_str,
+        }
+        try:
+            meta = record_download(
+                output_path,
+                job_id,
+                station_id,
+                station_name,
+                program_title,
+                start_time_str,
+                end_time_str,
+            )
+        except (OSError, sqlite3.Error) as e:
+            # 登録できなくても次回の走査で取り込まれる
+            print(f"Job {job_id}: 録音ライブラリへの登録に失敗しました: {e}")
+        # 後処理は別のプロセスプールで行い、ダウンロードの枠はここで空ける
+        postprocessor.submit(job_id, output_path, meta)
+        return "success"
+
+    except subprocess.CalledProcessError as e:
+        # トークン期限切れ(401 Unauthorized)を検知
+        if is_unauthorized(e):
+            reason, message = "token_expired", "Radikoトークンの有効期限切れ"
+        else:
+            lines = (e.stderr or "").strip().splitlines()
+            reason, message = "ffmpeg", lines[-1] if lines else str(e)
+    except requests.exceptions.HTTPError as e:
+        if is_unauthorized(e):
+            reason, message = "token_expired", "Radikoトークンの有効期限切れ"
+        else:
+            reason, message = "http_error", str(e)
+    except requests.exceptions.RequestException as e:
+        reason, message = "network", str(e)
+    except Exception as e:
+        reason, message = "other", str(e)
+
+    # 書きかけのファイルとチェックポイントは残し、再予約されたら続きから取得する。
+    # 再予約されないまま古くなったものは prune_checkpoints で消す
+    return fail_job(job_id, reason, message)
+
+
+def prune_checkpoints(retention: float = CHECKPOINT_RETENTION) -> int:
+    """再予約されないまま retention 秒たった書きかけのファイルと記録を消す"""
+    conn = get_db_connection()
+    try:
+        rows = conn.execute(
+            """
+            SELECT c.job_id, q.station_name, q.program_title, q.start_time
+            FROM download_checkpoints AS c
+            LEFT JOIN download_queue AS q ON q.job_id = c.job_id
+            WHERE c.updated_at < ?
+              AND COALESCE(q.state, '') NOT IN ('pending', 'running')
+            """,
+            (time.time() - retention,),
+        ).fetchall()
+    finally:
+        conn.close()
+    for row in rows:
+        checkpoint = JobCheckpoint(row["job_id"])
+        if row["station_name"] is None:
+            checkpoint.clear()
+            continue
+        save_dir, filename = output_location(
+            row["station_name"], row["program_title"], row["start_time"]
+        )
+        checkpoint.discard(os.path.join(save_dir, filename))
+    return len(rows)
+
+
+def run_queued_job(job):
+    """ワーカープールから呼び出され、キューのジョブを実行する"""
+    started = time.monotonic()
+    with ACTIVE_DOWNLOADS.track_inprogress():
+        outcome = start_download_job(
+            job["job_id"],
+            job["station_id"],
+            job["station_name"],
+            job["program_title"],
+            job["start_time"],
+            job["end_time"],
+            job["radiko_token"],
+            job["account"],
+        )
+    JOB_DURATION.labels(outcome).observe(time.monotonic() - started)
+
+
+download_workers = DownloadWorkerPool(run_queued_job)
+
+
+def update_library_after_postprocess(job_id: str, path: str, meta: dict):
+    """元のファイルを書き換える後処理のあとで、サイズやチェックサムを登録し直す"""
+    record_download(
+        path,
+        job_id,
+        meta["station_id"],
+        meta["station_name"],
+        meta["program_title"],
+        meta["start_time"],
+        meta["end_time"],
+    )
+
+
+postprocessor = Postprocessor(on_complete=update_library_after_postprocess)
+
+
+def scan_program_changes_and_notify():
+    if scan_program_changes():
+        download_workers.notify()
+
+
+def main():
+    init_db()
+    warn_default_secret_key()
+    stopping = threading.Event()
+
+    def handle_signal(signum, frame):
+        print(f"シグナル{signum}を受信しました。停止します...")
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    # 放送局マップなどのキャッシュは期限切れになる前にここで更新しておく
+    scheduler = BackgroundScheduler(timezone="Asia/Tokyo")
+    refresh_age = STATION_MAP_TTL * 3 // 4
+    scheduler.add_job(
+        station_map.ensure_loaded,
+        "interval",
+        seconds=MAINTENANCE_INTERVAL,
+        kwargs={"max_age": refresh_age},
+    )
+    scheduler.add_job(prune_guide_cache, "cron", hour=5, minute=30)
+    # ローカル検索インデックスは期限切れになる前に取り直す(初回は起動直後)
+    scheduler.add_job(
+        crawl_timefree_window,
+        "interval",
+        seconds=INDEX_TTL // 2,
+        next_run_time=datetime.now(JST),
+    )
+    scheduler.add_job(prune_program_index, "cron", hour=5, minute=40)
+    # 番組表の変更分を自動録音ルールと照合する
+    scheduler.add_job(
+        scan_program_changes_and_notify, "interval", seconds=SCAN_INTERVAL
+    )
+    scheduler.add_job(prune_job_events, "interval", seconds=MAINTENANCE_INTERVAL)
+    scheduler.add_job(prune_checkpoints, "interval", seconds=MAINTENANCE_INTERVAL)
+    # アプリの外で追加・削除された録音ファイルをライブラリに反映する(初回は起動直後)
+    scheduler.add_job(
+        scan_library,
+        "interval",
+        seconds=LIBRARY_SCAN_INTERVAL,
+        next_run_time=datetime.now(JST),
+    )
+    # 予約済みジョブのアカウントのトークンは期限が来る前に取り直しておく
+    scheduler.add_job(
+        token_manager.refresh_expiring, "interval", seconds=TOKEN_REFRESH_INTERVAL
+    )
+    scheduler.start()
+    station_map.ensure_loaded(max_age=refresh_age)
+
+    resumed = postprocessor.recover()
+    if resumed:
+        print(f"中断されていた後処理を{resumed}件再開します")
+    download_workers.start()
+    print(f"録音デーモンを起動しました (workers={download_workers.workers})")
+    stopping.wait()
+    download_workers.stop(timeout=10)
+    # 実行中の後処理は終わるのを待ち、始まっていないものは次回起動時に再開する
+    postprocessor.shutdown(wait=True)
+    status_writer.flush()
+    scheduler.shutdown(wait=False)
+    print("録音デーモンを停止しました")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,9 +7,27 @@ from jose import JWTError, jwt
 
 # --- 設定 ---
 # SECRET_KEYは.envファイルから読み込むのが望ましい
-SECRET_KEY = os.getenv("SECRET_KEY", "a_very_secret_key_that_should_be_in_env_file")
+DEFAULT_SECRET_KEY = "a_very_secret_key_that_should_be_in_env_file"
+SECRET_KEY = os.getenv("SECRET_KEY", DEFAULT_SECRET_KEY)
+# 既定値はリポジトリに載っているので、JWTも保存したパスワードも誰でも復号・偽造できる
+SECRET_KEY_IS_DEFAULT = SECRET_KEY == DEFAULT_SECRET_KEY
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # トークンの有効期限 (24時間)
+# <audio> などヘッダーを付けられない要求に渡す、録音ファイル用の署名付きURLの有効期限
+RECORDING_LINK_EXPIRE_MINUTES = 60
+RECORDING_SCOPE = "recording"
+
+
+def warn_default_secret_key():
+    """SECRET_KEYが既定値のままなら起動時に警告する"""
+    if SECRET_KEY_IS_DEFAULT:
+        print(
+            "警告: SECRET_KEY が設定されていません(既定値を使用中)。"
+            "JWTが偽造できる状態で、Radikoのパスワードは保存しません"
+            "(自動録音ルールは作成できず、予約したジョブはトークンが切れると失敗します)。"
+            ".env に SECRET_KEY を設定してください"
+        )
+
 
 # --- FastAPIのセキュリティ機能 ---
 # トークンを"Authorization: Bearer <token>"ヘッダーから受け取る
@@ -17,9 +35,9 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
 # --- JWT生成 ---
-def create_access_token(data: dict):
+def create_access_token(data: dict, expires_minutes: int = ACCESS_TOKEN_EXPIRE_MINUTES):
     to_encode = data.copy()
-    expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    expire = datetime.now(timezone.utc) + timedelta(minutes=expires_minutes)
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
@@ -35,8 +53,31 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
-        if email is None:
+        # 録音ファイル用のトークンではAPIを使わせない
+        if email is None or payload.get("scope"):
             raise credentials_exception
         return email
     except JWTError:
         raise credentials_exception
+
+
+# --- 録音ファイルの署名付きURL用トークン ---
+def create_recording_token(email: str, recording_id: int) -> str:
+    return create_access_token(
+        {"sub": email, "scope": RECORDING_SCOPE, "rec": recording_id},
+        expires_minutes=RECORDING_LINK_EXPIRE_MINUTES,
+    )
+
+
+def verify_recording_token(token: str, recording_id: int) -> str:
+    """トークンが指定した録音のものなら、発行したユーザーを返す"""
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        payload = {}
+    if payload.get("scope") != RECORDING_SCOPE or payload.get("rec") != recording_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="録音ファイルのURLが無効か期限切れです",
+        )
+    return payload["sub"]
@@ -0,0 +1,148 @@
+"""
+全国の放送局マップ
+
+47エリアの放送局リストを並列に取得してSQLiteに保存し、全プロセスで共有する。
+有効期限切れの場合はバックグラウンドで更新するため、検索リクエストは待たされない。
+放送局→エリアの逆引きも同じテーブルから引ける。
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from fastapi import HTTPException
+
+from .database import get_db_connection
+from .radiko import ALL_AREA_IDS, Station, get_station_list
+
+STATION_MAP_TTL = int(os.getenv("STATION_MAP_TTL", str(24 * 60 * 60)))  # 秒
+STATION_MAP_FANOUT = int(os.getenv("STATION_MAP_FANOUT", "8"))  # 同時取得数
+RELOAD_INTERVAL = 60  # 他プロセスの更新をSQLiteから読み直す間隔(秒)
+RETRY_INTERVAL = 300  # 更新に失敗した後、再試行するまでの間隔(秒)
+META_KEY = "station_map"
+
+
+def fetch_station_map(
+    auth_token: Optional[str] = None, fanout: int = STATION_MAP_FANOUT
+) -> Dict[str, List[Station]]:
+    """全エリアの放送局リストを並列に取得する。失敗したエリアは結果に含めない"""
+
+    def fetch(area_id):
+        try:
+            return area_id, get_station_list(area_id, auth_token)
+        except HTTPException as e:
+            print(f"{area_id}の放送局リストの取得に失敗しました: {e.detail}")
+            return area_id, None
+
+    with ThreadPoolExecutor(max_workers=fanout) as pool:
+        results = list(pool.map(fetch, ALL_AREA_IDS))
+    return {area_id: stations for area_id, stations in results if stations is not None}
+
+
+def save_station_map(conn, areas: Dict[str, List[Station]]):
+    """取得できたエリアの放送局を置き換え、更新日時を記録する"""
+    for area_id, stations in areas.items():
+        conn.execute("DELETE FROM station_areas WHERE area_id = ?", (area_id,))
+        conn.executemany(
+            "INSERT OR REPLACE INTO station_areas (station_id, area_id, name) VALUES (?, ?, ?)",
+            [(station.id, area_id, station.name) for station in stations],
+        )
+    conn.execute(
+        "INSERT OR REPLACE INTO cache_meta (key, updated_at) VALUES (?, CURRENT_TIMESTAMP)",
+        (META_KEY,),
+    )
+    conn.commit()
+
+
+def refresh_station_map(auth_token: Optional[str] = None) -> int:
+    """放送局マップを取得し直してSQLiteに保存する。保存した局数を返す"""
+    started = time.monotonic()
+    areas = fetch_station_map(auth_token)
+    if not areas:
+        # 全エリア失敗した場合は既存のデータをそのまま使う
+        return 0
+    conn = get_db_connection()
+    save_station_map(conn, areas)
+    conn.close()
+    station_map.invalidate()
+    count = len({station.id for stations in areas.values() for station in stations})
+    print(
+        f"放送局情報を更新しました ({len(areas)}エリア {count}局, "
+        f"{time.monotonic() - started:.1f}秒)"
+    )
+    return count
+
+
+class StationMap:
+    """SQLiteの放送局マップをプロセス内に保持する読み取り用キャッシュ"""
+
+    def __init__(self):
+        self._names: Dict[str, str] = {}
+        self._areas: Dict[str, List[str]] = {}
+        self._updated_at: Optional[float] = None  # SQLite上の更新日時(epoch)
+        self._loaded_at = 0.0
+        self._refreshing = False
+        self._last_refresh = float("-inf")
+        self._lock = threading.Lock()
+
+    def ensure_loaded(
+        self, auth_token: Optional[str] = None, max_age: float = STATION_MAP_TTL
+    ):
+        """必要ならSQLiteから読み直し、max_ageより古ければバックグラウンドで更新する"""
+        if time.monotonic() - self._loaded_at > RELOAD_INTERVAL:
+            self._load()
+        if self._updated_at is None or time.time() - self._updated_at > max_age:
+            self._refresh_in_background(auth_token)
+
+    def invalidate(self):
+        self._loaded_at = 0.0
+
+    def name(self, station_id: str) -> str:
+        return self._names.get(station_id, station_id)
+
+    def areas(self, station_id: str) -> List[str]:
+        return self._areas.get(station_id, [])
+
+    def _load(self):
+        conn = get_db_connection()
+        rows = conn.execute(
+            "SELECT station_id, area_id, name FROM station_areas ORDER BY station_id, area_id"
+        ).fetchall()
+        meta = conn.execute(
+            "SELECT CAST(strftime('%s', updated_at) AS INTEGER) FROM cache_meta WHERE key = ?",
+            (META_KEY,),
+        ).fetchone()
+        conn.close()
+
+        names: Dict[str, str] = {}
+        areas: Dict[str, List[str]] = {}
+        for row in rows:
+            names[row["station_id"]] = row["name"]
+            areas.setdefault(row["station_id"], []).append(row["area_id"])
+        self._names = names
+        self._areas = areas
+        self._updated_at = meta[0] if meta else None
+        self._loaded_at = time.monotonic()
+
+    def _refresh_in_background(self, auth_token: Optional[str]):
+        with self._lock:
+            now = time.monotonic()
+            if self._refreshing or now - self._last_refresh < RETRY_INTERVAL:
+                return
+            self._refreshing = True
+            self._last_refresh = now
+
+        def run():
+            try:
+                refresh_station_map(auth_token)
+            except Exception as e:
+                print(f"放送局情報の更新に失敗しました: {e}")
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name="station-map-refresh", daemon=True).start()
+
+
+station_map = StationMap()
@@ -0,0 +1,178 @@
+"""
+Radikoの認証トークンの管理
+
+ログインしたアカウントの認証結果(トークンとエリア)をSQLiteに保存し、APIワーカーと
+レコーダーで共有する。ジョブは実行時にここから有効なトークンを受け取るので、
+予約から実行までの間にブラウザのトークンが期限切れになっても失敗しない。
+再認証のためパスワードはSECRET_KEYから作った鍵で暗号化して保存する。
+SECRET_KEYが既定値のままなら鍵を誰でも作れるので、アカウントは保存しない。
+"""
+
+import base64
+import hashlib
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Tuple
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from .database import get_db_connection
+from .radiko import authenticate
+from .security import SECRET_KEY, SECRET_KEY_IS_DEFAULT
+
+# Radikoの認証トークンは発行から約70分有効。余裕を見て短めに扱う
+RADIKO_TOKEN_TTL = int(os.getenv("RADIKO_TOKEN_TTL", "3600"))
+TOKEN_REFRESH_MARGIN = 600  # 期限までこの秒数を切ったら取り直す
+TOKEN_REFRESH_INTERVAL = 300  # レコーダーが期限の近いトークンを確認する間隔(秒)
+
+_fernet = Fernet(base64.urlsafe_b64encode(hashlib.sha256(SECRET_KEY.encode()).digest()))
+
+
+def encrypt_password(password: str) -> str:
+    return _fernet.encrypt(password.encode()).decode()
+
+
+def decrypt_password(token: str) -> str:
+    return _fernet.decrypt(token.encode()).decode()
+
+
+@dataclass
+class CachedToken:
+    auth_token: Optional[str]
+    area_id: Optional[str]
+    expires_at: float
+
+
+class TokenManager:
+    def __init__(
+        self,
+        ttl: int = RADIKO_TOKEN_TTL,
+        margin: int = TOKEN_REFRESH_MARGIN,
+        authenticator: Callable[[str, str], Tuple[str, str]] = authenticate,
+    ):
+        self.ttl = ttl
+        self.margin = margin
+        self.authenticator = authenticator
+        self._tokens: Dict[str, CachedToken] = {}
+        self._lock = threading.Lock()
+        self._account_locks: Dict[str, threading.Lock] = {}
+
+    def save_account(self, email: str, password: str, auth_token: str, area_id: str):
+        """ログインに成功したアカウントと、そのとき発行されたトークンを保存する"""
+        if SECRET_KEY_IS_DEFAULT:
+            print(f"SECRET_KEYが既定値のため、アカウントを保存しません ({email})")
+            return
+        cached = CachedToken(auth_token, area_id, time.time() + self.ttl)
+        conn = get_db_connection()
+        conn.execute(
+            """
+            INSERT INTO radiko_accounts (email, password, area_id, auth_token, expires_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (email) DO UPDATE SET
+                password = excluded.password,
+                area_id = excluded.area_id,
+                auth_token = excluded.auth_token,
+                expires_at = excluded.expires_at
+            """,
+            (email, encrypt_password(password), area_id, auth_token, cached.expires_at),
+        )
+        conn.commit()
+        conn.close()
+        self._remember(email, cached)
+
+    def get_token(
+        self, email: str, invalid_token: Optional[str] = None
+    ) -> Optional[str]:
+        """
+        有効なトークンを返す。期限が近いか、invalid_token(401になったトークン)と
+        同じなら再認証する。アカウントが未登録か再認証に失敗した場合はNone。
+        """
+        with self._lock:
+            cached = self._tokens.get(email)
+        if self._usable(cached, invalid_token):
+            return cached.auth_token
+
+        # 同じアカウントの再認証は1回にまとめる
+        with self._account_lock(email):
+            row = self._load(email)
+            if row is None:
+                return None
+            # 他のスレッドやプロセスが更新済みならそれを使う
+            cached = CachedToken(row["auth_token"], row["area_id"], row["expires_at"])
+            if self._usable(cached, invalid_token):
+                self._remember(email, cached)
+                return cached.auth_token
+            return self._refresh(email, row["password"])
+
+    def refresh_expiring(self) -> int:
+        """待機中・実行中のジョブがあるアカウントのトークンを期限前に更新する"""
+        conn = get_db_connection()
+        try:
+            rows = conn.execute(
+                "SELECT DISTINCT account FROM download_queue "
+                "WHERE state IN ('pending', 'running') AND account IS NOT NULL"
+            ).fetchall()
+        finally:
+            conn.close()
+        return sum(1 for row in rows if self.get_token(row["account"]))
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+
+    def _usable(self, cached: Optional[CachedToken], invalid_token: Optional[str]):
+        return (
+            cached is not None
+            and cached.auth_token is not None
+            and cached.auth_token != invalid_token
+            and cached.expires_at - self.margin > time.time()
+        )
+
+    def _refresh(self, email: str, encrypted_password: str) -> Optional[str]:
+        try:
+            password = decrypt_password(encrypted_password)
+        except InvalidToken:
+            # SECRET_KEYが変わった場合は再ログインが必要
+            print(f"保存されたパスワードを復号できません ({email})")
+            return None
+        try:
+            auth_token, area_id = self.authenticator(email, password)
+        except Exception as e:
+            print(f"Radikoの再認証に失敗しました ({email}): {e}")
+            return None
+
+        cached = CachedToken(auth_token, area_id, time.time() + self.ttl)
+        conn = get_db_connection()
+        conn.execute(
+            "UPDATE radiko_accounts SET auth_token = ?, area_id = ?, expires_at = ? "
+            "WHERE email = ?",
+            (auth_token, area_id, cached.expires_at, email),
+        )
+        conn.commit()
+        conn.close()
+        self._remember(email, cached)
+        return auth_token
+
+    def _load(self, email: str):
+        conn = get_db_connection()
+        try:
+            return conn.execute(
+                "SELECT password, area_id, auth_token, expires_at "
+                "FROM radiko_accounts WHERE email = ?",
+                (email,),
+            ).fetchone()
+        finally:
+            conn.close()
+
+    def _remember(self, email: str, cached: CachedToken):
+        with self._lock:
+            self._tokens[email] = cached
+
+    def _account_lock(self, email: str) -> threading.Lock:
+        with self._lock:
+            return self._account_locks.setdefault(email, threading.Lock())
+
+
+token_manager = TokenManager()
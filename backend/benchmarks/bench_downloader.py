@@ -0,0 +1,55 @@
+"""
+HLSダウンローダーのスループット計測
+
+使い方 (backend ディレクトリで実行):
+    python -m benchmarks.bench_downloader --minutes 60 --latency 0.05
+"""
+
+import argparse
+import os
+import tempfile
+
+from app.downloader import download_hls
+
+from .fake_radiko import FakeRadikoConfig, start_server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--minutes", type=int, default=60, help="番組の長さ(分)")
+    parser.add_argument("--latency", type=float, default=0.05, help="応答遅延(秒)")
+    parser.add_argument(
+        "--bandwidth", type=float, default=None, help="1接続あたりの帯域(KB/s)"
+    )
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8, 16])
+    args = parser.parse_args()
+
+    config = FakeRadikoConfig(
+        latency=args.latency,
+        bandwidth=args.bandwidth * 1024 if args.bandwidth else None,
+    )
+    server, base_url = start_server(config)
+    hours, minutes = divmod(args.minutes, 60)
+    url = (
+        f"{base_url}/v2/api/ts/playlist.m3u8?station_id=TBS&l=15"
+        f"&ft=20240101000000&to=20240101{hours:02d}{minutes:02d}00"
+    )
+    print(f"program={args.minutes}min latency={args.latency * 1000:.0f}ms")
+    print(f"{'concurrency':>11} {'seconds':>8} {'MB/s':>8} {'realtime':>9}")
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for concurrency in args.concurrency:
+                output = os.path.join(tmp, f"bench_{concurrency}.aac")
+                result = download_hls(url, output, {}, concurrency=concurrency)
+                mb_per_sec = result.bytes_written / 1024 / 1024 / result.elapsed
+                speed = result.media_seconds / result.elapsed
+                print(
+                    f"{concurrency:>11} {result.elapsed:>8.2f} "
+                    f"{mb_per_sec:>8.2f} {speed:>8.0f}x"
+                )
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
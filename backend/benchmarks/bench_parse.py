@@ -0,0 +1,93 @@
+"""
+番組表XML解析のマイクロベンチマーク
+
+木全体を作ってstrptimeで日時を解析する従来の実装と、
+ストリーミング解析(iterparse)+高速な日時解析を比較する。
+
+使い方 (backend ディレクトリで実行):
+    python -m benchmarks.bench_parse --stations 15 --days 1
+"""
+
+import argparse
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+from app.radiko import (
+    JST,
+    AreaGuideResponse,
+    Program,
+    StationGuide,
+    parse_area_guide,
+)
+
+from .fake_radiko import build_area_guide_xml
+
+
+def parse_area_guide_tree(content: bytes, area_id: str, date_str: str):
+    """比較用: 以前の実装(ET.fromstring + strptime + 検証付きのモデル生成)"""
+    root = ET.fromstring(content)
+    stations = []
+    for station in root.iter("station"):
+        programs = []
+        for prog in station.iter("prog"):
+            image_elem = prog.find("img")
+            desc_elem = prog.find("desc")
+            programs.append(
+                Program(
+                    title=prog.find("title").text,
+                    start_time=JST.localize(
+                        datetime.strptime(prog.get("ft"), "%Y%m%d%H%M%S")
+                    ),
+                    end_time=JST.localize(
+                        datetime.strptime(prog.get("to"), "%Y%m%d%H%M%S")
+                    ),
+                    duration=int(prog.get("dur")),
+                    pfm=prog.find("pfm").text if prog.find("pfm") is not None else "",
+                    image_url=image_elem.text if image_elem is not None else None,
+                    description=desc_elem.text if desc_elem is not None else None,
+                )
+            )
+        stations.append(
+            StationGuide(
+                station_id=station.get("id"),
+                station_name=station.find("name").text,
+                programs=programs,
+            )
+        )
+    return AreaGuideResponse(area_id=area_id, date=date_str, stations=stations)
+
+
+def measure(parse, content: bytes, repeat: int) -> float:
+    """repeat回解析した中で最速の1回の秒数を返す"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        parse(content, "JP13", "20240101")
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stations", type=int, default=15, help="放送局数")
+    parser.add_argument("--days", type=int, default=1, help="日数")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    content = build_area_guide_xml(stations=args.stations, days=args.days)
+    programs = sum(
+        len(s.programs) for s in parse_area_guide(content, "JP13", "20240101").stations
+    )
+    print(f"xml={len(content) / 1024:.0f}KB programs={programs}")
+
+    tree = measure(parse_area_guide_tree, content, args.repeat)
+    stream = measure(parse_area_guide, content, args.repeat)
+    print(f"{'parser':>10} {'ms':>8} {'us/prog':>8}")
+    print(f"{'tree':>10} {tree * 1000:>8.2f} {tree * 1e6 / programs:>8.1f}")
+    print(f"{'streaming':>10} {stream * 1000:>8.2f} {stream * 1e6 / programs:>8.1f}")
+    print(f"speedup: {tree / stream:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
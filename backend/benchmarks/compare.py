@@ -0,0 +1,63 @@
+"""
+ベンチマーク結果の比較
+
+benchmarks.suite が書き出した2つのJSONの中央値を比べ、閾値より遅くなった
+項目があれば終了コード1で終わる(CIで使える)。
+
+使い方 (backend ディレクトリで実行):
+    python -m benchmarks.compare base.json head.json --threshold 0.1
+"""
+
+import argparse
+import json
+import sys
+
+
+def load(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compare(base: dict, head: dict, threshold: float):
+    """(項目名, 基準の中央値, 比較対象の中央値, 変化率, 遅くなったか) を返す"""
+    rows = []
+    for name, result in head["benchmarks"].items():
+        if name not in base["benchmarks"]:
+            continue
+        before = base["benchmarks"][name]["stats"]["median"]
+        after = result["stats"]["median"]
+        change = (after - before) / before if before else 0.0
+        rows.append((name, before, after, change, change > threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("base")
+    parser.add_argument("head")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="中央値がこの割合より遅くなったら失敗にする",
+    )
+    args = parser.parse_args()
+
+    base, head = load(args.base), load(args.head)
+    if base.get("config") != head.get("config"):
+        print("警告: 計測条件が異なります", file=sys.stderr)
+    rows = compare(base, head, args.threshold)
+    print(f"base={base.get('commit')} head={head.get('commit')}")
+    print(f"{'benchmark':<22} {'base ms':>10} {'head ms':>10} {'change':>8}")
+    for name, before, after, change, regressed in rows:
+        mark = "  <-- 遅くなりました" if regressed else ""
+        print(
+            f"{name:<22} {before * 1000:>10.2f} {after * 1000:>10.2f} "
+            f"{change:>+8.1%}{mark}"
+        )
+    if any(row[4] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""
+ベンチマーク用のローカルRadiko代替サーバー
+
+認証(login/auth1/auth2)、放送局リスト・番組表のXML、番組検索のJSON、
+タイムフリーのHLS(playlist.m3u8 → chunklist → AACセグメント)を
+実サイズ相当のダミーデータで配信する。遅延と帯域は引数で調整できる。
+
+単独で起動する場合 (backend ディレクトリで実行):
+    python -m benchmarks.fake_radiko --port 8765 --latency 0.02
+"""
+
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+SEGMENT_SECONDS = 5
+# 48kbps HE-AAC 5秒分 ≒ 30KB
+DEFAULT_SEGMENT_BYTES = 30 * 1024
+STATIONS_PER_AREA = 12
+SEARCH_RESULTS = 50  # 検索の総件数(1ページ10件)
+_STATION_GUIDE_PATH = re.compile(r"^/v3/program/station/date/(\d{8})/([^/]+)\.xml$")
+_AREA_GUIDE_PATH = re.compile(r"^/v3/program/date/(\d{8})/([^/]+)\.xml$")
+_STATION_LIST_PATH = re.compile(r"^/v3/station/list/([^/]+)\.xml$")
+
+
+def _id3_header() -> bytes:
+    """Radikoのセグメントと同様、先頭にID3タグを付ける"""
+    body = b"PRIV" + (20).to_bytes(4, "big") + b"\x00\x00" + b"\x00" * 20
+    size = len(body)
+    syncsafe = bytes(
+        [(size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F]
+    )
+    return b"ID3\x04\x00\x00" + syncsafe + body
+
+
+def _adts_segment(size: int, seconds: float = SEGMENT_SECONDS) -> bytes:
+    """48kHzのADTSフレームを並べた、再生時間とサイズが実物相当のセグメント"""
+    frames = int(seconds * 48000 / 1024)
+    frame_length = max(size // frames, 8)
+    header = bytes(
+        [
+            0xFF,
+            0xF1,
+            (1 << 6) | (3 << 2),  # AAC LC, 48kHz
+            0x80 | (frame_length >> 11),
+            (frame_length >> 3) & 0xFF,
+            ((frame_length & 0x07) << 5) | 0x1F,
+            0xFC,
+        ]
+    )
+    payload = os.urandom(frame_length - len(header))
+    return (header + payload) * frames
+
+
+def station_ids(area_id: str, count: int = STATIONS_PER_AREA):
+    return [f"{area_id}ST{s:02d}" for s in range(count)]
+
+
+def build_station_list_xml(area_id: str, count: int = STATIONS_PER_AREA) -> bytes:
+    parts = [f'<?xml version="1.0" encoding="UTF-8"?>\n<stations area_id="{area_id}">']
+    for station_id in station_ids(area_id, count):
+        parts.append(
+            f"<station><id>{station_id}</id><name>放送局{station_id}</name>"
+            f"<ascii_name>{station_id}</ascii_name><areafree>1</areafree>"
+            f"<timefree>1</timefree><banner>https://example.com/{station_id}.png</banner>"
+            "</station>"
+        )
+    parts.append("</stations>")
+    return "".join(parts).encode()
+
+
+def build_area_guide_xml(
+    stations: int = 15,
+    days: int = 1,
+    program_minutes: int = 30,
+    start="20240101",
+    ids=None,
+) -> bytes:
+    """実際の番組表XMLと同じ構造のダミー番組表を生成する"""
+    day_start = datetime.strptime(start, "%Y%m%d") + timedelta(hours=5)
+    slots = days * 24 * 60 // program_minutes
+    ids = ids or [f"ST{s:02d}" for s in range(stations)]
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>\n<radiko><ttl>1800</ttl><stations>'
+    ]
+    for s, station_id in enumerate(ids):
+        parts.append(f'<station id="{station_id}"><name>放送局{s}</name><progs>')
+        parts.append(f"<date>{start}</date>")
+        for i in range(slots):
+            ft = day_start + timedelta(minutes=program_minutes * i)
+            to = ft + timedelta(minutes=program_minutes)
+            parts.append(
+                f'<prog id="{s}{i}" master_id="" ft="{ft:%Y%m%d%H%M%S}" '
+                f'to="{to:%Y%m%d%H%M%S}" ftl="{ft:%H%M}" tol="{to:%H%M}" '
+                f'dur="{program_minutes * 60}">'
+                f"<title>番組{i} {escape('ニュース&天気')}</title><url/>"
+                f"<failed_record>0</failed_record><ts_in_ng>0</ts_in_ng>"
+                f"<tsplus_in_ng>0</tsplus_in_ng><ts_out_ng>0</ts_out_ng>"
+                f"<tsplus_out_ng>0</tsplus_out_ng><desc>{'番組の説明。' * 20}</desc>"
+                f"<info>{escape('<p>番組の詳細情報</p>') * 10}</info>"
+                f"<pfm>出演者{i % 7}</pfm>"
+                f"<img>https://example.com/img/{s}/{i}.jpg</img>"
+                f"<tag><item><name>タグ{i % 5}</name></item></tag>"
+                f'<genre><personality id="C008"><name>アナウンサー</name></personality>'
+                f'<program id="P008"><name>情報</name></program></genre>'
+                f'<metas><meta name="twitter" value="#radiko"/></metas>'
+                "</prog>"
+            )
+        parts.append("</progs></station>")
+    parts.append("</stations></radiko>")
+    return "".join(parts).encode()
+
+
+def build_search_json(keyword: str, page: int, per_page: int = 10) -> bytes:
+    """番組検索APIと同じ形式のレスポンス"""
+    start = datetime(2024, 1, 1, 5)
+    data = []
+    for i in range(page * per_page, min((page + 1) * per_page, SEARCH_RESULTS)):
+        ft = start + timedelta(hours=i)
+        data.append(
+            {
+                "title": f"{keyword}の番組{i}",
+                "station_id": f"JP13ST{i % STATIONS_PER_AREA:02d}",
+                "start_time": f"{ft:%Y-%m-%d %H:%M:%S}",
+                "end_time": f"{ft + timedelta(minutes=30):%Y-%m-%d %H:%M:%S}",
+                "performer": f"出演者{i % 7}",
+                "img": f"https://example.com/img/{i}.jpg",
+                "description": "番組の説明。" * 20,
+            }
+        )
+    body = {
+        "meta": {"result_count": SEARCH_RESULTS, "page_idx": page},
+        "data": data,
+    }
+    return json.dumps(body, ensure_ascii=False).encode()
+
+
+@lru_cache(maxsize=512)
+def _station_guide(station_id: str, date_str: str) -> bytes:
+    return build_area_guide_xml(start=date_str, ids=[station_id])
+
+
+@lru_cache(maxsize=64)
+def _area_guide(area_id: str, date_str: str) -> bytes:
+    return build_area_guide_xml(start=date_str, ids=station_ids(area_id))
+
+
+class FakeRadikoConfig:
+    def __init__(self, latency=0.02, bandwidth=None, segment_bytes=None):
+        self.latency = latency  # 1リクエストあたりの応答遅延(秒)
+        self.bandwidth = bandwidth  # 1接続あたりの帯域(bytes/sec)、Noneで無制限
+        self.segment_bytes = segment_bytes or DEFAULT_SEGMENT_BYTES
+        self.requests = 0
+        self.lock = threading.Lock()
+
+
+class FakeRadikoHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    config: FakeRadikoConfig = None
+    segment_payload: bytes = b""
+
+    def log_message(self, format, *args):  # noqa: A002
+        pass
+
+    def _send(self, body: bytes, content_type: str, status: int = 200, headers=None):
+        with self.config.lock:
+            self.config.requests += 1
+        if self.config.latency:
+            time.sleep(self.config.latency)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.config.bandwidth:
+            chunk = 16 * 1024
+            for i in range(0, len(body), chunk):
+                self.wfile.write(body[i : i + chunk])
+                time.sleep(len(body[i : i + chunk]) / self.config.bandwidth)
+        else:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/v2/api/ts/playlist.m3u8":
+            chunklist = f"/v2/api/ts/chunklist/fake.m3u8?{url.query}"
+            body = (
+                "#EXTM3U\n"
+                '#EXT-X-STREAM-INF:BANDWIDTH=52973,CODECS="mp4a.40.5"\n'
+                f"{chunklist}\n"
+            )
+            self._send(body.encode(), "application/vnd.apple.mpegurl")
+        elif url.path.startswith("/v2/api/ts/chunklist/"):
+            self._send(self._chunklist(query).encode(), "application/x-mpegURL")
+        elif url.path.startswith("/segments/"):
+            self._send(self.segment_payload, "audio/aac")
+        elif url.path == "/v2/api/auth1":
+            self._send(
+                b"OK",
+                "text/plain",
+                headers={
+                    "X-Radiko-AuthToken": "fake-auth-token",
+                    "X-Radiko-KeyLength": "16",
+                    "X-Radiko-KeyOffset": "8",
+                },
+            )
+        elif url.path == "/v2/api/auth2":
+            self._send(b"JP13,tokyo,Japan", "text/plain")
+        elif url.path == "/v3/api/program/search":
+            keyword = query.get("key", [""])[0]
+            page = int(query.get("page_idx", ["0"])[0])
+            self._send(build_search_json(keyword, page), "application/json")
+        elif _STATION_LIST_PATH.match(url.path):
+            area_id = _STATION_LIST_PATH.match(url.path).group(1)
+            self._send(build_station_list_xml(area_id), "application/xml")
+        elif _STATION_GUIDE_PATH.match(url.path):
+            date_str, station_id = _STATION_GUIDE_PATH.match(url.path).groups()
+            self._send(_station_guide(station_id, date_str), "application/xml")
+        elif _AREA_GUIDE_PATH.match(url.path):
+            date_str, area_id = _AREA_GUIDE_PATH.match(url.path).groups()
+            self._send(_area_guide(area_id, date_str), "application/xml")
+        else:
+            self._send(b"not found", "text/plain", status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        if urlparse(self.path).path == "/v4/api/member/login":
+            self._send(
+                b'{"radiko_session": "fake-session", "areafree": "1"}',
+                "application/json",
+                headers={"Set-Cookie": "radiko_session=fake-session; Path=/"},
+            )
+        else:
+            self._send(b"not found", "text/plain", status=404)
+
+    def _chunklist(self, query) -> str:
+        ft = datetime.strptime(query["ft"][0], "%Y%m%d%H%M%S")
+        to = datetime.strptime(query["to"][0], "%Y%m%d%H%M%S")
+        count = max(1, int((to - ft).total_seconds()) // SEGMENT_SECONDS)
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{SEGMENT_SECONDS}",
+            "#EXT-X-MEDIA-SEQUENCE:1",
+        ]
+        for i in range(count):
+            lines.append(f"#EXTINF:{SEGMENT_SECONDS},")
+            lines.append(f"/segments/{i}.aac")
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+
+def start_server(config: FakeRadikoConfig, host="127.0.0.1", port=0):
+    """別スレッドでサーバーを起動し、(server, base_url) を返す"""
+    handler = type(
+        "Handler",
+        (FakeRadikoHandler,),
+        {
+            "config": config,
+            "segment_payload": _id3_header() + _adts_segment(config.segment_bytes),
+        },
+    )
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.02, help="応答遅延(秒)")
+    parser.add_argument(
+        "--bandwidth", type=float, default=None, help="1接続あたりの帯域(KB/s)"
+    )
+    args = parser.parse_args()
+
+    config = FakeRadikoConfig(
+        latency=args.latency,
+        bandwidth=args.bandwidth * 1024 if args.bandwidth else None,
+    )
+    server, base_url = start_server(config, args.host, args.port)
+    print(f"fake radiko: {base_url}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+"""
+API の負荷試験
+
+本番と同じ gunicorn + UvicornWorker の構成でAPIを起動し、ログイン・番組表の閲覧・
+検索・ダウンロードの予約・状態のポーリングを混ぜたシナリオを多数の仮想ユーザーで
+実行する。Radikoの代わりにローカルの代替サーバー(fake_radiko)を別プロセスで起動する。
+ワーカー数ごとに、エンドポイント別の p50/p95/p99 とスループットを出力する。
+
+レコーダーは起動しないので、予約したジョブはキューに積まれるだけになる。
+Radikoへのレート制限は既定で無効にする(--rate-limits で有効にできる)。
+
+使い方 (backend ディレクトリで実行):
+    python -m benchmarks.loadtest --workers 1 2 4 --users 50 --duration 30
+    python -m benchmarks.loadtest --scenario scenario.json --output load.json
+
+シナリオ(JSON)では既定値(DEFAULT_SCENARIO)のうち変えたい項目だけを書けばよい:
+    {"users": 100, "think_time": 1.0, "mix": {"guide": 50, "status": 50}}
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from .fake_radiko import station_ids
+from .results import git_commit, percentile
+
+SCHEMA_VERSION = 1
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SCENARIO = {
+    "users": 20,  # 同時に操作する仮想ユーザー数
+    "duration": 30,  # 計測時間(秒)
+    "ramp_up": 5,  # 全ユーザーが揃うまでの時間(秒)
+    "think_time": 0.5,  # 操作の間隔の平均(秒、指数分布)
+    "areas": ["JP13", "JP27"],
+    "keywords": ["ニュース", "音楽", "野球", "落語"],
+    # 操作の比率(login は開始時の1回に加えて、この比率で再ログインする)
+    "mix": {
+        "login": 2,
+        "guide": 35,
+        "area_guide": 5,
+        "stations": 5,
+        "search": 15,
+        "download": 5,
+        "status": 25,
+        "jobs": 10,
+    },
+}
+# レート制限を無効にする設定(全種類の回数を0にする)
+NO_RATE_LIMITS = "auth=0,station=0,guide=0,search=0,stream=0"
+
+
+def load_scenario(path: Optional[str]) -> dict:
+    scenario = dict(DEFAULT_SCENARIO)
+    if path:
+        with open(path, encoding="utf-8") as f:
+            scenario.update(json.load(f))
+    return scenario
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"起動に失敗しました: {process.args}")
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{timeout}秒以内に起動しませんでした: {url}")
+
+
+def stop(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def start_fake_radiko(latency: float) -> Tuple[subprocess.Popen, str]:
+    port = free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.fake_radiko",
+            "--port",
+            str(port),
+            "--latency",
+            str(latency),
+        ],
+        cwd=BACKEND_DIR,
+        stdout=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    wait_until_ready(f"{base_url}/v2/api/auth2", process)
+    return process, base_url
+
+
+def start_api(workers: int, radiko_url: str, workdir: str, rate_limits: bool):
+    """本番と同じコマンドでAPIを起動する(作業ディレクトリの gunicorn.conf.py も読む)"""
+    port = free_port()
+    env = dict(
+        os.environ,
+        DATABASE_PATH=os.path.join(workdir, "load.db"),
+        RECORDINGS_DIR=os.path.join(workdir, "recordings"),
+        RADIKO_BASE_URL=radiko_url,
+        EMBEDDED_RECORDER="",
+    )
+    if not rate_limits:
+        env["RADIKO_RATE_LIMITS"] = NO_RATE_LIMITS
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "--bind",
+            f"127.0.0.1:{port}",
+            "--workers",
+            str(workers),
+            "-k",
+            "uvicorn.workers.UvicornWorker",
+            "app.main:app",
+        ],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    wait_until_ready(f"{base_url}/health", process)
+    return process, base_url
+
+
+class Recorder:
+    """エンドポイントごとの応答時間とエラー数を集める"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.recording = False
+
+    async def call(self, name: str, request):
+        started = time.perf_counter()
+        try:
+            res = await request
+            ok = res.status_code < 400
+        except httpx.HTTPError:
+            res, ok = None, False
+        elapsed = time.perf_counter() - started
+        if self.recording:
+            self.latencies[name].append(elapsed)
+            if not ok:
+                self.errors[name] += 1
+        return res
+
+    def report(self, duration: float) -> dict:
+        endpoints = {}
+        for name, samples in sorted(self.latencies.items()):
+            samples = sorted(samples)
+            endpoints[name] = {
+                "count": len(samples),
+                "errors": self.errors[name],
+                "rps": len(samples) / duration,
+                "p50": percentile(samples, 50),
+                "p95": percentile(samples, 95),
+                "p99": percentile(samples, 99),
+                "max": samples[-1],
+            }
+        total = sum(len(samples) for samples in self.latencies.values())
+        return {
+            "duration": duration,
+            "requests": total,
+            "errors": sum(self.errors.values()),
+            "rps": total / duration,
+            "endpoints": endpoints,
+        }
+
+
+class VirtualUser:
+    def __init__(self, index: int, client: httpx.AsyncClient, scenario: dict, stats):
+        self.index = index
+        self.client = client
+        self.scenario = scenario
+        self.stats = stats
+        self.random = random.Random(index)
+        self.headers: Dict[str, str] = {}
+        actions, weights = zip(*scenario["mix"].items())
+        self.actions, self.weights = list(actions), list(weights)
+
+    async def login(self) -> bool:
+        res = await self.stats.call(
+            "login",
+            self.client.post(
+                "/api/login",
+                data={"email": f"user{self.index}@example.com", "password": "pw"},
+            ),
+        )
+        if res is None or res.status_code != 200:
+            return False
+        body = res.json()
+        self.headers = {
+            "Authorization": f"Bearer {body['access_token']}",
+            "X-Radiko-AuthToken": body["radiko_token"],
+        }
+        return True
+
+    def _area(self) -> str:
+        return self.random.choice(self.scenario["areas"])
+
+    def _date(self) -> str:
+        # タイムフリーの範囲(過去7日)から選ぶ
+        today = datetime.now() - timedelta(hours=5)
+        return (today - timedelta(days=self.random.randint(0, 7))).strftime("%Y%m%d")
+
+    def _get(self, name: str, path: str, **params):
+        return self.stats.call(
+            name, self.client.get(path, params=params or None, headers=self.headers)
+        )
+
+    async def guide(self):
+        station = self.random.choice(station_ids(self._area()))
+        await self._get("guide", f"/api/guide/{station}/{self._date()}")
+
+    async def area_guide(self):
+        await self._get("area_guide", f"/api/guide/area/{self._area()}/{self._date()}")
+
+    async def stations(self):
+        await self._get("stations", f"/api/stations/{self._area()}")
+
+    async def search(self):
+        keyword = self.random.choice(self.scenario["keywords"])
+        await self._get("search", f"/api/search/{keyword}")
+
+    async def download(self):
+        station = self.random.choice(station_ids(self._area()))
+        start = datetime.strptime(self._date(), "%Y%m%d") + timedelta(
+            hours=5 + self.random.randint(0, 47) / 2
+        )
+        body = {
+            "station_id": station,
+            "station_name": station,
+            "program_title": "負荷試験",
+            "start_time": start.strftime("%Y%m%d%H%M%S"),
+            "end_time": (start + timedelta(minutes=30)).strftime("%Y%m%d%H%M%S"),
+        }
+        await self.stats.call(
+            "download",
+            self.client.post("/api/download", json=body, headers=self.headers),
+        )
+
+    async def status(self):
+        await self._get("status", "/api/status")
+
+    async def jobs(self):
+        await self._get("jobs", "/api/jobs")
+
+    async def run(self, deadline: float):
+        await asyncio.sleep(self.random.uniform(0, self.scenario["ramp_up"]))
+        if not await self.login():
+            return
+        while time.monotonic() < deadline:
+            action = self.random.choices(self.actions, self.weights)[0]
+            await getattr(self, action)()
+            await asyncio.sleep(
+                self.random.expovariate(1 / self.scenario["think_time"])
+            )
+
+
+async def drive(base_url: str, scenario: dict) -> dict:
+    """ランプアップの後、duration秒間の応答を集計する"""
+    stats = Recorder()
+    limits = httpx.Limits(max_connections=scenario["users"])
+    async with httpx.AsyncClient(
+        base_url=base_url, timeout=30, limits=limits
+    ) as client:
+        deadline = time.monotonic() + scenario["ramp_up"] + scenario["duration"]
+        users = [
+            VirtualUser(i, client, scenario, stats) for i in range(scenario["users"])
+        ]
+        tasks = [asyncio.create_task(user.run(deadline)) for user in users]
+        await asyncio.sleep(scenario["ramp_up"])
+        stats.recording = True
+        started = time.monotonic()
+        await asyncio.gather(*tasks)
+        return stats.report(time.monotonic() - started)
+
+
+def print_report(run: dict):
+    print(
+        f"\nworkers={run['workers']} requests={run['requests']} "
+        f"errors={run['errors']} rps={run['rps']:.1f}"
+    )
+    print(
+        f"{'endpoint':<12} {'count':>7} {'errors':>6} {'rps':>7} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    )
+    for name, row in run["endpoints"].items():
+        print(
+            f"{name:<12} {row['count']:>7} {row['errors']:>6} {row['rps']:>7.1f} "
+            f"{row['p50'] * 1000:>8.1f} {row['p95'] * 1000:>8.1f} "
+            f"{row['p99'] * 1000:>8.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--scenario", help="シナリオのJSONファイル")
+    parser.add_argument("--users", type=int, help="仮想ユーザー数(シナリオより優先)")
+    parser.add_argument("--duration", type=float, help="計測時間(秒、シナリオより優先)")
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="代替サーバーの応答遅延(秒)"
+    )
+    parser.add_argument("--output", help="結果のJSONの出力先")
+    parser.add_argument(
+        "--rate-limits",
+        action="store_true",
+        help="Radikoへのレート制限を有効にしたまま計測する",
+    )
+    args = parser.parse_args()
+
+    scenario = load_scenario(args.scenario)
+    if args.users:
+        scenario["users"] = args.users
+    if args.duration:
+        scenario["duration"] = args.duration
+
+    fake, radiko_url = start_fake_radiko(args.latency)
+    runs = []
+    try:
+        for workers in args.workers:
+            # ワーカー数ごとに空のデータベースから始める
+            with tempfile.TemporaryDirectory() as workdir:
+                api, base_url = start_api(
+                    workers, radiko_url, workdir, args.rate_limits
+                )
+                try:
+                    run = {"workers": workers, **asyncio.run(drive(base_url, scenario))}
+                finally:
+                    stop(api)
+            print_report(run)
+            runs.append(run)
+    finally:
+        stop(fake)
+
+    if args.output:
+        report = {
+            "schema": SCHEMA_VERSION,
+            "commit": git_commit(),
+            "created_at": datetime.now().astimezone().isoformat(),
+            "scenario": scenario,
+            "latency": args.latency,
+            "rate_limits": args.rate_limits,
+            "runs": runs,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
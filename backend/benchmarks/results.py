@@ -0,0 +1,36 @@
+"""
+ベンチマーク・負荷試験の結果の集計
+"""
+
+import subprocess
+from typing import List, Optional
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """最近傍順位法のパーセンタイル(samplesは昇順)"""
+    index = max(0, min(len(samples) - 1, int(round(q / 100 * len(samples))) - 1))
+    return samples[index]
+
+
+def summarize(samples: List[float]) -> dict:
+    samples = sorted(samples)
+    return {
+        "n": len(samples),
+        "min": samples[0],
+        "median": percentile(samples, 50),
+        "p95": percentile(samples, 95),
+        "max": samples[-1],
+        "mean": sum(samples) / len(samples),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,350 @@
+"""
+ベンチマークスイート
+
+ローカルのRadiko代替サーバー(fake_radiko)に向けて、番組表の解析と取得、
+放送局マップの初回構築、検索、ダウンロード(start_download_job)、
+ジョブが1万件以上ある状態の /api/status を計測し、結果をJSONで書き出す。
+コミット間の比較は benchmarks.compare で行う。
+
+データベースと録音ディレクトリは一時ディレクトリに作るので、実環境には触らない。
+Radikoへのレート制限は既定で無効にする(--rate-limits で有効にできる)。
+
+使い方 (backend ディレクトリで実行):
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --only guide_parse_station search_remote --repeat 5
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List
+
+from fastapi.testclient import TestClient
+
+from app import database, library, radiko, recorder
+from app.guide_cache import radiko_today
+from app.job_queue import submit_job
+from app.main import app
+from app.program_index import crawl_timefree_window
+from app.radiko import parse_area_guide, parse_program_guide
+from app.radiko_client import radiko_client
+from app.rate_limit import upstream_limiter
+from app.security import create_access_token
+from app.station_map import refresh_station_map
+
+from .fake_radiko import (
+    FakeRadikoConfig,
+    build_area_guide_xml,
+    start_server,
+)
+from .results import git_commit, summarize
+
+SCHEMA_VERSION = 1
+
+
+def timeit(func: Callable[[], object], repeat: int) -> List[float]:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+class Context:
+    """ベンチマーク間で共有する代替サーバー・API クライアント・設定"""
+
+    def __init__(self, args, config: FakeRadikoConfig, base_url: str, workdir: str):
+        self.args = args
+        self.config = config
+        self.base_url = base_url
+        self.workdir = workdir
+        self.client = TestClient(app)
+        token = create_access_token(data={"sub": "bench@example.com"})
+        self.headers = {
+            "Authorization": f"Bearer {token}",
+            "X-Radiko-AuthToken": "fake-auth-token",
+        }
+
+    def repeat(self, default: int) -> int:
+        return self.args.repeat or default
+
+    def upstream_requests(self) -> int:
+        with self.config.lock:
+            return self.config.requests
+
+
+BENCHMARKS: Dict[str, Callable[[Context], dict]] = {}
+
+
+def benchmark(name: str):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+
+    return register
+
+
+def _result(samples: List[float], **metrics) -> dict:
+    return {"unit": "seconds", "stats": summarize(samples), "metrics": metrics}
+
+
+@benchmark("guide_parse_station")
+def bench_guide_parse_station(ctx: Context) -> dict:
+    """放送局1日分の番組表XMLの解析"""
+    content = build_area_guide_xml(stations=1, program_minutes=15)
+    programs = len(parse_program_guide(content).programs)
+    samples = timeit(lambda: parse_program_guide(content), ctx.repeat(200))
+    return _result(samples, xml_bytes=len(content), programs=programs)
+
+
+@benchmark("guide_parse_area")
+def bench_guide_parse_area(ctx: Context) -> dict:
+    """エリア(15局)1日分の番組表XMLの解析"""
+    content = build_area_guide_xml(stations=15)
+    guide = parse_area_guide(content, "JP13", "20240101")
+    programs = sum(len(station.programs) for station in guide.stations)
+    samples = timeit(
+        lambda: parse_area_guide(content, "JP13", "20240101"), ctx.repeat(50)
+    )
+    return _result(samples, xml_bytes=len(content), programs=programs)
+
+
+@benchmark("guide_fetch")
+def bench_guide_fetch(ctx: Context) -> dict:
+    """get_program_guide(取得+解析、キャッシュなし)"""
+    samples = timeit(
+        lambda: radiko.get_program_guide("JP13ST00", radiko_today(), "token"),
+        ctx.repeat(50),
+    )
+    return _result(samples, latency=ctx.config.latency)
+
+
+@benchmark("station_map_cold")
+def bench_station_map_cold(ctx: Context) -> dict:
+    """空のデータベースから47エリアの放送局マップを作る"""
+    counts = []
+
+    def run():
+        conn = database.get_db_connection()
+        conn.execute("DELETE FROM station_areas")
+        conn.execute("DELETE FROM cache_meta")
+        conn.execute("DELETE FROM rate_limit_buckets")
+        conn.commit()
+        conn.close()
+        before = ctx.upstream_requests()
+        stations = refresh_station_map()
+        counts.append((stations, ctx.upstream_requests() - before))
+
+    samples = timeit(run, ctx.repeat(3))
+    stations, requests = counts[-1]
+    return _result(
+        samples, stations=stations, requests=requests, latency=ctx.config.latency
+    )
+
+
+def _ensure_station_map():
+    conn = database.get_db_connection()
+    loaded = conn.execute("SELECT 1 FROM station_areas LIMIT 1").fetchone()
+    conn.close()
+    if not loaded:
+        refresh_station_map()
+
+
+@benchmark("search_remote")
+def bench_search_remote(ctx: Context) -> dict:
+    """/api/search (Radikoの検索APIに問い合わせる場合)"""
+    _ensure_station_map()
+
+    def run():
+        res = ctx.client.get(
+            "/api/search/ニュース", params={"source": "remote"}, headers=ctx.headers
+        )
+        res.raise_for_status()
+
+    return _result(timeit(run, ctx.repeat(50)), latency=ctx.config.latency)
+
+
+@benchmark("search_local")
+def bench_search_local(ctx: Context) -> dict:
+    """/api/search (ローカルの検索インデックスを使う場合)"""
+    areas = ["JP13", "JP27"]
+    crawl_timefree_window(areas)
+    conn = database.get_db_connection()
+    programs = conn.execute("SELECT COUNT(*) FROM programs").fetchone()[0]
+    conn.close()
+
+    def run():
+        res = ctx.client.get(
+            "/api/search/ニュース", params={"source": "local"}, headers=ctx.headers
+        )
+        res.raise_for_status()
+
+    return _result(timeit(run, ctx.repeat(100)), indexed_programs=programs)
+
+
+@benchmark("download_e2e")
+def bench_download_e2e(ctx: Context) -> dict:
+    """start_download_job で1番組をダウンロードしてライブラリに登録するまで"""
+    minutes = ctx.args.program_minutes
+    start = datetime(2024, 1, 1, 5)
+    start_time = start.strftime("%Y%m%d%H%M%S")
+    end_time = (start + timedelta(minutes=minutes)).strftime("%Y%m%d%H%M%S")
+    recordings = os.path.join(ctx.workdir, "recordings")
+    recorder.RECORDINGS_DIR = library.RECORDINGS_DIR = recordings
+    recorder.postprocessor.steps = []
+    sizes = []
+
+    def run():
+        job_id = f"bench-{len(sizes)}"
+        outcome = recorder.start_download_job(
+            job_id,
+            "JP13ST00",
+            "放送局",
+            "ベンチマーク番組",
+            start_time,
+            end_time,
+            "fake-auth-token",
+        )
+        if outcome != "success":
+            raise RuntimeError(f"ダウンロードに失敗しました: {outcome}")
+        database.status_writer.flush()
+        conn = database.get_db_connection()
+        size = conn.execute(
+            "SELECT size FROM recordings WHERE job_id = ?", (job_id,)
+        ).fetchone()[0]
+        conn.close()
+        sizes.append(size)
+
+    samples = timeit(run, ctx.repeat(3))
+    median = summarize(samples)["median"]
+    return _result(
+        samples,
+        program_minutes=minutes,
+        bytes=sizes[-1],
+        mb_per_sec=sizes[-1] / 1024 / 1024 / median,
+        realtime_factor=minutes * 60 / median,
+        latency=ctx.config.latency,
+    )
+
+
+@benchmark("status_10k")
+def bench_status(ctx: Context) -> dict:
+    """ジョブとログイン履歴が大量にある状態の /api/status"""
+    rows = ctx.args.status_rows
+    conn = database.get_db_connection()
+    existing = conn.execute("SELECT COUNT(*) FROM download_log").fetchone()[0]
+    conn.execute("BEGIN IMMEDIATE")
+    start = datetime(2023, 1, 1, 5)
+    for i in range(existing, rows):
+        ft = start + timedelta(minutes=30 * i)
+        submit_job(
+            conn,
+            f"JP13ST{i % 12:02d}",
+            "放送局",
+            f"番組{i}",
+            ft.strftime("%Y%m%d%H%M%S"),
+            (ft + timedelta(minutes=30)).strftime("%Y%m%d%H%M%S"),
+            None,
+            "bench@example.com",
+        )
+    conn.executemany(
+        "INSERT INTO login_history (email, status) VALUES (?, 'success')",
+        [("bench@example.com",)] * rows,
+    )
+    conn.commit()
+    conn.close()
+
+    def run():
+        ctx.client.get("/api/status", headers=ctx.headers).raise_for_status()
+
+    return _result(timeit(run, ctx.repeat(100)), rows=rows)
+
+
+def run_suite(args) -> dict:
+    config = FakeRadikoConfig(
+        latency=args.latency,
+        bandwidth=args.bandwidth * 1024 if args.bandwidth else None,
+    )
+    server, base_url = start_server(config)
+    with tempfile.TemporaryDirectory() as workdir:
+        database.DATABASE = os.path.join(workdir, "bench.db")
+        database.init_db()
+        radiko.RADIKO_BASE_URL = base_url
+        radiko_client.base_url = base_url
+        if not args.rate_limits:
+            upstream_limiter.limits = {}
+        ctx = Context(args, config, base_url, workdir)
+        results = {}
+        try:
+            for name, func in BENCHMARKS.items():
+                if args.only and name not in args.only:
+                    continue
+                print(f"{name} ...", file=sys.stderr, flush=True)
+                results[name] = func(ctx)
+        finally:
+            database.status_writer.flush()
+            server.shutdown()
+    return {
+        "schema": SCHEMA_VERSION,
+        "commit": git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "latency": args.latency,
+            "bandwidth_kb": args.bandwidth,
+            "rate_limits": args.rate_limits,
+            "repeat": args.repeat,
+        },
+        "benchmarks": results,
+    }
+
+
+def print_table(report: dict):
+    print(f"{'benchmark':<22} {'median ms':>10} {'p95 ms':>10} {'n':>5}")
+    for name, result in report["benchmarks"].items():
+        stats = result["stats"]
+        print(
+            f"{name:<22} {stats['median'] * 1000:>10.2f} "
+            f"{stats['p95'] * 1000:>10.2f} {stats['n']:>5}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", help="結果のJSONの出力先(省略時は標準出力)")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS))
+    parser.add_argument(
+        "--repeat", type=int, default=None, help="計測回数(省略時は項目ごとの既定値)"
+    )
+    parser.add_argument("--latency", type=float, default=0.02, help="応答遅延(秒)")
+    parser.add_argument(
+        "--bandwidth", type=float, default=None, help="1接続あたりの帯域(KB/s)"
+    )
+    parser.add_argument("--program-minutes", type=int, default=60)
+    parser.add_argument("--status-rows", type=int, default=10000)
+    parser.add_argument(
+        "--rate-limits",
+        action="store_true",
+        help="Radikoへのレート制限を有効にしたまま計測する",
+    )
+    args = parser.parse_args()
+
+    report = run_suite(args)
+    body = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(body + "\n")
+        print_table(report)
+    else:
+        print(body)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+"""
+gunicornの設定（作業ディレクトリにあれば自動で読み込まれる）
+
+PROMETHEUS_MULTIPROC_DIR を使う場合、前回起動時のワーカーのメトリクスを消し、
+終了したワーカーの実行中ゲージを集計から外す。
+"""
+
+import os
+
+
+def on_starting(server):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from app.metrics import clear_multiproc_dir
+
+        clear_multiproc_dir()
+
+
+def child_exit(server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
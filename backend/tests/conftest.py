@@ -8,8 +8,14 @@ import tempfile
 import os
 from fastapi.testclient import TestClient
 
-from app.main import app
-from app.database import init_db
+# app.database はインポート時にパスを決めるので、先にテスト用の一時ファイルにしておく
+# (app/r_downloader.db を作らないように)
+os.environ.setdefault(
+    "DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "r_downloader.db")
+)
+
+from app.database import init_db  # noqa: E402
+from app.main import app  # noqa: E402
 
 
 @pytest.fixture(scope="session")
@@ -2,8 +2,12 @@
 APIエンドポイントのテスト
 """
 
+from datetime import datetime
+import time
 from unittest.mock import patch, MagicMock
 
+import pytest
+
 
 class TestHealthEndpoint:
     """ヘルスチェックエンドポイントのテスト"""
@@ -64,7 +68,7 @@ class TestStationsEndpoint:
         response = client.get("/api/stations/JP13")
         assert response.status_code == 401
 
-    @patch("app.main.get_station_list")
+    @patch("app.main.radiko_client.get_station_list")
     def test_stations_authorized(self, mock_get_stations, client):
         """認証ありでのアクセステスト"""
         # モックの設定
@@ -86,6 +90,8 @@ class TestStationsEndpoint:
         data = response.json()
         assert len(data) == 1
         assert data[0]["id"] == "TBS"
+        # 認証が必要なので共有キャッシュには保存させない
+        assert response.headers["cache-control"].startswith("private, max-age=")
 
 
 class TestSearchEndpoint:
@@ -165,3 +171,480 @@ class TestStatusEndpoint:
         data = response.json()
         assert "jobs" in data
         assert "logins" in data
+
+    def test_status_not_modified(self, client):
+        """状態に変化がなければ304を返す"""
+        from app.security import create_access_token
+
+        valid_token = create_access_token(data={"sub": "test@example.com"})
+        headers = {"Authorization": f"Bearer {valid_token}"}
+        first = client.get("/api/status", headers=headers)
+        assert first.headers["cache-control"] == "private, no-cache"
+
+        second = client.get(
+            "/api/status", headers={**headers, "If-None-Match": first.headers["etag"]}
+        )
+        assert second.status_code == 304
+
+
+class TestAreaGuideEndpoint:
+    """エリア番組表エンドポイントのテスト"""
+
+    def test_area_guide_unauthorized(self, client):
+        response = client.get("/api/guide/area/JP13/20240101")
+        assert response.status_code == 401
+
+    def _headers(self, **extra):
+        from app.security import create_access_token
+
+        valid_token = create_access_token(data={"sub": "test@example.com"})
+        return {
+            "Authorization": f"Bearer {valid_token}",
+            "X-Radiko-AuthToken": "test_radiko_token",
+            **extra,
+        }
+
+    def _entry(self, immutable=True):
+        from app.guide_cache import CacheEntry
+        from app.radiko import AreaGuideResponse
+
+        guide = AreaGuideResponse(area_id="JP13", date="20240101", stations=[])
+        return CacheEntry(guide, None, None, time.time(), immutable)
+
+    @patch("app.main.guide_cache.aget_area_guide_entry")
+    def test_area_guide_authorized(self, mock_get_area_guide, client):
+        mock_get_area_guide.return_value = self._entry()
+        response = client.get("/api/guide/area/JP13/20240101", headers=self._headers())
+
+        assert response.status_code == 200
+        assert response.json()["area_id"] == "JP13"
+        mock_get_area_guide.assert_awaited_once_with(
+            "JP13", "20240101", "test_radiko_token"
+        )
+
+    @patch("app.main.guide_cache.aget_area_guide_entry")
+    def test_not_modified(self, mock_get_area_guide, client):
+        entry = self._entry()
+        mock_get_area_guide.return_value = entry
+        first = client.get("/api/guide/area/JP13/20240101", headers=self._headers())
+        # 過去日の番組表は変わらないので長く保存させる
+        assert first.headers["cache-control"] == "private, max-age=604800, immutable"
+
+        with patch.object(type(entry.value), "model_dump_json") as dump:
+            second = client.get(
+                "/api/guide/area/JP13/20240101",
+                headers=self._headers(**{"If-None-Match": first.headers["etag"]}),
+            )
+        assert second.status_code == 304
+        assert second.content == b""
+        assert second.headers["cache-control"] == first.headers["cache-control"]
+        # 2回目はJSONを作り直さない
+        dump.assert_not_called()
+
+    @patch("app.main.guide_cache.aget_area_guide_entry")
+    def test_today_has_short_max_age(self, mock_get_area_guide, client):
+        mock_get_area_guide.return_value = self._entry(immutable=False)
+        response = client.get("/api/guide/area/JP13/20240101", headers=self._headers())
+
+        directives = response.headers["cache-control"].split(", ")
+        # 認証が必要なので共有キャッシュには保存させない
+        assert directives[0] == "private"
+        assert 0 < int(directives[1].removeprefix("max-age=")) <= 600
+
+
+class TestLocalSearch:
+    """ローカル検索インデックスを使った検索のテスト"""
+
+    def _headers(self):
+        from app.security import create_access_token
+
+        valid_token = create_access_token(data={"sub": "test@example.com"})
+        return {
+            "Authorization": f"Bearer {valid_token}",
+            "X-Radiko-AuthToken": "test_radiko_token",
+        }
+
+    @patch("app.main.search_radiko_programs")
+    @patch("app.main.search_local_programs")
+    @patch("app.main.is_index_complete", return_value=True)
+    def test_local_index_is_used_when_complete(
+        self, mock_complete, mock_local, mock_remote, client
+    ):
+        from app.radiko import SearchResponse
+
+        mock_local.return_value = SearchResponse(
+            programs=[], total_results=3, current_page=1, total_pages=1
+        )
+        response = client.get(
+            "/api/search/テスト番組?per_page=20", headers=self._headers()
+        )
+
+        assert response.status_code == 200
+        assert response.json()["total_results"] == 3
+        mock_local.assert_called_once_with("テスト番組", 1, 20, None)
+        mock_remote.assert_not_called()
+
+    @patch("app.main.search_radiko_programs")
+    @patch("app.main.search_local_programs", return_value=None)
+    @patch("app.main.is_index_complete", return_value=True)
+    def test_short_keyword_falls_back_to_radiko(
+        self, mock_complete, mock_local, mock_remote, client
+    ):
+        from app.radiko import SearchResponse
+
+        mock_remote.return_value = SearchResponse(
+            programs=[], total_results=0, current_page=1, total_pages=0
+        )
+        response = client.get("/api/search/ab", headers=self._headers())
+
+        assert response.status_code == 200
+        mock_remote.assert_called_once_with("ab", "test_radiko_token", 1)
+
+    @patch("app.main.search_local_programs", return_value=None)
+    def test_local_source_rejects_short_keyword(self, mock_local, client):
+        response = client.get("/api/search/ab?source=local", headers=self._headers())
+        assert response.status_code == 400
+
+
+class TestJobsEndpoint:
+    """ジョブ一覧・ログイン履歴のページングのテスト"""
+
+    @pytest.fixture
+    def jobs_db(self, tmp_path, monkeypatch):
+        from app import database
+
+        monkeypatch.setattr(database, "DATABASE", str(tmp_path / "jobs.db"))
+        database.init_db()
+        conn = database.get_db_connection()
+        rows = [
+            ("j1", "TBS", "番組1", datetime(2024, 1, 1, 10), "success"),
+            ("j2", "QRR", "番組2", datetime(2024, 1, 2, 10), "failed: エラー"),
+            ("j3", "TBS", "番組3", datetime(2024, 1, 3, 10), "queued"),
+            ("j4", "TBS", "番組4", datetime(2024, 1, 3, 10), "success"),
+            ("j5", "QRR", "番組5", datetime(2024, 1, 4, 10), "success"),
+        ]
+        conn.executemany(
+            "INSERT INTO download_log (job_id, station_id, program_title, start_time, status) VALUES (?, ?, ?, ?, ?)",
+            [(j, s, t, str(d), st) for j, s, t, d, st in rows],
+        )
+        conn.executemany(
+            "INSERT INTO login_history (email, status) VALUES (?, ?)",
+            [(f"user{i}@example.com", "success") for i in range(3)],
+        )
+        conn.commit()
+        conn.close()
+
+    def _headers(self):
+        from app.security import create_access_token
+
+        token = create_access_token(data={"sub": "test@example.com"})
+        return {"Authorization": f"Bearer {token}"}
+
+    def test_keyset_pagination(self, client, jobs_db):
+        titles, cursor = [], None
+        while True:
+            params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+            data = client.get("/api/jobs", params=params, headers=self._headers())
+            data = data.json()
+            titles += [job["program_title"] for job in data["jobs"]]
+            cursor = data["next_cursor"]
+            if cursor is None:
+                break
+        # 同じ開始時刻の番組もIDで順序が決まり、重複も漏れもない
+        assert titles == ["番組5", "番組4", "番組3", "番組2", "番組1"]
+
+    def test_filters(self, client, jobs_db):
+        def titles(**params):
+            res = client.get("/api/jobs", params=params, headers=self._headers())
+            return [job["program_title"] for job in res.json()["jobs"]]
+
+        assert titles(status="failed") == ["番組2"]
+        assert titles(station_id="QRR") == ["番組5", "番組2"]
+        assert titles(date_from="20240102", date_to="20240103") == [
+            "番組4",
+            "番組3",
+            "番組2",
+        ]
+
+    def test_invalid_cursor(self, client, jobs_db):
+        res = client.get("/api/jobs?cursor=broken", headers=self._headers())
+        assert res.status_code == 400
+
+    def test_tampered_cursor(self, client, jobs_db):
+        """形式は正しいが値の型が合わないカーソルも400にする"""
+        from app.main import encode_cursor
+
+        for path, cursor in [
+            ("/api/jobs", encode_cursor("2024-01-01 10:00:00", "x")),
+            ("/api/recordings", encode_cursor("2024-01-01 10:00:00", "1.5")),
+            ("/api/logins", encode_cursor("x")),
+            ("/api/logins", encode_cursor(1, 2)),
+        ]:
+            res = client.get(path, params={"cursor": cursor}, headers=self._headers())
+            assert res.status_code == 400, path
+
+    def test_logins(self, client, jobs_db):
+        res = client.get("/api/logins?limit=2", headers=self._headers()).json()
+        assert [login["email"] for login in res["logins"]] == [
+            "user2@example.com",
+            "user1@example.com",
+        ]
+        res = client.get(
+            f"/api/logins?cursor={res['next_cursor']}", headers=self._headers()
+        ).json()
+        assert [login["email"] for login in res["logins"]] == ["user0@example.com"]
+        assert res["next_cursor"] is None
+
+    def test_listing_uses_index(self, jobs_db):
+        from app import database
+
+        conn = database.get_db_connection()
+        plan = conn.execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM download_log "
+            "WHERE (start_time, id) < (?, ?) ORDER BY start_time DESC, id DESC LIMIT 3",
+            ("2024-01-03 10:00:00", 4),
+        ).fetchall()
+        conn.close()
+        detail = " ".join(row["detail"] for row in plan)
+        assert "idx_download_log_start_time" in detail
+        assert "TEMP B-TREE" not in detail
+
+
+class TestJobEventsEndpoint:
+    """ジョブイベント配信エンドポイントのテスト"""
+
+    def test_events_unauthorized(self, client):
+        response = client.get("/api/jobs/events")
+        assert response.status_code == 401
+
+
+class TestDownloadEndpoint:
+    """ダウンロード予約の重複排除のテスト"""
+
+    @pytest.fixture
+    def download_db(self, tmp_path, monkeypatch):
+        from app import database
+
+        monkeypatch.setattr(database, "DATABASE", str(tmp_path / "download.db"))
+        database.init_db()
+
+    def _headers(self, **extra):
+        from app.security import create_access_token
+
+        token = create_access_token(data={"sub": "test@example.com"})
+        return {"Authorization": f"Bearer {token}", **extra}
+
+    def _request(self, **kwargs):
+        return {
+            "station_id": "TBS",
+            "station_name": "TBSラジオ",
+            "program_title": "番組",
+            "start_time": "20240101100000",
+            "end_time": "20240101110000",
+            **kwargs,
+        }
+
+    def test_duplicate_returns_existing_job(self, client, download_db):
+        first = client.post(
+            "/api/download", json=self._request(), headers=self._headers()
+        )
+        second = client.post(
+            "/api/download", json=self._request(), headers=self._headers()
+        )
+
+        assert first.status_code == 202
+        assert second.status_code == 200
+        assert second.json()["job_id"] == first.json()["job_id"]
+
+    def test_idempotency_key_conflict(self, client, download_db):
+        headers = self._headers(**{"Idempotency-Key": "abc"})
+        client.post("/api/download", json=self._request(), headers=headers)
+        res = client.post(
+            "/api/download",
+            json=self._request(start_time="20240102100000", end_time="20240102110000"),
+            headers=headers,
+        )
+        assert res.status_code == 422
+
+    def test_invalid_times(self, client, download_db):
+        res = client.post(
+            "/api/download",
+            json=self._request(end_time="20240101090000"),
+            headers=self._headers(),
+        )
+        assert res.status_code == 422
+
+    def test_batch(self, client, download_db):
+        from app import database
+
+        existing = client.post(
+            "/api/download", json=self._request(), headers=self._headers()
+        ).json()["job_id"]
+        items = [
+            self._request(start_time="20240102100000", end_time="20240102110000"),
+            self._request(start_time="2024-01-03"),
+            self._request(),
+            self._request(start_time="20240102100000", end_time="20240102110000"),
+        ]
+        with patch("app.main.download_workers") as workers:
+            res = client.post(
+                "/api/download/batch", json={"items": items}, headers=self._headers()
+            )
+
+        assert res.status_code == 202
+        body = res.json()
+        results = body["results"]
+        assert body["scheduled"] == 1
+        assert results[0]["created"] and results[0]["job_id"]
+        assert results[1]["error"] and results[1]["job_id"] is None
+        # 予約済みの番組と、同じリクエスト内の重複は既存のジョブを返す
+        assert results[2]["job_id"] == existing and not results[2]["created"]
+        assert results[3]["job_id"] == results[0]["job_id"]
+        workers.notify.assert_called_once()
+
+        conn = database.get_db_connection()
+        count = conn.execute("SELECT COUNT(*) FROM download_queue").fetchone()[0]
+        conn.close()
+        assert count == 2
+
+    def test_batch_size_limit(self, client, download_db):
+        from app.main import MAX_BATCH_SIZE
+
+        res = client.post(
+            "/api/download/batch",
+            json={"items": [self._request()] * (MAX_BATCH_SIZE + 1)},
+            headers=self._headers(),
+        )
+        assert res.status_code == 422
+
+
+class TestRecordingsEndpoint:
+    """録音ライブラリの一覧のテスト"""
+
+    @pytest.fixture
+    def recordings_db(self, tmp_path, monkeypatch):
+        from app import database
+
+        monkeypatch.setattr(database, "DATABASE", str(tmp_path / "recordings.db"))
+        database.init_db()
+        conn = database.get_db_connection()
+        conn.executemany(
+            "INSERT INTO recordings (path, station_name, program_title, start_time, size, mtime_ns, checksum, pfm, indexed_at) VALUES (?, ?, ?, ?, ?, 0, '', ?, 0)",
+            [
+                (
+                    f"{station}/{day}.aac",
+                    station,
+                    title,
+                    f"2024-01-0{day} 10:00:00",
+                    100,
+                    pfm,
+                )
+                for station, title, day, pfm in [
+                    ("TBSラジオ", "番組1", 1, "出演者A"),
+                    ("文化放送", "番組2", 2, None),
+                    ("TBSラジオ", "番組3", 3, None),
+                ]
+            ],
+        )
+        conn.commit()
+        conn.close()
+
+    def _headers(self):
+        from app.security import create_access_token
+
+        token = create_access_token(data={"sub": "test@example.com"})
+        return {"Authorization": f"Bearer {token}"}
+
+    def _titles(self, client, **params):
+        res = client.get("/api/recordings", params=params, headers=self._headers())
+        return res.json()
+
+    def test_pagination(self, client, recordings_db):
+        page = self._titles(client, limit=2)
+        assert [r["program_title"] for r in page["recordings"]] == ["番組3", "番組2"]
+        page = self._titles(client, limit=2, cursor=page["next_cursor"])
+        assert [r["program_title"] for r in page["recordings"]] == ["番組1"]
+        assert page["next_cursor"] is None
+
+    def test_filters(self, client, recordings_db):
+        def titles(**params):
+            return [
+                r["program_title"] for r in self._titles(client, **params)["recordings"]
+            ]
+
+        assert titles(station_name="TBSラジオ") == ["番組3", "番組1"]
+        assert titles(keyword="出演者") == ["番組1"]
+        assert titles(date_from="20240102", date_to="20240102") == ["番組2"]
+
+
+class TestRulesEndpoint:
+    """自動録音ルールのAPIのテスト"""
+
+    @pytest.fixture
+    def rules_db(self, tmp_path, monkeypatch):
+        from app import database
+
+        monkeypatch.setattr(database, "DATABASE", str(tmp_path / "rules.db"))
+        database.init_db()
+        # SECRET_KEYを設定した環境として扱う
+        monkeypatch.setattr("app.main.SECRET_KEY_IS_DEFAULT", False)
+
+    def _headers(self, email="test@example.com"):
+        from app.security import create_access_token
+
+        token = create_access_token(data={"sub": email})
+        return {"Authorization": f"Bearer {token}"}
+
+    def test_create_list_and_delete(self, client, rules_db):
+        res = client.post(
+            "/api/rules",
+            json={"name": "深夜", "keyword": "JUNK", "weekdays": [0, 1]},
+            headers=self._headers(),
+        )
+        assert res.status_code == 201
+        rule = res.json()
+        assert rule["weekdays"] == [0, 1]
+
+        rules = client.get("/api/rules", headers=self._headers()).json()
+        assert [r["id"] for r in rules] == [rule["id"]]
+        # 他のアカウントのルールは見えない・消せない
+        assert (
+            client.get("/api/rules", headers=self._headers("other@example.com")).json()
+            == []
+        )
+        res = client.delete(
+            f"/api/rules/{rule['id']}", headers=self._headers("other@example.com")
+        )
+        assert res.status_code == 404
+
+        res = client.delete(f"/api/rules/{rule['id']}", headers=self._headers())
+        assert res.status_code == 204
+        assert client.get("/api/rules", headers=self._headers()).json() == []
+
+    def test_rejected_with_default_secret_key(self, client, rules_db, monkeypatch):
+        """アカウントを保存できないと自動録音のジョブは必ず失敗するので作らせない"""
+        monkeypatch.setattr("app.main.SECRET_KEY_IS_DEFAULT", True)
+        res = client.post(
+            "/api/rules",
+            json={"name": "深夜", "keyword": "JUNK"},
+            headers=self._headers(),
+        )
+        assert res.status_code == 503
+        assert "SECRET_KEY" in res.json()["detail"]
+        assert client.get("/api/rules", headers=self._headers()).json() == []
+
+    def test_rule_needs_a_condition(self, client, rules_db):
+        res = client.post(
+            "/api/rules",
+            json={"name": "全部", "weekdays": [0]},
+            headers=self._headers(),
+        )
+        assert res.status_code == 422
+
+    def test_invalid_weekday(self, client, rules_db):
+        res = client.post(
+            "/api/rules",
+            json={"name": "曜日", "keyword": "a", "weekdays": [7]},
+            headers=self._headers(),
+        )
+        assert res.status_code == 422
@@ -0,0 +1,293 @@
+"""
+自動録音ルールのテスト
+"""
+
+from datetime import datetime
+
+import pytest
+
+from app import database
+from app.auto_record import (
+    Rule,
+    RuleMatcher,
+    TermIndex,
+    backfill_rule,
+    create_rule,
+    normalize,
+    scan_program_changes,
+)
+from app.job_events import read_events, visible_to
+from app.program_index import index_programs
+from app.radiko import JST, Program
+
+NOW = JST.localize(datetime(2024, 1, 2, 12, 0))
+
+
+@pytest.fixture
+def rules_db(tmp_path, monkeypatch):
+    """自動録音のテスト用に空のデータベースを用意する"""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "rules.db"))
+    database.init_db()
+
+
+def _program(title, start_hour, day=1, **kwargs):
+    return Program(
+        title=title,
+        start_time=JST.localize(datetime(2024, 1, day, start_hour)),
+        end_time=JST.localize(datetime(2024, 1, day, start_hour + 1)),
+        duration=3600,
+        **kwargs,
+    )
+
+
+def _index(programs, station_id="TBS", date_str="20240101"):
+    conn = database.get_db_connection()
+    index_programs(conn, station_id, "TBSラジオ", date_str, programs)
+    conn.commit()
+    conn.close()
+
+
+def _rule(account="user@example.com", **kwargs):
+    conn = database.get_db_connection()
+    rule_id = create_rule(conn, account, "ルール", **kwargs)
+    conn.commit()
+    conn.close()
+    return rule_id
+
+
+def _queued():
+    conn = database.get_db_connection()
+    rows = conn.execute(
+        "SELECT l.program_title, q.account, q.not_before FROM download_queue q "
+        "JOIN download_log l ON l.job_id = q.job_id ORDER BY l.program_title"
+    ).fetchall()
+    conn.close()
+    return rows
+
+
+def _make_rule(**kwargs):
+    fields = dict(
+        id=1,
+        account="user@example.com",
+        keyword="",
+        performer="",
+        station_id=None,
+        weekdays=0b1111111,
+        start_after=None,
+        start_before=None,
+    )
+    fields.update(kwargs)
+    fields["keyword"] = normalize(fields["keyword"])
+    fields["performer"] = normalize(fields["performer"])
+    return Rule(**fields)
+
+
+class TestTermIndex:
+    """キーワード索引のテスト"""
+
+    def test_finds_overlapping_terms(self):
+        index = TermIndex(["ニュース", "ニュースワイド", "天気", "a"])
+
+        assert index.find("朝のニュースワイドと天気") == {
+            "ニュース",
+            "ニュースワイド",
+            "天気",
+        }
+        assert index.find("radio") == {"a"}
+        assert index.find("音楽") == set()
+
+    def test_empty_index(self):
+        assert TermIndex([]).find("ニュース") == set()
+
+
+class TestRuleMatching:
+    """ルールの条件のテスト"""
+
+    def test_keyword_is_normalized(self):
+        matcher = RuleMatcher([_make_rule(keyword="ｊｕｎｋ")])
+        program = {
+            "station_id": "TBS",
+            "start_time": "20240102010000",
+            "title": "JUNK 深夜",
+            "description": None,
+            "pfm": "",
+        }
+
+        assert len(matcher.match(program)) == 1
+
+    def test_keyword_and_performer_must_both_match(self):
+        matcher = RuleMatcher([_make_rule(keyword="ニュース", performer="出演者A")])
+        program = {
+            "station_id": "TBS",
+            "start_time": "20240101060000",
+            "title": "朝のニュース",
+            "description": None,
+            "pfm": "出演者B",
+        }
+
+        assert matcher.match(program) == []
+        assert len(matcher.match({**program, "pfm": "出演者A、出演者B"})) == 1
+
+    def test_weekday_uses_broadcast_day(self):
+        # 火曜1時の番組は月曜の深夜番組として扱う
+        monday_only = _make_rule(weekdays=0b0000001)
+
+        assert monday_only.accepts_time("TBS", datetime(2024, 1, 2, 1, 0))
+        assert not monday_only.accepts_time("TBS", datetime(2024, 1, 2, 6, 0))
+
+    def test_time_window_across_midnight(self):
+        late_night = _make_rule(start_after=23 * 60, start_before=2 * 60)
+
+        assert late_night.accepts_time("TBS", datetime(2024, 1, 1, 23, 30))
+        assert late_night.accepts_time("TBS", datetime(2024, 1, 2, 1, 0))
+        assert not late_night.accepts_time("TBS", datetime(2024, 1, 2, 2, 0))
+        assert not late_night.accepts_time("TBS", datetime(2024, 1, 1, 12, 0))
+
+    def test_station_filter(self):
+        rule = _make_rule(station_id="QRR")
+
+        assert not rule.accepts_time("TBS", datetime(2024, 1, 1, 12, 0))
+        assert rule.accepts_time("QRR", datetime(2024, 1, 1, 12, 0))
+
+
+class TestScanProgramChanges:
+    """番組表の変更分の照合のテスト"""
+
+    def test_queues_matching_programs_after_broadcast(self, rules_db):
+        _rule(keyword="ニュース")
+        _index([_program("朝のニュース", 6), _program("音楽の時間", 7)])
+
+        assert len(scan_program_changes(now=NOW)) == 1
+        rows = _queued()
+        assert [row["program_title"] for row in rows] == ["朝のニュース"]
+        assert rows[0]["account"] == "user@example.com"
+        end = JST.localize(datetime(2024, 1, 1, 7)).timestamp()
+        assert rows[0]["not_before"] > end
+
+    def test_rescan_without_changes_queues_nothing(self, rules_db):
+        _rule(keyword="ニュース")
+        _index([_program("朝のニュース", 6)])
+        scan_program_changes(now=NOW)
+
+        assert scan_program_changes(now=NOW) == []
+        conn = database.get_db_connection()
+        assert conn.execute("SELECT COUNT(*) FROM program_changes").fetchone()[0] == 0
+        conn.close()
+
+    def test_changed_program_is_not_queued_twice(self, rules_db):
+        _rule(keyword="ニュース")
+        _index([_program("朝のニュース", 6)])
+        scan_program_changes(now=NOW)
+
+        _index([_program("朝のニュース", 6, description="内容を更新")])
+        assert scan_program_changes(now=NOW) == []
+        assert len(_queued()) == 1
+
+    def test_only_new_programs_are_matched(self, rules_db):
+        _rule(keyword="ニュース")
+        _index([_program("朝のニュース", 6)])
+        scan_program_changes(now=NOW)
+
+        _index([_program("夜のニュース", 20, day=2)], date_str="20240102")
+        assert len(scan_program_changes(now=NOW)) == 1
+        assert len(_queued()) == 2
+
+    def test_skips_programs_outside_timefree_window(self, rules_db):
+        _rule(keyword="ニュース")
+        _index([_program("朝のニュース", 6)])
+
+        later = JST.localize(datetime(2024, 1, 10, 12, 0))
+        assert scan_program_changes(now=later) == []
+
+    def test_processes_changes_in_batches(self, rules_db):
+        _rule(keyword="ニュース")
+        _index([_program(f"ニュース{hour}", hour) for hour in range(6, 12)])
+
+        assert len(scan_program_changes(batch_size=2, now=NOW)) == 6
+
+
+class TestMultipleAccounts:
+    """複数のアカウントのルールが同じ番組に一致する場合のテスト"""
+
+    def _matches(self):
+        conn = database.get_db_connection()
+        rows = conn.execute(
+            "SELECT account, job_id FROM auto_record_matches ORDER BY account"
+        ).fetchall()
+        conn.close()
+        return [tuple(row) for row in rows]
+
+    def test_every_account_shares_the_job(self, rules_db):
+        _rule(keyword="ニュース")
+        _rule(account="other@example.com", keyword="朝")
+        _index([_program("朝のニュース", 6)])
+
+        (job_id,) = scan_program_changes(now=NOW)
+        assert self._matches() == [
+            ("other@example.com", job_id),
+            ("user@example.com", job_id),
+        ]
+        # どちらのアカウントにもジョブのイベントが届く
+        conn = database.get_db_connection()
+        (event,) = read_events(conn, 0)
+        conn.close()
+        assert visible_to(event, "user@example.com")
+        assert visible_to(event, "other@example.com")
+        assert not visible_to(event, "third@example.com")
+
+    def test_backfill_adds_account_to_existing_job(self, rules_db):
+        _rule(keyword="ニュース")
+        _index([_program("朝のニュース", 6)])
+        (job_id,) = scan_program_changes(now=NOW)
+
+        rule_id = _rule(account="other@example.com", keyword="ニュース")
+        assert backfill_rule(rule_id, now=NOW) == []
+        assert ("other@example.com", job_id) in self._matches()
+        assert len(_queued()) == 1
+
+    def test_old_matches_table_is_migrated(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(database, "DATABASE", str(tmp_path / "old.db"))
+        conn = database.get_db_connection()
+        conn.executescript("""
+            CREATE TABLE auto_record_rules (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                account TEXT NOT NULL,
+                name TEXT NOT NULL,
+                keyword TEXT,
+                performer TEXT,
+                station_id TEXT,
+                weekdays INTEGER NOT NULL DEFAULT 127,
+                start_after TEXT,
+                start_before TEXT,
+                enabled INTEGER NOT NULL DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            INSERT INTO auto_record_rules (account, name) VALUES ('user@example.com', 'ルール');
+            CREATE TABLE auto_record_matches (
+                station_id TEXT NOT NULL,
+                start_time TEXT NOT NULL,
+                rule_id INTEGER NOT NULL,
+                job_id TEXT NOT NULL,
+                PRIMARY KEY (station_id, start_time)
+            );
+            INSERT INTO auto_record_matches VALUES ('TBS', '20240101060000', 1, 'job1');
+            """)
+        conn.close()
+
+        database.init_db()
+        assert self._matches() == [("user@example.com", "job1")]
+
+
+class TestBackfillRule:
+    """作成したルールの既存番組への適用のテスト"""
+
+    def test_matches_already_indexed_programs(self, rules_db):
+        _index([_program("朝のニュース", 6), _program("音楽の時間", 7)])
+        scan_program_changes(now=NOW)
+        rule_id = _rule(performer="出演者A")
+        _index([_program("朝のニュース", 6, pfm="出演者A")])
+
+        assert len(backfill_rule(rule_id, now=NOW)) == 1
+        # 変更ログに残った同じ番組は重複して登録しない
+        assert scan_program_changes(now=NOW) == []
+        assert len(_queued()) == 1
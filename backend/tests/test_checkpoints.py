@@ -0,0 +1,209 @@
+"""
+ダウンロードのチェックポイントのテスト
+"""
+
+import os
+import subprocess
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+
+from app import database, recorder
+from app.checkpoints import JobCheckpoint
+from app.downloader import Checkpoint, download_hls
+from app.job_queue import submit_job
+
+from .test_downloader import _failing_session, _fake_session
+
+
+@pytest.fixture
+def checkpoint_db(tmp_path, monkeypatch):
+    """チェックポイントのテスト用に空のデータベースを用意する"""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "checkpoints.db"))
+    database.init_db()
+
+
+class TestJobCheckpoint:
+    """SQLiteへの保存のテスト"""
+
+    def test_save_and_load(self, checkpoint_db):
+        checkpoint = JobCheckpoint("job1")
+        assert checkpoint.load() is None
+
+        checkpoint.save(Checkpoint(1, 3, 4, 5.0))
+        checkpoint.save(Checkpoint(2, 3, 8, 10.0))
+        assert JobCheckpoint("job1").load() == Checkpoint(2, 3, 8, 10.0)
+        assert JobCheckpoint("job2").load() is None
+
+    def test_discard_removes_partial_file(self, checkpoint_db, tmp_path):
+        output = str(tmp_path / "out.aac")
+        with open(output + ".part", "wb") as f:
+            f.write(b"seg0")
+        checkpoint = JobCheckpoint("job1")
+        checkpoint.save(Checkpoint(1, 3, 4, 5.0))
+
+        checkpoint.discard(output)
+        assert checkpoint.load() is None
+        assert not os.path.exists(output + ".part")
+
+
+class TestJobResume:
+    """一時的な失敗からの再開のテスト"""
+
+    def _run(self, download):
+        with patch("app.recorder.os.makedirs"), patch(
+            "app.recorder.download_stream", download
+        ), patch("app.recorder.RETRY_DELAY", 0):
+            outcome = recorder.start_download_job(
+                "job1",
+                "TBS",
+                "TBSラジオ",
+                "番組",
+                "20240101050000",
+                "20240101060000",
+                "token",
+            )
+        database.status_writer.flush()
+        return outcome
+
+    def test_retries_network_errors_with_same_checkpoint(self, checkpoint_db):
+        download = MagicMock(side_effect=[requests.ConnectionError(), None])
+
+        assert self._run(download) == "success"
+        first, second = download.call_args_list
+        assert first.args[5] is second.args[5]
+        assert first.args[5].job_id == "job1"
+
+    def test_gives_up_after_retries(self, checkpoint_db):
+        download = MagicMock(side_effect=requests.ConnectionError())
+
+        assert self._run(download) == "failed"
+        assert download.call_count == recorder.DOWNLOAD_RETRIES + 1
+
+    def test_does_not_retry_client_errors(self, checkpoint_db):
+        response = requests.Response()
+        response.status_code = 404
+        download = MagicMock(side_effect=requests.HTTPError(response=response))
+
+        assert self._run(download) == "failed"
+        assert download.call_count == 1
+
+    def test_ffmpeg_error_without_stderr(self, checkpoint_db):
+        """stderrが空でも失敗として記録する"""
+        error = subprocess.CalledProcessError(1, "ffmpeg", stderr="")
+        download = MagicMock(side_effect=error)
+
+        with patch("app.recorder.fail_job", return_value="failed") as fail:
+            assert self._run(download) == "failed"
+        fail.assert_called_once_with("job1", "ffmpeg", str(error))
+
+
+class TestResubmitResume:
+    """失敗したジョブを再予約したときの再開のテスト"""
+
+    def _submit(self):
+        conn = database.get_db_connection()
+        submission = submit_job(
+            conn,
+            "TBS",
+            "TBSラジオ",
+            "番組",
+            "20240101050000",
+            "20240101060000",
+            "token",
+        )
+        conn.commit()
+        conn.close()
+        return submission
+
+    def _run(self, job_id, session):
+        def download(*args, **kwargs):
+            return download_hls(*args, session=session, concurrency=1, **kwargs)
+
+        with patch("app.recorder.download_hls", download), patch(
+            "app.recorder.DOWNLOAD_RETRIES", 0
+        ), patch("app.recorder.record_download"), patch("app.recorder.postprocessor"):
+            outcome = recorder.start_download_job(
+                job_id,
+                "TBS",
+                "TBSラジオ",
+                "番組",
+                "20240101050000",
+                "20240101060000",
+                "token",
+            )
+        database.status_writer.flush()
+        return outcome
+
+    def test_resubmitted_job_fetches_missing_segments_only(
+        self, checkpoint_db, tmp_path, monkeypatch
+    ):
+        monkeypatch.setattr(recorder, "RECORDINGS_DIR", str(tmp_path))
+        job_id = self._submit().job_id
+        assert self._run(job_id, _failing_session("1.aac")) == "failed"
+
+        resubmitted = self._submit()
+        assert resubmitted.job_id == job_id and resubmitted.created
+        session = _fake_session()
+        assert self._run(job_id, session) == "success"
+
+        segments = [
+            call.args[0].rsplit("/", 1)[-1]
+            for call in session.get.call_args_list
+            if call.args[0].endswith(".aac")
+        ]
+        assert sorted(segments) == ["1.aac", "2.aac"]
+        save_dir, filename = recorder.output_location(
+            "TBSラジオ", "番組", "20240101050000"
+        )
+        with open(os.path.join(save_dir, filename), "rb") as f:
+            assert f.read() == b"seg0seg1seg2"
+        assert JobCheckpoint(job_id).load() is None
+
+
+class TestPruneCheckpoints:
+    """再予約されなかった書きかけファイルの削除のテスト"""
+
+    def _failed_job(self, start_time, state):
+        conn = database.get_db_connection()
+        job_id = submit_job(
+            conn,
+            "TBS",
+            "TBSラジオ",
+            "番組",
+            start_time,
+            start_time[:8] + "235959",
+            None,
+        ).job_id
+        conn.execute(
+            "UPDATE download_queue SET state = ? WHERE job_id = ?", (state, job_id)
+        )
+        conn.commit()
+        conn.close()
+        JobCheckpoint(job_id).save(Checkpoint(1, 3, 4, 5.0))
+        save_dir, filename = recorder.output_location("TBSラジオ", "番組", start_time)
+        os.makedirs(save_dir, exist_ok=True)
+        part_path = os.path.join(save_dir, filename) + ".part"
+        with open(part_path, "wb") as f:
+            f.write(b"seg0")
+        return job_id, part_path
+
+    def test_prunes_only_old_unqueued_checkpoints(
+        self, checkpoint_db, tmp_path, monkeypatch
+    ):
+        monkeypatch.setattr(recorder, "RECORDINGS_DIR", str(tmp_path))
+        failed, failed_part = self._failed_job("20240101050000", "done")
+        queued, queued_part = self._failed_job("20240102050000", "pending")
+        database.status_writer.flush()
+
+        # 期限内なら失敗したジョブの分も残す
+        assert recorder.prune_checkpoints(retention=3600) == 0
+        assert recorder.prune_checkpoints(retention=-1) == 1
+        database.status_writer.flush()
+
+        assert not os.path.exists(failed_part)
+        assert JobCheckpoint(failed).load() is None
+        # 再予約されて待機中のジョブは続きから取得するので残す
+        assert os.path.exists(queued_part)
+        assert JobCheckpoint(queued).load() is not None
@@ -4,9 +4,14 @@
 
 import sqlite3
 import tempfile
+import threading
 import os
 from unittest.mock import patch, MagicMock
 
+import pytest
+
+from app import database
+
 
 class TestDatabaseConnection:
     """データベース接続のテスト"""
@@ -41,19 +46,16 @@ class TestDatabaseConnection:
             conn.row_factory = sqlite3.Row
 
             # テーブルを作成
-            conn.execute(
-                """
+            conn.execute("""
                 CREATE TABLE IF NOT EXISTS login_history (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     login_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     email TEXT NOT NULL,
                     status TEXT NOT NULL
                 )
-            """
-            )
+            """)
 
-            conn.execute(
-                """
+            conn.execute("""
                 CREATE TABLE IF NOT EXISTS download_log (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     job_id TEXT UNIQUE NOT NULL,
@@ -63,8 +65,7 @@ class TestDatabaseConnection:
                     status TEXT NOT NULL,
                     filename TEXT
                 )
-            """
-            )
+            """)
 
             conn.commit()
             conn.close()
@@ -97,16 +98,14 @@ class TestDatabaseOperations:
             conn.row_factory = sqlite3.Row
 
             # テーブルを作成
-            conn.execute(
-                """
+            conn.execute("""
                 CREATE TABLE IF NOT EXISTS login_history (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     login_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     email TEXT NOT NULL,
                     status TEXT NOT NULL
                 )
-            """
-            )
+            """)
 
             # データを挿入
             conn.execute(
@@ -139,8 +138,7 @@ class TestDatabaseOperations:
             conn.row_factory = sqlite3.Row
 
             # テーブルを作成
-            conn.execute(
-                """
+            conn.execute("""
                 CREATE TABLE IF NOT EXISTS download_log (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     job_id TEXT UNIQUE NOT NULL,
@@ -150,8 +148,7 @@ class TestDatabaseOperations:
                     status TEXT NOT NULL,
                     filename TEXT
                 )
-            """
-            )
+            """)
 
             # データを挿入
             from datetime import datetime
@@ -250,3 +247,136 @@ class TestDatabaseIntegration:
         mock_conn.execute.assert_called()
         mock_conn.commit.assert_called()
         mock_conn.close.assert_called()
+
+
+class TestConnectionPool:
+    """接続の再利用とPRAGMAのテスト"""
+
+    @pytest.fixture(autouse=True)
+    def pool_db(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(database, "DATABASE", str(tmp_path / "pool.db"))
+        database.init_db()
+
+    def test_connection_is_reused_in_same_thread(self):
+        conn = database.get_db_connection()
+        conn.close()
+        assert database.get_db_connection() is conn
+
+    def test_nested_connections_are_distinct(self):
+        outer = database.get_db_connection()
+        inner = database.get_db_connection()
+        assert inner is not outer
+        inner.close()
+        outer.close()
+
+    def test_other_threads_get_their_own_connection(self):
+        conn = database.get_db_connection()
+        conn.close()
+        other = []
+        thread = threading.Thread(
+            target=lambda: other.append(database.get_db_connection())
+        )
+        thread.start()
+        thread.join()
+        assert other[0] is not conn
+
+    def test_pragmas(self):
+        conn = database.get_db_connection()
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+        assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+        conn.close()
+
+    def test_uncommitted_changes_are_rolled_back_on_close(self):
+        conn = database.get_db_connection()
+        conn.execute(
+            "INSERT INTO login_history (email, status) VALUES (?, ?)",
+            ("a@example.com", "success"),
+        )
+        conn.close()
+
+        conn = database.get_db_connection()
+        assert conn.execute("SELECT COUNT(*) FROM login_history").fetchone()[0] == 0
+        conn.close()
+
+
+class TestWriteBatcher:
+    """まとめ書きのテスト"""
+
+    def test_updates_are_applied_in_order(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(database, "DATABASE", str(tmp_path / "batch.db"))
+        database.init_db()
+        conn = database.get_db_connection()
+        conn.execute(
+            "INSERT INTO download_log (job_id, station_id, program_title, start_time, status) VALUES ('j1', 'TBS', 't', '2024-01-01', 'queued')"
+        )
+        conn.commit()
+        conn.close()
+
+        writer = database.WriteBatcher(interval=0.05)
+        for status in ["downloading", "processing", "success"]:
+            writer.submit(
+                "UPDATE download_log SET status = ? WHERE job_id = ?", (status, "j1")
+            )
+        writer.flush()
+
+        conn = database.get_db_connection()
+        row = conn.execute("SELECT status FROM download_log WHERE job_id = 'j1'")
+        assert row.fetchone()[0] == "success"
+        conn.close()
+
+    def _setup_jobs(self, tmp_path, monkeypatch, count):
+        monkeypatch.setattr(database, "DATABASE", str(tmp_path / "batch.db"))
+        database.init_db()
+        conn = database.get_db_connection()
+        conn.executemany(
+            "INSERT INTO download_log (job_id, station_id, program_title, start_time, status) VALUES (?, 'TBS', 't', '2024-01-01', 'queued')",
+            [(f"j{i}",) for i in range(count)],
+        )
+        conn.commit()
+        conn.close()
+
+    def _statuses(self):
+        conn = database.get_db_connection()
+        rows = conn.execute("SELECT job_id, status FROM download_log ORDER BY id")
+        statuses = [tuple(row) for row in rows.fetchall()]
+        conn.close()
+        return statuses
+
+    def test_lock_timeout_is_retried(self, tmp_path, monkeypatch):
+        """ロック待ちがタイムアウトしても、再試行して1件も失わない"""
+        self._setup_jobs(tmp_path, monkeypatch, 3)
+        monkeypatch.setattr(database, "BUSY_TIMEOUT", 0.05)
+        monkeypatch.setattr(database, "WRITE_RETRY_DELAY", 0.05)
+
+        # 別の接続が書き込みロックを持ち続ける
+        blocker = sqlite3.connect(
+            database.DATABASE, isolation_level=None, check_same_thread=False
+        )
+        blocker.execute("BEGIN IMMEDIATE")
+        release = threading.Timer(0.3, blocker.rollback)
+        release.start()
+
+        writer = database.WriteBatcher(interval=0.01)
+        for i in range(3):
+            writer.submit(
+                "UPDATE download_log SET status = 'success' WHERE job_id = ?",
+                (f"j{i}",),
+            )
+        writer.flush()
+        release.join()
+        blocker.close()
+
+        assert self._statuses() == [(f"j{i}", "success") for i in range(3)]
+
+    def test_bad_statement_does_not_drop_batch(self, tmp_path, monkeypatch):
+        """不正な更新があっても、同じバッチの他の更新は書き込む"""
+        self._setup_jobs(tmp_path, monkeypatch, 2)
+
+        writer = database.WriteBatcher(interval=0.05)
+        writer.submit("UPDATE download_log SET status = 'success' WHERE job_id = 'j0'")
+        writer.submit("UPDATE no_such_table SET status = 'success'")
+        writer.submit("UPDATE download_log SET status = 'failed' WHERE job_id = 'j1'")
+        writer.flush()
+
+        assert self._statuses() == [("j0", "success"), ("j1", "failed")]
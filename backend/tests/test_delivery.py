@@ -0,0 +1,127 @@
+"""
+録音ファイルの配信のテスト
+"""
+
+import pytest
+from fastapi import HTTPException
+
+from app import database, delivery
+from app.delivery import parse_range
+from app.security import create_access_token, create_recording_token
+
+DATA = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def recording(tmp_path, monkeypatch):
+    """録音ファイルを1件登録したデータベースと録音ディレクトリを用意する"""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "delivery.db"))
+    database.init_db()
+    root = tmp_path / "recordings"
+    (root / "TBSラジオ").mkdir(parents=True)
+    (root / "TBSラジオ" / "20240101-0500_番組.aac").write_bytes(DATA)
+    monkeypatch.setattr(delivery, "RECORDINGS_DIR", str(root))
+    monkeypatch.setattr(delivery, "RECORDINGS_ACCEL_PREFIX", "")
+    conn = database.get_db_connection()
+    cursor = conn.execute(
+        "INSERT INTO recordings (path, station_name, program_title, start_time, size, mtime_ns, checksum, indexed_at) VALUES (?, ?, ?, ?, ?, 0, '', 0)",
+        (
+            "TBSラジオ/20240101-0500_番組.aac",
+            "TBSラジオ",
+            "番組",
+            "2024-01-01 05:00:00",
+            len(DATA),
+        ),
+    )
+    conn.commit()
+    conn.close()
+    return cursor.lastrowid
+
+
+def _url(recording_id):
+    token = create_recording_token("test@example.com", recording_id)
+    return f"/api/recordings/{recording_id}/file?token={token}"
+
+
+class TestParseRange:
+    """Rangeヘッダーの解釈のテスト"""
+
+    def test_ranges(self):
+        assert parse_range(None, 100) is None
+        assert parse_range("bytes=0-9", 100) == (0, 9)
+        assert parse_range("bytes=90-", 100) == (90, 99)
+        assert parse_range("bytes=-10", 100) == (90, 99)
+        assert parse_range("bytes=50-1000", 100) == (50, 99)
+
+    def test_unsupported_forms_return_whole_file(self):
+        assert parse_range("bytes=0-1,5-6", 100) is None
+        assert parse_range("items=0-1", 100) is None
+
+    def test_unsatisfiable(self):
+        with pytest.raises(HTTPException) as e:
+            parse_range("bytes=100-", 100)
+        assert e.value.status_code == 416
+        assert e.value.headers["Content-Range"] == "bytes */100"
+
+
+class TestRecordingFile:
+    """録音ファイルのエンドポイントのテスト"""
+
+    def test_link_requires_login(self, client, recording):
+        res = client.get(f"/api/recordings/{recording}/link")
+        assert res.status_code == 401
+
+    def test_link_and_full_download(self, client, recording):
+        token = create_access_token(data={"sub": "test@example.com"})
+        res = client.get(
+            f"/api/recordings/{recording}/link",
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        url = res.json()["url"]
+
+        res = client.get(url)
+        assert res.status_code == 200
+        assert res.content == DATA
+        assert res.headers["accept-ranges"] == "bytes"
+        assert res.headers["content-type"] == "audio/aac"
+
+    def test_range_request(self, client, recording):
+        res = client.get(_url(recording), headers={"Range": "bytes=256-511"})
+
+        assert res.status_code == 206
+        assert res.content == DATA[256:512]
+        assert res.headers["content-range"] == f"bytes 256-511/{len(DATA)}"
+        assert res.headers["content-length"] == "256"
+
+    def test_unsatisfiable_range(self, client, recording):
+        res = client.get(_url(recording), headers={"Range": f"bytes={len(DATA)}-"})
+        assert res.status_code == 416
+
+    def test_accel_redirect(self, client, recording, monkeypatch):
+        monkeypatch.setattr(
+            delivery, "RECORDINGS_ACCEL_PREFIX", "/internal/recordings/"
+        )
+
+        res = client.get(_url(recording) + "&download=true")
+        assert res.status_code == 200
+        assert res.content == b""
+        assert res.headers["x-accel-redirect"] == (
+            "/internal/recordings/TBS%E3%83%A9%E3%82%B8%E3%82%AA/"
+            "20240101-0500_%E7%95%AA%E7%B5%84.aac"
+        )
+        assert res.headers["content-disposition"].startswith("attachment;")
+
+    def test_token_is_bound_to_recording(self, client, recording):
+        token = create_recording_token("test@example.com", recording + 1)
+        res = client.get(f"/api/recordings/{recording}/file?token={token}")
+        assert res.status_code == 403
+
+    def test_recording_token_is_not_an_api_token(self, client, recording):
+        token = create_recording_token("test@example.com", recording)
+        res = client.get("/api/rules", headers={"Authorization": f"Bearer {token}"})
+        assert res.status_code == 401
+
+    def test_path_outside_recordings_dir(self, recording):
+        with pytest.raises(HTTPException) as e:
+            delivery.recording_response("../delivery.db")
+        assert e.value.status_code == 404
@@ -0,0 +1,327 @@
+"""
+HLSダウンローダーのテスト
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from app.downloader import (
+    Checkpoint,
+    PlaylistError,
+    download_hls,
+    download_with_ffmpeg,
+    parse_playlist,
+    strip_id3,
+)
+
+MASTER = """#EXTM3U
+#EXT-X-STREAM-INF:BANDWIDTH=52973,CODECS="mp4a.40.5"
+https://radiko.jp/v2/api/ts/chunklist/abc.m3u8
+"""
+
+CHUNKLIST = """#EXTM3U
+#EXT-X-VERSION:3
+#EXT-X-TARGETDURATION:5
+#EXTINF:5,
+https://media.radiko.jp/sound/0.aac
+#EXTINF:5,
+https://media.radiko.jp/sound/1.aac
+#EXTINF:4.5,
+https://media.radiko.jp/sound/2.aac
+#EXT-X-ENDLIST
+"""
+
+
+def _id3(payload: bytes) -> bytes:
+    return b"ID3\x04\x00\x00\x00\x00\x00" + bytes([len(payload)]) + payload
+
+
+def _response(url, text="", content=b""):
+    res = MagicMock()
+    res.url = url
+    res.text = text
+    res.content = content
+    res.raise_for_status.return_value = None
+    return res
+
+
+def _fake_session():
+    """プレイリストとセグメントを返すモックセッション"""
+
+    def get(url, headers=None, timeout=None):
+        if "playlist.m3u8" in url:
+            return _response(url, text=MASTER)
+        if "chunklist" in url:
+            return _response(url, text=CHUNKLIST)
+        index = url.rsplit("/", 1)[-1].split(".")[0]
+        return _response(url, content=_id3(b"tag") + f"seg{index}".encode())
+
+    session = MagicMock()
+    session.get.side_effect = get
+    return session
+
+
+class MemoryCheckpoint:
+    """テスト用のチェックポイントの保存先"""
+
+    def __init__(self, saved=None):
+        self.saved = saved
+
+    def load(self):
+        return self.saved
+
+    def save(self, checkpoint):
+        self.saved = checkpoint
+
+    def clear(self):
+        self.saved = None
+
+
+def _failing_session(failing_url):
+    session = _fake_session()
+    original = session.get.side_effect
+
+    def get(url, headers=None, timeout=None):
+        if url.endswith(failing_url):
+            raise ConnectionError("network error")
+        return original(url, headers, timeout)
+
+    session.get.side_effect = get
+    return session
+
+
+class TestParsePlaylist:
+    """m3u8解析のテスト"""
+
+    def test_master_playlist(self):
+        playlist = parse_playlist(MASTER, "https://radiko.jp/v2/api/ts/playlist.m3u8")
+        assert playlist.variants == ["https://radiko.jp/v2/api/ts/chunklist/abc.m3u8"]
+        assert playlist.segments == []
+
+    def test_chunklist(self):
+        playlist = parse_playlist(CHUNKLIST, "https://radiko.jp/")
+        assert len(playlist.segments) == 3
+        assert playlist.segments[2].duration == 4.5
+        assert playlist.segments[0].url == "https://media.radiko.jp/sound/0.aac"
+
+    def test_relative_urls(self):
+        text = "#EXTM3U\n#EXTINF:5,\nseg/0.aac\n"
+        playlist = parse_playlist(text, "https://radiko.jp/v2/api/ts/chunklist/a.m3u8")
+        assert (
+            playlist.segments[0].url
+            == "https://radiko.jp/v2/api/ts/chunklist/seg/0.aac"
+        )
+
+    def test_invalid_playlist(self):
+        with pytest.raises(PlaylistError):
+            parse_playlist("<html></html>", "https://radiko.jp/")
+
+
+class TestStripId3:
+    """ID3タグ除去のテスト"""
+
+    def test_strip_id3(self):
+        assert strip_id3(_id3(b"timestamp") + b"\xff\xf1adts") == b"\xff\xf1adts"
+
+    def test_without_id3(self):
+        assert strip_id3(b"\xff\xf1adts") == b"\xff\xf1adts"
+
+
+class TestDownloadHls:
+    """並列ダウンロードのテスト"""
+
+    def test_segments_written_in_order(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "out.aac")
+            result = download_hls(
+                "https://radiko.jp/v2/api/ts/playlist.m3u8",
+                output,
+                {"X-Radiko-AuthToken": "token"},
+                concurrency=3,
+                session=_fake_session(),
+            )
+
+            with open(output, "rb") as f:
+                assert f.read() == b"seg0seg1seg2"
+            assert result.segments == 3
+            assert result.media_seconds == 14.5
+            assert not os.path.exists(output + ".part")
+
+    def test_progress_is_reported_per_segment(self):
+        reports = []
+        with tempfile.TemporaryDirectory() as tmp:
+            download_hls(
+                "https://radiko.jp/v2/api/ts/playlist.m3u8",
+                os.path.join(tmp, "out.aac"),
+                {},
+                concurrency=2,
+                session=_fake_session(),
+                progress=reports.append,
+            )
+
+        assert [r.media_seconds for r in reports] == [5, 10, 14.5]
+        assert [r.bytes_written for r in reports] == [4, 8, 12]
+        assert all(r.total_media_seconds == 14.5 for r in reports)
+
+    def test_failure_removes_partial_file(self):
+        session = _failing_session("1.aac")
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "out.aac")
+            with pytest.raises(ConnectionError):
+                download_hls(
+                    "https://radiko.jp/v2/api/ts/playlist.m3u8",
+                    output,
+                    {},
+                    session=session,
+                )
+            assert os.listdir(tmp) == []
+
+
+class TestResumeDownload:
+    """チェックポイントからの再開のテスト"""
+
+    def test_failure_keeps_checkpointed_part(self):
+        checkpoint = MemoryCheckpoint()
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "out.aac")
+            with pytest.raises(ConnectionError):
+                download_hls(
+                    "https://radiko.jp/v2/api/ts/playlist.m3u8",
+                    output,
+                    {},
+                    concurrency=1,
+                    session=_failing_session("1.aac"),
+                    checkpoint=checkpoint,
+                )
+            with open(output + ".part", "rb") as f:
+                assert f.read() == b"seg0"
+        assert checkpoint.saved == Checkpoint(1, 3, 4, 5.0)
+
+    def test_resumes_missing_segments_only(self):
+        checkpoint = MemoryCheckpoint(Checkpoint(1, 3, 4, 5.0))
+        session = _fake_session()
+        reports = []
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "out.aac")
+            # チェックポイントの後ろに書きかけのデータが残っている
+            with open(output + ".part", "wb") as f:
+                f.write(b"seg0se")
+            result = download_hls(
+                "https://radiko.jp/v2/api/ts/playlist.m3u8",
+                output,
+                {},
+                session=session,
+                progress=reports.append,
+                checkpoint=checkpoint,
+            )
+            with open(output, "rb") as f:
+                assert f.read() == b"seg0seg1seg2"
+
+        fetched = [call.args[0] for call in session.get.call_args_list]
+        assert not any(url.endswith("/0.aac") for url in fetched)
+        assert result.resumed_segments == 1
+        assert [r.media_seconds for r in reports] == [10, 14.5]
+        assert all(r.resumed_bytes == 4 for r in reports)
+        assert checkpoint.saved is None
+
+    def test_restarts_when_playlist_changed(self):
+        checkpoint = MemoryCheckpoint(Checkpoint(1, 5, 4, 5.0))
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "out.aac")
+            with open(output + ".part", "wb") as f:
+                f.write(b"old!")
+            result = download_hls(
+                "https://radiko.jp/v2/api/ts/playlist.m3u8",
+                output,
+                {},
+                session=_fake_session(),
+                checkpoint=checkpoint,
+            )
+            with open(output, "rb") as f:
+                assert f.read() == b"seg0seg1seg2"
+        assert result.resumed_segments == 0
+
+
+# stderrに大量に書いてから進捗を出し、失敗で終わるffmpegの代わり
+NOISY_FFMPEG = """
+import sys
+sys.stderr.write("reconnect warning\\n" * 20000)
+sys.stderr.flush()
+print("out_time_us=1000000")
+print("total_size=1024")
+print("progress=end", flush=True)
+sys.exit(1)
+"""
+
+
+# 出力先(最後の引数)に書き込んで、指定した終了コードで終わるffmpegの代わり
+WRITING_FFMPEG = """
+import sys
+with open(sys.argv[1], "wb") as f:
+    f.write(b"audio")
+print("progress=end", flush=True)
+sys.exit(int(sys.argv[2]))
+"""
+
+
+class TestDownloadWithFfmpeg:
+    """ffmpegフォールバックのテスト"""
+
+    def test_large_stderr_does_not_block(self):
+        popen = subprocess.Popen
+        reports = []
+
+        def fake_popen(command, **kwargs):
+            return popen([sys.executable, "-c", NOISY_FFMPEG], **kwargs)
+
+        with patch("app.downloader.subprocess.Popen", side_effect=fake_popen):
+            with pytest.raises(subprocess.CalledProcessError) as excinfo:
+                download_with_ffmpeg(
+                    "https://radiko.jp/playlist.m3u8",
+                    "out.aac",
+                    "token",
+                    progress=reports.append,
+                )
+
+        assert excinfo.value.stderr.count("reconnect warning") == 20000
+        assert reports[0].bytes_written == 1024
+
+    def _run(self, output, returncode):
+        popen = subprocess.Popen
+        commands = []
+
+        def fake_popen(command, **kwargs):
+            commands.append(command)
+            args = [command[-1], str(returncode)]
+            return popen([sys.executable, "-c", WRITING_FFMPEG, *args], **kwargs)
+
+        with patch("app.downloader.subprocess.Popen", side_effect=fake_popen):
+            download_with_ffmpeg(
+                "https://radiko.jp/playlist.m3u8", str(output), "token"
+            )
+        return commands[0]
+
+    def test_retry_replaces_leftover_partial_file(self, tmp_path):
+        output = tmp_path / "out.aac"
+        (tmp_path / "out.aac.part").write_bytes(b"partial from failed attempt")
+
+        command = self._run(output, 0)
+
+        assert "-y" in command
+        assert command[-1] == str(output) + ".part"
+        assert output.read_bytes() == b"audio"
+        assert not (tmp_path / "out.aac.part").exists()
+
+    def test_failure_removes_partial_file(self, tmp_path):
+        output = tmp_path / "out.aac"
+
+        with pytest.raises(subprocess.CalledProcessError):
+            self._run(output, 1)
+
+        assert not output.exists()
+        assert not (tmp_path / "out.aac.part").exists()
@@ -0,0 +1,210 @@
+"""
+番組表キャッシュのテスト
+"""
+
+import asyncio
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+
+import pytest
+from fastapi import HTTPException
+
+from app import database
+from app.guide_cache import KEY_LOCK_STRIPES, GuideCache, radiko_today
+from app.radiko import JST, GuideFetch, GuideResponse, parse_area_guide
+
+from .test_radiko import AREA_XML
+
+
+@pytest.fixture
+def cache_db(tmp_path, monkeypatch):
+    """番組表キャッシュのテスト用に空のデータベースを用意する"""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "guide.db"))
+    database.init_db()
+
+
+def _guide(name="TBSラジオ"):
+    return GuideResponse(station_name=name, programs=[])
+
+
+def _loader(*results):
+    loader = MagicMock()
+    loader.side_effect = list(results)
+    return loader
+
+
+class TestRadikoToday:
+    """放送日の判定のテスト"""
+
+    def test_before_5am_is_previous_day(self):
+        assert radiko_today(JST.localize(datetime(2024, 1, 2, 4, 59))) == "20240101"
+
+    def test_after_5am(self):
+        assert radiko_today(JST.localize(datetime(2024, 1, 2, 5, 0))) == "20240102"
+
+
+class TestGuideCache:
+    """キャッシュの動作のテスト"""
+
+    def test_past_date_is_cached_forever(self, cache_db):
+        cache = GuideCache(ttl=0)
+        loader = _loader((_guide(), "etag1", None))
+
+        first = cache.get("station:TBS", "20000101", GuideResponse, loader)
+        second = cache.get("station:TBS", "20000101", GuideResponse, loader)
+
+        assert first.station_name == second.station_name == "TBSラジオ"
+        assert loader.call_count == 1
+
+    def test_sqlite_tier_is_shared(self, cache_db):
+        loader = _loader((_guide(), None, None))
+        GuideCache().get("station:TBS", "20000101", GuideResponse, loader)
+
+        # 別プロセス相当の新しいインスタンスでも上流へは問い合わせない
+        other = GuideCache()
+        guide = other.get("station:TBS", "20000101", GuideResponse, _loader())
+        assert guide.station_name == "TBSラジオ"
+
+    def test_today_is_revalidated_after_ttl(self, cache_db):
+        cache = GuideCache(ttl=0)
+        today = radiko_today()
+        loader = _loader((_guide(), "etag1", "Mon, 01 Jan 2024 00:00:00 GMT"))
+        cache.get("station:TBS", today, GuideResponse, loader)
+
+        revalidate = _loader((None, "etag1", "Mon, 01 Jan 2024 00:00:00 GMT"))
+        guide = cache.get("station:TBS", today, GuideResponse, revalidate)
+
+        assert guide.station_name == "TBSラジオ"
+        revalidate.assert_called_once_with("etag1", "Mon, 01 Jan 2024 00:00:00 GMT")
+
+    def test_today_within_ttl_is_not_revalidated(self, cache_db):
+        cache = GuideCache(ttl=600)
+        today = radiko_today()
+        cache.get("station:TBS", today, GuideResponse, _loader((_guide(), None, None)))
+
+        loader = _loader()
+        cache.get("station:TBS", today, GuideResponse, loader)
+        loader.assert_not_called()
+
+    def test_changed_guide_replaces_entry(self, cache_db):
+        cache = GuideCache(ttl=0)
+        today = radiko_today()
+        cache.get("station:TBS", today, GuideResponse, _loader((_guide(), "a", None)))
+
+        guide = cache.get(
+            "station:TBS", today, GuideResponse, _loader((_guide("新"), "b", None))
+        )
+        assert guide.station_name == "新"
+
+    def test_stale_entry_on_upstream_error(self, cache_db):
+        cache = GuideCache(ttl=0)
+        today = radiko_today()
+        cache.get("station:TBS", today, GuideResponse, _loader((_guide(), "a", None)))
+
+        failing = _loader(HTTPException(status_code=500, detail="error"))
+        guide = cache.get("station:TBS", today, GuideResponse, failing)
+        assert guide.station_name == "TBSラジオ"
+
+    def test_error_without_entry_is_raised(self, cache_db):
+        failing = _loader(HTTPException(status_code=500, detail="error"))
+        with pytest.raises(HTTPException):
+            GuideCache().get("station:TBS", "20000101", GuideResponse, failing)
+
+    def test_lru_eviction(self, cache_db):
+        cache = GuideCache(size=2)
+        for date in ["20000101", "20000102", "20000103"]:
+            cache.get(
+                "station:TBS", date, GuideResponse, _loader((_guide(), None, None))
+            )
+        assert len(cache._memory) == 2
+        assert ("station:TBS", "20000101") not in cache._memory
+
+    def test_key_locks_do_not_grow(self, cache_db):
+        """取得したキーの数だけロックが増えない"""
+        cache = GuideCache(size=2)
+        for day in range(1, 29):
+            cache.get(
+                "station:TBS",
+                f"200001{day:02d}",
+                GuideResponse,
+                _loader((_guide(), None, None)),
+            )
+        assert len(cache._key_locks) == KEY_LOCK_STRIPES
+
+
+class TestAreaGuide:
+    """エリア番組表のテスト"""
+
+    @patch("app.guide_cache.fetch_area_guide")
+    def test_area_fetch_seeds_station_guides(self, mock_fetch, cache_db):
+        mock_fetch.return_value = GuideFetch(
+            parse_area_guide(AREA_XML, "JP13", "20000101"), None, None
+        )
+        cache = GuideCache()
+        grid = cache.get_area_guide("JP13", "20000101", "token")
+        assert len(grid.stations) == 2
+
+        # 放送局単位の番組表は上流へ問い合わせずに返る
+        with patch("app.guide_cache.fetch_program_guide") as mock_station:
+            guide = cache.get_station_guide("QRR", "20000101", "token")
+        mock_station.assert_not_called()
+        assert guide.station_name == "文化放送"
+        assert mock_fetch.call_count == 1
+
+
+class TestAsyncGuideCache:
+    """非同期版のテスト"""
+
+    def test_concurrent_requests_share_one_fetch(self, cache_db):
+        cache = GuideCache()
+        calls = []
+
+        async def loader(etag, last_modified):
+            calls.append(etag)
+            await asyncio.sleep(0.01)
+            return _guide(), "etag1", None
+
+        async def run():
+            return await asyncio.gather(
+                *(
+                    cache.aget("station:TBS", "20000101", GuideResponse, loader)
+                    for _ in range(5)
+                )
+            )
+
+        guides = asyncio.run(run())
+        assert all(guide.station_name == "TBSラジオ" for guide in guides)
+        assert len(calls) == 1
+
+    def test_locks_work_across_event_loops(self, cache_db):
+        """別のイベントループから使っても同じキャッシュのロックが使える"""
+        # 期限0なので2回目も同じキーのロックを取り合う
+        cache = GuideCache(ttl=0)
+
+        async def loader(etag, last_modified):
+            await asyncio.sleep(0.01)
+            return _guide(), None, None
+
+        async def run(date):
+            await asyncio.gather(
+                *(
+                    cache.aget("station:TBS", date, GuideResponse, loader)
+                    for _ in range(3)
+                )
+            )
+
+        asyncio.run(run(radiko_today()))
+        asyncio.run(run(radiko_today()))
+        assert len(cache._async_key_locks) == KEY_LOCK_STRIPES
+
+    def test_stale_entry_on_upstream_error(self, cache_db):
+        cache = GuideCache(ttl=0)
+        today = radiko_today()
+        cache.get("station:TBS", today, GuideResponse, _loader((_guide(), "a", None)))
+
+        async def failing(etag, last_modified):
+            assert etag == "a"
+            raise HTTPException(status_code=500, detail="error")
+
+        guide = asyncio.run(cache.aget("station:TBS", today, GuideResponse, failing))
+        assert guide.station_name == "TBSラジオ"
@@ -0,0 +1,116 @@
+"""
+HTTPキャッシュと圧縮のテスト
+"""
+
+import gzip
+import json
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from app.guide_cache import CacheEntry, GuideCache
+from app.http_cache import (
+    CACHE_IMMUTABLE,
+    COMPRESS_MIN_SIZE,
+    RenderedBody,
+    RenderedCache,
+    cached_response,
+    choose_encoding,
+    etag_matches,
+)
+
+LARGE = json.dumps({"items": ["番組"] * COMPRESS_MIN_SIZE}).encode()
+SMALL = b'{"items": []}'
+
+
+def _client(rendered: RenderedBody) -> TestClient:
+    app = FastAPI()
+
+    @app.get("/body")
+    def body(request: Request):
+        return cached_response(request, rendered, "private, no-cache")
+
+    return TestClient(app)
+
+
+class TestEncoding:
+    """圧縮方式の選択のテスト"""
+
+    def test_small_body_is_not_compressed(self):
+        assert choose_encoding("gzip", len(SMALL)) is None
+
+    def test_gzip(self, monkeypatch):
+        monkeypatch.setattr("app.http_cache.BROTLI_AVAILABLE", False)
+        assert choose_encoding("gzip, deflate, br", len(LARGE)) == "gzip"
+        assert choose_encoding("gzip;q=0, identity", len(LARGE)) is None
+        assert choose_encoding(None, len(LARGE)) is None
+
+    def test_brotli_preferred(self, monkeypatch):
+        monkeypatch.setattr("app.http_cache.BROTLI_AVAILABLE", True)
+        assert choose_encoding("gzip, br", len(LARGE)) == "br"
+        assert choose_encoding("gzip, br;q=0", len(LARGE)) == "gzip"
+
+
+class TestETag:
+    """ETagと304のテスト"""
+
+    def test_etag_matches_any_encoding(self):
+        rendered = RenderedBody(SMALL)
+        assert etag_matches(f'"{rendered.etag}"', rendered)
+        assert etag_matches(f'W/"{rendered.etag}-gzip"', rendered)
+        assert etag_matches(f'"other", "{rendered.etag}-br"', rendered)
+        assert not etag_matches('"other"', rendered)
+        assert not etag_matches(None, rendered)
+
+    def test_not_modified(self):
+        client = _client(RenderedBody(SMALL))
+        first = client.get("/body")
+        assert first.status_code == 200
+        assert first.content == SMALL
+
+        second = client.get("/body", headers={"If-None-Match": first.headers["etag"]})
+        assert second.status_code == 304
+        assert second.content == b""
+        assert second.headers["etag"] == first.headers["etag"]
+
+    def test_gzip_response(self, monkeypatch):
+        monkeypatch.setattr("app.http_cache.BROTLI_AVAILABLE", False)
+        rendered = RenderedBody(LARGE)
+        client = _client(rendered)
+        response = client.get("/body", headers={"Accept-Encoding": "gzip"})
+
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.headers["etag"] == f'"{rendered.etag}-gzip"'
+        assert response.headers["vary"] == "Accept-Encoding"
+        assert response.content == LARGE
+        # 圧縮結果は使い回す
+        assert rendered.encoded("gzip") is rendered.encoded("gzip")
+        assert gzip.decompress(rendered.encoded("gzip")) == LARGE
+
+
+class TestCacheControl:
+    """Cache-Control の決め方のテスト"""
+
+    def test_past_guide_is_immutable(self):
+        entry = CacheEntry({}, None, None, time.time(), True)
+        assert GuideCache(ttl=600).cache_control(entry) == CACHE_IMMUTABLE
+        assert CACHE_IMMUTABLE.startswith("private, ")
+
+    def test_today_guide_uses_remaining_ttl(self):
+        entry = CacheEntry({}, None, None, time.time() - 100, False)
+        scope, age = GuideCache(ttl=600).cache_control(entry).split(", ")
+        assert scope == "private"
+        assert 0 < int(age.removeprefix("max-age=")) < 600
+
+
+class TestRenderedCache:
+    def test_expires(self, monkeypatch):
+        cache = RenderedCache(ttl=10)
+        rendered = RenderedBody(SMALL)
+        cache.put("JP13", rendered)
+        assert cache.get("JP13")[0] is rendered
+
+        now = time.monotonic()
+        monkeypatch.setattr("app.http_cache.time.monotonic", lambda: now + 11)
+        assert cache.get("JP13") is None
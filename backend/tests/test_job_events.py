@@ -0,0 +1,170 @@
+"""
+ジョブイベント配信のテスト
+"""
+
+import asyncio
+import json
+import sqlite3
+from unittest.mock import patch
+
+import pytest
+
+from app import database, job_events
+from app.downloader import DownloadProgress
+from app.job_events import (
+    EventBroadcaster,
+    ProgressReporter,
+    event_stream,
+    insert_event,
+    prune_job_events,
+    read_events,
+)
+from app.job_queue import submit_job
+
+
+@pytest.fixture
+def events_db(tmp_path, monkeypatch):
+    """イベント配信のテスト用に空のデータベースを用意する"""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "events.db"))
+    database.init_db()
+
+
+def _insert(job_id, status):
+    conn = database.get_db_connection()
+    insert_event(conn, job_id, "status", {"status": status})
+    conn.commit()
+    conn.close()
+
+
+def _events():
+    conn = database.get_db_connection()
+    events = read_events(conn, 0)
+    conn.close()
+    return [(e["event"], json.loads(e["data"])) for e in events]
+
+
+class TestProgressReporter:
+    """進捗の間引きと計算のテスト"""
+
+    def test_throttles_and_reports_completion(self, events_db):
+        reporter = ProgressReporter("job1", interval=60)
+        reporter(DownloadProgress(1000, 5.0, 20.0, 1.0))
+        reporter(DownloadProgress(2000, 10.0, 20.0, 2.0))  # 間引かれる
+        reporter(DownloadProgress(4000, 20.0, 20.0, 3.0))  # 完了時は必ず送る
+        database.status_writer.flush()
+
+        events = _events()
+        assert [data["percent"] for _, data in events] == [25.0, 100.0]
+        # 速度は前回の通知からの増分 (3000 bytes / 2秒)
+        assert events[1][1]["bytes_per_second"] == 1500
+        assert events[1][1]["job_id"] == "job1"
+
+
+class TestEventBroadcaster:
+    """購読とファンアウトのテスト"""
+
+    def test_all_subscribers_receive_new_events(self, events_db):
+        _insert("old", "success")
+        broadcaster = EventBroadcaster(poll_interval=0.01)
+
+        async def run():
+            first = broadcaster.subscribe()
+            second = broadcaster.subscribe()
+            pending = [
+                asyncio.ensure_future(first.__anext__()),
+                asyncio.ensure_future(second.__anext__()),
+            ]
+            await asyncio.sleep(0.05)
+            _insert("job1", "downloading")
+            received = await asyncio.wait_for(asyncio.gather(*pending), 5)
+            await first.aclose()
+            await second.aclose()
+            return received
+
+        received = asyncio.run(run())
+        # 購読前のイベントは配らない
+        assert [json.loads(e["data"])["job_id"] for e in received] == ["job1", "job1"]
+
+    def test_backlog_after_last_event_id(self, events_db):
+        _insert("job1", "queued")
+        _insert("job1", "downloading")
+        broadcaster = EventBroadcaster(poll_interval=0.01)
+
+        async def run():
+            stream = event_stream(broadcaster, last_event_id=1)
+            chunks = [await stream.__anext__() for _ in range(2)]
+            await stream.aclose()
+            return chunks
+
+        retry, event = asyncio.run(run())
+        assert retry.startswith("retry:")
+        assert event.startswith("id: 2\nevent: status\n")
+        assert '"status": "downloading"' in event
+
+    def _next_job_ids(self, broadcaster, accounts, submit):
+        """accountsごとに購読し、submit()のあとで最初に届いたイベントのジョブを返す"""
+
+        async def run():
+            streams = [broadcaster.subscribe(account=account) for account in accounts]
+            pending = [asyncio.ensure_future(stream.__anext__()) for stream in streams]
+            await asyncio.sleep(0.05)
+            submit()
+            received = await asyncio.wait_for(asyncio.gather(*pending), 5)
+            for stream in streams:
+                await stream.aclose()
+            return [json.loads(event["data"])["job_id"] for event in received]
+
+        return asyncio.run(run())
+
+    def test_events_are_filtered_by_account(self, events_db):
+        job_ids = {}
+
+        def submit():
+            conn = database.get_db_connection()
+            for account in ["a@example.com", "b@example.com"]:
+                job_ids[account] = submit_job(
+                    conn,
+                    "TBS",
+                    "TBSラジオ",
+                    "番組",
+                    "20240101100000",
+                    "20240101110000" if account[0] == "a" else "20240101120000",
+                    "token",
+                    account,
+                ).job_id
+            conn.commit()
+            conn.close()
+
+        received = self._next_job_ids(
+            EventBroadcaster(poll_interval=0.01),
+            ["a@example.com", "b@example.com"],
+            submit,
+        )
+        assert received == [job_ids["a@example.com"], job_ids["b@example.com"]]
+
+    def test_poll_survives_database_errors(self, events_db):
+        """読み込みがロック待ちで失敗しても、ポーリングを続ける"""
+        fetch_events = job_events._fetch_events
+        failures = [sqlite3.OperationalError("database is locked")] * 2
+
+        def flaky(*args):
+            if failures:
+                raise failures.pop()
+            return fetch_events(*args)
+
+        with patch("app.job_events._fetch_events", side_effect=flaky), patch(
+            "app.job_events._latest_event_id",
+            side_effect=[sqlite3.OperationalError("database is locked"), 0],
+        ):
+            received = self._next_job_ids(
+                EventBroadcaster(poll_interval=0.01),
+                [None],
+                lambda: _insert("job1", "downloading"),
+            )
+        assert received == ["job1"]
+        assert not failures
+
+    def test_prune(self, events_db):
+        _insert("job1", "success")
+        assert prune_job_events(retention=-1) == 1
+        assert _events() == []
@@ -0,0 +1,248 @@
+"""
+ダウンロードジョブキューのテスト
+"""
+
+import threading
+
+import pytest
+
+from app import database
+from app.job_queue import (
+    DownloadWorkerPool,
+    IdempotencyKeyConflict,
+    claim_next_job,
+    enqueue_job,
+    recover_interrupted_jobs,
+    submit_job,
+)
+
+
+@pytest.fixture
+def queue_db(tmp_path, monkeypatch):
+    """キューのテスト用に空のデータベースを用意する"""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "queue.db"))
+    database.init_db()
+    conn = database.get_db_connection()
+    yield conn
+    conn.close()
+
+
+def _add_job(conn, job_id, station_id="TBS"):
+    conn.execute(
+        "INSERT INTO download_log (job_id, station_id, program_title, start_time, status) VALUES (?, ?, ?, ?, ?)",
+        (job_id, station_id, "番組", "2024-01-01 10:00:00", "queued"),
+    )
+    enqueue_job(
+        conn,
+        job_id,
+        station_id,
+        station_id,
+        "番組",
+        "20240101100000",
+        "20240101110000",
+        "token",
+    )
+    conn.commit()
+
+
+def _submit(conn, start_time="20240101100000", **kwargs):
+    submission = submit_job(
+        conn,
+        "TBS",
+        "TBSラジオ",
+        "番組",
+        start_time,
+        start_time[:8] + "110000",
+        "token",
+        "user@example.com",
+        **kwargs,
+    )
+    conn.commit()
+    return submission
+
+
+def _set_status(conn, job_id, status):
+    conn.execute(
+        "UPDATE download_log SET status = ? WHERE job_id = ?", (status, job_id)
+    )
+    conn.execute("UPDATE download_queue SET state = 'done' WHERE job_id = ?", (job_id,))
+    conn.commit()
+
+
+class TestSubmitJob:
+    """重複した予約をまとめるテスト"""
+
+    def test_duplicate_attaches_to_queued_job(self, queue_db):
+        first = _submit(queue_db)
+        second = _submit(queue_db)
+
+        assert first.created and not second.created
+        assert second.job_id == first.job_id
+        assert second.status == "queued"
+        count = queue_db.execute("SELECT COUNT(*) FROM download_log").fetchone()[0]
+        assert count == 1
+
+    def test_completed_recording_is_returned(self, queue_db):
+        first = _submit(queue_db)
+        _set_status(queue_db, first.job_id, "success")
+
+        second = _submit(queue_db)
+        assert second == (first.job_id, "success", False)
+        assert claim_next_job(queue_db) is None
+
+    def test_failed_job_is_requeued(self, queue_db):
+        first = _submit(queue_db)
+        _set_status(queue_db, first.job_id, "failed: エラー")
+
+        second = _submit(queue_db)
+        assert second == (first.job_id, "queued", True)
+        assert claim_next_job(queue_db)["job_id"] == first.job_id
+
+    def test_different_programs_are_separate(self, queue_db):
+        first = _submit(queue_db)
+        second = _submit(queue_db, start_time="20240102100000")
+
+        assert second.created and second.job_id != first.job_id
+
+    def test_idempotency_key(self, queue_db):
+        first = _submit(queue_db, idempotency_key="key1")
+        assert _submit(queue_db, idempotency_key="key1").job_id == first.job_id
+
+        with pytest.raises(IdempotencyKeyConflict):
+            _submit(queue_db, start_time="20240102100000", idempotency_key="key1")
+
+
+class TestClaimNextJob:
+    """ジョブ取り出しのテスト"""
+
+    def test_claims_in_order(self, queue_db):
+        _add_job(queue_db, "job1")
+        _add_job(queue_db, "job2")
+
+        job = claim_next_job(queue_db)
+        assert job["job_id"] == "job1"
+        state = queue_db.execute(
+            "SELECT state, attempts FROM download_queue WHERE job_id = 'job1'"
+        ).fetchone()
+        assert state["state"] == "running"
+        assert state["attempts"] == 1
+
+    def test_global_limit(self, queue_db):
+        for i in range(3):
+            _add_job(queue_db, f"job{i}", station_id=f"ST{i}")
+
+        assert claim_next_job(queue_db, max_running=2) is not None
+        assert claim_next_job(queue_db, max_running=2) is not None
+        assert claim_next_job(queue_db, max_running=2) is None
+
+    def test_per_station_limit(self, queue_db):
+        _add_job(queue_db, "job1", station_id="TBS")
+        _add_job(queue_db, "job2", station_id="TBS")
+        _add_job(queue_db, "job3", station_id="LFR")
+
+        assert claim_next_job(queue_db, max_per_station=1)["job_id"] == "job1"
+        # TBSは上限に達しているので、後から追加されたLFRが先に取り出される
+        assert claim_next_job(queue_db, max_per_station=1)["job_id"] == "job3"
+        assert claim_next_job(queue_db, max_per_station=1) is None
+
+
+class TestRecovery:
+    """中断ジョブ回収のテスト"""
+
+    def test_recover_stale_jobs(self, queue_db):
+        _add_job(queue_db, "job1")
+        claim_next_job(queue_db)
+        queue_db.execute(
+            "UPDATE download_log SET status = 'downloading' WHERE job_id = 'job1'"
+        )
+        queue_db.execute(
+            "UPDATE download_queue SET heartbeat_at = datetime('now', '-10 minutes')"
+        )
+        queue_db.commit()
+
+        assert recover_interrupted_jobs(queue_db) == 1
+        state = queue_db.execute(
+            "SELECT state FROM download_queue WHERE job_id = 'job1'"
+        ).fetchone()[0]
+        status = queue_db.execute(
+            "SELECT status FROM download_log WHERE job_id = 'job1'"
+        ).fetchone()[0]
+        assert state == "pending"
+        assert status == "queued"
+
+    def test_active_jobs_are_kept(self, queue_db):
+        _add_job(queue_db, "job1")
+        claim_next_job(queue_db)
+
+        assert recover_interrupted_jobs(queue_db) == 0
+
+
+class TestDownloadWorkerPool:
+    """ワーカープールのテスト"""
+
+    def test_pool_runs_queued_jobs(self, queue_db):
+        done = []
+        finished = threading.Event()
+
+        def handler(job):
+            done.append(job["job_id"])
+            if len(done) == 3:
+                finished.set()
+
+        for i in range(3):
+            _add_job(queue_db, f"job{i}", station_id=f"ST{i}")
+
+        pool = DownloadWorkerPool(handler, workers=2, poll_interval=0.05)
+        pool.start()
+        try:
+            assert finished.wait(5)
+        finally:
+            pool.stop(timeout=5)
+
+        assert sorted(done) == ["job0", "job1", "job2"]
+        states = queue_db.execute("SELECT state FROM download_queue").fetchall()
+        assert {row[0] for row in states} == {"done"}
+
+    def test_stop_requeues_unfinished_jobs(self, queue_db):
+        started = threading.Event()
+        release = threading.Event()
+
+        def handler(job):
+            started.set()
+            release.wait(5)
+
+        _add_job(queue_db, "job1")
+        pool = DownloadWorkerPool(handler, workers=1, poll_interval=0.05)
+        pool.start()
+        try:
+            assert started.wait(5)
+            pool.stop(timeout=0.1)
+            state = queue_db.execute(
+                "SELECT state FROM download_queue WHERE job_id = 'job1'"
+            ).fetchone()[0]
+            assert state == "pending"
+        finally:
+            release.set()
+
+    def test_stop_keeps_result_written_during_stop(self, queue_db):
+        """停止中に終わったジョブはまとめ書き待ちの結果を優先し、やり直さない"""
+        _add_job(queue_db, "job1", station_id="ST1")
+        _add_job(queue_db, "job2", station_id="ST2")
+        claim_next_job(queue_db)
+        claim_next_job(queue_db)
+        database.status_writer.submit(
+            "UPDATE download_log SET status = 'success' WHERE job_id = 'job1'"
+        )
+
+        pool = DownloadWorkerPool(lambda job: None)
+        pool._running.update({"job1", "job2"})
+        pool.stop()
+
+        rows = queue_db.execute(
+            "SELECT l.job_id, l.status, q.state FROM download_log AS l "
+            "JOIN download_queue AS q ON q.job_id = l.job_id ORDER BY l.job_id"
+        ).fetchall()
+        assert [tuple(row) for row in rows] == [
+            ("job1", "success", "done"),
+            ("job2", "queued", "pending"),
+        ]
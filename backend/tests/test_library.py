@@ -0,0 +1,164 @@
+"""
+録音ライブラリのテスト
+"""
+
+import hashlib
+import os
+from unittest.mock import patch
+
+import pytest
+
+from app import database, library
+from app.library import (
+    adts_duration,
+    parse_recording_path,
+    record_download,
+    scan_library,
+)
+
+
+@pytest.fixture
+def library_db(tmp_path, monkeypatch):
+    """ライブラリのテスト用に空のデータベースと録音ディレクトリを用意する"""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "library.db"))
+    database.init_db()
+    root = tmp_path / "recordings"
+    root.mkdir()
+    # 直前に変更されたディレクトリも走査済みとして記録する
+    with patch("app.library.MTIME_GRACE_NS", -(10**18)):
+        yield root
+
+
+def _adts(frames, rate_index=3, payload=b"\x00" * 10):
+    """48kHzのADTSフレームを frames 個並べる"""
+    length = 7 + len(payload)
+    header = bytes(
+        [
+            0xFF,
+            0xF1,
+            (1 << 6) | (rate_index << 2),
+            0x80 | (length >> 11),
+            (length >> 3) & 0xFF,
+            ((length & 0x07) << 5) | 0x1F,
+            0xFC,
+        ]
+    )
+    return (header + payload) * frames
+
+
+def _write(root, relpath, data):
+    path = root / relpath
+    path.parent.mkdir(exist_ok=True)
+    path.write_bytes(data)
+    return path
+
+
+def _rows():
+    conn = database.get_db_connection()
+    rows = conn.execute("SELECT * FROM recordings ORDER BY path").fetchall()
+    conn.close()
+    return rows
+
+
+class TestFileMetadata:
+    """ファイル名と中身からの情報の取得のテスト"""
+
+    def test_adts_duration(self):
+        # 1フレーム1024サンプル、48kHz
+        assert adts_duration(_adts(375)) == pytest.approx(8.0)
+        assert adts_duration(b"not audio") is None
+
+    def test_leading_id3_tag_is_skipped(self):
+        # 後処理のタグ付けで先頭にID3v2タグが付いたファイル
+        tag = b"ID3\x04\x00\x00\x00\x00\x01\x00" + b"\x00" * 128
+        assert adts_duration(tag + _adts(375)) == pytest.approx(8.0)
+        assert adts_duration(tag) is None
+
+    def test_truncated_last_frame_is_ignored(self):
+        assert adts_duration(_adts(375) + b"\xff\xf1") == pytest.approx(8.0)
+
+    def test_parse_recording_path(self):
+        station, start, title = parse_recording_path(
+            "TBSラジオ/20240101-0500_朝の_番組.aac"
+        )
+
+        assert station == "TBSラジオ"
+        assert str(start) == "2024-01-01 05:00:00"
+        assert title == "朝の 番組"
+        assert parse_recording_path("TBSラジオ/memo.aac") is None
+
+
+class TestScanLibrary:
+    """録音ディレクトリの走査のテスト"""
+
+    def test_indexes_new_files(self, library_db):
+        data = _adts(375)
+        _write(library_db, "TBSラジオ/20240101-0500_番組A.aac", data)
+        _write(library_db, "TBSラジオ/20240101-0500_番組A.aac.part", b"x")
+
+        assert scan_library(str(library_db)) == (1, 0)
+        (row,) = _rows()
+        assert row["path"] == "TBSラジオ/20240101-0500_番組A.aac"
+        assert row["size"] == len(data)
+        assert row["checksum"] == hashlib.sha256(data).hexdigest()
+        assert row["duration"] == pytest.approx(8.0)
+
+    def test_unchanged_directories_are_not_read(self, library_db):
+        _write(library_db, "TBSラジオ/20240101-0500_番組A.aac", _adts(1))
+        scan_library(str(library_db))
+
+        with patch("app.library._scan_directory") as scan_directory:
+            assert scan_library(str(library_db)) == (0, 0)
+        scan_directory.assert_not_called()
+
+    def test_only_changed_files_are_read(self, library_db):
+        _write(library_db, "TBSラジオ/20240101-0500_番組A.aac", _adts(1))
+        scan_library(str(library_db))
+        _write(library_db, "TBSラジオ/20240102-0500_番組B.aac", _adts(2))
+        os.utime(library_db / "TBSラジオ", ns=(0, 0))
+
+        with patch("app.library.inspect_file", wraps=library.inspect_file) as inspect:
+            assert scan_library(str(library_db)) == (1, 0)
+        assert [
+            call.args[0].endswith("番組B.aac") for call in inspect.call_args_list
+        ] == [True]
+
+    def test_removed_files_and_directories(self, library_db):
+        a = _write(library_db, "TBSラジオ/20240101-0500_番組A.aac", _adts(1))
+        _write(library_db, "TBSラジオ/20240102-0500_番組B.aac", _adts(1))
+        c = _write(library_db, "文化放送/20240101-0500_番組C.aac", _adts(1))
+        scan_library(str(library_db))
+
+        a.unlink()
+        os.utime(library_db / "TBSラジオ", ns=(0, 0))
+        c.unlink()
+        (library_db / "文化放送").rmdir()
+
+        assert scan_library(str(library_db)) == (0, 2)
+        assert [row["path"] for row in _rows()] == ["TBSラジオ/20240102-0500_番組B.aac"]
+
+
+class TestRecordDownload:
+    """ダウンロード完了時の登録のテスト"""
+
+    def test_registers_with_job_metadata(self, library_db):
+        path = _write(library_db, "TBSラジオ/20240101-0500_朝の番組.aac", _adts(375))
+
+        record_download(
+            str(path),
+            "job1",
+            "TBS",
+            "TBSラジオ",
+            "朝の番組",
+            "20240101050000",
+            "20240101060000",
+            root=str(library_db),
+        )
+
+        (row,) = _rows()
+        assert row["job_id"] == "job1"
+        assert row["station_id"] == "TBS"
+        assert row["end_time"] == "2024-01-01 06:00:00"
+        # 走査しても読み直さない
+        os.utime(library_db / "TBSラジオ", ns=(0, 0))
+        assert scan_library(str(library_db)) == (0, 0)
@@ -0,0 +1,141 @@
+"""
+メトリクスのテスト
+"""
+
+import os
+import subprocess
+import sys
+from unittest.mock import patch
+
+import pytest
+import requests
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+from app import database, recorder
+from app.job_queue import enqueue_job
+from app.main import app
+from app.metrics import endpoint_label, render_metrics
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def metrics_db(tmp_path, monkeypatch):
+    """メトリクスのテスト用に空のデータベースを用意する"""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "metrics.db"))
+    database.init_db()
+
+
+def _value(name, labels=None):
+    return REGISTRY.get_sample_value(name, labels or {}) or 0
+
+
+class TestEndpointLabel:
+    """URLからラベルへの変換のテスト"""
+
+    def test_known_endpoints(self):
+        assert (
+            endpoint_label("https://radiko.jp/v3/program/station/date/20240101/TBS.xml")
+            == "station_guide"
+        )
+        assert (
+            endpoint_label("https://radiko.jp/v3/program/date/20240101/JP13.xml")
+            == "area_guide"
+        )
+        assert endpoint_label("https://radiko.jp/v2/api/auth2") == "auth2"
+        assert (
+            endpoint_label("https://radiko.jp/v2/api/ts/playlist.m3u8?station_id=TBS")
+            == "hls_playlist"
+        )
+        assert (
+            endpoint_label("https://media.radiko.jp/sound/b/TBS/1.aac") == "hls_segment"
+        )
+
+    def test_unknown_endpoint(self):
+        assert endpoint_label("https://radiko.jp/unknown") == "other"
+
+
+class TestMetricsEndpoint:
+    """/metrics のテスト"""
+
+    def test_exposes_queue_depth(self, metrics_db):
+        conn = database.get_db_connection()
+        for i in range(3):
+            enqueue_job(
+                conn,
+                f"job{i}",
+                "TBS",
+                "TBSラジオ",
+                "番組",
+                "20240101050000",
+                "20240101060000",
+                "token",
+            )
+        conn.execute(
+            "UPDATE download_queue SET state = 'running' WHERE job_id = 'job0'"
+        )
+        conn.commit()
+        conn.close()
+
+        response = TestClient(app).get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert 'recorder_queue_jobs{state="pending"} 2.0' in response.text
+        assert 'recorder_queue_jobs{state="running"} 1.0' in response.text
+
+
+class TestJobMetrics:
+    """ダウンロードジョブのメトリクスのテスト"""
+
+    def test_counts_token_expiry_as_failure_reason(self, metrics_db):
+        error = requests.exceptions.HTTPError(response=requests.Response())
+        error.response.status_code = 401
+        before = _value("recorder_job_failures_total", {"reason": "token_expired"})
+        before_duration = _value(
+            "recorder_job_duration_seconds_count", {"outcome": "failed"}
+        )
+
+        job = {
+            "job_id": "job1",
+            "station_id": "TBS",
+            "station_name": "TBSラジオ",
+            "program_title": "番組",
+            "start_time": "20240101050000",
+            "end_time": "20240101060000",
+            "radiko_token": "token",
+            "account": None,
+        }
+        with patch("app.recorder.os.makedirs"), patch(
+            "app.recorder.download_hls", side_effect=error
+        ):
+            recorder.run_queued_job(job)
+        database.status_writer.flush()
+
+        assert (
+            _value("recorder_job_failures_total", {"reason": "token_expired"})
+            == before + 1
+        )
+        assert (
+            _value("recorder_job_duration_seconds_count", {"outcome": "failed"})
+            == before_duration + 1
+        )
+        assert _value("recorder_active_downloads") == 0
+
+
+class TestMultiProcess:
+    """複数プロセスの値が合算されることのテスト"""
+
+    def test_aggregates_across_processes(self, tmp_path):
+        env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path)}
+        script = "from app.metrics import DOWNLOAD_BYTES; DOWNLOAD_BYTES.inc(100)"
+        for name in ("", "recorder"):
+            subprocess.run(
+                [sys.executable, "-c", script],
+                cwd=BACKEND_DIR,
+                env={**env, "METRICS_PROCESS_NAME": name},
+                check=True,
+            )
+
+        body, _ = render_metrics(str(tmp_path))
+        assert "recorder_download_bytes_total 200.0" in body.decode()
@@ -0,0 +1,248 @@
+"""
+ダウンロード後の後処理のテスト
+"""
+
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from app import database, postprocess, recorder
+from app.postprocess import Postprocessor
+
+META = {
+    "station_id": "TBS",
+    "station_name": "TBSラジオ",
+    "program_title": "番組",
+    "start_time": "20240101050000",
+    "end_time": "20240101060000",
+    "pfm": "出演者A",
+}
+
+
+@pytest.fixture
+def postprocess_db(tmp_path, monkeypatch):
+    """後処理のテスト用に空のデータベースを用意する"""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "postprocess.db"))
+    database.init_db()
+
+
+def _postprocessor(steps, runner, **kwargs):
+    return Postprocessor(
+        steps=steps,
+        runner=runner,
+        executor_factory=lambda: ThreadPoolExecutor(max_workers=1),
+        **kwargs,
+    )
+
+
+def _steps(job_id="job1", timeout=5):
+    """すべてのステップが終わるまで待って状態を返す"""
+    deadline = time.monotonic() + timeout
+    while True:
+        database.status_writer.flush()
+        conn = database.get_db_connection()
+        rows = conn.execute(
+            "SELECT step, status, output, message FROM postprocess_steps "
+            "WHERE job_id = ? ORDER BY position",
+            (job_id,),
+        ).fetchall()
+        conn.close()
+        done = all(row["status"] not in ("pending", "running") for row in rows)
+        if done or time.monotonic() > deadline:
+            return [dict(row) for row in rows]
+        time.sleep(0.01)
+
+
+class TestPostprocessor:
+    """ステップの実行と状態の記録のテスト"""
+
+    def test_runs_steps_in_order(self, postprocess_db):
+        calls = []
+
+        def runner(step, path, meta):
+            calls.append(step)
+            return path.replace(".aac", ".opus") if step == "opus" else None
+
+        on_complete = MagicMock()
+        processor = _postprocessor(
+            ["loudnorm", "tag", "opus"], runner, on_complete=on_complete
+        )
+        assert processor.submit("job1", "/recordings/a.aac", META)
+
+        steps = _steps()
+        assert calls == ["loudnorm", "tag", "opus"]
+        assert [row["status"] for row in steps] == ["success"] * 3
+        assert steps[2]["output"] == "/recordings/a.opus"
+        # 元のファイルを書き換えたのでライブラリを更新する
+        on_complete.assert_called_once_with("job1", "/recordings/a.aac", META)
+        processor.shutdown()
+
+    def test_failure_skips_remaining_steps(self, postprocess_db):
+        def runner(step, path, meta):
+            if step == "tag":
+                raise subprocess.CalledProcessError(
+                    1, "ffmpeg", stderr="warning\nInvalid data found"
+                )
+
+        processor = _postprocessor(["tag", "opus"], runner)
+        processor.submit("job1", "/recordings/a.aac", META)
+
+        steps = _steps()
+        assert [row["status"] for row in steps] == ["failed", "skipped"]
+        assert steps[0]["message"] == "Invalid data found"
+        processor.shutdown()
+
+    def test_no_steps(self, postprocess_db):
+        assert not _postprocessor([], MagicMock()).submit("job1", "a.aac", META)
+
+    def test_unknown_step(self):
+        with pytest.raises(ValueError):
+            Postprocessor(steps=["tag", "flac"])
+
+    def test_recover_resumes_unfinished_steps(self, postprocess_db):
+        conn = database.get_db_connection()
+        conn.execute(
+            "INSERT INTO postprocess_jobs (job_id, path, meta) VALUES ('job1', 'a.aac', '{}')"
+        )
+        conn.executemany(
+            "INSERT INTO postprocess_steps (job_id, position, step, status) VALUES ('job1', ?, ?, ?)",
+            [(0, "loudnorm", "success"), (1, "tag", "running"), (2, "opus", "pending")],
+        )
+        conn.commit()
+        conn.close()
+        calls = []
+        on_complete = MagicMock()
+        processor = _postprocessor(
+            ["tag"],
+            lambda step, path, meta: calls.append(step),
+            on_complete=on_complete,
+        )
+
+        assert processor.recover() == 1
+        steps = _steps()
+        # 記録されたステップで再開する(現在の設定ではなく)
+        assert calls == ["tag", "opus"]
+        assert [row["status"] for row in steps] == ["success"] * 3
+        on_complete.assert_called_once()
+        processor.shutdown()
+
+
+class TestDownloadSlot:
+    """後処理がダウンロードの枠を使わないことのテスト"""
+
+    def test_job_returns_before_postprocessing_finishes(self, postprocess_db):
+        release = threading.Event()
+
+        def runner(step, path, meta):
+            release.wait(5)
+
+        processor = _postprocessor(["loudnorm"], runner)
+        with patch("app.recorder.postprocessor", processor), patch(
+            "app.recorder.os.makedirs"
+        ), patch("app.recorder.download_stream"), patch(
+            "app.recorder.record_download", side_effect=OSError("no file")
+        ):
+            outcome = recorder.start_download_job(
+                "job1",
+                "TBS",
+                "TBSラジオ",
+                "番組",
+                "20240101050000",
+                "20240101060000",
+                "token",
+            )
+
+        assert outcome == "success"
+        database.status_writer.flush()
+        conn = database.get_db_connection()
+        status = conn.execute(
+            "SELECT status FROM postprocess_steps WHERE job_id = 'job1'"
+        ).fetchone()[0]
+        conn.close()
+        assert status == "running"
+
+        release.set()
+        assert [row["status"] for row in _steps()] == ["success"]
+        processor.shutdown()
+
+
+class TestSteps:
+    """ffmpegに渡す引数のテスト"""
+
+    def test_tag_step_writes_tags_in_place(self, tmp_path):
+        path = tmp_path / "a.aac"
+        path.write_bytes(b"original")
+
+        def fake_ffmpeg(command, **kwargs):
+            (tmp_path / "a.aac.tmp").write_bytes(b"tagged")
+            return subprocess.CompletedProcess(command, 0)
+
+        with patch("app.postprocess.subprocess.run", side_effect=fake_ffmpeg) as run:
+            assert postprocess.tag_step(str(path), META) is None
+
+        command = run.call_args.args[0]
+        assert "title=番組" in command
+        assert "artist=出演者A" in command
+        assert "date=2024" in command
+        assert path.read_bytes() == b"tagged"
+        assert not (tmp_path / "a.aac.tmp").exists()
+
+    def test_tagged_recording_keeps_duration(self, postprocess_db, tmp_path):
+        # 48kHzのADTSフレーム(ヘッダー7バイト+本体10バイト)を375個 = 8秒
+        frame = bytes([0xFF, 0xF1, 0x4C, 0x80, 0x02, 0x3F, 0xFC]) + b"\x00" * 10
+        path = tmp_path / "TBSラジオ" / "20240101-0500_番組.aac"
+        path.parent.mkdir()
+        path.write_bytes(frame * 375)
+
+        def fake_ffmpeg(command, **kwargs):
+            # -write_id3v2 1 と同じく、ADTSの前にID3v2タグを置く
+            tag = b"TIT2\x00\x00\x00\x03\x00\x00\x00ab"
+            header = b"ID3\x04\x00\x00" + bytes([0, 0, 0, len(tag)])
+            (path.parent / (path.name + ".tmp")).write_bytes(
+                header + tag + path.read_bytes()
+            )
+            return subprocess.CompletedProcess(command, 0)
+
+        with patch("app.postprocess.subprocess.run", side_effect=fake_ffmpeg):
+            postprocess.tag_step(str(path), META)
+        with patch("app.library.RECORDINGS_DIR", str(tmp_path)):
+            recorder.update_library_after_postprocess("job1", str(path), META)
+
+        conn = database.get_db_connection()
+        row = conn.execute("SELECT size, duration FROM recordings").fetchone()
+        conn.close()
+        assert row["size"] > len(frame) * 375
+        assert row["duration"] == pytest.approx(8.0)
+
+    def test_transcode_creates_sidecar(self, tmp_path):
+        path = tmp_path / "a.aac"
+        path.write_bytes(b"original")
+
+        def fake_ffmpeg(command, **kwargs):
+            (tmp_path / "a.opus.tmp").write_bytes(b"opus")
+            return subprocess.CompletedProcess(command, 0)
+
+        with patch("app.postprocess.subprocess.run", side_effect=fake_ffmpeg):
+            output = postprocess.opus_step(str(path), META)
+
+        assert output == str(tmp_path / "a.opus")
+        assert path.read_bytes() == b"original"
+
+    def test_failed_step_leaves_original(self, tmp_path):
+        path = tmp_path / "a.aac"
+        path.write_bytes(b"original")
+
+        def fake_ffmpeg(command, **kwargs):
+            (tmp_path / "a.aac.tmp").write_bytes(b"broken")
+            raise subprocess.CalledProcessError(1, command)
+
+        with patch("app.postprocess.subprocess.run", side_effect=fake_ffmpeg):
+            with pytest.raises(subprocess.CalledProcessError):
+                postprocess.loudnorm_step(str(path), META)
+
+        assert path.read_bytes() == b"original"
+        assert not (tmp_path / "a.aac.tmp").exists()
@@ -0,0 +1,129 @@
+"""
+ローカル検索インデックスのテスト
+"""
+
+from datetime import datetime
+
+import pytest
+
+from app import database
+from app.program_index import (
+    index_area_guide,
+    index_guide,
+    prune_program_index,
+    search_local_programs,
+)
+from app.radiko import JST, GuideResponse, Program, parse_area_guide
+
+from .test_radiko import AREA_XML
+
+NOW = JST.localize(datetime(2024, 1, 2, 12, 0))
+
+
+@pytest.fixture
+def index_db(tmp_path, monkeypatch):
+    """検索インデックスのテスト用に空のデータベースを用意する"""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "index.db"))
+    database.init_db()
+
+
+def _search(keyword, **kwargs):
+    return search_local_programs(keyword, now=NOW, **kwargs)
+
+
+def _program(title, start_hour, **kwargs):
+    return Program(
+        title=title,
+        start_time=JST.localize(datetime(2024, 1, 1, start_hour)),
+        end_time=JST.localize(datetime(2024, 1, 1, start_hour + 1)),
+        duration=3600,
+        **kwargs,
+    )
+
+
+class TestIndexing:
+    """番組表の取り込みのテスト"""
+
+    def test_area_guide_is_searchable(self, index_db):
+        index_area_guide(parse_area_guide(AREA_XML, "JP13", "20240101"))
+
+        result = _search("文化放送")
+        assert result.total_results == 1
+        assert result.programs[0].station_id == "QRR"
+        assert result.programs[0].station_name == "文化放送"
+
+    def test_performer_and_description_are_searchable(self, index_db):
+        index_area_guide(parse_area_guide(AREA_XML, "JP13", "20240101"))
+
+        assert _search("出演者A").programs[0].title == "朝の番組"
+        assert _search("出演者").total_results == 2
+
+    def test_unchanged_programs_are_not_rewritten(self, index_db):
+        guide = parse_area_guide(AREA_XML, "JP13", "20240101")
+        assert index_area_guide(guide) == 3
+        assert index_area_guide(guide) == 0
+
+    def test_changed_and_removed_programs(self, index_db):
+        index_guide(
+            "TBS",
+            "20240101",
+            GuideResponse(
+                station_name="TBSラジオ",
+                programs=[_program("古いタイトル", 6), _program("消える番組", 8)],
+            ),
+        )
+        changed = index_guide(
+            "TBS",
+            "20240101",
+            GuideResponse(
+                station_name="TBSラジオ", programs=[_program("新しいタイトル", 6)]
+            ),
+        )
+
+        assert changed == 1
+        assert _search("古いタイトル").total_results == 0
+        assert _search("新しいタイトル").total_results == 1
+        assert _search("消える番組").total_results == 0
+
+
+class TestSearch:
+    """検索のテスト"""
+
+    def test_title_ranks_above_description(self, index_db):
+        index_guide(
+            "TBS",
+            "20240101",
+            GuideResponse(
+                station_name="TBSラジオ",
+                programs=[
+                    _program("朝の情報", 6, description="野球中継のお知らせ"),
+                    _program("野球中継", 9),
+                ],
+            ),
+        )
+        result = _search("野球中継")
+        assert [p.title for p in result.programs] == ["野球中継", "朝の情報"]
+
+    def test_all_terms_must_match(self, index_db):
+        index_area_guide(parse_area_guide(AREA_XML, "JP13", "20240101"))
+        assert _search("朝の番組 出演者A").total_results == 1
+        assert _search("朝の番組 出演者B").total_results == 0
+
+    def test_paging_and_station_filter(self, index_db):
+        index_area_guide(parse_area_guide(AREA_XML, "JP13", "20240101"))
+
+        result = _search("出演者", page=2, per_page=1)
+        assert result.total_pages == 2
+        assert len(result.programs) == 1
+        assert _search("出演者", station_id="TBS").total_results == 1
+
+    def test_short_terms_are_not_supported(self, index_db):
+        assert _search("ニュ") is None
+
+    def test_programs_past_timefree_window_are_excluded(self, index_db):
+        index_area_guide(parse_area_guide(AREA_XML, "JP13", "20240101"))
+        later = JST.localize(datetime(2024, 1, 20))
+        assert search_local_programs("出演者", now=later).total_results == 0
+
+        assert prune_program_index(later) == 3
+        assert _search("出演者").total_results == 0
@@ -0,0 +1,118 @@
+"""
+Radiko APIレスポンス解析のテスト
+"""
+
+from datetime import datetime
+
+import pytest
+
+from app.radiko import (
+    JST,
+    parse_area_guide,
+    parse_program_guide,
+    parse_radiko_time,
+    parse_station_list,
+)
+
+AREA_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<radiko>
+  <ttl>1800</ttl>
+  <srvtime>1704067200</srvtime>
+  <stations>
+    <station id="TBS">
+      <name>TBSラジオ</name>
+      <progs>
+        <date>20240101</date>
+        <prog id="1" ft="20240101050000" to="20240101060000" ftl="0500" tol="0600" dur="3600">
+          <title>朝の番組</title>
+          <genre>
+            <program id="P001"><name>情報</name></program>
+          </genre>
+          <pfm>出演者A</pfm>
+          <desc>説明</desc>
+          <img>https://example.com/a.jpg</img>
+        </prog>
+        <prog id="2" ft="20240101060000" to="20240101063000" ftl="0600" tol="0630" dur="1800">
+          <title>ニュース</title>
+        </prog>
+      </progs>
+    </station>
+    <station id="QRR">
+      <name>文化放送</name>
+      <progs>
+        <date>20240101</date>
+        <prog id="3" ft="20240101050000" to="20240101053000" ftl="0500" tol="0530" dur="1800">
+          <title>文化放送の番組</title>
+          <pfm>出演者B</pfm>
+        </prog>
+      </progs>
+    </station>
+  </stations>
+</radiko>
+""".encode()
+
+
+class TestParseProgramGuide:
+    """番組表XML解析のテスト"""
+
+    def test_station_guide(self):
+        guide = parse_program_guide(AREA_XML)
+        assert guide.station_name == "TBSラジオ"
+        assert len(guide.programs) == 2
+        first = guide.programs[0]
+        assert first.title == "朝の番組"
+        assert first.pfm == "出演者A"
+        assert first.duration == 3600
+        assert first.image_url == "https://example.com/a.jpg"
+        assert first.start_time.isoformat() == "2024-01-01T05:00:00+09:00"
+        # 出演者がない番組は空文字、画像がない番組はNone
+        assert guide.programs[1].pfm == ""
+        assert guide.programs[1].image_url is None
+
+    def test_area_guide(self):
+        grid = parse_area_guide(AREA_XML, "JP13", "20240101")
+        assert grid.area_id == "JP13"
+        assert [s.station_id for s in grid.stations] == ["TBS", "QRR"]
+        assert grid.stations[1].station_name == "文化放送"
+        assert grid.stations[1].programs[0].title == "文化放送の番組"
+
+    def test_nested_names_do_not_override_station_name(self):
+        # <genre>内の<name>は放送局名として扱わない
+        grid = parse_area_guide(AREA_XML, "JP13", "20240101")
+        assert grid.stations[0].station_name == "TBSラジオ"
+
+    def test_station_list(self):
+        content = """<?xml version="1.0" encoding="UTF-8"?>
+<stations area_id="JP13" area_name="TOKYO JAPAN">
+  <station>
+    <id>TBS</id>
+    <name>TBSラジオ</name>
+    <ascii_name>TBS RADIO</ascii_name>
+  </station>
+  <station>
+    <id>QRR</id>
+    <name>文化放送</name>
+  </station>
+</stations>
+""".encode()
+        stations = parse_station_list(content)
+        assert [(s.id, s.name) for s in stations] == [
+            ("TBS", "TBSラジオ"),
+            ("QRR", "文化放送"),
+        ]
+
+
+class TestParseRadikoTime:
+    """日時の高速解析のテスト"""
+
+    def test_matches_strptime(self):
+        expected = JST.localize(datetime(2024, 1, 2, 23, 59, 30))
+        assert parse_radiko_time("20240102235930") == expected
+        assert parse_radiko_time("20240102235930").isoformat().endswith("+09:00")
+
+    @pytest.mark.parametrize(
+        "value", ["2024010223593", "2024010223593x", "20241301000000"]
+    )
+    def test_invalid(self, value):
+        with pytest.raises(ValueError):
+            parse_radiko_time(value)
@@ -0,0 +1,150 @@
+"""
+Radiko非同期クライアントのテスト
+"""
+
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from app.radiko_client import RadikoClient
+
+from .test_radiko import AREA_XML
+
+STATION_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<stations area_id="JP13">
+  <station><id>TBS</id><name>TBSラジオ</name></station>
+  <station><id>QRR</id><name>文化放送</name></station>
+</stations>
+""".encode()
+
+
+def _client(handler) -> RadikoClient:
+    return RadikoClient(transport=httpx.MockTransport(handler))
+
+
+class TestGuides:
+    """放送局リスト・番組表取得のテスト"""
+
+    def test_station_list(self):
+        def handler(request):
+            assert request.url.path == "/v3/station/list/JP13.xml"
+            assert request.headers["X-Radiko-AuthToken"] == "token"
+            return httpx.Response(200, content=STATION_XML)
+
+        stations = asyncio.run(_client(handler).get_station_list("JP13", "token"))
+        assert [s.id for s in stations] == ["TBS", "QRR"]
+
+    def test_area_guide_not_modified(self):
+        def handler(request):
+            assert request.headers["If-None-Match"] == "etag1"
+            return httpx.Response(304)
+
+        fetched = asyncio.run(
+            _client(handler).fetch_area_guide("JP13", "20240101", None, "etag1")
+        )
+        assert fetched.guide is None
+        assert fetched.etag == "etag1"
+
+    def test_area_guide(self):
+        def handler(request):
+            return httpx.Response(200, content=AREA_XML, headers={"ETag": "etag2"})
+
+        fetched = asyncio.run(
+            _client(handler).fetch_area_guide("JP13", "20240101", "token")
+        )
+        assert len(fetched.guide.stations) == 2
+        assert fetched.etag == "etag2"
+
+    def test_upstream_error(self):
+        client = _client(lambda request: httpx.Response(503))
+        with pytest.raises(HTTPException) as e:
+            asyncio.run(client.fetch_program_guide("TBS", "20240101", "token"))
+        assert e.value.status_code == 500
+
+    def test_connection_is_shared(self):
+        client = _client(lambda request: httpx.Response(200, content=STATION_XML))
+
+        async def run():
+            await asyncio.gather(
+                *(client.get_station_list("JP13", None) for _ in range(5))
+            )
+            return client.client
+
+        first = client._client
+        shared = asyncio.run(run())
+        assert first is None
+        assert shared is client._client
+
+    def test_old_client_is_closed_when_loop_changes(self):
+        client = _client(lambda request: httpx.Response(200, content=STATION_XML))
+        asyncio.run(client.get_station_list("JP13", None))
+        old = client._client
+
+        async def run():
+            await client.get_station_list("JP13", None)
+            await asyncio.sleep(0)
+
+        asyncio.run(run())
+        assert client._client is not old
+        assert old.is_closed
+        assert not client._closing
+
+
+class TestSearch:
+    """番組検索のテスト"""
+
+    def test_expired_token(self):
+        client = _client(lambda request: httpx.Response(401))
+        with pytest.raises(HTTPException) as e:
+            asyncio.run(client.search("test", "expired"))
+        assert e.value.status_code == 401
+
+    def test_page_index(self):
+        def handler(request):
+            assert request.url.params["page_idx"] == "2"
+            return httpx.Response(200, json={"meta": {"result_count": 0}, "data": []})
+
+        data = asyncio.run(_client(handler).search("test", "token", page=3))
+        assert data["meta"]["result_count"] == 0
+
+
+class TestAuthenticate:
+    """ログインと認証のテスト"""
+
+    def test_login_flow(self):
+        def handler(request):
+            if request.url.path == "/v4/api/member/login":
+                return httpx.Response(
+                    200,
+                    json={"radiko_session": "session1"},
+                    headers={"Set-Cookie": "radiko_session=session1; Path=/"},
+                )
+            if request.url.path == "/v2/api/auth1":
+                assert request.headers["Cookie"] == "radiko_session=session1"
+                return httpx.Response(
+                    200,
+                    headers={
+                        "X-Radiko-AuthToken": "token1",
+                        "X-Radiko-KeyLength": "16",
+                        "X-Radiko-KeyOffset": "0",
+                    },
+                )
+            assert request.url.params["radiko_session"] == "session1"
+            assert request.headers["X-Radiko-PartialKey"]
+            return httpx.Response(200, text="JP13,東京都,tokyo Japan")
+
+        client = _client(handler)
+        assert asyncio.run(client.authenticate("a@example.com", "pass")) == (
+            "token1",
+            "JP13",
+        )
+        # ログインのCookieは共有クライアントに残らない
+        assert len(client._client.cookies) == 0
+
+    def test_login_failure(self):
+        client = _client(lambda request: httpx.Response(400))
+        with pytest.raises(HTTPException) as e:
+            asyncio.run(client.authenticate("a@example.com", "wrong"))
+        assert e.value.status_code == 401
@@ -0,0 +1,241 @@
+"""
+Radikoへのリクエストのレート制限のテスト
+"""
+
+import asyncio
+import sqlite3
+from unittest.mock import MagicMock, patch
+
+import httpx
+import pytest
+
+from app import database
+from app.radiko_client import RadikoClient
+from app.rate_limit import (
+    BACKGROUND,
+    ERROR_RETRIES,
+    ERROR_WAIT,
+    INTERACTIVE,
+    Bucket,
+    RateLimitedAdapter,
+    RateLimitedRetry,
+    RateLimiter,
+    RateLimitUnavailable,
+    limit_class,
+    parse_rate_limits,
+)
+
+
+@pytest.fixture
+def limiter_db(tmp_path, monkeypatch):
+    """レート制限のテスト用に空のデータベースを用意する"""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "rate_limit.db"))
+    database.init_db()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+GUIDE_URL = "https://radiko.jp/v3/program/date/20240101/JP13.xml"
+
+
+def _limiter(clock, reserve=0.5):
+    return RateLimiter({"guide": Bucket(2.0, 4.0)}, reserve=reserve, clock=clock)
+
+
+class TestRateLimiter:
+    """トークンバケットのテスト"""
+
+    def test_burst_then_wait(self, limiter_db):
+        clock = FakeClock()
+        limiter = _limiter(clock)
+
+        assert [limiter.try_acquire("guide") for _ in range(4)] == [0.0] * 4
+        # 1トークン貯まるまで 1/2 秒
+        assert limiter.try_acquire("guide") == pytest.approx(0.5)
+        clock.now += 0.5
+        assert limiter.try_acquire("guide") == 0.0
+
+    def test_background_keeps_reserve(self, limiter_db):
+        limiter = _limiter(FakeClock())
+
+        # バースト4のうち半分はinteractiveのために残す
+        assert limiter.try_acquire("guide", BACKGROUND) == 0.0
+        assert limiter.try_acquire("guide", BACKGROUND) == 0.0
+        assert limiter.try_acquire("guide", BACKGROUND) > 0
+        assert limiter.try_acquire("guide", INTERACTIVE) == 0.0
+        assert limiter.try_acquire("guide", INTERACTIVE) == 0.0
+
+    def test_bucket_is_shared_between_limiters(self, limiter_db):
+        # 別のプロセスでもSQLiteの同じバケットを使う
+        clock = FakeClock()
+        first, second = _limiter(clock), _limiter(clock)
+        for _ in range(2):
+            first.try_acquire("guide")
+            second.try_acquire("guide")
+
+        assert first.try_acquire("guide") > 0
+
+    def test_unlimited(self, limiter_db):
+        limiter = RateLimiter({"guide": Bucket(0, 1)})
+        assert [limiter.try_acquire("guide") for _ in range(10)] == [0.0] * 10
+        assert limiter.try_acquire("search") == 0.0
+
+    def test_acquire_sleeps_until_available(self, limiter_db):
+        clock = FakeClock()
+        limiter = _limiter(clock)
+
+        def sleep(seconds):
+            clock.now += seconds
+
+        with patch("app.rate_limit.time.sleep", side_effect=sleep) as sleeper:
+            for _ in range(5):
+                limiter.acquire(
+                    "https://radiko.jp/v3/program/date/20240101/JP13.xml", INTERACTIVE
+                )
+        sleeper.assert_called_once_with(pytest.approx(0.5))
+
+    def test_tokens_are_leased_in_batches(self, limiter_db):
+        # 40/秒なら0.25秒分の10個をまとめて借り、残りはSQLiteを使わずに渡す
+        clock = FakeClock()
+        limiter = RateLimiter({"stream": Bucket(40.0, 80.0)}, clock=clock)
+        assert limiter.try_acquire("stream") == 0.0
+
+        conn = database.get_db_connection()
+        row = conn.execute(
+            "SELECT tokens FROM rate_limit_buckets WHERE name = 'stream'"
+        ).fetchone()
+        conn.close()
+        assert row["tokens"] == pytest.approx(70.0)
+
+        with patch("app.rate_limit.get_db_connection") as connect:
+            assert [limiter.try_acquire("stream") for _ in range(9)] == [0.0] * 9
+        connect.assert_not_called()
+
+    def test_expired_lease_is_not_used(self, limiter_db):
+        clock = FakeClock()
+        limiter = RateLimiter({"stream": Bucket(40.0, 80.0)}, clock=clock)
+        limiter.try_acquire("stream")
+        clock.now += 2
+
+        with patch(
+            "app.rate_limit.get_db_connection", wraps=database.get_db_connection
+        ) as connect:
+            limiter.try_acquire("stream")
+        connect.assert_called_once()
+
+    def test_waits_while_database_is_unavailable(self, limiter_db):
+        limiter = _limiter(FakeClock())
+        errors = [sqlite3.OperationalError("database is locked")] * 2
+
+        def connect():
+            if errors:
+                raise errors.pop()
+            return database.get_db_connection()
+
+        with patch("app.rate_limit.get_db_connection", side_effect=connect), patch(
+            "app.rate_limit.time.sleep"
+        ) as sleeper:
+            assert limiter.acquire(GUIDE_URL, INTERACTIVE) == 2 * ERROR_WAIT
+        assert sleeper.call_count == 2
+
+    def test_gives_up_when_database_stays_unavailable(self, limiter_db):
+        limiter = _limiter(FakeClock())
+        with patch(
+            "app.rate_limit.get_db_connection",
+            side_effect=sqlite3.OperationalError("no such table: rate_limit_buckets"),
+        ), patch("app.rate_limit.time.sleep") as sleeper:
+            with pytest.raises(RateLimitUnavailable):
+                limiter.acquire(GUIDE_URL)
+        assert sleeper.call_count == ERROR_RETRIES
+
+    def test_async_gives_up_when_database_stays_unavailable(self, limiter_db):
+        limiter = _limiter(FakeClock())
+
+        async def no_sleep(seconds):
+            pass
+
+        with patch(
+            "app.rate_limit.get_db_connection",
+            side_effect=sqlite3.OperationalError(
+                "attempt to write a readonly database"
+            ),
+        ), patch("app.rate_limit.asyncio.sleep", side_effect=no_sleep):
+            with pytest.raises(RateLimitUnavailable):
+                asyncio.run(limiter.aacquire(GUIDE_URL))
+
+    def test_background_yields_to_waiting_interactive(self, limiter_db):
+        clock = FakeClock()
+        limiter = _limiter(clock, reserve=0)
+        for _ in range(4):
+            limiter.try_acquire("guide", INTERACTIVE)
+        assert limiter.try_acquire("guide", INTERACTIVE) == pytest.approx(0.5)
+
+        # 貯まった1個はinteractiveが待っている間backgroundには渡さない
+        clock.now += 0.25
+        assert limiter.try_acquire("guide", BACKGROUND) == pytest.approx(0.25)
+        clock.now += 0.25
+        assert limiter.try_acquire("guide", INTERACTIVE) == 0.0
+
+
+class TestConfiguration:
+    """設定とエンドポイントの分類のテスト"""
+
+    def test_parse_rate_limits(self):
+        assert parse_rate_limits("guide=10/20, search=5") == {
+            "guide": Bucket(10.0, 20.0),
+            "search": Bucket(5.0, 5.0),
+        }
+
+    def test_limit_class(self):
+        assert limit_class("https://radiko.jp/v2/api/auth1") == "auth"
+        assert limit_class("https://radiko.jp/v3/api/program/search?key=a") == "search"
+        assert limit_class("https://example.com/segment/1.aac") == "stream"
+
+
+class TestClients:
+    """同期・非同期のクライアントがレート制限を通すことのテスト"""
+
+    def test_adapter_acquires_before_send(self):
+        limiter = MagicMock()
+        adapter = RateLimitedAdapter(limiter=limiter)
+        request = MagicMock(url="https://radiko.jp/v2/api/auth1")
+
+        with patch("requests.adapters.HTTPAdapter.send") as send:
+            adapter.send(request)
+
+        limiter.acquire.assert_called_once_with(request.url, BACKGROUND)
+        send.assert_called_once()
+
+    def test_retry_acquires_before_resend(self):
+        limiter = MagicMock()
+        retry = RateLimitedRetry(total=3, limiter=limiter, priority=INTERACTIVE)
+
+        retry = retry.increment("GET", "/v2/api/auth1", error=ConnectionError())
+        assert retry.limiter is limiter and retry.priority == INTERACTIVE
+        with patch("urllib3.util.retry.time.sleep"):
+            retry.sleep()
+
+        limiter.acquire.assert_called_once_with("/v2/api/auth1", INTERACTIVE)
+
+    def test_async_client_is_interactive(self):
+        limiter = MagicMock()
+
+        async def aacquire(url, priority):
+            limiter.acquire(url, priority)
+
+        limiter.aacquire = aacquire
+        client = RadikoClient(
+            transport=httpx.MockTransport(lambda request: httpx.Response(200, json={})),
+            limiter=limiter,
+        )
+
+        asyncio.run(client.search("番組", "token"))
+        url, priority = limiter.acquire.call_args.args
+        assert "/v3/api/program/search" in url
+        assert priority == INTERACTIVE
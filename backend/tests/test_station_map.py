@@ -0,0 +1,109 @@
+"""
+放送局マップのテスト
+"""
+
+import threading
+from unittest.mock import patch
+
+import pytest
+from fastapi import HTTPException
+
+from app import database
+from app.radiko import ALL_AREA_IDS, Station
+from app.station_map import (
+    StationMap,
+    fetch_station_map,
+    refresh_station_map,
+    save_station_map,
+)
+
+
+@pytest.fixture
+def map_db(tmp_path, monkeypatch):
+    """放送局マップのテスト用に空のデータベースを用意する"""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "stations.db"))
+    database.init_db()
+
+
+def _fake_station_list(area_id, auth_token):
+    """JP13とJP14には同じ局(NHK)と固有の局がある想定"""
+    stations = [Station(id="JOAK", name="NHK")]
+    if area_id == "JP13":
+        stations.append(Station(id="TBS", name="TBSラジオ"))
+    return stations
+
+
+class TestFetchStationMap:
+    """並列取得のテスト"""
+
+    @patch("app.station_map.get_station_list", side_effect=_fake_station_list)
+    def test_fetches_all_areas(self, mock_get):
+        areas = fetch_station_map("token", fanout=4)
+        assert sorted(areas) == sorted(ALL_AREA_IDS)
+        assert mock_get.call_count == len(ALL_AREA_IDS)
+
+    @patch("app.station_map.get_station_list")
+    def test_failed_areas_are_skipped(self, mock_get):
+        def get(area_id, auth_token):
+            if area_id == "JP1":
+                raise HTTPException(status_code=500, detail="error")
+            return _fake_station_list(area_id, auth_token)
+
+        mock_get.side_effect = get
+        areas = fetch_station_map("token")
+        assert "JP1" not in areas
+        assert len(areas) == len(ALL_AREA_IDS) - 1
+
+
+class TestStationMap:
+    """永続化と逆引きのテスト"""
+
+    def test_reverse_index(self, map_db):
+        conn = database.get_db_connection()
+        save_station_map(
+            conn,
+            {
+                "JP13": _fake_station_list("JP13", None),
+                "JP14": _fake_station_list("JP14", None),
+            },
+        )
+        conn.close()
+
+        stations = StationMap()
+        stations.ensure_loaded()
+        assert stations.name("TBS") == "TBSラジオ"
+        assert stations.areas("JOAK") == ["JP13", "JP14"]
+        assert stations.areas("TBS") == ["JP13"]
+        # 未知の局はIDをそのまま名前として返す
+        assert stations.name("UNKNOWN") == "UNKNOWN"
+
+    @patch("app.station_map.get_station_list", side_effect=_fake_station_list)
+    def test_refresh_persists(self, mock_get, map_db):
+        assert refresh_station_map() == 2
+
+        stations = StationMap()
+        with patch.object(stations, "_refresh_in_background") as mock_refresh:
+            stations.ensure_loaded()
+        assert stations.name("TBS") == "TBSラジオ"
+        mock_refresh.assert_not_called()
+
+    def test_empty_map_refreshes_in_background(self, map_db):
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_refresh(auth_token):
+            started.set()
+            release.wait(5)
+
+        stations = StationMap()
+        with patch(
+            "app.station_map.refresh_station_map", side_effect=slow_refresh
+        ) as mock_refresh:
+            # 取得が終わるのを待たずに戻る
+            stations.ensure_loaded("token")
+            assert started.wait(5)
+            # 更新中は重ねて取得しない
+            stations.ensure_loaded("token")
+            release.set()
+        assert mock_refresh.call_count == 1
+        assert stations.name("TBS") == "TBS"
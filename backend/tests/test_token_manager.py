@@ -0,0 +1,174 @@
+"""
+Radikoトークン管理のテスト
+"""
+
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+
+from app import database, recorder
+from app.job_queue import enqueue_job
+from app.token_manager import TokenManager
+
+
+@pytest.fixture
+def accounts_db(tmp_path, monkeypatch):
+    """トークン管理のテスト用に空のデータベースを用意する"""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "accounts.db"))
+    database.init_db()
+    # SECRET_KEYを設定した環境として扱う
+    monkeypatch.setattr("app.token_manager.SECRET_KEY_IS_DEFAULT", False)
+
+
+def _authenticator(*tokens):
+    return MagicMock(side_effect=[(token, "JP13") for token in tokens])
+
+
+def _unauthorized():
+    response = requests.Response()
+    response.status_code = 401
+    return requests.exceptions.HTTPError("401 Client Error", response=response)
+
+
+class TestTokenManager:
+    """トークンの保存と再認証のテスト"""
+
+    def test_reuses_token_from_login(self, accounts_db):
+        authenticator = _authenticator()
+        manager = TokenManager(authenticator=authenticator)
+        manager.save_account("user@example.com", "secret", "login_token", "JP13")
+
+        assert manager.get_token("user@example.com") == "login_token"
+        authenticator.assert_not_called()
+
+    def test_password_is_not_stored_in_plain_text(self, accounts_db):
+        TokenManager().save_account("user@example.com", "secret", "token", "JP13")
+
+        conn = database.get_db_connection()
+        stored = conn.execute("SELECT password FROM radiko_accounts").fetchone()[0]
+        conn.close()
+        assert "secret" not in stored
+
+    def test_refreshes_before_expiry(self, accounts_db):
+        authenticator = _authenticator("fresh_token")
+        manager = TokenManager(ttl=60, margin=120, authenticator=authenticator)
+        manager.save_account("user@example.com", "secret", "old_token", "JP13")
+
+        assert manager.get_token("user@example.com") == "fresh_token"
+        authenticator.assert_called_once_with("user@example.com", "secret")
+
+    def test_refreshes_rejected_token_once(self, accounts_db):
+        authenticator = _authenticator("fresh_token")
+        manager = TokenManager(authenticator=authenticator)
+        manager.save_account("user@example.com", "secret", "old_token", "JP13")
+
+        assert (
+            manager.get_token("user@example.com", invalid_token="old_token")
+            == "fresh_token"
+        )
+        # 別のジョブが同じ古いトークンで401になっても、再認証は繰り返さない
+        assert (
+            manager.get_token("user@example.com", invalid_token="old_token")
+            == "fresh_token"
+        )
+        assert authenticator.call_count == 1
+
+    def test_shares_refreshed_token_across_processes(self, accounts_db):
+        api = TokenManager(authenticator=_authenticator())
+        api.save_account("user@example.com", "secret", "old_token", "JP13")
+        recorder_side = TokenManager(authenticator=_authenticator("fresh_token"))
+        recorder_side.get_token("user@example.com", invalid_token="old_token")
+
+        other = TokenManager(authenticator=_authenticator())
+        assert other.get_token("user@example.com") == "fresh_token"
+
+    def test_default_secret_key_refuses_to_store(self, accounts_db, monkeypatch):
+        """SECRET_KEYが既定値ならパスワードを保存しない"""
+        monkeypatch.setattr("app.token_manager.SECRET_KEY_IS_DEFAULT", True)
+        manager = TokenManager(authenticator=_authenticator())
+        manager.save_account("user@example.com", "secret", "token", "JP13")
+
+        conn = database.get_db_connection()
+        count = conn.execute("SELECT COUNT(*) FROM radiko_accounts").fetchone()[0]
+        conn.close()
+        assert count == 0
+        assert manager.get_token("user@example.com") is None
+
+    def test_unknown_account(self, accounts_db):
+        assert TokenManager().get_token("nobody@example.com") is None
+
+    def test_failed_refresh_returns_none(self, accounts_db):
+        manager = TokenManager(
+            ttl=0, authenticator=MagicMock(side_effect=requests.ConnectionError())
+        )
+        manager.save_account("user@example.com", "secret", "old_token", "JP13")
+
+        assert manager.get_token("user@example.com") is None
+
+    def test_refresh_expiring_only_for_queued_accounts(self, accounts_db):
+        authenticator = _authenticator("fresh_token")
+        manager = TokenManager(ttl=60, margin=120, authenticator=authenticator)
+        manager.save_account("queued@example.com", "secret", "old", "JP13")
+        manager.save_account("idle@example.com", "secret", "old", "JP13")
+        conn = database.get_db_connection()
+        enqueue_job(
+            conn,
+            "job1",
+            "TBS",
+            "TBSラジオ",
+            "番組",
+            "20240101050000",
+            "20240101060000",
+            None,
+            "queued@example.com",
+        )
+        conn.commit()
+        conn.close()
+
+        assert manager.refresh_expiring() == 1
+        authenticator.assert_called_once_with("queued@example.com", "secret")
+
+
+class TestJobTokenRetry:
+    """ジョブ実行時のトークンの受け渡しと再試行のテスト"""
+
+    def _run(self, manager, download):
+        with patch("app.recorder.token_manager", manager), patch(
+            "app.recorder.os.makedirs"
+        ), patch("app.recorder.download_stream", download):
+            outcome = recorder.start_download_job(
+                "job1",
+                "TBS",
+                "TBSラジオ",
+                "番組",
+                "20240101050000",
+                "20240101060000",
+                "browser_token",
+                "user@example.com",
+            )
+        database.status_writer.flush()
+        return outcome
+
+    def test_uses_account_token_and_retries_on_401(self, accounts_db):
+        manager = TokenManager(authenticator=_authenticator("fresh_token"))
+        manager.save_account("user@example.com", "secret", "server_token", "JP13")
+        download = MagicMock(side_effect=[_unauthorized(), None])
+
+        assert self._run(manager, download) == "success"
+        tokens = [call.args[3] for call in download.call_args_list]
+        assert tokens == ["server_token", "fresh_token"]
+
+    def test_fails_when_retry_is_also_rejected(self, accounts_db):
+        manager = TokenManager(authenticator=_authenticator("fresh_token"))
+        manager.save_account("user@example.com", "secret", "server_token", "JP13")
+        download = MagicMock(side_effect=[_unauthorized(), _unauthorized()])
+
+        assert self._run(manager, download) == "failed"
+        assert download.call_count == 2
+
+    def test_falls_back_to_job_token(self, accounts_db):
+        download = MagicMock(return_value=None)
+
+        assert self._run(TokenManager(), download) == "success"
+        assert download.call_args.args[3] == "browser_token"
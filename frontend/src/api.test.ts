@@ -0,0 +1,70 @@
+import { streamWithAuth } from './api'
+
+// チャンクに分けて届くSSEのレスポンス
+const sseResponse = (chunks) =>
+  new Response(
+    new ReadableStream({
+      start(controller) {
+        const encoder = new TextEncoder()
+        chunks.forEach((chunk) => controller.enqueue(encoder.encode(chunk)))
+        controller.close()
+      },
+    }),
+    { status: 200 }
+  )
+
+beforeEach(() => {
+  vi.useFakeTimers({ toFake: ['setTimeout'] })
+  localStorage.setItem('jwt_token', 'jwt')
+  localStorage.setItem('radiko_token', 'radiko')
+})
+
+afterEach(() => {
+  vi.useRealTimers()
+  vi.unstubAllGlobals()
+  localStorage.clear()
+})
+
+test('parses events split across chunks and resumes from the last event id', async () => {
+  const fetchMock = vi
+    .fn()
+    .mockResolvedValueOnce(
+      sseResponse([
+        'retry: 3000\n\nid: 1\nevent: status\ndata: {"job_id": "a", "sta',
+        'tus": "downloading"}\n\nid: 2\nevent: progress\ndata: {"job_id": "a", "percent": 50}\n\n',
+      ])
+    )
+    .mockResolvedValue(sseResponse([]))
+  vi.stubGlobal('fetch', fetchMock)
+  const controller = new AbortController()
+  const events = []
+
+  streamWithAuth('jobs/events', (event, data) => events.push([event, data]), controller.signal)
+  await vi.waitFor(() => expect(events).toHaveLength(2))
+
+  expect(events).toEqual([
+    ['status', { job_id: 'a', status: 'downloading' }],
+    ['progress', { job_id: 'a', percent: 50 }],
+  ])
+  const [url, options] = fetchMock.mock.calls[0]
+  expect(url).toBe('/api/jobs/events')
+  expect(options.headers.Authorization).toBe('Bearer jwt')
+  expect(options.headers['Last-Event-ID']).toBeUndefined()
+
+  // 切断されたら待ってから続きを要求する
+  await vi.advanceTimersByTimeAsync(3000)
+  await vi.waitFor(() => expect(fetchMock).toHaveBeenCalledTimes(2))
+  expect(fetchMock.mock.calls[1][1].headers['Last-Event-ID']).toBe('2')
+  controller.abort()
+})
+
+test('stops when aborted', async () => {
+  const fetchMock = vi.fn().mockRejectedValue(new DOMException('aborted', 'AbortError'))
+  vi.stubGlobal('fetch', fetchMock)
+  const controller = new AbortController()
+  controller.abort()
+
+  await streamWithAuth('jobs/events', () => {}, controller.signal)
+
+  expect(fetchMock).not.toHaveBeenCalled()
+})
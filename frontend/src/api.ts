@@ -34,4 +34,41 @@ const fetchWithAuth = async (url, options = {}) => {
     return response;
 };
 
-export {getToken, setTokens, removeTokens, fetchWithAuth, getRadikoToken};
+// Server-Sent Eventsを購読する。EventSourceは認証ヘッダーを付けられないのでfetchで読む
+const streamWithAuth = async (url, onEvent, signal) => {
+    let lastEventId = null;
+    while (!signal.aborted) {
+        try {
+            const headers = lastEventId ? {'Last-Event-ID': lastEventId} : {};
+            const response = await fetchWithAuth(url, {headers, signal});
+            if (!response.ok) throw new Error('Event stream failed');
+            const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+            let buffer = '';
+            while (true) {
+                const {value, done} = await reader.read();
+                if (done) break;
+                buffer += value;
+                // イベントは空行で区切られる
+                let separator;
+                while ((separator = buffer.indexOf('\n\n')) >= 0) {
+                    const block = buffer.slice(0, separator);
+                    buffer = buffer.slice(separator + 2);
+                    const event = {event: 'message', data: ''};
+                    for (const line of block.split('\n')) {
+                        const [field, ...rest] = line.split(': ');
+                        if (field === 'id') lastEventId = rest.join(': ');
+                        if (field === 'event') event.event = rest.join(': ');
+                        if (field === 'data') event.data = rest.join(': ');
+                    }
+                    if (event.data) onEvent(event.event, JSON.parse(event.data));
+                }
+            }
+        } catch (error) {
+            if (signal.aborted) return;
+        }
+        // 切断されたら少し待って続きから再接続する
+        await new Promise(resolve => setTimeout(resolve, 3000));
+    }
+};
+
+export {getToken, setTokens, removeTokens, fetchWithAuth, getRadikoToken, streamWithAuth};
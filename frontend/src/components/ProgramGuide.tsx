@@ -16,6 +16,18 @@ function ProgramGuide({ stationId: propStationId, dateStr: propDateStr, areaId:
         const fetchGuide = async () => {
             setLoading(true);
             try {
+                // エリアが分かっている場合はエリア全局の番組表(1回の取得でキャッシュされる)から探す
+                if (areaId) {
+                    const areaResponse = await fetchWithAuth(`guide/area/${areaId}/${dateStr}`);
+                    if (areaResponse.ok) {
+                        const grid = await areaResponse.json();
+                        const station = grid.stations.find(s => s.station_id === stationId);
+                        if (station) {
+                            setGuide({station_name: station.station_name, programs: station.programs});
+                            return;
+                        }
+                    }
+                }
                 const response = await fetchWithAuth(`guide/${stationId}/${dateStr}`);
                 if (!response.ok) throw new Error('番組表の取得に失敗');
                 const data = await response.json();
@@ -27,7 +39,7 @@ function ProgramGuide({ stationId: propStationId, dateStr: propDateStr, areaId:
             }
         };
         fetchGuide();
-    }, [stationId, dateStr]);
+    }, [stationId, dateStr, areaId]);
 
     const handleDownload = async (program) => {
         const payload = {
@@ -0,0 +1,82 @@
+import { act, fireEvent, render, screen } from '@testing-library/react'
+import '@testing-library/jest-dom'
+import { MemoryRouter } from 'react-router-dom'
+import { fetchWithAuth, streamWithAuth } from '../api'
+import StatusPage from './StatusPage'
+
+vi.mock('../api', () => ({
+  fetchWithAuth: vi.fn(),
+  streamWithAuth: vi.fn(),
+}))
+
+const jsonResponse = (body) => ({ ok: true, json: async () => body }) as unknown as Response
+
+const job = (id, title) => ({
+  id,
+  job_id: `job${id}`,
+  program_title: title,
+  station_id: 'TBS',
+  start_time: '2024-01-01T05:00:00',
+  status: 'success',
+  filename: null,
+})
+
+beforeEach(() => {
+  vi.mocked(fetchWithAuth).mockImplementation(async (url) => {
+    if (url.startsWith('logins')) return jsonResponse({ logins: [], next_cursor: null })
+    // 2ページ目は最後のページ
+    if (url.includes('cursor=c1')) return jsonResponse({ jobs: [job(1, '古い番組')], next_cursor: null })
+    return jsonResponse({ jobs: [job(2, '新しい番組')], next_cursor: 'c1' })
+  })
+  vi.mocked(streamWithAuth).mockResolvedValue(undefined)
+})
+
+afterEach(() => {
+  vi.clearAllMocks()
+})
+
+const renderPage = async () => {
+  render(
+    <MemoryRouter>
+      <StatusPage />
+    </MemoryRouter>
+  )
+  await screen.findByText('新しい番組')
+  // ジョブの状態を受け取るコールバック
+  return vi.mocked(streamWithAuth).mock.calls.at(-1)[1]
+}
+
+test('loads older jobs with the next cursor', async () => {
+  await renderPage()
+
+  fireEvent.click(screen.getByText('さらに読み込む'))
+
+  expect(await screen.findByText('古い番組')).toBeInTheDocument()
+  expect(fetchWithAuth).toHaveBeenCalledWith('jobs?limit=50&cursor=c1')
+  expect(screen.queryByText('さらに読み込む')).not.toBeInTheDocument()
+})
+
+test('subscribes to job events and applies status and progress', async () => {
+  const onEvent = await renderPage()
+  expect(streamWithAuth).toHaveBeenCalledWith('jobs/events', expect.any(Function), expect.any(AbortSignal))
+
+  act(() => onEvent('status', { job_id: 'job2', status: 'downloading', filename: null }))
+  act(() =>
+    onEvent('progress', { job_id: 'job2', percent: 25, media_seconds: 900, bytes_per_second: 1048576 })
+  )
+  expect(screen.getByText('downloading 25% (1.0MB/s)')).toBeInTheDocument()
+
+  act(() => onEvent('status', { job_id: 'job2', status: 'success', filename: 'a.aac' }))
+  // 絞り込みの選択肢にも同じ文字があるので行の中で確かめる
+  expect(screen.getByText('a.aac').closest('tr')).toHaveTextContent('success')
+})
+
+test('reloads the first page when a job is queued', async () => {
+  const onEvent = await renderPage()
+  const jobRequests = () => vi.mocked(fetchWithAuth).mock.calls.filter(([url]) => url.startsWith('jobs')).length
+  const before = jobRequests()
+
+  await act(async () => onEvent('status', { job_id: 'job3', status: 'queued', filename: null }))
+
+  expect(jobRequests()).toBe(before + 1)
+})
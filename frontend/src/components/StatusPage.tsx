@@ -1,44 +1,117 @@
 import React from 'react';
-import {useState, useEffect} from 'react';
+import {useState, useEffect, useCallback} from 'react';
 import {Link} from 'react-router-dom';
-import {fetchWithAuth} from '../api';
+import {fetchWithAuth, streamWithAuth} from '../api';
+
+const JOBS_PER_PAGE = 50;
 
 function StatusPage() {
-    const [status, setStatus] = useState(null);
+    const [jobs, setJobs] = useState([]);
+    const [olderJobs, setOlderJobs] = useState([]);
+    const [nextCursor, setNextCursor] = useState(null);
+    const [logins, setLogins] = useState([]);
+    const [statusFilter, setStatusFilter] = useState('');
+    const [progress, setProgress] = useState({});
     const [loading, setLoading] = useState(true);
 
-    const fetchStatus = async () => {
+    const jobsUrl = (cursor = null) => {
+        const params = new URLSearchParams({limit: String(JOBS_PER_PAGE)});
+        if (statusFilter) params.set('status', statusFilter);
+        if (cursor) params.set('cursor', cursor);
+        return `jobs?${params}`;
+    };
+
+    // 最新の1ページとログイン履歴だけを取り直す
+    const fetchStatus = useCallback(async () => {
         try {
-            const response = await fetchWithAuth('status');
-            if (!response.ok) throw new Error('Status fetch failed');
-            const data = await response.json();
-            setStatus(data);
+            const [jobsResponse, loginsResponse] = await Promise.all([
+                fetchWithAuth(jobsUrl()),
+                fetchWithAuth('logins?limit=10'),
+            ]);
+            if (!jobsResponse.ok || !loginsResponse.ok) throw new Error('Status fetch failed');
+            const jobPage = await jobsResponse.json();
+            const loginPage = await loginsResponse.json();
+            setJobs(jobPage.jobs);
+            setLogins(loginPage.logins);
+            setNextCursor(cursor => cursor ?? jobPage.next_cursor);
         } catch (error) {
             alert(error.message);
         } finally {
             setLoading(false);
         }
+    }, [statusFilter]);
+
+    const fetchOlderJobs = async () => {
+        const response = await fetchWithAuth(jobsUrl(nextCursor));
+        if (!response.ok) {
+            alert('Status fetch failed');
+            return;
+        }
+        const jobPage = await response.json();
+        setOlderJobs(older => [...older, ...jobPage.jobs]);
+        setNextCursor(jobPage.next_cursor);
     };
 
     useEffect(() => {
+        setOlderJobs([]);
+        setNextCursor(null);
         fetchStatus();
-        // 10秒ごとに自動更新
-        const interval = setInterval(fetchStatus, 10000);
-        return () => clearInterval(interval);
-    }, []);
+    }, [fetchStatus]);
+
+    // 状態変化と進捗はサーバーから送られてくる
+    useEffect(() => {
+        const controller = new AbortController();
+        streamWithAuth('jobs/events', (event, data) => {
+            if (event === 'progress') {
+                setProgress(current => ({...current, [data.job_id]: data}));
+                return;
+            }
+            if (data.status === 'queued') {
+                // 新しいジョブは一覧を取り直して先頭に表示する
+                fetchStatus();
+                return;
+            }
+            const apply = jobs => jobs.map(job => job.job_id === data.job_id
+                ? {...job, status: data.status, filename: data.filename ?? job.filename}
+                : job);
+            setJobs(apply);
+            setOlderJobs(apply);
+        }, controller.signal);
+        return () => controller.abort();
+    }, [fetchStatus]);
+
+    const formatProgress = job => {
+        const current = progress[job.job_id];
+        if (job.status !== 'downloading' || !current) return job.status;
+        const speed = (current.bytes_per_second / 1024 / 1024).toFixed(1);
+        const percent = current.percent !== null ? `${current.percent}%` : `${Math.round(current.media_seconds)}秒`;
+        return `${job.status} ${percent} (${speed}MB/s)`;
+    };
 
     if (loading) {
         return <article aria-busy="true">状況を読み込み中...</article>;
     }
 
+    // 自動更新で最新ページがずれても同じジョブを2回表示しない
+    const shownIds = new Set(jobs.map(job => job.id));
+    const allJobs = [...jobs, ...olderJobs.filter(job => !shownIds.has(job.id))];
+
     return (
         <article>
             <hgroup>
                 <h2>ダウンロード状況</h2>
-                <p>このページは10秒ごとに自動更新されます。</p>
+                <p>ダウンロードの状態と進捗はリアルタイムに更新されます。</p>
             </hgroup>
             <Link to="/areas" role="button" className="outline">エリア選択に戻る</Link>
 
+            <select value={statusFilter} onChange={e => setStatusFilter(e.target.value)}>
+                <option value="">すべてのステータス</option>
+                <option value="queued">queued</option>
+                <option value="downloading">downloading</option>
+                <option value="success">success</option>
+                <option value="failed">failed</option>
+            </select>
+
             <table>
                 <thead>
                 <tr>
@@ -50,17 +123,20 @@ function StatusPage() {
                 </tr>
                 </thead>
                 <tbody>
-                {status?.jobs.map(job => (
+                {allJobs.map(job => (
                     <tr key={job.id}>
                         <td>{job.program_title}</td>
                         <td>{job.station_id}</td>
                         <td>{new Date(job.start_time).toLocaleString('ja-JP')}</td>
-                        <td>{job.status}</td>
+                        <td>{formatProgress(job)}</td>
                         <td>{job.filename || ''}</td>
                     </tr>
                 ))}
                 </tbody>
             </table>
+            {nextCursor && (
+                <button className="outline" onClick={fetchOlderJobs}>さらに読み込む</button>
+            )}
 
             <h2 style={{marginTop: '2rem'}}>ログイン履歴</h2>
             <table>
@@ -72,7 +148,7 @@ function StatusPage() {
                 </tr>
                 </thead>
                 <tbody>
-                {status?.logins.map(login => (
+                {logins.map(login => (
                     <tr key={login.id}>
                         <td>{new Date(login.login_time).toLocaleString('ja-JP')}</td>
                         <td>{login.email}</td>
@@ -85,4 +161,4 @@ function StatusPage() {
     );
 }
 
-export default StatusPage;
\ No newline at end of file
+export default StatusPage;